@@ -7,12 +7,309 @@ This module configures the Django admin interface to include and manage
 the Note model from this application. It facilitates administrators in
 performing CRUD operations on Note entries directly from the Django
 admin panel.
+
+It also replaces the admin for users, so that deleting a user only
+deactivates them and queues their notes for deletion in the background
+(see 'notes.purge'), and shows the progress of those deletions and
+the queue of background tasks (see 'notes.tasks').
+
+When notes are sharded (see 'notes.sharding'), the note list shows the
+notes on one database at a time, chosen with the 'database' filter.
 """
 
-from django.contrib import admin
-from .models import Note
+from django.contrib import admin, messages
+from django.contrib.auth import get_user_model
+from django.contrib.auth.admin import UserAdmin
+from django.core.exceptions import ValidationError
+from django.http import HttpResponseRedirect
+from django.urls import reverse
+from .models import Note, Task, UserPurge
+from . import board_cache, events, purge, sharding
 
 # Register your models here.
 
+
+class NoteDatabaseFilter(admin.SimpleListFilter):
+    """
+    Filters the note list by the database holding the notes, shown only
+    when notes are sharded.
+
+    A queryset reads from a single database, so there is no choice of
+    all databases; the notes on 'default' are listed until another
+    database is chosen.
+
+    Methods
+    -------
+    lookups(self, request, model_admin):
+        Returns the databases that may hold notes.
+    choices(self, changelist):
+        Lists the databases, with 'default' chosen if none is.
+    queryset(self, request, queryset):
+        Reads the notes from the chosen database.
+    """
+
+    title = 'database'
+    parameter_name = 'database'
+
+    def lookups(self, request, model_admin):
+        """Returns the databases that may hold notes."""
+
+        if not sharding.is_enabled():
+            return []
+        return [(alias, alias) for alias in sharding.note_databases()]
+
+    def choices(self, changelist):
+        """Lists the databases, with 'default' chosen if none is."""
+
+        chosen = self.value() or 'default'
+        for alias, title in self.lookup_choices:
+            yield {
+                'selected': alias == chosen,
+                'query_string': changelist.get_query_string(
+                    {self.parameter_name: alias}
+                ),
+                'display': title,
+            }
+
+    def queryset(self, request, queryset):
+        """Reads the notes from the chosen database."""
+
+        if self.value() in sharding.note_databases():
+            return queryset.using(self.value())
+        if sharding.is_enabled():
+            return queryset.using('default')
+        return queryset
+
+
 # Note model - registration with the admin interface
-admin.site.register(Note)
+@admin.register(Note)
+class NoteAdmin(admin.ModelAdmin):
+    """
+    Admin options for the Note model.
+
+    Saving and deleting notes invalidates the owner's cached noteboard
+    through the model signals. The only case the signals cannot see is
+    a note being moved to another user, so save_model also invalidates
+    the previous owner's board and removes the note from their open
+    noteboards. When notes are sharded, such a note is saved to the new
+    owner's shard and deleted from the previous one.
+
+    Methods
+    -------
+    get_object(self, request, object_id, from_field=None):
+        Finds a note on whichever database holds it.
+    save_model(self, request, obj, form, change):
+        Saves the note and invalidates the previous owner's board if
+        the note changed hands.
+    """
+
+    list_filter = [NoteDatabaseFilter]
+
+    def get_object(self, request, object_id, from_field=None):
+        """
+        Finds a note on whichever database holds it.
+
+        :param request: HTTP request object.
+        :param object_id: Primary key of the note, from the URL.
+        :param from_field: Optional field to look the note up by.
+        :return: The Note instance, or None if no database holds it.
+        """
+
+        obj = super().get_object(request, object_id, from_field)
+        if obj is not None or not sharding.is_enabled():
+            return obj
+
+        queryset = self.get_queryset(request)
+        for alias in sharding.note_databases():
+            try:
+                obj = queryset.using(alias).filter(pk=object_id).first()
+            except (ValidationError, ValueError):
+                return None
+            if obj is not None:
+                return obj
+        return None
+
+    def save_model(self, request, obj, form, change):
+        """
+        Saves the note and invalidates the previous owner's board if
+        the note changed hands.
+
+        :param request: HTTP request object.
+        :param obj: The Note instance being saved.
+        :param form: The bound admin form.
+        :param change: True if an existing note is being changed.
+        """
+
+        previous_db = obj._state.db
+        super().save_model(request, obj, form, change)
+
+        # Moving a note to a user on another shard copies it there
+        if change and previous_db not in (None, obj._state.db):
+            Note.objects.using(previous_db).filter(pk=obj.pk).delete()
+
+        previous_user_id = form.initial.get('user')
+        if change and previous_user_id not in (None, obj.user_id):
+            board_cache.bump_board_version_on_commit(previous_user_id)
+            events.publish_notes_deleted(previous_user_id, [obj.pk])
+
+
+# User model - replace the default admin so deletions run in the background
+User = get_user_model()
+admin.site.unregister(User)
+
+
+@admin.register(User)
+class PurgingUserAdmin(UserAdmin):
+    """
+    Admin options for users, deleting accounts in the background.
+
+    Deleting a user from the admin deactivates them at once and queues
+    a UserPurge. The task worker, or the 'purge_users' management
+    command, then deletes their notes in batches and finally the user,
+    so the admin request never holds the database write lock while a
+    large account is removed.
+
+    Methods
+    -------
+    get_deleted_objects(self, objs, request):
+        Lists only the users on the delete confirmation page.
+    delete_model(self, request, obj):
+        Queues a user for deletion instead of deleting them.
+    delete_queryset(self, request, queryset):
+        Queues several users for deletion.
+    response_delete(self, request, obj_display, obj_id):
+        Reports that the user was queued rather than deleted.
+    """
+
+    def get_deleted_objects(self, objs, request):
+        """
+        Lists only the users on the delete confirmation page.
+
+        Django would otherwise load every note of every user to list
+        them, which is as slow as the delete itself.
+
+        :param objs: The users to delete.
+        :param request: HTTP request object.
+        :return: A (deleted_objects, model_count, perms_needed,
+            protected) tuple, as from the default implementation.
+        """
+
+        users = [
+            f"{User._meta.verbose_name.capitalize()}: {user} (deactivated "
+            f"now; their notes are deleted in the background)"
+            for user in objs
+        ]
+        model_count = {User._meta.verbose_name_plural: len(users)}
+        return users, model_count, set(), []
+
+    def delete_model(self, request, obj):
+        """
+        Queues a user for deletion instead of deleting them.
+
+        :param request: HTTP request object.
+        :param obj: The user to delete.
+        """
+
+        purge.request_user_deletion(obj)
+
+    def delete_queryset(self, request, queryset):
+        """
+        Queues several users for deletion.
+
+        :param request: HTTP request object.
+        :param queryset: The users to delete.
+        """
+
+        for user in queryset:
+            purge.request_user_deletion(user)
+
+    def response_delete(self, request, obj_display, obj_id):
+        """
+        Reports that the user was queued rather than deleted.
+
+        :param request: HTTP request object.
+        :param obj_display: The user's display string.
+        :param obj_id: The user's primary key.
+        :return: A redirect to the purge progress page.
+        """
+
+        self.message_user(
+            request,
+            f"{obj_display} has been deactivated and their notes are being "
+            f"deleted in the background by the task worker.",
+            messages.SUCCESS,
+        )
+        return HttpResponseRedirect(
+            reverse('admin:notes_userpurge_changelist',
+                    current_app=self.admin_site.name)
+        )
+
+
+# UserPurge model - read-only progress of background deletions
+@admin.register(UserPurge)
+class UserPurgeAdmin(admin.ModelAdmin):
+    """
+    Admin options showing the progress of background user deletions.
+
+    The records are written by 'notes.purge' only, so they cannot be
+    added or changed here.
+
+    Methods
+    -------
+    progress(self, obj):
+        Returns the share of the notes deleted for the list display.
+    has_add_permission(self, request):
+        Stops purges being added by hand.
+    has_change_permission(self, request, obj=None):
+        Stops purges being changed by hand.
+    """
+
+    list_display = ('username', 'requested', 'notes_deleted', 'notes_total',
+                    'progress', 'finished')
+    list_filter = ('finished',)
+    search_fields = ('username',)
+
+    @admin.display(description='Progress')
+    def progress(self, obj):
+        """Returns the share of the notes deleted for the list display."""
+        return f"{obj.progress()}%"
+
+    def has_add_permission(self, request):
+        """Stops purges being added by hand."""
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        """Stops purges being changed by hand."""
+        return False
+
+
+# Task model - read-only view of the background task queue
+@admin.register(Task)
+class TaskAdmin(admin.ModelAdmin):
+    """
+    Admin options showing the queue of background tasks.
+
+    Tasks are queued by the app and run by the 'run_tasks' command, so
+    they cannot be added or changed here. Finished tasks can be
+    deleted.
+
+    Methods
+    -------
+    has_add_permission(self, request):
+        Stops tasks being added by hand.
+    has_change_permission(self, request, obj=None):
+        Stops tasks being changed by hand.
+    """
+
+    list_display = ('name', 'status', 'attempts', 'run_after', 'created',
+                    'finished')
+    list_filter = ('status', 'name')
+    search_fields = ('name', 'key')
+
+    def has_add_permission(self, request):
+        """Stops tasks being added by hand."""
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        """Stops tasks being changed by hand."""
+        return False
@@ -0,0 +1,561 @@
+# notes/api.py
+
+"""
+This module contains the JSON API for the Sticky Notes application.
+
+The API lets integrations work with a user's notes without scraping
+the HTML views. It uses the same session authentication and CSRF
+protection as the rest of the site, and is always scoped to the
+logged in user.
+
+Endpoints
+---------
+api/notes/ (GET):
+    A keyset-paginated list of notes, using the 'after' cursor.
+api/notes/ (POST):
+    Create one note (JSON object) or a batch of notes (JSON list).
+api/notes/ (PATCH):
+    Update a batch of notes, given a list of objects with an 'id'.
+api/notes/ (DELETE):
+    Delete a batch of notes, given {"ids": [...]}.
+api/notes/<pk>/ (GET, PUT, PATCH, DELETE):
+    Read, update or delete a single note.
+
+Batches are all or nothing: every item is validated first and, if any
+item is invalid, the response lists the errors by item index and
+nothing is written. Valid batches are written inside one transaction,
+using bulk_create for creation and a single set-based statement for
+updates and deletions. Because those statements bypass the model
+signals, the search index and noteboard cache are updated here. Bulk
+deletions also queue a merge of the search index for the task worker.
+When notes are sharded, each batch is written to the user's shard.
+
+All writes go through 'notes.writer.run_write', so they join the
+single-writer queue when write coalescing is enabled.
+"""
+
+import json
+from functools import wraps
+from django.conf import settings
+from django.db import connections, transaction
+from django.db.models import Case, F, Value, When
+from django.http import JsonResponse
+from django.utils import timezone
+from .models import Note, make_excerpt
+from .forms import NoteForm
+from .pagination import keyset_paginate, parse_cursor
+from .sharding import notes_database
+from .writer import run_write
+from . import board_cache, events, search
+
+# Default largest number of items accepted in one batch request
+DEFAULT_MAX_BATCH = 500
+
+
+class APIError(Exception):
+    """
+    Raised inside an API view to return a JSON error response.
+
+    Attributes
+    ----------
+    status (int):
+        The HTTP status code of the response.
+    payload (dict):
+        The JSON body of the response.
+    """
+
+    def __init__(self, status, message, **extra):
+        """
+        Builds the error response details.
+
+        :param status: The HTTP status code of the response.
+        :param message: A human readable description of the error.
+        :param extra: Extra keys to include in the response body.
+        """
+
+        super().__init__(message)
+        self.status = status
+        self.payload = {"error": message, **extra}
+
+
+def api_view(methods):
+    """
+    Decorator for API views that checks authentication and the request
+    method, and turns APIError exceptions into JSON responses.
+
+    :param methods: The HTTP methods the view accepts.
+    :return: The decorated view function.
+    """
+
+    def decorator(view):
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            if not request.user.is_authenticated:
+                return JsonResponse(
+                    {"error": "Authentication required."}, status=401
+                )
+            if request.method not in methods:
+                response = JsonResponse(
+                    {"error": "Method not allowed."}, status=405
+                )
+                response["Allow"] = ", ".join(methods)
+                return response
+            try:
+                return view(request, *args, **kwargs)
+            except APIError as error:
+                return JsonResponse(error.payload, status=error.status)
+        return wrapper
+
+    return decorator
+
+
+def get_max_batch():
+    """
+    Returns the largest number of items accepted in one batch.
+
+    :return: The value of the NOTES_API_MAX_BATCH setting, or
+        DEFAULT_MAX_BATCH if it has not been set.
+    """
+
+    return getattr(settings, 'NOTES_API_MAX_BATCH', DEFAULT_MAX_BATCH)
+
+
+def note_to_dict(note):
+    """
+    Converts a note into its JSON representation.
+
+    :param note: A Note instance.
+    :return: A dictionary with the note's id, title and content.
+    """
+
+    return {"id": note.pk, "title": note.title, "content": note.content}
+
+
+def parse_body(request):
+    """
+    Decodes the JSON body of a request.
+
+    :param request: HTTP request object.
+    :return: The decoded JSON value.
+    :raises APIError: If the body is not valid JSON.
+    """
+
+    try:
+        return json.loads(request.body)
+    except (UnicodeDecodeError, json.JSONDecodeError):
+        raise APIError(400, "Request body must be valid JSON.")
+
+
+def parse_batch(value):
+    """
+    Checks that a decoded request body is a usable batch.
+
+    :param value: The decoded JSON value.
+    :return: The batch as a list.
+    :raises APIError: If the value is not a non-empty list within the
+        batch size limit.
+    """
+
+    if not isinstance(value, list) or not value:
+        raise APIError(400, "Expected a non-empty JSON list.")
+
+    max_batch = get_max_batch()
+    if len(value) > max_batch:
+        raise APIError(
+            400, f"Batches are limited to {max_batch} items."
+        )
+
+    return value
+
+
+def validate_note_data(data, partial=False):
+    """
+    Validates the fields of one note using NoteForm.
+
+    :param data: The decoded JSON object for the note.
+    :param partial: If True, only the fields present in `data` are
+        validated and returned.
+    :return: A (cleaned_data, errors) tuple. `errors` is an empty dict
+        if the data is valid.
+    """
+
+    if not isinstance(data, dict):
+        return {}, {"__all__": ["Expected a JSON object."]}
+
+    form = NoteForm(data=data)
+    form.is_valid()
+
+    # For partial updates, only report on the fields that were sent
+    fields = [
+        name for name in form.fields if not partial or name in data
+    ]
+    if not fields:
+        return {}, {"__all__": ["No fields to update."]}
+
+    errors = {
+        name: list(messages) for name, messages in form.errors.items()
+        if name in fields
+    }
+    cleaned = {
+        name: form.cleaned_data[name] for name in fields
+        if name in form.cleaned_data
+    }
+
+    return cleaned, errors
+
+
+def raise_item_errors(item_errors):
+    """
+    Raises an APIError listing per-item errors if there are any.
+
+    :param item_errors: A list of {"index": ..., "errors": ...} dicts.
+    :raises APIError: If the list is not empty.
+    """
+
+    if item_errors:
+        raise APIError(
+            400, "One or more items are invalid.", items=item_errors
+        )
+
+
+def get_api_note(request, pk):
+    """
+    Returns one of the requesting user's notes.
+
+    Notes belonging to other users are reported as missing so the API
+    does not reveal which primary keys exist.
+
+    :param request: HTTP request object.
+    :param pk: Primary key of the note.
+    :return: The Note instance.
+    :raises APIError: If the user has no note with that primary key.
+    """
+
+    try:
+        return Note.objects.get(pk=pk, user_id=request.user.pk)
+    except Note.DoesNotExist:
+        raise APIError(404, "Note not found.")
+
+
+def owned_ids(user, ids, using='default'):
+    """
+    Returns which of the given note ids belong to a user.
+
+    :param user: The user who must own the notes.
+    :param ids: An iterable of primary keys.
+    :param using: Database alias holding the user's notes.
+    :return: A set of the primary keys the user owns.
+    """
+
+    return set(
+        Note.objects.using(using).filter(user=user, pk__in=ids)
+        .values_list('pk', flat=True)
+    )
+
+
+@api_view(["GET", "POST", "PATCH", "DELETE"])
+def api_notes(request):
+    """
+    API view for the collection of the user's notes.
+
+    :param request: HTTP request object.
+    :return: JSON response for the list, create, bulk update or bulk
+        delete operation.
+    """
+
+    if request.method == "GET":
+        return list_notes(request)
+    if request.method == "POST":
+        body = parse_body(request)
+        if isinstance(body, list):
+            return bulk_create_notes(request, parse_batch(body))
+        return create_note(request, body)
+    if request.method == "PATCH":
+        return bulk_update_notes(request, parse_batch(parse_body(request)))
+
+    body = parse_body(request)
+    ids = body.get("ids") if isinstance(body, dict) else None
+    return bulk_delete_notes(request, parse_batch(ids))
+
+
+@api_view(["GET", "PUT", "PATCH", "DELETE"])
+def api_note(request, pk):
+    """
+    API view for a single note.
+
+    :param request: HTTP request object.
+    :param pk: Primary key of the note.
+    :return: JSON response for the read, update or delete operation.
+    """
+
+    note = get_api_note(request, pk)
+
+    if request.method == "GET":
+        return JsonResponse(note_to_dict(note))
+
+    if request.method == "DELETE":
+        run_write(note.delete)
+        return JsonResponse({"deleted": [pk]})
+
+    cleaned, errors = validate_note_data(
+        parse_body(request), partial=request.method == "PATCH"
+    )
+    if errors:
+        raise APIError(400, "The note is invalid.", errors=errors)
+
+    for name, value in cleaned.items():
+        setattr(note, name, value)
+    run_write(note.save, update_fields=list(cleaned))
+
+    return JsonResponse(note_to_dict(note))
+
+
+def list_notes(request):
+    """
+    Returns a keyset-paginated page of the user's notes.
+
+    :param request: HTTP request object.
+    :return: JSON response with the notes and the next cursor.
+    """
+
+    page = keyset_paginate(
+        Note.objects.filter(user=request.user),
+        after=parse_cursor(request.GET.get("after")),
+    )
+
+    return JsonResponse({
+        "results": [note_to_dict(note) for note in page],
+        "next": page.next_cursor,
+    })
+
+
+def create_note(request, data):
+    """
+    Creates a single note.
+
+    :param request: HTTP request object.
+    :param data: The decoded JSON object for the note.
+    :return: JSON response with the created note.
+    """
+
+    cleaned, errors = validate_note_data(data)
+    if errors:
+        raise APIError(400, "The note is invalid.", errors=errors)
+
+    # Saved through the instance, so the router can find the owner's shard
+    note = Note(user=request.user, **cleaned)
+    run_write(note.save, force_insert=True)
+
+    return JsonResponse(note_to_dict(note), status=201)
+
+
+def bulk_create_notes(request, items):
+    """
+    Creates a batch of notes with bulk_create.
+
+    :param request: HTTP request object.
+    :param items: A list of decoded JSON objects.
+    :return: JSON response with the created notes.
+    """
+
+    notes = []
+    item_errors = []
+    for index, item in enumerate(items):
+        cleaned, errors = validate_note_data(item)
+        if errors:
+            item_errors.append({"index": index, "errors": errors})
+        else:
+            notes.append(Note(user=request.user,
+                              excerpt=make_excerpt(cleaned["content"]),
+                              **cleaned))
+    raise_item_errors(item_errors)
+
+    notes = run_write(create_batch, request.user, notes)
+
+    return JsonResponse(
+        {"results": [note_to_dict(note) for note in notes]}, status=201
+    )
+
+
+def create_batch(user, notes):
+    """
+    Inserts a validated batch of notes in one transaction.
+
+    :param user: The user who owns the notes.
+    :param notes: A list of unsaved Note instances.
+    :return: The saved Note instances.
+    """
+
+    using = notes_database(user.pk)
+    with transaction.atomic(using=using):
+        notes = Note.objects.using(using).bulk_create(notes)
+        search.index_rows(
+            [(note.pk, note.title, note.content) for note in notes],
+            using=using,
+        )
+        board_cache.bump_board_version_on_commit(user.pk, using=using)
+        # Bulk writes skip the model signals, so publish the changes here
+        events.publish_notes_saved(user.pk, notes, using=using)
+
+    return notes
+
+
+def bulk_update_notes(request, items):
+    """
+    Updates a batch of notes with a single UPDATE statement.
+
+    Each field is set with a CASE expression over the primary keys, so
+    items may change different fields. Fields an item leaves out keep
+    their current value.
+
+    :param request: HTTP request object.
+    :param items: A list of decoded JSON objects, each with an 'id'.
+    :return: JSON response with the updated notes.
+    """
+
+    # Validate every item before touching the database
+    changes = {}
+    item_errors = []
+    for index, item in enumerate(items):
+        pk = item.get("id") if isinstance(item, dict) else None
+        if not isinstance(pk, int) or isinstance(pk, bool):
+            item_errors.append(
+                {"index": index, "errors": {"id": ["A note id is required."]}}
+            )
+            continue
+        if pk in changes:
+            item_errors.append(
+                {"index": index, "errors": {"id": ["Duplicate note id."]}}
+            )
+            continue
+        fields = {key: value for key, value in item.items() if key != "id"}
+        cleaned, errors = validate_note_data(fields, partial=True)
+        if errors:
+            item_errors.append({"index": index, "errors": errors})
+        changes[pk] = cleaned
+    raise_item_errors(item_errors)
+
+    notes = run_write(update_batch, request.user, changes)
+
+    return JsonResponse({"results": [note_to_dict(note) for note in notes]})
+
+
+def update_batch(user, changes):
+    """
+    Applies a validated batch of changes in one transaction.
+
+    :param user: The user who must own the notes.
+    :param changes: A dict mapping note primary keys to the cleaned
+        fields to change.
+    :return: The updated Note instances.
+    :raises APIError: If any note is missing or owned by someone else.
+    """
+
+    using = notes_database(user.pk)
+    with transaction.atomic(using=using):
+        # Check every note exists and belongs to the user
+        found = owned_ids(user, changes, using)
+        raise_item_errors([
+            {"index": index, "errors": {"id": ["Note not found."]}}
+            for index, pk in enumerate(changes) if pk not in found
+        ])
+
+        # Build one CASE expression per field that any item changes
+        updates = {}
+        for name in ("title", "content"):
+            whens = [
+                When(pk=pk, then=Value(cleaned[name]))
+                for pk, cleaned in changes.items() if name in cleaned
+            ]
+            if whens:
+                updates[name] = Case(
+                    *whens, default=F(name),
+                    output_field=Note._meta.get_field(name),
+                )
+
+        # Bulk updates skip Note.save(), so refresh the excerpts here
+        whens = [
+            When(pk=pk, then=Value(make_excerpt(cleaned["content"])))
+            for pk, cleaned in changes.items() if "content" in cleaned
+        ]
+        if whens:
+            updates["excerpt"] = Case(
+                *whens, default=F("excerpt"),
+                output_field=Note._meta.get_field("excerpt"),
+            )
+
+        # update() skips auto_now, so move the cards' cache keys on here
+        updates["updated"] = timezone.now()
+        owned = Note.objects.using(using).filter(user=user, pk__in=found)
+        owned.update(**updates)
+
+        # Re-read the final rows to refresh the search index
+        notes = list(owned.order_by('pk'))
+        search.index_rows(
+            [(note.pk, note.title, note.content) for note in notes],
+            using=using,
+        )
+        board_cache.bump_board_version_on_commit(user.pk, using=using)
+        # Bulk writes skip the model signals, so publish the changes here
+        events.publish_notes_saved(user.pk, notes, using=using)
+
+    return notes
+
+
+def bulk_delete_notes(request, ids):
+    """
+    Deletes a batch of notes with a single DELETE statement.
+
+    The statement is issued directly rather than through
+    QuerySet.delete(), which would load every note to send the model
+    signals one at a time.
+
+    :param request: HTTP request object.
+    :param ids: A list of note primary keys.
+    :return: JSON response with the deleted primary keys.
+    """
+
+    item_errors = [
+        {"index": index, "errors": {"id": ["A note id is required."]}}
+        for index, pk in enumerate(ids)
+        if not isinstance(pk, int) or isinstance(pk, bool)
+    ]
+    raise_item_errors(item_errors)
+
+    deleted = run_write(delete_batch, request.user, ids)
+
+    return JsonResponse({"deleted": deleted})
+
+
+def delete_batch(user, ids):
+    """
+    Deletes a validated batch of notes in one transaction.
+
+    :param user: The user who must own the notes.
+    :param ids: A list of note primary keys.
+    :return: The sorted list of deleted primary keys.
+    :raises APIError: If any note is missing or owned by someone else.
+    """
+
+    using = notes_database(user.pk)
+    with transaction.atomic(using=using):
+        found = owned_ids(user, ids, using)
+        raise_item_errors([
+            {"index": index, "errors": {"id": ["Note not found."]}}
+            for index, pk in enumerate(ids) if pk not in found
+        ])
+
+        deleted = sorted(found)
+        placeholders = ", ".join(["%s"] * len(deleted))
+        with connections[using].cursor() as cursor:
+            cursor.execute(
+                f"DELETE FROM {Note._meta.db_table} "
+                f"WHERE user_id = %s AND id IN ({placeholders})",
+                [user.pk, *deleted],
+            )
+        search.unindex_notes(deleted, using=using)
+        search.schedule_optimize(using)
+        board_cache.bump_board_version_on_commit(user.pk, using=using)
+        events.publish_notes_deleted(user.pk, deleted, using=using)
+
+    return deleted
@@ -20,8 +20,17 @@ class NotesConfig(AppConfig):
       models in this app. It defaults to BigAutoField.
     name (str):
       Defines the path to the application.
+
+    Methods
+    -------
+    ready(self):
+      Connects the signal handlers for the app's models.
     """
 
     # Define the database auto field type and path to the app
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'notes'
+
+    def ready(self):
+        """Imports the signals module so its handlers are connected."""
+        from . import signals  # noqa: F401
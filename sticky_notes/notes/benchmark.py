@@ -0,0 +1,521 @@
+# notes/benchmark.py
+
+"""
+This module contains the load-testing benchmark for the Sticky Notes
+application, run through the 'benchmark' management command.
+
+The benchmark seeds a configurable data set (users x notes per user x
+content size), then drives every named route in 'notes.urls' in turn
+with a number of concurrent clients. Requests go through Django's
+in-process WSGI handler (one test client per thread) or ASGI handler
+(one async test client per task), so the same benchmark compares both
+servers without needing an external load generator.
+
+For each route the report records throughput, latency percentiles and
+the average number of database queries per request. The report is a
+JSON document with sorted keys, so reports from two commits can be
+diffed directly or compared with compare_reports().
+"""
+
+import asyncio
+import itertools
+import json
+import math
+import platform
+import queue
+import random
+import subprocess
+import threading
+import time
+from contextvars import ContextVar
+
+import django
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.test import AsyncClient, Client, override_settings
+from django.urls import reverse
+from .models import Note, make_excerpt
+from . import hashing, search
+
+# Password given to every seeded user
+BENCHMARK_PASSWORD = 'benchmark-password'
+
+# Routes driven by the benchmark, in the order they run
+ROUTES = [
+    'signup', 'login', 'note_noteboard', 'note_create', 'note_read',
+    'note_update', 'note_delete', 'logout',
+]
+
+# Query counter of the request being timed, if any
+_query_counter = ContextVar('benchmark_query_counter', default=None)
+
+
+class BenchmarkConfig:
+    """
+    Settings for one benchmark run.
+
+    Attributes
+    ----------
+    users (int):
+        Number of users to seed.
+    notes_per_user (int):
+        Number of notes seeded for each user.
+    content_size (int):
+        Number of characters in each seeded note's content.
+    requests (int):
+        Number of requests sent to each route.
+    concurrency (int):
+        Number of clients sending requests at the same time.
+    server (str):
+        'wsgi' or 'asgi', the request handler to drive.
+    routes (list):
+        Names of the routes to run, a subset of ROUTES.
+    seed (int):
+        Seed for the random choices, so runs are repeatable.
+    """
+
+    def __init__(self, users=10, notes_per_user=100, content_size=200,
+                 requests=100, concurrency=4, server='wsgi', routes=None,
+                 seed=0):
+        """Stores the benchmark settings."""
+
+        self.users = users
+        self.notes_per_user = notes_per_user
+        self.content_size = content_size
+        self.requests = requests
+        self.concurrency = concurrency
+        self.server = server
+        self.routes = list(routes or ROUTES)
+        self.seed = seed
+
+    def as_dict(self):
+        """Returns the settings as a dictionary for the report."""
+        return dict(vars(self))
+
+
+class QueryCounter:
+    """
+    Counts the database queries run while handling one request.
+
+    Attributes
+    ----------
+    count (int):
+        Number of queries counted so far.
+    """
+
+    def __init__(self):
+        """Starts the count at zero."""
+        self.count = 0
+
+
+def count_queries(execute, sql, params, many, context):
+    """
+    Database execute wrapper that adds to the current request's count.
+
+    :return: The result of the wrapped execute call.
+    """
+
+    counter = _query_counter.get()
+    if counter is not None:
+        counter.count += 1
+    return execute(sql, params, many, context)
+
+
+def install_query_counter(sender, connection, **kwargs):
+    """Adds count_queries() to every new database connection."""
+
+    if count_queries not in connection.execute_wrappers:
+        connection.execute_wrappers.append(count_queries)
+
+
+def percentile(sorted_values, fraction):
+    """
+    Returns a percentile of sorted values using the nearest-rank method.
+
+    :param sorted_values: A sorted, non-empty list of numbers.
+    :param fraction: The percentile as a fraction, such as 0.95.
+    :return: The value at that percentile.
+    """
+
+    rank = max(math.ceil(fraction * len(sorted_values)) - 1, 0)
+    return sorted_values[min(rank, len(sorted_values) - 1)]
+
+
+def seed_data(config):
+    """
+    Creates the users and notes used by the benchmark.
+
+    Every user gets the same pre-hashed password, so seeding does not
+    pay for one expensive hash per user.
+
+    :param config: The BenchmarkConfig for the run.
+    :return: A list of the seeded User instances.
+    """
+
+    password = make_password(BENCHMARK_PASSWORD)
+    User.objects.bulk_create([
+        User(username=f'bench-{number}', password=password)
+        for number in range(config.users)
+    ])
+    users = list(
+        User.objects.filter(username__startswith='bench-').order_by('pk')
+    )
+
+    content = ('lorem ipsum ' * (config.content_size // 12 + 1))
+    content = content[:config.content_size]
+    excerpt = make_excerpt(content)
+    for user in users:
+        Note.objects.bulk_create([
+            Note(user=user, title=f'Note {number}', content=content,
+                 excerpt=excerpt)
+            for number in range(config.notes_per_user)
+        ], batch_size=500)
+
+    search.rebuild_index()
+    return users
+
+
+def build_requests(route, config, users, rng):
+    """
+    Describes the requests sent to one route.
+
+    Each request is described by a (method, path, data, login_as,
+    expected_status) tuple. `login_as` is the user whose session the
+    client holds before the request, or None for an anonymous client;
+    logging in happens outside the timed part of the request. Any other
+    response status counts as an error.
+
+    :param route: The route name, one of ROUTES.
+    :param config: The BenchmarkConfig for the run.
+    :param users: The seeded User instances.
+    :param rng: A random.Random instance.
+    :return: A list of request description tuples.
+    """
+
+    content = 'x' * config.content_size
+    owned = {}
+    if route in ('note_read', 'note_update'):
+        for user in users:
+            owned[user.pk] = list(
+                Note.objects.filter(user=user)
+                .values_list('pk', flat=True)[:100]
+            )
+
+    requests = []
+    for number, user in zip(range(config.requests), itertools.cycle(users)):
+        if route == 'signup':
+            username = f'signup-{config.seed}-{number}'
+            requests.append(('post', reverse('signup'), {
+                'username': username,
+                'email': f'{username}@example.com',
+                'password1': BENCHMARK_PASSWORD,
+                'password2': BENCHMARK_PASSWORD,
+            }, None, 302))
+        elif route == 'login':
+            requests.append(('post', reverse('login'), {
+                'username': user.username, 'password': BENCHMARK_PASSWORD,
+            }, None, 302))
+        elif route == 'note_noteboard':
+            requests.append(
+                ('get', reverse('note_noteboard'), None, user, 200)
+            )
+        elif route == 'note_create':
+            requests.append(('post', reverse('note_create'), {
+                'title': f'Benchmark {number}', 'content': content,
+            }, user, 302))
+        elif route == 'note_read':
+            pk = rng.choice(owned[user.pk])
+            requests.append(
+                ('get', reverse('note_read', args=[pk]), None, user, 200)
+            )
+        elif route == 'note_update':
+            pk = rng.choice(owned[user.pk])
+            requests.append(('post', reverse('note_update', args=[pk]), {
+                'title': f'Updated {number}', 'content': content,
+            }, user, 302))
+        elif route == 'note_delete':
+            pk = Note.objects.create(
+                user=user, title=f'Delete {number}', content=content
+            ).pk
+            requests.append(
+                ('post', reverse('note_delete', args=[pk]), None, user, 302)
+            )
+        elif route == 'logout':
+            requests.append(('post', reverse('logout'), None, user, 302))
+        else:
+            raise ValueError(f"Unknown route '{route}'.")
+
+    return requests
+
+
+def summarise(samples, errors, elapsed):
+    """
+    Summarises the timings of one route.
+
+    :param samples: A list of (seconds, queries) tuples for each
+        successful request.
+    :param errors: Number of failed requests.
+    :param elapsed: Wall clock seconds taken by the route.
+    :return: A dictionary of results for the report.
+    """
+
+    latencies = sorted(seconds * 1000 for seconds, queries in samples)
+    result = {
+        'requests': len(samples) + errors,
+        'errors': errors,
+        'throughput_rps': round(len(samples) / elapsed, 2) if elapsed else 0,
+    }
+    if latencies:
+        result['latency_ms'] = {
+            'p50': round(percentile(latencies, 0.50), 3),
+            'p95': round(percentile(latencies, 0.95), 3),
+            'p99': round(percentile(latencies, 0.99), 3),
+            'mean': round(sum(latencies) / len(latencies), 3),
+            'max': round(latencies[-1], 3),
+        }
+        result['queries_per_request'] = round(
+            sum(queries for seconds, queries in samples) / len(samples), 2
+        )
+
+    return result
+
+
+def run_wsgi(requests, concurrency):
+    """
+    Sends requests through the WSGI handler from a pool of threads,
+    each with its own test client and database connection.
+
+    :param requests: A list of request descriptions.
+    :param concurrency: Number of threads sending requests.
+    :return: A (samples, errors, elapsed) tuple.
+    """
+
+    pending = queue.SimpleQueue()
+    for description in requests:
+        pending.put(description)
+    results = []
+
+    def worker():
+        try:
+            while True:
+                try:
+                    description = pending.get_nowait()
+                except queue.Empty:
+                    return
+                results.append(send_wsgi(description))
+        finally:
+            connections.close_all()
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    return collect(results, elapsed)
+
+
+def send_wsgi(description):
+    """
+    Sends and times one request through the WSGI handler.
+
+    :param description: A request description tuple.
+    :return: A (seconds, queries, ok) tuple.
+    """
+
+    method, path, data, login_as, expected_status = description
+    client = Client()
+    if login_as is not None:
+        client.force_login(login_as)
+
+    counter = QueryCounter()
+    token = _query_counter.set(counter)
+    try:
+        start = time.perf_counter()
+        response = getattr(client, method)(path, data or {})
+        seconds = time.perf_counter() - start
+    finally:
+        _query_counter.reset(token)
+
+    return seconds, counter.count, response.status_code == expected_status
+
+
+def run_asgi(requests, concurrency):
+    """
+    Sends requests through the ASGI handler from concurrent tasks, each
+    with its own async test client.
+
+    :param requests: A list of request descriptions.
+    :param concurrency: Number of requests in flight at once.
+    :return: A (samples, errors, elapsed) tuple.
+    """
+
+    async def main():
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def send(description):
+            method, path, data, login_as, expected_status = description
+            async with semaphore:
+                client = AsyncClient()
+                if login_as is not None:
+                    await client.aforce_login(login_as)
+
+                # Each task runs in its own context, so the counter set
+                # here only sees this request's queries
+                counter = QueryCounter()
+                _query_counter.set(counter)
+                start = time.perf_counter()
+                response = await getattr(client, method)(path, data or {})
+                seconds = time.perf_counter() - start
+                ok = response.status_code == expected_status
+                return seconds, counter.count, ok
+
+        start = time.perf_counter()
+        results = await asyncio.gather(
+            *(send(description) for description in requests)
+        )
+        return results, time.perf_counter() - start
+
+    results, elapsed = asyncio.run(main())
+    return collect(results, elapsed)
+
+
+def collect(results, elapsed):
+    """
+    Splits raw request results into samples and an error count.
+
+    :param results: A list of (seconds, queries, ok) tuples.
+    :param elapsed: Wall clock seconds taken.
+    :return: A (samples, errors, elapsed) tuple.
+    """
+
+    samples = [(seconds, queries) for seconds, queries, ok in results if ok]
+    return samples, len(results) - len(samples), elapsed
+
+
+def git_revision():
+    """Returns the current git commit, or None outside a checkout."""
+
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def benchmark_settings(config):
+    """
+    Returns the settings overrides the benchmark runs under.
+
+    Rate limiting is turned off, since every benchmark client comes
+    from one address and would otherwise be measured getting 429
+    responses. The password hashing queue is made long enough for every
+    client to have a hash waiting, so no request is turned away with a
+    503 response either.
+
+    :param config: The BenchmarkConfig for the run.
+    :return: An override_settings instance.
+    """
+
+    _, max_pending = hashing.get_pool_size()
+    return override_settings(
+        NOTES_RATE_LIMITS={},
+        NOTES_HASHING_QUEUE=max(max_pending, config.concurrency),
+    )
+
+
+def run_benchmark(config, progress=None):
+    """
+    Seeds the data set and runs every configured route.
+
+    The database must already be set up; the 'benchmark' management
+    command runs this against a throwaway test database. The routes run
+    under benchmark_settings(), so they measure the views rather than
+    the rate limits.
+
+    :param config: The BenchmarkConfig for the run.
+    :param progress: Optional callable, given each route name and its
+        results as it finishes.
+    :return: The report as a dictionary.
+    """
+
+    rng = random.Random(config.seed)
+    users = seed_data(config)
+    runner = run_asgi if config.server == 'asgi' else run_wsgi
+
+    connection_created.connect(install_query_counter)
+    for connection in connections.all():
+        install_query_counter(None, connection)
+
+    results = {}
+    try:
+        with benchmark_settings(config):
+            for route in config.routes:
+                requests = build_requests(route, config, users, rng)
+                samples, errors, elapsed = runner(requests,
+                                                  config.concurrency)
+                results[route] = summarise(samples, errors, elapsed)
+                if progress is not None:
+                    progress(route, results[route])
+    finally:
+        connection_created.disconnect(install_query_counter)
+
+    return {
+        'config': config.as_dict(),
+        'environment': {
+            'django': django.get_version(),
+            'python': platform.python_version(),
+            'git_revision': git_revision(),
+        },
+        'routes': results,
+    }
+
+
+def dump_report(report, stream):
+    """
+    Writes a report as stable, diff-friendly JSON.
+
+    :param report: The report dictionary.
+    :param stream: A writable text stream.
+    """
+
+    json.dump(report, stream, indent=2, sort_keys=True)
+    stream.write('\n')
+
+
+def compare_reports(baseline, report):
+    """
+    Compares the headline numbers of two reports.
+
+    :param baseline: The earlier report dictionary.
+    :param report: The later report dictionary.
+    :return: A list of (route, metric, before, after, change_percent)
+        tuples for routes present in both reports.
+    """
+
+    rows = []
+    for route, after in report['routes'].items():
+        before = baseline.get('routes', {}).get(route)
+        if before is None:
+            continue
+        metrics = [
+            ('throughput_rps', before.get('throughput_rps'),
+             after.get('throughput_rps')),
+            ('p95_ms', before.get('latency_ms', {}).get('p95'),
+             after.get('latency_ms', {}).get('p95')),
+            ('queries', before.get('queries_per_request'),
+             after.get('queries_per_request')),
+        ]
+        for metric, old, new in metrics:
+            if old is None or new is None:
+                continue
+            change = round((new - old) / old * 100, 1) if old else None
+            rows.append((route, metric, old, new, change))
+
+    return rows
@@ -0,0 +1,306 @@
+# notes/board_cache.py
+
+"""
+This module caches the rendered noteboard fragment for each user, and
+the rendered card of each note, using Django's cache framework.
+
+Every user has a board version number stored in the cache. Rendered
+fragments are stored under keys that include this version, so bumping
+the version (whenever one of the user's notes is created, changed or
+deleted) makes every cached page of their board unreachable at once
+without having to find and delete the keys. Stale fragments simply
+expire.
+
+Each function that touches the cache has an async counterpart, prefixed
+with 'a', for use by the async views.
+
+Each note's card is cached under a key holding the note's id and its
+'updated' time. When the board version is bumped and a page has to be
+rendered again, only the cards of notes that changed since they were
+last rendered are rendered; the rest are fetched with one get_many().
+Cards hold no per-request data: the delete buttons submit a shared form
+carrying the CSRF token, which is rendered outside the cached HTML.
+
+Versions start from the current time in milliseconds rather than 1, so
+that if a version key is evicted from the cache the new version can
+never collide with one that was used before.
+
+Notes also change in other processes: other web workers, the admin,
+the task worker and management commands such as 'import_notes'. Each
+of them bumps the version in its own cache, so fragments are only
+cached when the default cache is shared between processes (such as
+Redis, Memcached, the database or the file cache). With the per-process
+LocMemCache a bump in another process would never reach the web
+worker, which would keep serving the old board, so fragments are not
+cached at all and the 'notes.W001' check warns about it at startup.
+Note cards are cached either way, as their keys change with the note.
+"""
+
+import time
+from django.conf import settings
+from django.core import checks
+from django.core.cache import DEFAULT_CACHE_ALIAS, cache, caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.db import transaction
+
+# Default number of seconds a rendered noteboard fragment is kept
+DEFAULT_BOARD_CACHE_TIMEOUT = 60 * 60
+
+
+def get_board_cache_timeout():
+    """
+    Returns how long rendered noteboard fragments are cached.
+
+    :return: The value of the NOTES_BOARD_CACHE_TIMEOUT setting in
+        seconds, or DEFAULT_BOARD_CACHE_TIMEOUT if it has not been set.
+    """
+
+    return getattr(
+        settings, 'NOTES_BOARD_CACHE_TIMEOUT', DEFAULT_BOARD_CACHE_TIMEOUT
+    )
+
+
+def is_shared():
+    """
+    Checks whether the default cache is shared between processes, so
+    cached noteboard fragments can be invalidated from any of them.
+
+    :return: False if the default cache is a per-process LocMemCache,
+        True otherwise.
+    """
+
+    return not isinstance(caches[DEFAULT_CACHE_ALIAS], LocMemCache)
+
+
+@checks.register(checks.Tags.caches)
+def check_shared_cache(app_configs, **kwargs):
+    """
+    Warns that noteboard fragments are not cached when the default
+    cache is private to each process.
+
+    :return: A list holding the warning, or an empty list.
+    """
+
+    if is_shared():
+        return []
+    return [checks.Warning(
+        "Rendered noteboards are not cached, because the default cache "
+        "is a per-process LocMemCache.",
+        hint="Configure a cache shared by every process, such as Redis, "
+             "Memcached or the file-based cache, to cache noteboards.",
+        id='notes.W001',
+    )]
+
+
+def _version_key(user_id):
+    """Returns the cache key holding a user's board version."""
+    return f'notes:board-version:{user_id}'
+
+
+def _new_version():
+    """Returns a fresh version number based on the current time."""
+    return time.time_ns() // 1_000_000
+
+
+def get_board_version(user_id):
+    """
+    Returns the current board version for a user, creating one if the
+    cache does not hold it.
+
+    :param user_id: Primary key of the user.
+    :return: The board version number.
+    """
+
+    key = _version_key(user_id)
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, _new_version(), timeout=None)
+        version = cache.get(key)
+
+    return version
+
+
+async def aget_board_version(user_id):
+    """
+    Async version of get_board_version().
+
+    :param user_id: Primary key of the user.
+    :return: The board version number.
+    """
+
+    key = _version_key(user_id)
+    version = await cache.aget(key)
+    if version is None:
+        await cache.aadd(key, _new_version(), timeout=None)
+        version = await cache.aget(key)
+
+    return version
+
+
+def bump_board_version(user_id):
+    """
+    Moves a user's board to a new version, invalidating every cached
+    fragment of their noteboard.
+
+    :param user_id: Primary key of the user.
+    """
+
+    key = _version_key(user_id)
+    try:
+        cache.incr(key)
+    except ValueError:
+        # The version was evicted, so start again from a fresh value
+        cache.set(key, _new_version(), timeout=None)
+
+
+def bump_board_version_on_commit(user_id, using='default'):
+    """
+    Bumps a user's board version once the current transaction commits.
+
+    Waiting for the commit stops a concurrent request from caching the
+    old board under the new version before the change is visible.
+
+    :param user_id: Primary key of the user.
+    :param using: Database alias the change was written to.
+    """
+
+    transaction.on_commit(lambda: bump_board_version(user_id), using=using)
+
+
+def board_fragment_key(user_id, *parts):
+    """
+    Returns the cache key for a rendered noteboard fragment.
+
+    :param user_id: Primary key of the user.
+    :param parts: Extra values identifying the fragment, such as the
+        pagination cursors.
+    :return: A cache key including the user's current board version.
+    """
+
+    version = get_board_version(user_id)
+    suffix = ':'.join(str(part) for part in parts)
+    return f'notes:board:{user_id}:{version}:{suffix}'
+
+
+async def aboard_fragment_key(user_id, *parts):
+    """
+    Async version of board_fragment_key().
+
+    :param user_id: Primary key of the user.
+    :param parts: Extra values identifying the fragment.
+    :return: A cache key including the user's current board version.
+    """
+
+    version = await aget_board_version(user_id)
+    suffix = ':'.join(str(part) for part in parts)
+    return f'notes:board:{user_id}:{version}:{suffix}'
+
+
+def get_board_fragment(key):
+    """
+    Returns a cached noteboard fragment.
+
+    :param key: A key from board_fragment_key().
+    :return: The rendered HTML, or None if it is not cached or the
+        cache is not shared between processes.
+    """
+
+    if not is_shared():
+        return None
+    return cache.get(key)
+
+
+async def aget_board_fragment(key):
+    """
+    Async version of get_board_fragment().
+
+    :param key: A key from aboard_fragment_key().
+    :return: The rendered HTML, or None if it is not cached or the
+        cache is not shared between processes.
+    """
+
+    if not is_shared():
+        return None
+    return await cache.aget(key)
+
+
+def set_board_fragment(key, html):
+    """
+    Stores a rendered noteboard fragment, if the cache is shared
+    between processes.
+
+    :param key: A key from board_fragment_key().
+    :param html: The rendered HTML.
+    """
+
+    if is_shared():
+        cache.set(key, html, timeout=get_board_cache_timeout())
+
+
+async def aset_board_fragment(key, html):
+    """
+    Async version of set_board_fragment().
+
+    :param key: A key from aboard_fragment_key().
+    :param html: The rendered HTML.
+    """
+
+    if is_shared():
+        await cache.aset(key, html, timeout=get_board_cache_timeout())
+
+
+def note_card_key(note):
+    """
+    Returns the cache key for a note's rendered card.
+
+    :param note: A Note instance with its 'updated' field loaded.
+    :return: A cache key that changes whenever the note is saved.
+    """
+
+    return f'notes:card:{note.pk}:{note.updated:%Y%m%d%H%M%S%f}'
+
+
+def get_note_cards(notes):
+    """
+    Returns the cached cards of some notes.
+
+    :param notes: The notes whose cards are wanted.
+    :return: A dictionary mapping the keys from note_card_key() to the
+        rendered HTML of the cards that are cached.
+    """
+
+    return cache.get_many([note_card_key(note) for note in notes])
+
+
+async def aget_note_cards(notes):
+    """
+    Async version of get_note_cards().
+
+    :param notes: The notes whose cards are wanted.
+    :return: A dictionary mapping card keys to cached HTML.
+    """
+
+    return await cache.aget_many([note_card_key(note) for note in notes])
+
+
+def set_note_cards(cards):
+    """
+    Stores rendered note cards.
+
+    :param cards: A dictionary mapping the keys from note_card_key() to
+        the rendered HTML.
+    """
+
+    if cards:
+        cache.set_many(cards, timeout=get_board_cache_timeout())
+
+
+async def aset_note_cards(cards):
+    """
+    Async version of set_note_cards().
+
+    :param cards: A dictionary mapping card keys to rendered HTML.
+    """
+
+    if cards:
+        await cache.aset_many(cards, timeout=get_board_cache_timeout())
@@ -0,0 +1,495 @@
+# notes/events.py
+
+"""
+This module publishes note changes to the noteboard pages a user has
+open, for the Server-Sent Events view 'note_events'.
+
+Whenever a note is created, changed or deleted, an event is published
+to its owner once the transaction commits:
+
+    {"action": "saved", "id": 12, "html": "<li data-note-id=...>"}
+    {"action": "deleted", "id": 12}
+
+Saved events carry the note's rendered card, so the script on the
+noteboard can swap the card in place without fetching the page again.
+A subscriber that falls too far behind is sent a single "reload" event
+instead of the events it missed.
+
+Events go through a broker chosen by the NOTES_EVENTS_BACKEND setting:
+
+- LocalBroker keeps the subscribers in memory. It is fast but only
+  reaches pages served by the same process, so it suits a single ASGI
+  worker.
+- CacheBroker appends events to a per-user log in Django's cache and
+  has subscribers poll it. With a cache shared between processes, such
+  as Redis or Memcached, it reaches every worker.
+
+A broker has publish(user_id, event), called from any thread, and
+subscribe(user_id), which returns a subscription whose async get()
+waits for the next event on the event loop. Its has_subscribers(user_id)
+tells whether any of the user's noteboards are open; events are only
+published, and cards only rendered, when one is, so saves nobody is
+watching (under WSGI, or in bulk imports) cost nothing extra.
+"""
+
+import asyncio
+import json
+import threading
+import time
+from collections import defaultdict
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.template.loader import render_to_string
+from django.utils.module_loading import import_string
+from . import board_cache
+
+# Default broker class
+DEFAULT_EVENTS_BACKEND = 'notes.events.LocalBroker'
+
+# Most undelivered events held for one subscriber
+MAX_QUEUED_EVENTS = 100
+
+# Event sent to a subscriber that missed events
+RELOAD_EVENT = {"action": "reload"}
+
+
+class LocalSubscription:
+    """
+    A subscriber's queue of events in a LocalBroker.
+
+    Attributes
+    ----------
+    user_id (int):
+        Primary key of the user whose events are received.
+
+    Methods
+    -------
+    put(self, event):
+        Queues an event from any thread.
+    get(self, timeout):
+        Waits for the next event.
+    close(self):
+        Stops receiving events.
+    """
+
+    def __init__(self, broker, user_id):
+        """
+        Starts an empty queue on the running event loop.
+
+        :param broker: The LocalBroker subscribed to.
+        :param user_id: Primary key of the user whose events are
+            received.
+        """
+
+        self.broker = broker
+        self.user_id = user_id
+        self._loop = asyncio.get_running_loop()
+        self._queue = asyncio.Queue()
+        self._overflowed = False
+
+    def _put(self, event):
+        """Queues an event on the event loop's thread."""
+
+        if self._overflowed:
+            return
+        if self._queue.qsize() >= MAX_QUEUED_EVENTS:
+            # Too far behind to catch up, so ask for a reload instead
+            self._overflowed = True
+            event = RELOAD_EVENT
+        self._queue.put_nowait(event)
+
+    def put(self, event):
+        """Queues an event from any thread."""
+
+        try:
+            self._loop.call_soon_threadsafe(self._put, event)
+        except RuntimeError:
+            # The subscriber's event loop has closed
+            self.close()
+
+    async def get(self, timeout):
+        """
+        Waits for the next event.
+
+        :param timeout: Most seconds to wait.
+        :return: The event, or None if none arrived in time.
+        """
+
+        try:
+            return await asyncio.wait_for(self._queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    def close(self):
+        """Stops receiving events."""
+        self.broker.unsubscribe(self)
+
+
+class LocalBroker:
+    """
+    In-process broker delivering events to subscribers in memory.
+
+    Methods
+    -------
+    has_subscribers(self, user_id):
+        Checks whether a user has any subscribers.
+    publish(self, user_id, event):
+        Sends an event to every subscriber of a user.
+    subscribe(self, user_id):
+        Returns a new subscription to a user's events.
+    unsubscribe(self, subscription):
+        Removes a subscription.
+    """
+
+    def __init__(self):
+        """Starts with no subscribers."""
+
+        self._subscribers = defaultdict(set)
+        self._lock = threading.Lock()
+
+    def has_subscribers(self, user_id):
+        """Checks whether a user has any subscribers."""
+
+        with self._lock:
+            return bool(self._subscribers.get(user_id))
+
+    def publish(self, user_id, event):
+        """
+        Sends an event to every subscriber of a user.
+
+        :param user_id: Primary key of the user.
+        :param event: A JSON-serialisable dictionary.
+        """
+
+        with self._lock:
+            subscriptions = list(self._subscribers.get(user_id, ()))
+        for subscription in subscriptions:
+            subscription.put(event)
+
+    def subscribe(self, user_id):
+        """
+        Returns a new subscription to a user's events.
+
+        Must be called from the event loop that will read the events.
+
+        :param user_id: Primary key of the user.
+        :return: A LocalSubscription.
+        """
+
+        subscription = LocalSubscription(self, user_id)
+        with self._lock:
+            self._subscribers[user_id].add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        """Removes a subscription."""
+
+        with self._lock:
+            subscriptions = self._subscribers.get(subscription.user_id)
+            if subscriptions is not None:
+                subscriptions.discard(subscription)
+                if not subscriptions:
+                    del self._subscribers[subscription.user_id]
+
+
+class CacheSubscription:
+    """
+    A subscriber's position in a user's event log in the cache.
+
+    Methods
+    -------
+    get(self, timeout):
+        Waits for the next event.
+    close(self):
+        Does nothing; present for the subscription interface.
+    """
+
+    def __init__(self, broker, user_id, position):
+        """
+        Starts reading the log after the given position.
+
+        :param broker: The CacheBroker subscribed to.
+        :param user_id: Primary key of the user whose events are read.
+        :param position: The sequence number of the last event already
+            seen.
+        """
+
+        self.broker = broker
+        self.user_id = user_id
+        self.position = position
+        self._pending = []
+        self._renew_at = time.monotonic() + broker.timeout / 2
+
+    async def _fetch(self):
+        """Reads any new events from the log into the pending list."""
+
+        latest = await cache.aget(self.broker.sequence_key(self.user_id), 0)
+        if latest < self.position:
+            # The counter was evicted and restarted, so events were lost
+            self._pending.append(RELOAD_EVENT)
+            self.position = latest
+        if latest <= self.position:
+            return
+
+        if latest - self.position > MAX_QUEUED_EVENTS:
+            # Too far behind to catch up, so ask for a reload instead
+            self._pending.append(RELOAD_EVENT)
+        else:
+            keys = [self.broker.event_key(self.user_id, number)
+                    for number in range(self.position + 1, latest + 1)]
+            events = await cache.aget_many(keys)
+
+            # The newest events may have been numbered but not stored
+            # yet, so stop before them and read them on the next poll
+            stored = [index for index, key in enumerate(keys)
+                      if key in events]
+            if not stored:
+                return
+            keys = keys[:stored[-1] + 1]
+
+            # Older events that expired or were evicted leave a gap
+            if len(stored) < len(keys):
+                self._pending.append(RELOAD_EVENT)
+            else:
+                self._pending.extend(events[key] for key in keys)
+            latest = self.position + len(keys)
+        self.position = latest
+
+    async def get(self, timeout):
+        """
+        Waits for the next event, polling the cache.
+
+        :param timeout: Most seconds to wait.
+        :return: The event, or None if none arrived in time.
+        """
+
+        # Keep the user marked as subscribed while this stays open
+        if time.monotonic() >= self._renew_at:
+            await cache.aset(self.broker.listeners_key(self.user_id), True,
+                             timeout=self.broker.timeout)
+            self._renew_at = time.monotonic() + self.broker.timeout / 2
+
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while not self._pending:
+            await self._fetch()
+            remaining = deadline - loop.time()
+            if self._pending or remaining <= 0:
+                break
+            await asyncio.sleep(min(self.broker.poll_interval, remaining))
+
+        return self._pending.pop(0) if self._pending else None
+
+    def close(self):
+        """Does nothing; present for the subscription interface."""
+
+
+class CacheBroker:
+    """
+    Broker keeping a short log of each user's events in the cache, so
+    every process sharing the cache receives them.
+
+    Attributes
+    ----------
+    poll_interval (float):
+        Seconds subscribers wait between reads of the log, from the
+        NOTES_EVENTS_POLL_INTERVAL setting.
+    timeout (int):
+        Seconds each event is kept in the log, and a user is counted as
+        subscribed after their last subscription polled.
+
+    Methods
+    -------
+    sequence_key(self, user_id):
+        Returns the key of a user's latest event number.
+    event_key(self, user_id, number):
+        Returns the key of one event.
+    listeners_key(self, user_id):
+        Returns the key marking a user as subscribed.
+    has_subscribers(self, user_id):
+        Checks whether a user has subscribed recently.
+    publish(self, user_id, event):
+        Appends an event to a user's log.
+    subscribe(self, user_id):
+        Returns a subscription reading new events from a user's log.
+    """
+
+    timeout = 60
+
+    def __init__(self):
+        """Reads the polling interval from the settings."""
+        self.poll_interval = getattr(settings, 'NOTES_EVENTS_POLL_INTERVAL',
+                                     0.5)
+
+    def sequence_key(self, user_id):
+        """Returns the key of a user's latest event number."""
+        return f'notes:events:{user_id}:sequence'
+
+    def event_key(self, user_id, number):
+        """Returns the key of one event."""
+        return f'notes:events:{user_id}:{number}'
+
+    def listeners_key(self, user_id):
+        """Returns the key marking a user as subscribed."""
+        return f'notes:events:{user_id}:listeners'
+
+    def has_subscribers(self, user_id):
+        """
+        Checks whether a user has subscribed recently.
+
+        Subscriptions in any process renew the mark while they are
+        open, so it lapses `timeout` seconds after the last one closed.
+
+        :param user_id: Primary key of the user.
+        :return: True if the user may have a subscriber.
+        """
+
+        return cache.get(self.listeners_key(user_id)) is not None
+
+    def publish(self, user_id, event):
+        """
+        Appends an event to a user's log.
+
+        The event's number is taken before the event is stored, so a
+        subscriber can briefly see the new number without the event;
+        CacheSubscription waits for it rather than asking for a reload.
+
+        :param user_id: Primary key of the user.
+        :param event: A JSON-serialisable dictionary.
+        """
+
+        key = self.sequence_key(user_id)
+        cache.add(key, 0, timeout=None)
+        try:
+            number = cache.incr(key)
+        except ValueError:
+            # The counter was evicted between add() and incr()
+            cache.set(key, 1, timeout=None)
+            number = 1
+        cache.set(self.event_key(user_id, number), event,
+                  timeout=self.timeout)
+
+    def subscribe(self, user_id):
+        """
+        Returns a subscription reading new events from a user's log.
+
+        :param user_id: Primary key of the user.
+        :return: A CacheSubscription starting after the latest event.
+        """
+
+        cache.set(self.listeners_key(user_id), True, timeout=self.timeout)
+        position = cache.get(self.sequence_key(user_id), 0)
+        return CacheSubscription(self, user_id, position)
+
+
+# Brokers by class path, created on first use
+_brokers = {}
+_brokers_lock = threading.Lock()
+
+
+def get_broker():
+    """
+    Returns the broker set by the NOTES_EVENTS_BACKEND setting.
+
+    :return: The shared broker instance.
+    """
+
+    path = getattr(settings, 'NOTES_EVENTS_BACKEND', DEFAULT_EVENTS_BACKEND)
+    with _brokers_lock:
+        if path not in _brokers:
+            _brokers[path] = import_string(path)()
+        return _brokers[path]
+
+
+def render_card(note):
+    """
+    Renders a note's noteboard card, caching it for the next board
+    render.
+
+    :param note: The saved Note instance.
+    :return: The card's HTML.
+    """
+
+    html = render_to_string("notes/note_card.html", {"note": note})
+    board_cache.set_note_cards({board_cache.note_card_key(note): html})
+    return html
+
+
+def publish_on_commit(user_id, make_events, using='default'):
+    """
+    Publishes events to a user once the current transaction commits,
+    if the user has any subscribers.
+
+    :param user_id: Primary key of the user.
+    :param make_events: Callable returning the JSON-serialisable
+        dictionaries to publish. It is only called if they will be
+        sent.
+    :param using: Database alias the change was written to.
+    """
+
+    def publish():
+        """Publishes the events if anyone is subscribed."""
+
+        broker = get_broker()
+        if broker.has_subscribers(user_id):
+            for event in make_events():
+                broker.publish(user_id, event)
+
+    transaction.on_commit(publish, using=using)
+
+
+def publish_note_saved(note, using='default'):
+    """
+    Publishes a note's new card to its owner after the commit.
+
+    :param note: The saved Note instance.
+    :param using: Database alias the note was saved to.
+    """
+
+    publish_notes_saved(note.user_id, [note], using)
+
+
+def publish_notes_saved(user_id, notes, using='default'):
+    """
+    Publishes the new cards of some notes to their owner after the
+    commit. The cards are only rendered if the owner has a noteboard
+    open.
+
+    :param user_id: Primary key of the owner.
+    :param notes: The saved Note instances.
+    :param using: Database alias the notes were saved to.
+    """
+
+    publish_on_commit(user_id, lambda: [
+        {"action": "saved", "id": note.pk, "html": render_card(note)}
+        for note in notes
+    ], using)
+
+
+def publish_notes_deleted(user_id, ids, using='default'):
+    """
+    Publishes the deletion of some notes to their owner after the
+    commit.
+
+    :param user_id: Primary key of the owner.
+    :param ids: Primary keys of the deleted notes.
+    :param using: Database alias the notes were deleted from.
+    """
+
+    publish_on_commit(user_id, lambda: [
+        {"action": "deleted", "id": pk} for pk in ids
+    ], using)
+
+
+def format_event(event_id, event):
+    """
+    Formats an event for a text/event-stream response.
+
+    :param event_id: The event's number within the stream.
+    :param event: A JSON-serialisable dictionary.
+    :return: The encoded event.
+    """
+
+    data = json.dumps(event, separators=(',', ':'))
+    return f"id: {event_id}\nevent: note\ndata: {data}\n\n".encode()
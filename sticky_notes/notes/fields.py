@@ -0,0 +1,212 @@
+# notes/fields.py
+
+"""
+This module contains custom model fields for the Sticky Notes
+application.
+
+CompressedTextField is a drop-in replacement for models.TextField that
+stores large values compressed. Values whose UTF-8 encoding reaches the
+NOTES_COMPRESS_THRESHOLD setting are compressed with zlib and stored as
+text in the form ``zlib$<base64 data>``, so the column keeps its text
+type on every database backend. Smaller values are stored unchanged.
+Any stored value starting with the ``zlib$`` marker is compressed, as
+values that happen to start with the marker are always compressed when
+saved.
+
+Compressed values are decompressed lazily: loading a model instance
+keeps the stored text, and it is only decompressed the first time the
+attribute is read. Forms, the admin and templates read the attribute,
+so they only ever see plain text. Queries that bypass model instances,
+such as values() and values_list(), return CompressedText objects for
+compressed rows; use decompress() on them to get the text. Database
+lookups such as `contains` only match uncompressed rows.
+"""
+
+import base64
+import zlib
+from django.conf import settings
+from django.db import models
+from django.db.models.query_utils import DeferredAttribute
+
+# Prefix marking a stored value as compressed
+COMPRESSED_MARKER = 'zlib$'
+
+# Default size in bytes from which values are compressed
+DEFAULT_COMPRESS_THRESHOLD = 4096
+
+# zlib compression level, trading speed for size
+COMPRESS_LEVEL = 6
+
+
+def get_compress_threshold():
+    """
+    Returns the size from which values are stored compressed.
+
+    :return: The value of the NOTES_COMPRESS_THRESHOLD setting in
+        bytes, or DEFAULT_COMPRESS_THRESHOLD if it has not been set.
+    """
+
+    return getattr(
+        settings, 'NOTES_COMPRESS_THRESHOLD', DEFAULT_COMPRESS_THRESHOLD
+    )
+
+
+def compress(text, threshold=None):
+    """
+    Converts text to its stored form, compressing it if it is large.
+
+    :param text: The text to store.
+    :param threshold: Size in bytes from which the text is compressed.
+        Defaults to the NOTES_COMPRESS_THRESHOLD setting.
+    :return: The text unchanged, or the compressed form with the marker.
+    """
+
+    if threshold is None:
+        threshold = get_compress_threshold()
+
+    data = text.encode('utf-8')
+    if len(data) < threshold and not text.startswith(COMPRESSED_MARKER):
+        return text
+
+    packed = base64.b64encode(zlib.compress(data, COMPRESS_LEVEL))
+    stored = COMPRESSED_MARKER + packed.decode('ascii')
+
+    # Only keep the compressed form if it saves space, unless the text
+    # would otherwise be mistaken for a compressed value
+    if len(stored) >= len(data) and not text.startswith(COMPRESSED_MARKER):
+        return text
+    return stored
+
+
+def decompress(stored):
+    """
+    Converts a stored value back to text.
+
+    :param stored: A value as stored by compress().
+    :return: The original text.
+    """
+
+    if not stored.startswith(COMPRESSED_MARKER):
+        return stored
+
+    packed = stored[len(COMPRESSED_MARKER):].encode('ascii')
+    return zlib.decompress(base64.b64decode(packed)).decode('utf-8')
+
+
+class CompressedText:
+    """
+    A compressed value loaded from the database but not yet
+    decompressed.
+
+    Attributes
+    ----------
+    stored (str):
+        The value as stored, including the marker.
+
+    Methods
+    -------
+    decompress(self):
+        Returns the original text.
+    """
+
+    __slots__ = ('stored',)
+
+    def __init__(self, stored):
+        """
+        Wraps a stored compressed value.
+
+        :param stored: The value as stored, including the marker.
+        """
+
+        self.stored = stored
+
+    def decompress(self):
+        """Returns the original text."""
+        return decompress(self.stored)
+
+    def __str__(self):
+        """Returns the original text."""
+        return self.decompress()
+
+    def __repr__(self):
+        """Returns a short representation without decompressing."""
+        return f'<CompressedText: {len(self.stored)} characters stored>'
+
+
+class CompressedTextDescriptor(DeferredAttribute):
+    """
+    Attribute descriptor decompressing a loaded value the first time it
+    is read, and keeping the text for later reads.
+
+    Defining __set__ makes this a data descriptor, so reads go through
+    __get__ even once the value is in the instance dictionary.
+    """
+
+    def __set__(self, instance, value):
+        """Stores a value in the instance dictionary."""
+        instance.__dict__[self.field.attname] = value
+
+    def __get__(self, instance, cls=None):
+        """Returns the field's text, decompressing it if needed."""
+
+        value = super().__get__(instance, cls)
+        if isinstance(value, CompressedText):
+            value = value.decompress()
+            instance.__dict__[self.field.attname] = value
+
+        return value
+
+
+class CompressedTextField(models.TextField):
+    """
+    A text field storing values from NOTES_COMPRESS_THRESHOLD bytes
+    compressed, and decompressing them when first read.
+
+    Methods
+    -------
+    from_db_value(self, value, expression, connection):
+        Wraps compressed values so they are decompressed on access.
+    to_python(self, value):
+        Returns plain text for forms and validation.
+    get_prep_value(self, value):
+        Converts text to its stored form.
+    pre_save(self, model_instance, add):
+        Returns the value to save without decompressing unread values.
+    """
+
+    descriptor_class = CompressedTextDescriptor
+
+    def from_db_value(self, value, expression, connection):
+        """Wraps compressed values so they are decompressed on access."""
+
+        if isinstance(value, str) and value.startswith(COMPRESSED_MARKER):
+            return CompressedText(value)
+        return value
+
+    def to_python(self, value):
+        """Returns plain text for forms and validation."""
+
+        if isinstance(value, CompressedText):
+            return value.decompress()
+        return super().to_python(value)
+
+    def get_prep_value(self, value):
+        """Converts text to its stored form."""
+
+        if isinstance(value, CompressedText):
+            return value.stored
+
+        value = super().get_prep_value(value)
+        if isinstance(value, str):
+            return compress(value)
+        return value
+
+    def pre_save(self, model_instance, add):
+        """
+        Returns the value to save without decompressing unread values,
+        so saving other fields does not recompress the content.
+        """
+
+        if self.attname in model_instance.__dict__:
+            return model_instance.__dict__[self.attname]
+        return super().pre_save(model_instance, add)
@@ -10,6 +10,7 @@ from django import forms
 from django.contrib.auth.forms import UserCreationForm
 from django.contrib.auth.models import User
 from .models import Note
+from . import hashing
 
 
 class NoteForm(forms.ModelForm):
@@ -104,6 +105,12 @@ class SignUpForm(UserCreationForm):
     ----------
     Subclass for specifying model behaviour options in the SignUpForm.
 
+    Methods
+    -------
+    save(self, commit=True):
+        Saves the user with the password hashed in the bounded pool in
+        'notes.hashing'.
+
     :param forms.ModelForm: Django's ModelForm class.
     """
 
@@ -147,3 +154,21 @@ class SignUpForm(UserCreationForm):
             'password1': forms.PasswordInput(attrs={'class': 'form-control'}),
             'password2': forms.PasswordInput(attrs={'class': 'form-control'}),
         }
+
+    def save(self, commit=True):
+        """
+        Saves the user with the password hashed in the bounded pool in
+        'notes.hashing', instead of on the request thread.
+
+        :param commit: Whether to save the user to the database.
+        :return: The User instance.
+        :raises HashingBusy: If the hashing pool is full.
+        """
+
+        # Skip UserCreationForm.save(), which hashes in this thread
+        user = forms.ModelForm.save(self, commit=False)
+        hashing.set_password(user, self.cleaned_data['password1'])
+        if commit:
+            user.save()
+            self.save_m2m()
+        return user
@@ -0,0 +1,325 @@
+# notes/hashing.py
+
+"""
+This module runs password hashing for signup and login in a bounded
+pool of worker threads.
+
+Password hashes are deliberately slow, and a burst of signups or login
+attempts could otherwise keep every request thread busy hashing. Here
+each hash is handed to a HashingPool with NOTES_HASHING_WORKERS
+threads. PBKDF2 runs in OpenSSL without holding the GIL, so the
+threads hash on separate cores. At most NOTES_HASHING_QUEUE hashes may
+be running or waiting at once; beyond that HashingBusy is raised at
+once rather than queueing more work, and views wrapped with shed_load()
+answer with a cheap 503 response.
+
+PooledModelBackend is Django's ModelBackend with the password check run
+in the pool. SignUpForm hashes the new user's password through
+make_password() here.
+
+TunablePBKDF2PasswordHasher is Django's PBKDF2 hasher with its
+iteration count taken from the NOTES_PBKDF2_ITERATIONS setting. Run
+the 'tune_password_hasher' management command to measure the hashing
+time on the server and get a recommended value. Existing hashes keep
+working when the value changes, and are upgraded on the next login.
+"""
+
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import wraps
+from django.conf import settings
+from django.contrib.auth import get_user_model, hashers
+from django.contrib.auth.backends import ModelBackend
+from django.http import HttpResponse
+
+# Default number of threads hashing passwords
+DEFAULT_HASHING_WORKERS = os.cpu_count() or 1
+
+# Default most hashes running or waiting, per worker thread
+DEFAULT_QUEUE_PER_WORKER = 4
+
+# Seconds a client is asked to wait when the pool is full
+BUSY_RETRY_AFTER = 1
+
+
+class HashingBusy(Exception):
+    """
+    Raised when the hashing pool already has as many hashes running or
+    waiting as it allows.
+    """
+
+
+class HashingPool:
+    """
+    A thread pool that refuses work once too many tasks are pending.
+
+    Attributes
+    ----------
+    workers (int):
+        Number of worker threads.
+    max_pending (int):
+        Most tasks running or waiting at once.
+    pending (int):
+        Number of tasks running or waiting now.
+
+    Methods
+    -------
+    submit(self, func, *args):
+        Queues a call, returning a Future.
+    run(self, func, *args):
+        Runs a call in the pool and waits for its result.
+    shutdown(self):
+        Stops the worker threads once the pending tasks finish.
+    """
+
+    def __init__(self, workers, max_pending):
+        """
+        Starts a pool.
+
+        :param workers: Number of worker threads.
+        :param max_pending: Most tasks running or waiting at once.
+        """
+
+        self.workers = workers
+        self.max_pending = max_pending
+        self.pending = 0
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix='password-hashing'
+        )
+
+    def _task_done(self, future):
+        """Frees the slot of a finished task."""
+
+        with self._lock:
+            self.pending -= 1
+
+    def submit(self, func, *args):
+        """
+        Queues a call, returning a Future.
+
+        :param func: The function to call.
+        :param args: Positional arguments for the function.
+        :return: A concurrent.futures.Future for the result.
+        :raises HashingBusy: If max_pending tasks are already pending.
+        """
+
+        with self._lock:
+            if self.pending >= self.max_pending:
+                raise HashingBusy(
+                    f"{self.pending} password hashes are already pending."
+                )
+            self.pending += 1
+
+        try:
+            future = self._executor.submit(func, *args)
+        except BaseException:
+            self._task_done(None)
+            raise
+        future.add_done_callback(self._task_done)
+        return future
+
+    def run(self, func, *args):
+        """
+        Runs a call in the pool and waits for its result.
+
+        :param func: The function to call.
+        :param args: Positional arguments for the function.
+        :return: The function's return value.
+        :raises HashingBusy: If max_pending tasks are already pending.
+        """
+
+        return self.submit(func, *args).result()
+
+    def shutdown(self):
+        """Stops the worker threads once the pending tasks finish."""
+        self._executor.shutdown(wait=True)
+
+
+# The shared pool, created on first use
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool_size():
+    """
+    Returns the configured size of the hashing pool.
+
+    :return: A (workers, max_pending) tuple from the
+        NOTES_HASHING_WORKERS and NOTES_HASHING_QUEUE settings, falling
+        back to DEFAULT_HASHING_WORKERS threads and
+        DEFAULT_QUEUE_PER_WORKER pending hashes per thread.
+    """
+
+    workers = getattr(settings, 'NOTES_HASHING_WORKERS', None)
+    workers = workers or DEFAULT_HASHING_WORKERS
+    max_pending = getattr(settings, 'NOTES_HASHING_QUEUE', None)
+    return workers, max_pending or workers * DEFAULT_QUEUE_PER_WORKER
+
+
+def get_pool():
+    """
+    Returns the shared hashing pool, starting it if needed.
+
+    The pool is replaced if its settings have changed.
+
+    :return: The HashingPool.
+    """
+
+    global _pool
+    workers, max_pending = get_pool_size()
+    with _pool_lock:
+        if (_pool is None or _pool.workers != workers
+                or _pool.max_pending != max_pending):
+            if _pool is not None:
+                _pool.shutdown()
+            _pool = HashingPool(workers, max_pending)
+        return _pool
+
+
+def make_password(password):
+    """
+    Hashes a password in the pool.
+
+    :param password: The raw password.
+    :return: The encoded hash, as from Django's make_password().
+    :raises HashingBusy: If the pool is full.
+    """
+
+    return get_pool().run(hashers.make_password, password)
+
+
+def set_password(user, password):
+    """
+    Sets a user's password like User.set_password(), but hashes it in
+    the pool.
+
+    The raw password is kept on the user, as set_password() does, so
+    that saving the user tells the password validators it changed.
+
+    :param user: The user whose password is set.
+    :param password: The raw password.
+    :raises HashingBusy: If the pool is full.
+    """
+
+    user.password = make_password(password)
+    user._password = password
+
+
+def _needs_rehash(encoded):
+    """Checks whether a hash was made with outdated hasher settings."""
+
+    try:
+        hasher = hashers.identify_hasher(encoded)
+    except ValueError:
+        return False
+    preferred = hashers.get_hasher('default')
+    return (hasher.algorithm != preferred.algorithm
+            or preferred.must_update(encoded))
+
+
+def check_user_password(user, password):
+    """
+    Checks a user's password in the pool, upgrading the stored hash if
+    it was made with outdated hasher settings.
+
+    :param user: The user whose password is checked.
+    :param password: The raw password given.
+    :return: True if the password is correct.
+    :raises HashingBusy: If the pool is full.
+    """
+
+    correct = get_pool().run(hashers.check_password, password, user.password)
+    if correct and _needs_rehash(user.password):
+        user.password = make_password(password)
+        user.save(update_fields=['password'])
+
+    return correct
+
+
+class PooledModelBackend(ModelBackend):
+    """
+    Django's ModelBackend with passwords checked in the hashing pool.
+
+    Methods
+    -------
+    authenticate(self, request, username=None, password=None, **kwargs):
+        Returns the user if the username and password match.
+    """
+
+    def authenticate(self, request, username=None, password=None, **kwargs):
+        """
+        Returns the user if the username and password match.
+
+        :param request: HTTP request object, or None.
+        :param username: The username given.
+        :param password: The raw password given.
+        :return: The User, or None if the credentials do not match.
+        :raises HashingBusy: If the pool is full.
+        """
+
+        users = get_user_model()
+        if username is None:
+            username = kwargs.get(users.USERNAME_FIELD)
+        if username is None or password is None:
+            return None
+
+        try:
+            user = users._default_manager.get_by_natural_key(username)
+        except users.DoesNotExist:
+            # Hash anyway so unknown usernames take as long as known ones
+            make_password(password)
+            return None
+
+        if (check_user_password(user, password)
+                and self.user_can_authenticate(user)):
+            return user
+        return None
+
+
+def shed_load(view):
+    """
+    Decorator answering with a 503 response when the hashing pool is
+    full, instead of failing the request.
+
+    :param view: A sync view function.
+    :return: The decorated view function.
+    """
+
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        try:
+            return view(request, *args, **kwargs)
+        except HashingBusy:
+            response = HttpResponse(
+                "The server is busy. Please try again shortly.\n",
+                content_type='text/plain', status=503,
+            )
+            response['Retry-After'] = BUSY_RETRY_AFTER
+            return response
+
+    return wrapper
+
+
+class TunablePBKDF2PasswordHasher(hashers.PBKDF2PasswordHasher):
+    """
+    Django's PBKDF2-SHA256 hasher with its iteration count taken from
+    the NOTES_PBKDF2_ITERATIONS setting.
+
+    It keeps the 'pbkdf2_sha256' algorithm name, so existing hashes are
+    still accepted and are rehashed with the new count on login.
+
+    Attributes
+    ----------
+    iterations (int):
+        NOTES_PBKDF2_ITERATIONS, or Django's default if it is not set.
+    """
+
+    @property
+    def iterations(self):
+        """Returns the configured number of iterations."""
+
+        iterations = getattr(settings, 'NOTES_PBKDF2_ITERATIONS', None)
+        return iterations or hashers.PBKDF2PasswordHasher.iterations
+
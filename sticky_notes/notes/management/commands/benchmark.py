@@ -0,0 +1,144 @@
+# notes/management/commands/benchmark.py
+
+"""
+Management command to load-test every route in 'notes.urls'.
+
+The benchmark never touches the real database. It creates a throwaway
+test database in a temporary file (so that concurrent clients share it
+as they would in production), seeds it, runs the routes and then
+destroys it.
+
+Usage:
+    python manage.py benchmark [--users N] [--notes-per-user N]
+        [--content-size N] [--requests N] [--concurrency N]
+        [--server wsgi|asgi] [--route NAME ...] [--seed N]
+        [--output report.json] [--baseline old-report.json]
+"""
+
+import json
+import os
+import tempfile
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.test.utils import setup_databases, teardown_databases
+from notes import benchmark
+
+
+class Command(BaseCommand):
+    """
+    Seeds a throwaway database and measures every note route.
+
+    Methods
+    -------
+    add_arguments(self, parser):
+        Adds the data volume, load and report options.
+    handle(self, *args, **options):
+        Runs the benchmark and writes the report.
+    """
+
+    help = (
+        "Load-tests every route with concurrent clients and reports "
+        "throughput, latency percentiles and queries per request."
+    )
+
+    def add_arguments(self, parser):
+        """Adds the data volume, load and report options."""
+
+        parser.add_argument('--users', type=int, default=10,
+                            help="Number of users to seed.")
+        parser.add_argument('--notes-per-user', type=int, default=100,
+                            help="Number of notes seeded per user.")
+        parser.add_argument('--content-size', type=int, default=200,
+                            help="Characters of content per note.")
+        parser.add_argument('--requests', type=int, default=100,
+                            help="Number of requests sent to each route.")
+        parser.add_argument('--concurrency', type=int, default=4,
+                            help="Number of concurrent clients.")
+        parser.add_argument('--server', choices=['wsgi', 'asgi'],
+                            default='wsgi',
+                            help="Request handler to drive.")
+        parser.add_argument('--route', action='append',
+                            choices=benchmark.ROUTES, dest='routes',
+                            help="Route to run (repeatable). "
+                                 "Defaults to every route.")
+        parser.add_argument('--seed', type=int, default=0,
+                            help="Seed for repeatable random choices.")
+        parser.add_argument('--output',
+                            help="File to write the JSON report to. "
+                                 "Defaults to standard output.")
+        parser.add_argument('--baseline',
+                            help="Earlier JSON report to compare with.")
+
+    def handle(self, *args, **options):
+        """Runs the benchmark and writes the report."""
+
+        config = benchmark.BenchmarkConfig(
+            users=options['users'],
+            notes_per_user=options['notes_per_user'],
+            content_size=options['content_size'],
+            requests=options['requests'],
+            concurrency=options['concurrency'],
+            server=options['server'],
+            routes=options['routes'],
+            seed=options['seed'],
+        )
+        if min(config.users, config.notes_per_user, config.requests,
+               config.concurrency) < 1:
+            raise CommandError(
+                "--users, --notes-per-user, --requests and --concurrency "
+                "must be at least 1."
+            )
+
+        baseline = None
+        if options['baseline']:
+            with open(options['baseline']) as stream:
+                baseline = json.load(stream)
+
+        report = self.run(config)
+
+        if options['output']:
+            with open(options['output'], 'w') as stream:
+                benchmark.dump_report(report, stream)
+            self.stderr.write(f"Report written to {options['output']}")
+        else:
+            benchmark.dump_report(report, self.stdout)
+
+        if baseline is not None:
+            for route, metric, old, new, change in \
+                    benchmark.compare_reports(baseline, report):
+                change = "n/a" if change is None else f"{change:+.1f}%"
+                self.stderr.write(
+                    f"{route:16} {metric:15} {old:>10} -> {new:>10} "
+                    f"({change})"
+                )
+
+    def run(self, config):
+        """
+        Runs the benchmark against a temporary test database.
+
+        :param config: The BenchmarkConfig for the run.
+        :return: The report dictionary.
+        """
+
+        # Measure the app as it runs in production
+        settings.DEBUG = False
+        settings.ALLOWED_HOSTS = [*settings.ALLOWED_HOSTS, 'testserver']
+
+        with tempfile.TemporaryDirectory() as directory:
+            test_settings = connections['default'].settings_dict['TEST']
+            test_settings['NAME'] = os.path.join(directory, 'bench.sqlite3')
+            old_config = setup_databases(
+                verbosity=0, interactive=False, aliases={'default'}
+            )
+            try:
+                return benchmark.run_benchmark(
+                    config,
+                    progress=lambda route, result: self.stderr.write(
+                        f"{route}: {result['throughput_rps']} req/s, "
+                        f"{result['errors']} errors"
+                    ),
+                )
+            finally:
+                connections.close_all()
+                teardown_databases(old_config, verbosity=0)
@@ -0,0 +1,77 @@
+# notes/management/commands/export_notes.py
+
+"""
+Management command to export notes as JSON Lines.
+
+The notes are streamed in primary key order with constant memory use.
+Progress is reported on standard error, so the export can be written to
+standard output and piped elsewhere.
+
+Usage:
+    python manage.py export_notes [--user USERNAME ...] [--output FILE]
+        [--chunk-size N] [--database ALIAS]
+"""
+
+from django.core.management.base import BaseCommand, CommandError
+from notes import transfer
+
+
+class Command(BaseCommand):
+    """
+    Writes every note, or the notes of some users, as JSON lines.
+
+    Methods
+    -------
+    add_arguments(self, parser):
+        Adds the --user, --output, --chunk-size and --database options.
+    handle(self, *args, **options):
+        Runs the export and reports progress.
+    """
+
+    help = "Exports notes as JSON Lines, streamed with constant memory."
+
+    def add_arguments(self, parser):
+        """Adds the --user, --output, --chunk-size and --database
+        options."""
+
+        parser.add_argument(
+            '--user', action='append', dest='usernames',
+            help="Only export this user's notes (repeatable).",
+        )
+        parser.add_argument(
+            '--output',
+            help="File to write to. Defaults to standard output.",
+        )
+        parser.add_argument(
+            '--chunk-size', type=int, default=transfer.DEFAULT_CHUNK_SIZE,
+            help="Number of notes fetched per database round trip.",
+        )
+        parser.add_argument(
+            '--database', default='default',
+            help="Database alias to export from.",
+        )
+
+    def handle(self, *args, **options):
+        """Runs the export and reports progress."""
+
+        chunk_size = options['chunk_size']
+        if chunk_size < 1:
+            raise CommandError("--chunk-size must be at least 1.")
+
+        def progress(count):
+            """Reports the running total on standard error."""
+            self.stderr.write(f"Exported {count} notes...")
+
+        arguments = dict(
+            usernames=options['usernames'],
+            chunk_size=chunk_size,
+            using=options['database'],
+            progress=progress,
+        )
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as stream:
+                total = transfer.export_notes(stream, **arguments)
+        else:
+            total = transfer.export_notes(self.stdout, **arguments)
+
+        self.stderr.write(self.style.SUCCESS(f"Exported {total} notes."))
@@ -0,0 +1,124 @@
+# notes/management/commands/import_notes.py
+
+"""
+Management command to import notes from JSON Lines, as written by the
+'export_notes' command.
+
+Notes are inserted in batches, each in its own transaction. When
+importing from a file, a checkpoint file next to it (FILE.progress)
+records how many lines have been committed. If the import fails, fix
+the cause and run the same command with --resume to carry on from the
+last committed batch. The checkpoint is removed once the import
+completes.
+
+Usage:
+    python manage.py import_notes FILE [--resume] [--owner USERNAME]
+        [--batch-size N] [--database ALIAS]
+    python manage.py import_notes - < notes.jsonl
+"""
+
+import os
+import sys
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from notes import transfer
+
+
+class Command(BaseCommand):
+    """
+    Inserts notes from a JSON Lines file in batched transactions.
+
+    Methods
+    -------
+    add_arguments(self, parser):
+        Adds the input argument and the import options.
+    handle(self, *args, **options):
+        Runs the import and reports progress.
+    """
+
+    help = (
+        "Imports notes from JSON Lines in batched transactions, "
+        "resumable after a failure."
+    )
+
+    def add_arguments(self, parser):
+        """Adds the input argument and the import options."""
+
+        parser.add_argument(
+            'input', help="JSON Lines file to import, or - for standard "
+                          "input.",
+        )
+        parser.add_argument(
+            '--resume', action='store_true',
+            help="Skip the lines committed by an earlier failed import.",
+        )
+        parser.add_argument(
+            '--owner',
+            help="Give every note to this user instead of matching the "
+                 "usernames in the file.",
+        )
+        parser.add_argument(
+            '--batch-size', type=int, default=transfer.DEFAULT_BATCH_SIZE,
+            help="Number of notes inserted per transaction.",
+        )
+        parser.add_argument(
+            '--database', default='default',
+            help="Database alias to import into.",
+        )
+
+    def handle(self, *args, **options):
+        """Runs the import and reports progress."""
+
+        batch_size = options['batch_size']
+        using = options['database']
+        if batch_size < 1:
+            raise CommandError("--batch-size must be at least 1.")
+
+        owner = None
+        if options['owner']:
+            users = get_user_model().objects.using(using)
+            owner = users.filter(username=options['owner']).first()
+            if owner is None:
+                raise CommandError(f"Unknown user '{options['owner']}'.")
+
+        from_stdin = options['input'] == '-'
+        if from_stdin and options['resume']:
+            raise CommandError("--resume needs a file, not standard input.")
+
+        # Only files can be resumed, so only they get a checkpoint
+        checkpoint = None
+        if not from_stdin:
+            checkpoint = f"{options['input']}.progress"
+            if os.path.exists(checkpoint) and not options['resume']:
+                raise CommandError(
+                    f"{checkpoint} exists from an earlier import. Use "
+                    f"--resume to continue it, or delete it to start over."
+                )
+            if options['resume']:
+                done = transfer.read_checkpoint(checkpoint)
+                self.stdout.write(f"Resuming after line {done}.")
+
+        arguments = dict(
+            batch_size=batch_size,
+            owner=owner,
+            checkpoint=checkpoint,
+            using=using,
+            progress=lambda count: self.stdout.write(
+                f"Imported {count} notes..."
+            ),
+        )
+        try:
+            if from_stdin:
+                total = transfer.import_notes(sys.stdin, **arguments)
+            else:
+                with open(options['input'], encoding='utf-8') as stream:
+                    total = transfer.import_notes(stream, **arguments)
+        except OSError as error:
+            raise CommandError(f"Cannot read {options['input']}: {error}")
+        except transfer.TransferError as error:
+            hint = " Fix it and rerun with --resume." if checkpoint else ""
+            raise CommandError(f"Import stopped. {error}{hint}")
+
+        if checkpoint and os.path.exists(checkpoint):
+            os.remove(checkpoint)
+        self.stdout.write(self.style.SUCCESS(f"Imported {total} notes."))
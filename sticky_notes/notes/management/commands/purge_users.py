@@ -0,0 +1,79 @@
+# notes/management/commands/purge_users.py
+
+"""
+Management command to finish deleting the users queued for deletion in
+the admin.
+
+Each user's notes are deleted in small batches, each in its own
+transaction, with a pause between batches so the app's other writes
+are never held up for long. The user is deleted once their notes are
+gone. Run it from cron or a process supervisor; an interrupted run
+carries on where it stopped.
+
+Usage:
+    python manage.py purge_users [--batch-size N] [--pause SECONDS]
+        [--database ALIAS]
+"""
+
+from django.core.management.base import BaseCommand, CommandError
+from notes import purge
+
+
+class Command(BaseCommand):
+    """
+    Deletes the notes of every queued user in throttled batches, then
+    the users.
+
+    Methods
+    -------
+    add_arguments(self, parser):
+        Adds the --batch-size, --pause and --database options.
+    handle(self, *args, **options):
+        Runs the pending purges and reports progress.
+    """
+
+    help = (
+        "Deletes the notes of users queued for deletion in throttled "
+        "batches, then the users."
+    )
+
+    def add_arguments(self, parser):
+        """Adds the --batch-size, --pause and --database options."""
+
+        batch_size, pause = purge.get_purge_throttle()
+        parser.add_argument(
+            '--batch-size', type=int, default=batch_size,
+            help="Number of notes deleted per transaction.",
+        )
+        parser.add_argument(
+            '--pause', type=float, default=pause,
+            help="Seconds to wait between batches.",
+        )
+        parser.add_argument(
+            '--database', default='default',
+            help="Database alias to delete from.",
+        )
+
+    def handle(self, *args, **options):
+        """Runs the pending purges and reports progress."""
+
+        if options['batch_size'] < 1:
+            raise CommandError("--batch-size must be at least 1.")
+        if options['pause'] < 0:
+            raise CommandError("--pause cannot be negative.")
+
+        def progress(user_purge):
+            """Reports the notes deleted so far for one user."""
+            self.stdout.write(
+                f"{user_purge.username}: deleted "
+                f"{user_purge.notes_deleted} of {user_purge.notes_total} "
+                f"notes..."
+            )
+
+        count = purge.purge_pending(
+            batch_size=options['batch_size'],
+            pause=options['pause'],
+            using=options['database'],
+            progress=progress,
+        )
+        self.stdout.write(self.style.SUCCESS(f"Deleted {count} users."))
@@ -0,0 +1,132 @@
+# notes/management/commands/rebalance_shards.py
+
+"""
+Management command to move users' notes between the shard databases
+while the app is running (see 'notes.rebalance').
+
+Without options, every user whose notes are not on the shard their id
+hashes to is moved there, including users whose notes were on
+'default' before sharding was turned on. Users who existed before
+sharding was turned on are placed first. Run it after turning sharding
+on, and after adding or removing a shard in NOTES_SHARDS; a shard
+being removed must stay in DATABASES until it is empty. --user moves a single user, to the shard
+named by --to if given, in which case the user is pinned there and
+left alone by later rebalances. --dry-run only lists the planned moves.
+
+Each user's notes are copied in throttled batches, so the user can keep
+using them, then switched over in one short transaction. An interrupted
+run can simply be started again.
+
+Usage:
+    python manage.py rebalance_shards [--dry-run] [--user USERNAME]
+        [--to ALIAS] [--limit N] [--batch-size N] [--pause SECONDS]
+"""
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from notes import rebalance, sharding
+
+
+class Command(BaseCommand):
+    """
+    Moves users' notes to the shards they belong on.
+
+    Methods
+    -------
+    add_arguments(self, parser):
+        Adds the --dry-run, --user, --to, --limit, --batch-size and
+        --pause options.
+    handle(self, *args, **options):
+        Plans the moves, then runs them and reports progress.
+    """
+
+    help = "Moves users' notes to the shards they belong on."
+
+    def add_arguments(self, parser):
+        """
+        Adds the --dry-run, --user, --to, --limit, --batch-size and
+        --pause options.
+        """
+
+        batch_size, pause = rebalance.get_move_settings()
+        parser.add_argument(
+            '--dry-run', action='store_true',
+            help="List the planned moves without moving anything.",
+        )
+        parser.add_argument(
+            '--user',
+            help="Only move the user with this username.",
+        )
+        parser.add_argument(
+            '--to',
+            help="Database alias to move --user to, pinning them there.",
+        )
+        parser.add_argument(
+            '--limit', type=int,
+            help="Most users moved in this run.",
+        )
+        parser.add_argument(
+            '--batch-size', type=int, default=batch_size,
+            help="Number of notes copied per transaction.",
+        )
+        parser.add_argument(
+            '--pause', type=float, default=pause,
+            help="Seconds to wait between batches.",
+        )
+
+    def plan(self, options):
+        """Returns the (user_id, source, target) moves to run."""
+
+        if options['user'] is None:
+            if options['to'] is not None:
+                raise CommandError("--to can only be used with --user.")
+            return rebalance.plan_rebalance()
+
+        users = get_user_model().objects.using('default')
+        try:
+            user = users.get(username=options['user'])
+        except users.model.DoesNotExist:
+            raise CommandError(f"No user named '{options['user']}'.")
+
+        target = options['to'] or sharding.hash_shard(user.pk)
+        if target not in sharding.note_databases():
+            raise CommandError(f"'{target}' is not a notes database.")
+        return [(user.pk, sharding.place_user(user.pk), target)]
+
+    def handle(self, *args, **options):
+        """Plans the moves, then runs them and reports progress."""
+
+        if not sharding.is_enabled():
+            raise CommandError("Notes are not sharded; set NOTES_SHARDS.")
+        if options['batch_size'] < 1:
+            raise CommandError("--batch-size must be at least 1.")
+        if options['pause'] < 0:
+            raise CommandError("--pause cannot be negative.")
+
+        if not options['dry_run']:
+            sharding.place_users()
+
+        moves = self.plan(options)
+        if options['limit'] is not None:
+            moves = moves[:options['limit']]
+
+        for user_id, source, target in moves:
+            self.stdout.write(f"User {user_id}: {source} -> {target}")
+            if options['dry_run']:
+                continue
+
+            def progress(copied, user_id=user_id):
+                """Reports the notes copied so far for one user."""
+                self.stdout.write(f"User {user_id}: copied {copied} notes...")
+
+            moved = rebalance.move_user(
+                user_id, target,
+                batch_size=options['batch_size'],
+                pause=options['pause'],
+                pin=options['to'] is not None,
+                progress=progress,
+            )
+            self.stdout.write(f"User {user_id}: moved {moved} notes.")
+
+        verb = "Would move" if options['dry_run'] else "Moved"
+        self.stdout.write(self.style.SUCCESS(f"{verb} {len(moves)} users."))
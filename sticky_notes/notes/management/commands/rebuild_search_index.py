@@ -0,0 +1,66 @@
+# notes/management/commands/rebuild_search_index.py
+
+"""
+Management command to rebuild the full-text search index for notes.
+
+Use this after upgrading an existing database, or if the index has
+drifted from the notes table (for example after raw SQL changes that
+bypassed the model signals).
+
+Usage:
+    python manage.py rebuild_search_index [--batch-size N]
+"""
+
+from django.core.management.base import BaseCommand, CommandError
+from notes import search
+
+
+class Command(BaseCommand):
+    """
+    Rebuilds the FTS5 search index from the notes table in batches.
+
+    Methods
+    -------
+    add_arguments(self, parser):
+        Adds the --batch-size and --database options.
+    handle(self, *args, **options):
+        Runs the rebuild and reports progress.
+    """
+
+    help = "Rebuilds the full-text search index for notes in batches."
+
+    def add_arguments(self, parser):
+        """Adds the --batch-size and --database options."""
+
+        parser.add_argument(
+            '--batch-size', type=int, default=1000,
+            help="Number of notes indexed per transaction.",
+        )
+        parser.add_argument(
+            '--database', default='default',
+            help="Database alias to rebuild the index on.",
+        )
+
+    def handle(self, *args, **options):
+        """Runs the rebuild and reports progress."""
+
+        batch_size = options['batch_size']
+        using = options['database']
+
+        if batch_size < 1:
+            raise CommandError("--batch-size must be at least 1.")
+        if not search.is_supported(using):
+            raise CommandError(
+                f"Database '{using}' does not support FTS5 search."
+            )
+
+        total = search.rebuild_index(
+            batch_size=batch_size,
+            using=using,
+            progress=lambda count: self.stdout.write(
+                f"Indexed {count} notes..."
+            ),
+        )
+        self.stdout.write(
+            self.style.SUCCESS(f"Search index rebuilt with {total} notes.")
+        )
@@ -0,0 +1,87 @@
+# notes/management/commands/run_tasks.py
+
+"""
+Management command to run the background tasks queued by the app, such
+as user purges and search index merges (see 'notes.tasks').
+
+Several worker threads claim and run due tasks from the queue table,
+retrying failed ones with a growing delay. Run it under a process
+supervisor, where it keeps waiting for new tasks, or from cron with
+--once, which returns when no task is due. Stopping it with Ctrl+C lets
+the running tasks finish first. More than one worker may run at once,
+even on different machines sharing the database.
+
+Usage:
+    python manage.py run_tasks [--threads N] [--poll-interval SECONDS]
+        [--once] [--database ALIAS]
+"""
+
+from django.core.management.base import BaseCommand, CommandError
+from notes import tasks
+
+
+class Command(BaseCommand):
+    """
+    Runs queued background tasks on a pool of worker threads.
+
+    Methods
+    -------
+    add_arguments(self, parser):
+        Adds the --threads, --poll-interval, --once and --database
+        options.
+    handle(self, *args, **options):
+        Runs tasks and reports each one's outcome.
+    """
+
+    help = "Runs the queued background tasks on a pool of worker threads."
+
+    def add_arguments(self, parser):
+        """
+        Adds the --threads, --poll-interval, --once and --database
+        options.
+        """
+
+        threads, poll_interval = tasks.get_worker_settings()
+        parser.add_argument(
+            '--threads', type=int, default=threads,
+            help="Number of worker threads.",
+        )
+        parser.add_argument(
+            '--poll-interval', type=float, default=poll_interval,
+            help="Seconds an idle worker waits before looking for tasks.",
+        )
+        parser.add_argument(
+            '--once', action='store_true',
+            help="Return once no task is due instead of waiting for more.",
+        )
+        parser.add_argument(
+            '--database', default='default',
+            help="Database alias holding the queue.",
+        )
+
+    def handle(self, *args, **options):
+        """Runs tasks and reports each one's outcome."""
+
+        if options['threads'] < 1:
+            raise CommandError("--threads must be at least 1.")
+        if options['poll_interval'] <= 0:
+            raise CommandError("--poll-interval must be positive.")
+
+        def report(task, succeeded):
+            """Reports the outcome of one task."""
+            if succeeded:
+                self.stdout.write(f"Finished {task.name} (task {task.pk}).")
+            else:
+                self.stderr.write(
+                    f"Failed {task.name} (task {task.pk}, attempt "
+                    f"{task.attempts} of {task.max_attempts})."
+                )
+
+        runner = tasks.TaskRunner(
+            options['threads'], options['poll_interval'],
+            using=options['database'], report=report,
+        )
+        try:
+            runner.run(once=options['once'])
+        except KeyboardInterrupt:
+            self.stdout.write("Stopped.")
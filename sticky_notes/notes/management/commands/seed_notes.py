@@ -0,0 +1,114 @@
+# notes/management/commands/seed_notes.py
+
+"""
+Management command to fill the database with a large synthetic data
+set of users and notes, for reproducing scaling problems locally (see
+'notes.seeding').
+
+Notes are shared out between users by a Zipf distribution, have
+log-normal content lengths with a long tail, and mix in unicode text.
+The same --seed always creates the same data. The notes are generated
+by several processes and inserted in bulk batches, so millions of notes
+take minutes rather than hours. Every seeded user gets the password
+given with --password.
+
+Usage:
+    python manage.py seed_notes [--users N] [--notes N] [--seed N]
+        [--skew S] [--median-length N] [--max-length N]
+        [--unicode-ratio R] [--prefix NAME] [--password PASSWORD]
+        [--batch-size N] [--processes N] [--database ALIAS]
+"""
+
+from django.core.management.base import BaseCommand, CommandError
+from notes import seeding
+
+
+class Command(BaseCommand):
+    """
+    Creates users and notes with realistic distributions in bulk.
+
+    Methods
+    -------
+    add_arguments(self, parser):
+        Adds the data set shape, speed and database options.
+    handle(self, *args, **options):
+        Seeds the data and reports progress.
+    """
+
+    help = (
+        "Creates many users and notes with realistic distributions, in "
+        "bulk and repeatably for a given seed."
+    )
+
+    def add_arguments(self, parser):
+        """Adds the data set shape, speed and database options."""
+
+        parser.add_argument('--users', type=int, default=100,
+                            help="Number of users to create.")
+        parser.add_argument('--notes', type=int, default=10000,
+                            help="Total number of notes to create.")
+        parser.add_argument('--seed', type=int, default=0,
+                            help="Seed for a repeatable data set.")
+        parser.add_argument('--skew', type=float, default=1.2,
+                            help="Zipf exponent of the notes per user.")
+        parser.add_argument('--median-length', type=int, default=160,
+                            help="Median characters of content per note.")
+        parser.add_argument('--max-length', type=int, default=20000,
+                            help="Most characters of content per note.")
+        parser.add_argument('--unicode-ratio', type=float, default=0.1,
+                            help="Fraction of non-ASCII words.")
+        parser.add_argument('--prefix', default='seed',
+                            help="Start of every seeded username.")
+        parser.add_argument('--password', default=seeding.SEED_PASSWORD,
+                            help="Password of every seeded user.")
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help="Number of rows inserted per transaction.")
+        parser.add_argument('--processes', type=int,
+                            default=seeding.DEFAULT_PROCESSES,
+                            help="Number of processes generating notes.")
+        parser.add_argument('--database', default='default',
+                            help="Database alias to seed.")
+
+    def handle(self, *args, **options):
+        """Seeds the data and reports progress."""
+
+        if options['users'] < 1 or options['notes'] < 0:
+            raise CommandError(
+                "--users must be at least 1 and --notes cannot be negative."
+            )
+        if min(options['batch_size'], options['processes'],
+               options['median_length'], options['max_length']) < 1:
+            raise CommandError(
+                "--batch-size, --processes, --median-length and "
+                "--max-length must be at least 1."
+            )
+        if not 0 <= options['unicode_ratio'] <= 1:
+            raise CommandError("--unicode-ratio must be between 0 and 1.")
+
+        config = seeding.SeedConfig(
+            users=options['users'],
+            notes=options['notes'],
+            seed=options['seed'],
+            skew=options['skew'],
+            median_length=options['median_length'],
+            max_length=options['max_length'],
+            unicode_ratio=options['unicode_ratio'],
+            prefix=options['prefix'],
+            password=options['password'],
+        )
+        try:
+            users, notes = seeding.seed(
+                config,
+                batch_size=options['batch_size'],
+                processes=options['processes'],
+                using=options['database'],
+                progress=lambda count: self.stdout.write(
+                    f"Created {count} notes..."
+                ),
+            )
+        except ValueError as error:
+            raise CommandError(str(error))
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Created {users} users and {notes} notes."
+        ))
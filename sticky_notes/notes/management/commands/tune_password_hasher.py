@@ -0,0 +1,152 @@
+# notes/management/commands/tune_password_hasher.py
+
+"""
+Management command to measure how long password hashing takes on this
+machine and recommend a PBKDF2 iteration count.
+
+The default hasher is timed with its current iteration count, and the
+count that makes one hash take about --target-ms milliseconds is
+recommended, but never fewer than MIN_ITERATIONS. The command also runs
+hashes through a pool of the configured size to show how many signups
+and logins per second the server can hash at the recommended count.
+
+Run it on the production hardware, then set NOTES_PBKDF2_ITERATIONS in
+settings.py to the recommended value.
+
+Usage:
+    python manage.py tune_password_hasher [--target-ms MS] [--samples N]
+        [--workers N]
+"""
+
+import math
+import statistics
+import time
+from django.contrib.auth import hashers
+from django.core.management.base import BaseCommand, CommandError
+from notes import hashing
+
+# Fewest PBKDF2-HMAC-SHA256 iterations recommended, following the OWASP
+# password storage guidance
+MIN_ITERATIONS = 600000
+
+# Recommended counts are rounded up to a multiple of this
+ITERATION_STEP = 10000
+
+# Password and salt hashed by the benchmark
+SAMPLE_PASSWORD = 'tune-password-hasher'
+SAMPLE_SALT = 'tunepasswordhasher'
+
+
+def round_iterations(iterations):
+    """
+    Rounds an iteration count up to a multiple of ITERATION_STEP.
+
+    :param iterations: The exact count.
+    :return: The rounded count, at least MIN_ITERATIONS.
+    """
+
+    rounded = math.ceil(iterations / ITERATION_STEP) * ITERATION_STEP
+    return max(MIN_ITERATIONS, rounded)
+
+
+class Command(BaseCommand):
+    """
+    Times the default password hasher and recommends an iteration
+    count.
+
+    Methods
+    -------
+    add_arguments(self, parser):
+        Adds the --target-ms, --samples and --workers options.
+    time_hash(self, hasher, iterations):
+        Returns the seconds one hash takes.
+    handle(self, *args, **options):
+        Runs the measurements and prints the recommendation.
+    """
+
+    help = (
+        "Measures password hashing time and recommends a PBKDF2 "
+        "iteration count for this machine."
+    )
+
+    def add_arguments(self, parser):
+        """Adds the --target-ms, --samples and --workers options."""
+
+        parser.add_argument(
+            '--target-ms', type=float, default=250,
+            help="Time one hash should take, in milliseconds.",
+        )
+        parser.add_argument(
+            '--samples', type=int, default=5,
+            help="Number of hashes timed; the median is used.",
+        )
+        parser.add_argument(
+            '--workers', type=int,
+            help="Hashing pool threads for the throughput test. Defaults "
+                 "to the NOTES_HASHING_WORKERS setting.",
+        )
+
+    def time_hash(self, hasher, iterations):
+        """Returns the seconds one hash takes."""
+
+        start = time.perf_counter()
+        hasher.encode(SAMPLE_PASSWORD, SAMPLE_SALT, iterations)
+        return time.perf_counter() - start
+
+    def handle(self, *args, **options):
+        """Runs the measurements and prints the recommendation."""
+
+        samples = options['samples']
+        if samples < 1:
+            raise CommandError("--samples must be at least 1.")
+        if options['target_ms'] <= 0:
+            raise CommandError("--target-ms must be positive.")
+
+        hasher = hashers.get_hasher('default')
+        if not isinstance(hasher, hashers.PBKDF2PasswordHasher):
+            raise CommandError(
+                f"The default hasher is {hasher.algorithm}; only PBKDF2 "
+                f"iteration counts can be tuned."
+            )
+
+        # Time single hashes with the current count
+        current = hasher.iterations
+        seconds = statistics.median(
+            self.time_hash(hasher, current) for _ in range(samples)
+        )
+        self.stdout.write(
+            f"{hasher.algorithm} with {current} iterations: "
+            f"{seconds * 1000:.0f} ms per hash."
+        )
+
+        exact = current * options['target_ms'] / 1000 / seconds
+        recommended = round_iterations(exact)
+        expected = seconds * recommended / current
+        if recommended > exact + ITERATION_STEP:
+            self.stdout.write(self.style.WARNING(
+                f"Reaching {options['target_ms']:.0f} ms needs only "
+                f"{round(exact)} iterations, below the minimum of "
+                f"{MIN_ITERATIONS}."
+            ))
+
+        # Hash in a pool to measure throughput across the worker threads
+        workers = options['workers'] or hashing.get_pool_size()[0]
+        pool = hashing.HashingPool(workers, workers * samples)
+        start = time.perf_counter()
+        futures = [pool.submit(self.time_hash, hasher, current)
+                   for _ in range(workers * samples)]
+        for future in futures:
+            future.result()
+        elapsed = time.perf_counter() - start
+        pool.shutdown()
+        per_second = workers * samples / elapsed * current / recommended
+
+        self.stdout.write(
+            f"Recommended: {recommended} iterations, about "
+            f"{expected * 1000:.0f} ms per hash. Hashing threads: "
+            f"{workers}, handling about {per_second:.1f} signups or "
+            f"logins per second."
+        )
+        self.stdout.write(self.style.SUCCESS(
+            f"Set NOTES_PBKDF2_ITERATIONS = {recommended} in settings.py."
+        ))
@@ -0,0 +1,374 @@
+# notes/metrics.py
+
+"""
+This module provides lightweight request instrumentation for the Sticky
+Notes application.
+
+'notes.middleware.RequestMetricsMiddleware' starts a RequestTimings
+record for every request. While the request is handled, the database
+execute wrapper time_queries() adds each query's duration to it, and
+the TimedDjangoTemplates template backend adds the time spent rendering
+templates. When the response is ready the middleware reports the
+timings in a Server-Timing header and records them in the in-process
+histograms below, labelled with the view name.
+
+The histograms are exposed in the Prometheus text format by the
+'note_metrics' view. They are kept per process, so each worker process
+of a deployment must be scraped separately.
+
+The overhead is two clock reads per query and per template render, plus
+one short lock per histogram at the end of each request, so the
+instrumentation can stay enabled in production. Writes handed to the
+background writer in 'notes.writer' run in a copy of the request's
+context, so their queries count towards the request's database time,
+while the writer's shared transaction around them does not.
+"""
+
+import bisect
+import threading
+import time
+from contextvars import ContextVar
+from django.template import TemplateDoesNotExist
+from django.template.backends.django import DjangoTemplates, Template, reraise
+
+# Upper bounds, in seconds, of the duration histogram buckets
+DURATION_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+)
+
+# Upper bounds of the queries-per-request histogram buckets
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+# Label used for requests that did not resolve to a view
+UNRESOLVED_VIEW = 'unresolved'
+
+# Timings of the request being handled, if any
+_request_timings = ContextVar('notes_request_timings', default=None)
+
+
+class RequestTimings:
+    """
+    The time spent in each part of handling one request.
+
+    Durations are in seconds.
+
+    Attributes
+    ----------
+    started (float):
+        Clock reading when the request started.
+    view_started (float):
+        Clock reading when the view was called, or None.
+    db_time (float):
+        Time spent executing database queries.
+    queries (int):
+        Number of database queries executed.
+    template_time (float):
+        Time spent rendering templates.
+
+    Methods
+    -------
+    elapsed(self, since=None):
+        Returns the time since the request, or another clock reading.
+    """
+
+    def __init__(self):
+        """Starts timing a request."""
+
+        self.started = time.perf_counter()
+        self.view_started = None
+        self.db_time = 0.0
+        self.queries = 0
+        self.template_time = 0.0
+
+    def elapsed(self, since=None):
+        """
+        Returns the time since the request, or another clock reading.
+
+        :param since: A clock reading. Defaults to the request start.
+        :return: The elapsed time in seconds.
+        """
+
+        return time.perf_counter() - (self.started if since is None
+                                      else since)
+
+
+def start_request():
+    """
+    Starts timing the current request.
+
+    :return: A (timings, token) tuple, where token is passed to
+        finish_request().
+    """
+
+    timings = RequestTimings()
+    return timings, _request_timings.set(timings)
+
+
+def finish_request(token):
+    """
+    Stops timing the current request.
+
+    :param token: The token returned by start_request().
+    """
+
+    _request_timings.reset(token)
+
+
+def get_request_timings():
+    """
+    Returns the timings of the request being handled.
+
+    :return: A RequestTimings instance, or None outside a request.
+    """
+
+    return _request_timings.get()
+
+
+def time_queries(execute, sql, params, many, context):
+    """
+    Database execute wrapper that adds each query's duration to the
+    current request's timings.
+
+    :return: The result of the wrapped execute call.
+    """
+
+    timings = _request_timings.get()
+    if timings is None:
+        return execute(sql, params, many, context)
+
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        timings.db_time += time.perf_counter() - start
+        timings.queries += 1
+
+
+def install_query_timer(sender, connection, **kwargs):
+    """Adds time_queries() to a new database connection."""
+
+    if time_queries not in connection.execute_wrappers:
+        connection.execute_wrappers.append(time_queries)
+
+
+class TimedTemplate(Template):
+    """
+    A Django template that adds its render time to the current
+    request's timings.
+
+    Methods
+    -------
+    render(self, context=None, request=None):
+        Renders the template, timing the render.
+    """
+
+    def render(self, context=None, request=None):
+        """
+        Renders the template, timing the render.
+
+        :param context: A dict of template variables.
+        :param request: HTTP request object.
+        :return: The rendered template.
+        """
+
+        timings = _request_timings.get()
+        if timings is None:
+            return super().render(context, request)
+
+        start = time.perf_counter()
+        try:
+            return super().render(context, request)
+        finally:
+            timings.template_time += time.perf_counter() - start
+
+
+class TimedDjangoTemplates(DjangoTemplates):
+    """
+    The Django template backend, returning TimedTemplate instances.
+
+    Use it as the BACKEND of the TEMPLATES setting in place of
+    'django.template.backends.django.DjangoTemplates'.
+    """
+
+    def from_string(self, template_code):
+        """Compiles a template from a string."""
+        return TimedTemplate(self.engine.from_string(template_code), self)
+
+    def get_template(self, template_name):
+        """Loads a template by name."""
+
+        try:
+            return TimedTemplate(self.engine.get_template(template_name), self)
+        except TemplateDoesNotExist as exc:
+            reraise(exc, self)
+
+
+class Histogram:
+    """
+    A Prometheus-style histogram with one series per label value.
+
+    Attributes
+    ----------
+    name (str):
+        The metric name.
+    help_text (str):
+        The metric description.
+    label (str):
+        The name of the label separating the series.
+    buckets (tuple):
+        The ascending upper bounds of the buckets.
+
+    Methods
+    -------
+    observe(self, label_value, value):
+        Records one observation.
+    render(self):
+        Returns the histogram in the Prometheus text format.
+    """
+
+    def __init__(self, name, help_text, buckets, label='view'):
+        """
+        Creates an empty histogram.
+
+        :param name: The metric name.
+        :param help_text: The metric description.
+        :param buckets: The ascending upper bounds of the buckets.
+        :param label: The name of the label separating the series.
+        """
+
+        self.name = name
+        self.help_text = help_text
+        self.label = label
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, label_value, value):
+        """
+        Records one observation.
+
+        :param label_value: The series to record it in.
+        :param value: The observed value.
+        """
+
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_value)
+            if series is None:
+                # Per-bucket counts with a final +Inf bucket, sum, count
+                series = self._series[label_value] = [
+                    [0] * (len(self.buckets) + 1), 0, 0
+                ]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        """
+        Returns the histogram in the Prometheus text format.
+
+        :return: A list of lines.
+        """
+
+        lines = [
+            f'# HELP {self.name} {self.help_text}',
+            f'# TYPE {self.name} histogram',
+        ]
+        with self._lock:
+            series = {key: (list(counts), total, count)
+                      for key, (counts, total, count)
+                      in self._series.items()}
+
+        for label_value in sorted(series):
+            counts, total, count = series[label_value]
+            label = f'{self.label}="{label_value}"'
+            bounds = [str(bound) for bound in self.buckets] + ['+Inf']
+            cumulative = 0
+            # Prometheus buckets count every observation up to the bound
+            for bound, bucket_count in zip(bounds, counts):
+                cumulative += bucket_count
+                lines.append(
+                    f'{self.name}_bucket{{{label},le="{bound}"}} {cumulative}'
+                )
+            lines.append(f'{self.name}_sum{{{label}}} {total}')
+            lines.append(f'{self.name}_count{{{label}}} {count}')
+
+        return lines
+
+
+REQUEST_DURATION = Histogram(
+    'notes_request_duration_seconds',
+    'Total time spent handling requests.', DURATION_BUCKETS,
+)
+VIEW_DURATION = Histogram(
+    'notes_view_duration_seconds',
+    'Time spent in the view and the middleware inside it.',
+    DURATION_BUCKETS,
+)
+DB_DURATION = Histogram(
+    'notes_db_duration_seconds',
+    'Time spent executing database queries per request.', DURATION_BUCKETS,
+)
+TEMPLATE_DURATION = Histogram(
+    'notes_template_duration_seconds',
+    'Time spent rendering templates per request.', DURATION_BUCKETS,
+)
+DB_QUERIES = Histogram(
+    'notes_db_queries',
+    'Number of database queries per request.', QUERY_COUNT_BUCKETS,
+)
+
+# Every histogram, in the order they are exposed
+HISTOGRAMS = [
+    REQUEST_DURATION, VIEW_DURATION, DB_DURATION, TEMPLATE_DURATION,
+    DB_QUERIES,
+]
+
+
+def record_request(view_name, timings, total, view_time):
+    """
+    Records a finished request in the histograms.
+
+    :param view_name: The resolved view name, used as the label.
+    :param timings: The request's RequestTimings.
+    :param total: Total time spent handling the request, in seconds.
+    :param view_time: Time spent in the view, in seconds.
+    """
+
+    REQUEST_DURATION.observe(view_name, total)
+    VIEW_DURATION.observe(view_name, view_time)
+    DB_DURATION.observe(view_name, timings.db_time)
+    TEMPLATE_DURATION.observe(view_name, timings.template_time)
+    DB_QUERIES.observe(view_name, timings.queries)
+
+
+def server_timing(timings, total, view_time):
+    """
+    Builds the Server-Timing header value for a finished request.
+
+    :param timings: The request's RequestTimings.
+    :param total: Total time spent handling the request, in seconds.
+    :param view_time: Time spent in the view, in seconds.
+    :return: The header value, with durations in milliseconds.
+    """
+
+    return ', '.join([
+        f'db;dur={timings.db_time * 1000:.2f};'
+        f'desc="{timings.queries} queries"',
+        f'tpl;dur={timings.template_time * 1000:.2f}',
+        f'view;dur={view_time * 1000:.2f}',
+        f'total;dur={total * 1000:.2f}',
+    ])
+
+
+def render_metrics():
+    """
+    Returns every histogram in the Prometheus text format.
+
+    :return: The exposition text.
+    """
+
+    lines = []
+    for histogram in HISTOGRAMS:
+        lines.extend(histogram.render())
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,442 @@
+# notes/middleware.py
+
+"""
+This module contains middleware for the Sticky Notes application.
+"""
+
+import os
+import time
+from urllib.parse import urlsplit
+from asgiref.sync import (iscoroutinefunction, markcoroutinefunction,
+                          sync_to_async)
+from django.conf import settings
+from django.contrib.auth import SESSION_KEY, get_user_model
+from django.http import FileResponse, HttpResponse, HttpResponseNotModified
+from . import metrics, sharding
+from .staticfiles import StaticAsset
+from .routers import (RoutingState, get_routing_state, set_routing_state,
+                      reset_routing_state)
+
+# Default number of seconds a client reads from the primary after a write
+DEFAULT_REPLICA_PIN_SECONDS = 5
+
+# Default names of the views whose reads may go to a replica
+DEFAULT_REPLICA_VIEWS = ['note_noteboard', 'note_read']
+
+# Whether responses carry a Server-Timing header by default
+DEFAULT_SERVER_TIMING = True
+
+# Whether collected static files are served by the app by default
+DEFAULT_SERVE_STATIC = True
+
+
+class ReplicaRoutingMiddleware:
+    """
+    Sets up the per-request state used by 'notes.routers.ShardRouter'
+    and 'notes.routers.ReplicaRouter'.
+
+    Requests to the views named in NOTES_REPLICA_VIEWS may read from a
+    replica. When a request writes to the notes app, a short-lived
+    cookie pins the client's following requests to the primary so they
+    always see their own writes. When notes are sharded, the logged-in
+    user is recorded so their notes are read from their shard.
+
+    The middleware supports both sync and async requests, so it adds no
+    thread switches under ASGI. Only the session and shard lookups of a
+    sharded setup run on a worker thread, since they query the
+    database.
+
+    Methods
+    -------
+    __call__(self, request):
+        Handles a sync request with a fresh routing state.
+    __acall__(self, request):
+        Handles an async request with a fresh routing state.
+    process_view(self, request, view_func, view_args, view_kwargs):
+        Allows replica reads if the resolved view is replica-enabled,
+        and records the logged-in user when notes are sharded.
+    aprocess_view(self, request, view_func, view_args, view_kwargs):
+        Async version of process_view(), used for async requests.
+    use_replica(self, request):
+        Allows replica reads if the resolved view is replica-enabled.
+    route_user(self, request, state):
+        Records the logged-in user and their shard.
+    finish(self, response, state):
+        Sets the pin cookie if the request wrote to the notes app.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    cookie_name = 'notes_primary_pin'
+
+    def __init__(self, get_response):
+        """
+        Stores the next handler in the middleware chain.
+
+        :param get_response: The next middleware or view.
+        """
+
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+            # Django runs a sync process_view() on a thread for async
+            # requests, so hand it the async version instead
+            self.process_view = self.aprocess_view
+
+    def __call__(self, request):
+        """
+        Handles a sync request with a fresh routing state.
+
+        :param request: HTTP request object.
+        :return: The response, with the pin cookie set if the request
+            wrote to the notes app.
+        """
+
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+
+        state = RoutingState(pinned=self.cookie_name in request.COOKIES)
+        token = set_routing_state(state)
+        try:
+            response = self.get_response(request)
+        finally:
+            reset_routing_state(token)
+
+        return self.finish(response, state)
+
+    async def __acall__(self, request):
+        """
+        Handles an async request with a fresh routing state.
+
+        :param request: HTTP request object.
+        :return: The response, with the pin cookie set if the request
+            wrote to the notes app.
+        """
+
+        state = RoutingState(pinned=self.cookie_name in request.COOKIES)
+        token = set_routing_state(state)
+        try:
+            response = await self.get_response(request)
+        finally:
+            reset_routing_state(token)
+
+        return self.finish(response, state)
+
+    def finish(self, response, state):
+        """
+        Sets the pin cookie if the request wrote to the notes app.
+
+        :param response: The response from the rest of the chain.
+        :param state: The request's RoutingState.
+        :return: The response.
+        """
+
+        if state.wrote:
+            response.set_cookie(
+                self.cookie_name, '1',
+                max_age=getattr(settings, 'NOTES_REPLICA_PIN_SECONDS',
+                                DEFAULT_REPLICA_PIN_SECONDS),
+                httponly=True, samesite='Lax',
+            )
+
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        """
+        Allows replica reads if the resolved view is replica-enabled,
+        and records the logged-in user when notes are sharded.
+
+        :param request: HTTP request object.
+        :return: None, so the view is called as normal.
+        """
+
+        state = self.use_replica(request)
+        if state is not None and sharding.is_enabled():
+            self.route_user(request, state)
+
+        return None
+
+    async def aprocess_view(self, request, view_func, view_args,
+                            view_kwargs):
+        """
+        Async version of process_view(), used for async requests.
+
+        :param request: HTTP request object.
+        :return: None, so the view is called as normal.
+        """
+
+        state = self.use_replica(request)
+        if state is not None and sharding.is_enabled():
+            await sync_to_async(self.route_user)(request, state)
+
+        return None
+
+    def use_replica(self, request):
+        """
+        Allows replica reads if the resolved view is replica-enabled.
+
+        :param request: HTTP request object.
+        :return: The request's RoutingState, or None outside of this
+            middleware.
+        """
+
+        state = get_routing_state()
+        if state is not None and request.resolver_match is not None:
+            views = getattr(settings, 'NOTES_REPLICA_VIEWS',
+                            DEFAULT_REPLICA_VIEWS)
+            state.use_replica = request.resolver_match.url_name in views
+        return state
+
+    def route_user(self, request, state):
+        """
+        Records the logged-in user and their shard.
+
+        The session names the user without loading them. Their shard is
+        looked up here, since async views cannot query while routing;
+        a user who has not been placed is only placed by requests that
+        may write, so reads never take the write lock. Admin views work
+        on every user's notes, so they are not routed to the shard of
+        the staff member using them.
+
+        :param request: HTTP request object.
+        :param state: The request's RoutingState.
+        """
+
+        if request.resolver_match.app_name == 'admin':
+            return
+
+        user_id = request.session.get(SESSION_KEY)
+        if user_id is not None:
+            state.user_id = get_user_model()._meta.pk.to_python(user_id)
+            state.shard = sharding.shard_for_user(
+                state.user_id,
+                place=request.method not in ('GET', 'HEAD', 'OPTIONS'),
+            )
+
+
+class RequestMetricsMiddleware:
+    """
+    Times every request and records the timings in 'notes.metrics'.
+
+    The response gets a Server-Timing header with the database time and
+    query count, template render time, view time and total time, unless
+    the NOTES_SERVER_TIMING setting is False. The middleware supports
+    both sync and async requests, so it adds no thread switches under
+    ASGI. It should come before all but the security and static files
+    middleware, so the total time covers the rest of the middleware.
+
+    Methods
+    -------
+    __call__(self, request):
+        Handles a sync request, timing it.
+    __acall__(self, request):
+        Handles an async request, timing it.
+    process_view(self, request, view_func, view_args, view_kwargs):
+        Notes the time the view is called.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        """
+        Stores the next handler in the middleware chain.
+
+        :param get_response: The next middleware or view.
+        """
+
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        """
+        Handles a sync request, timing it.
+
+        :param request: HTTP request object.
+        :return: The response.
+        """
+
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+
+        timings, token = metrics.start_request()
+        try:
+            response = self.get_response(request)
+        finally:
+            metrics.finish_request(token)
+
+        return self.finish(request, response, timings)
+
+    async def __acall__(self, request):
+        """
+        Handles an async request, timing it.
+
+        :param request: HTTP request object.
+        :return: The response.
+        """
+
+        timings, token = metrics.start_request()
+        try:
+            response = await self.get_response(request)
+        finally:
+            metrics.finish_request(token)
+
+        return self.finish(request, response, timings)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        """
+        Notes the time the view is called.
+
+        :param request: HTTP request object.
+        :return: None, so the view is called as normal.
+        """
+
+        timings = metrics.get_request_timings()
+        if timings is not None:
+            timings.view_started = time.perf_counter()
+
+        return None
+
+    def finish(self, request, response, timings):
+        """
+        Records the timings and adds the Server-Timing header.
+
+        :param request: HTTP request object.
+        :param response: The response from the rest of the chain.
+        :param timings: The request's RequestTimings.
+        :return: The response.
+        """
+
+        total = timings.elapsed()
+        if timings.view_started is None:
+            view_time = 0.0
+        else:
+            view_time = timings.elapsed(since=timings.view_started)
+
+        match = getattr(request, 'resolver_match', None)
+        view_name = match.view_name if match else metrics.UNRESOLVED_VIEW
+        metrics.record_request(view_name, timings, total, view_time)
+
+        if getattr(settings, 'NOTES_SERVER_TIMING', DEFAULT_SERVER_TIMING):
+            response['Server-Timing'] = metrics.server_timing(
+                timings, total, view_time
+            )
+
+        return response
+
+
+class StaticFilesMiddleware:
+    """
+    Serves the files collected into STATIC_ROOT by 'collectstatic'.
+
+    Content-hashed files get far-future immutable cache headers, and
+    the precompressed brotli or gzip variant is sent when the client
+    accepts it. Requests for files that have not been collected pass
+    through untouched, so Django's development server still serves
+    static files itself. Set NOTES_SERVE_STATIC to False when a web
+    server or CDN serves STATIC_ROOT instead.
+
+    Methods
+    -------
+    __call__(self, request):
+        Serves a static file, or passes the request on.
+    __acall__(self, request):
+        Async version of __call__().
+    serve(self, request):
+        Returns the response for a static file, or None.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        """
+        Stores the next handler in the middleware chain.
+
+        :param get_response: The next middleware or view.
+        """
+
+        self.get_response = get_response
+        self.prefix = urlsplit(settings.STATIC_URL or '').path
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        """
+        Serves a static file, or passes the request on.
+
+        :param request: HTTP request object.
+        :return: The response.
+        """
+
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+
+        response = self.serve(request)
+        if response is None:
+            response = self.get_response(request)
+        return response
+
+    async def __acall__(self, request):
+        """
+        Async version of __call__().
+
+        :param request: HTTP request object.
+        :return: The response.
+        """
+
+        response = self.serve(request)
+        if response is None:
+            response = await self.get_response(request)
+        return response
+
+    def serve(self, request):
+        """
+        Returns the response for a static file, or None.
+
+        :param request: HTTP request object.
+        :return: A response, or None if the request is not for a
+            collected static file.
+        """
+
+        if (not getattr(settings, 'NOTES_SERVE_STATIC', DEFAULT_SERVE_STATIC)
+                or request.method not in ('GET', 'HEAD')
+                or not self.prefix
+                or not request.path_info.startswith(self.prefix)):
+            return None
+
+        asset = StaticAsset.find(
+            request.path_info[len(self.prefix):],
+            request.META.get('HTTP_ACCEPT_ENCODING', ''),
+        )
+        if asset is None:
+            return None
+
+        stat = os.stat(asset.path)
+        headers = {
+            'Cache-Control': asset.cache_control,
+            'ETag': f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"',
+        }
+        if asset.has_variants:
+            headers['Vary'] = 'Accept-Encoding'
+        if asset.encoding:
+            headers['Content-Encoding'] = asset.encoding
+
+        # The client's copy is current
+        if headers['ETag'] in request.META.get('HTTP_IF_NONE_MATCH', ''):
+            return HttpResponseNotModified(headers=headers)
+
+        if request.method == 'HEAD':
+            response = HttpResponse(content_type=asset.content_type,
+                                    headers=headers)
+            response['Content-Length'] = stat.st_size
+            return response
+
+        response = FileResponse(open(asset.path, 'rb'),
+                                content_type=asset.content_type,
+                                headers=headers)
+        # Static files are shown inline under their own URL
+        del response['Content-Disposition']
+        return response
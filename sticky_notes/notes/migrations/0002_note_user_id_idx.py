@@ -0,0 +1,19 @@
+# Generated by Django 5.0.6 on 2026-10-18 06:01
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('notes', '0001_initial'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='note',
+            index=models.Index(fields=['user', 'id'], name='note_user_id_idx'),
+        ),
+    ]
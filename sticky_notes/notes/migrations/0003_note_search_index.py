@@ -0,0 +1,39 @@
+# Generated by Django 5.0.6 on 2026-10-18 07:12
+
+from django.db import migrations
+
+
+def create_search_index(apps, schema_editor):
+    """Creates the FTS5 search table and fills it from existing notes."""
+
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+
+    schema_editor.execute(
+        "CREATE VIRTUAL TABLE IF NOT EXISTS notes_note_fts "
+        "USING fts5(title, content, tokenize='unicode61 remove_diacritics 2')"
+    )
+    schema_editor.execute(
+        "INSERT INTO notes_note_fts (rowid, title, content) "
+        "SELECT id, title, content FROM notes_note"
+    )
+
+
+def drop_search_index(apps, schema_editor):
+    """Drops the FTS5 search table."""
+
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+
+    schema_editor.execute("DROP TABLE IF EXISTS notes_note_fts")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('notes', '0002_note_user_id_idx'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
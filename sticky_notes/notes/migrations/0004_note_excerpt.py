@@ -0,0 +1,47 @@
+# Generated by Django 5.0.6 on 2026-10-18 09:05
+
+from django.db import migrations, models
+from django.utils.text import Truncator
+
+# Copied from notes.models so the migration does not change with it
+EXCERPT_LENGTH = 200
+
+# Number of notes backfilled per UPDATE batch
+BATCH_SIZE = 1000
+
+
+def backfill_excerpts(apps, schema_editor):
+    """Fills in the excerpt of every existing note in batches."""
+
+    Note = apps.get_model('notes', 'Note')
+    notes = Note.objects.using(schema_editor.connection.alias)
+    last_pk = 0
+    while True:
+        batch = list(
+            notes.filter(pk__gt=last_pk).order_by('pk')
+            .only('pk', 'content')[:BATCH_SIZE]
+        )
+        if not batch:
+            break
+        for note in batch:
+            note.excerpt = Truncator(
+                ' '.join(note.content.split())
+            ).chars(EXCERPT_LENGTH)
+        notes.bulk_update(batch, ['excerpt'])
+        last_pk = batch[-1].pk
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('notes', '0003_note_search_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='note',
+            name='excerpt',
+            field=models.CharField(blank=True, editable=False, max_length=200),
+        ),
+        migrations.RunPython(backfill_excerpts, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,64 @@
+# Generated by Django 5.0.6 on 2026-10-18 10:20
+
+from django.db import migrations
+import notes.fields
+
+# Number of notes converted per batch
+BATCH_SIZE = 500
+
+
+def convert_content(schema_editor, convert):
+    """
+    Rewrites the content of every note whose stored form changes when
+    passed through `convert`, reading the rows in keyset batches.
+    """
+
+    last_pk = 0
+    with schema_editor.connection.cursor() as cursor:
+        while True:
+            cursor.execute(
+                "SELECT id, content FROM notes_note WHERE id > %s "
+                "ORDER BY id LIMIT %s",
+                [last_pk, BATCH_SIZE],
+            )
+            rows = cursor.fetchall()
+            if not rows:
+                break
+
+            changed = []
+            for pk, content in rows:
+                stored = convert(content)
+                if stored != content:
+                    changed.append((stored, pk))
+            if changed:
+                cursor.executemany(
+                    "UPDATE notes_note SET content = %s WHERE id = %s",
+                    changed,
+                )
+            last_pk = rows[-1][0]
+
+
+def compress_content(apps, schema_editor):
+    """Compresses the stored content of existing large notes."""
+    convert_content(schema_editor, notes.fields.compress)
+
+
+def decompress_content(apps, schema_editor):
+    """Restores the plain content of every compressed note."""
+    convert_content(schema_editor, notes.fields.decompress)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('notes', '0004_note_excerpt'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='note',
+            name='content',
+            field=notes.fields.CompressedTextField(),
+        ),
+        migrations.RunPython(compress_content, decompress_content),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.0.6 on 2026-10-18 11:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('notes', '0005_note_compressed_content'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='note',
+            name='updated',
+            field=models.DateTimeField(auto_now=True),
+        ),
+    ]
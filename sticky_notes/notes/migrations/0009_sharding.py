@@ -0,0 +1,129 @@
+# Generated by Django 5.0.6 on 2026-10-18 07:24
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+def user_field(apps, db_constraint):
+    """
+    Builds the owner field of the historical Note model.
+
+    :param apps: The historical app registry.
+    :param db_constraint: Whether the field has a foreign key
+        constraint.
+    :return: The field, attached to the Note model.
+    """
+
+    note_model = apps.get_model('notes', 'Note')
+    field = models.ForeignKey(
+        apps.get_model(settings.AUTH_USER_MODEL),
+        on_delete=django.db.models.deletion.CASCADE,
+        db_constraint=db_constraint,
+    )
+    field.set_attributes_from_name('user')
+    field.model = note_model
+    return field
+
+
+def drop_user_constraint(apps, schema_editor):
+    """
+    Drops the foreign key constraint on the owner of each note, on the
+    databases that do not hold the users.
+
+    Shard databases have only the notes tables, so a constraint on the
+    users table would reject every note written to them. The main
+    database keeps its constraint, so unsharded installs still have
+    the owner of each note checked by the database. Later migrations
+    that rebuild the notes table on a shard must drop it again.
+    """
+
+    user_model = apps.get_model(settings.AUTH_USER_MODEL)
+    connection = schema_editor.connection
+    if user_model._meta.db_table in connection.introspection.table_names():
+        return
+
+    schema_editor.alter_field(apps.get_model('notes', 'Note'),
+                              user_field(apps, db_constraint=True),
+                              user_field(apps, db_constraint=False))
+
+
+def restore_user_constraint(apps, schema_editor):
+    """Restores the foreign key constraint on the owner of each note,
+    on the databases that do not hold the users."""
+
+    user_model = apps.get_model(settings.AUTH_USER_MODEL)
+    connection = schema_editor.connection
+    if user_model._meta.db_table in connection.introspection.table_names():
+        return
+
+    schema_editor.alter_field(apps.get_model('notes', 'Note'),
+                              user_field(apps, db_constraint=False),
+                              user_field(apps, db_constraint=True))
+
+
+def create_tombstone_triggers(apps, schema_editor):
+    """Creates the triggers rejecting writes of moved users' notes."""
+
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+
+    for event in ('INSERT', 'UPDATE'):
+        schema_editor.execute(
+            f"CREATE TRIGGER IF NOT EXISTS notes_note_moved_{event.lower()} "
+            f"BEFORE {event} ON notes_note "
+            f"WHEN EXISTS (SELECT 1 FROM notes_shardtombstone "
+            f"WHERE user_id = NEW.user_id) "
+            f"BEGIN SELECT RAISE(ABORT, 'The notes of this user have moved "
+            f"to another database.'); END"
+        )
+
+
+def drop_tombstone_triggers(apps, schema_editor):
+    """Drops the triggers rejecting writes of moved users' notes."""
+
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+
+    for event in ('insert', 'update'):
+        schema_editor.execute(f"DROP TRIGGER IF EXISTS notes_note_moved_{event}")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('notes', '0008_task'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='NoteIdSequence',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('next_id', models.BigIntegerField()),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ShardTombstone',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('user_id', models.BigIntegerField(unique=True)),
+                ('moved', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='UserShard',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('shard', models.CharField(max_length=100)),
+                ('pinned', models.BooleanField(default=False)),
+                ('moved', models.DateTimeField(blank=True, null=True)),
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.RunPython(drop_user_constraint,
+                             restore_user_constraint),
+        migrations.RunPython(create_tombstone_triggers,
+                             drop_tombstone_triggers),
+    ]
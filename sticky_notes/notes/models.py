@@ -3,7 +3,19 @@
 """
 This module contains Django models for managing data for a simple
 Sticky Notes application. The provided model `Note` represents a sticky
-note with a user, title, and some content.
+note with a user, title, and some content (stored compressed when it is
+large, see 'notes.fields'), plus a short excerpt of the
+content that the noteboard shows instead of the full text, and the
+time it was last changed, which versions its cached noteboard card.
+The model `UserPurge` tracks a deleted account whose notes are being
+removed in the background, see 'notes.purge'. The model `Task` is a
+queued piece of deferred work for the task worker, see 'notes.tasks'.
+
+When notes are sharded across several databases (see 'notes.sharding'),
+`UserShard` records which database holds each user's notes,
+`NoteIdSequence` hands out note ids that are unique across all of them,
+and `ShardTombstone` marks users whose notes have moved out of a
+database.
 
 Each model in this module inherits from 'models.Model', making
 integration with Django's ORM straightforward.
@@ -11,6 +23,84 @@ integration with Django's ORM straightforward.
 
 from django.db import models
 from django.conf import settings
+from django.utils.text import Truncator
+from .fields import CompressedTextField
+
+# Maximum number of characters in a note's excerpt
+EXCERPT_LENGTH = 200
+
+
+def next_note_id():
+    """
+    Returns the primary key for a new note.
+
+    :return: An id from 'notes.sharding' when notes are sharded, so it
+        is unique across the shards and kept when the note moves to
+        another shard, or None to let the database pick one.
+    """
+
+    from .sharding import allocate_note_id
+    return allocate_note_id()
+
+
+def make_excerpt(content):
+    """
+    Builds the noteboard excerpt of a note's content.
+
+    :param content: The full note content.
+    :return: The content with runs of whitespace collapsed, truncated
+        to EXCERPT_LENGTH characters with an ellipsis if it is longer.
+    """
+
+    return Truncator(' '.join(content.split())).chars(EXCERPT_LENGTH)
+
+
+class NoteQuerySet(models.QuerySet):
+    """
+    QuerySet for notes, creating each note on its owner's database.
+
+    Methods
+    -------
+    create(self, **kwargs):
+        Creates and saves a note.
+    bulk_create(self, objs, *args, **kwargs):
+        Gives the notes ids from next_note_id(), then inserts them.
+    """
+
+    def create(self, **kwargs):
+        """
+        Creates and saves a note.
+
+        Django saves created objects to the queryset's database, which
+        the router picks without seeing the new row. Unless a database
+        was chosen with using(), the note is saved wherever the router
+        sends the note itself instead, which is its owner's shard when
+        notes are sharded.
+
+        :param kwargs: The note's field values.
+        :return: The saved Note instance.
+        """
+
+        if self._db is not None:
+            return super().create(**kwargs)
+
+        note = self.model(**kwargs)
+        note.save(force_insert=True)
+        return note
+
+    def bulk_create(self, objs, *args, **kwargs):
+        """
+        Gives the notes ids from next_note_id(), then inserts them.
+
+        :param objs: The unsaved Note instances.
+        :return: The inserted notes.
+        """
+
+        objs = list(objs)
+        for note in objs:
+            if note.pk is None:
+                note.pk = next_note_id()
+        return super().bulk_create(objs, *args, **kwargs)
 
 
 class Note(models.Model):
@@ -21,28 +111,352 @@ class Note(models.Model):
     -------------------
     user (models.ForeignKey):
         Field pointing to the user who created the note, links
-        to the user model.
+        to the user model. It has no database constraint, since the
+        users stay on the default database while the notes may be on
+        a shard.
     title: (models.CharField):
         Field holding the note's title, limited to 50 characters.
-    content (models.TextField):
-        Field for storing note content.
+    content (CompressedTextField):
+        Field for storing note content. Large content is stored
+        compressed and decompressed when first read.
+    excerpt (models.CharField):
+        Field holding the start of the content, limited to
+        EXCERPT_LENGTH characters. It is kept up to date by save(), so
+        the noteboard can show it without loading every full note.
+    updated (models.DateTimeField):
+        Field holding when the note was last saved. The noteboard
+        caches each note's card under this timestamp, see
+        'notes.board_cache'.
+
+    Meta class
+    ----------
+    Defines a composite index on (user, id) so that a user's notes can
+    be paginated by primary key without scanning other users' rows.
 
     Methods
     -------
+    save(self, *args, **kwargs):
+        Refreshes the excerpt from the content and, for partial saves,
+        the updated time, then saves the note.
     __str__(self):
        Returns a string representation of the Object's title.
 
     :param models.Model: Django's base model class.
     """
 
-    # Define fields for the Note model
+    # Define fields for the Note model; shards have no users table, so
+    # the owner's constraint is dropped there (see migration 0009)
     user = models.ForeignKey(
         settings.AUTH_USER_MODEL, on_delete=models.CASCADE
     )
     title = models.CharField(max_length=50)
-    content = models.TextField()
+    content = CompressedTextField()
+    excerpt = models.CharField(
+        max_length=EXCERPT_LENGTH, blank=True, editable=False
+    )
+    updated = models.DateTimeField(auto_now=True)
+
+    objects = NoteQuerySet.as_manager()
+
+    class Meta:
+        """
+        Meta subclass for specifying model behaviour options for Note.
+
+        Attributes
+        ----------
+        indexes (list):
+            A composite index on (user, id) used by the keyset
+            paginated noteboard.
+        """
+
+        indexes = [
+            models.Index(fields=['user', 'id'], name='note_user_id_idx'),
+        ]
+
+    def save(self, *args, **kwargs):
+        """
+        Refreshes the excerpt from the content and, for partial saves,
+        the updated time, then saves the note.
+
+        The excerpt is left alone if the content is not being saved or
+        was deferred and never loaded, since it cannot have changed.
+        This also avoids decompressing large content needlessly.
+
+        Saves limited to some fields still move the updated time on, so
+        the note's cached noteboard card is never served stale.
+
+        A new note is given its id from next_note_id() when notes are
+        sharded, and is then always inserted.
+        """
+
+        if self.pk is None and self._state.adding:
+            self.pk = next_note_id()
+            if self.pk is not None:
+                kwargs['force_insert'] = True
+
+        update_fields = kwargs.get('update_fields')
+        if update_fields:
+            kwargs['update_fields'] = update_fields = {*update_fields,
+                                                       'updated'}
+        saving_content = update_fields is None or 'content' in update_fields
+        if saving_content and 'content' not in self.get_deferred_fields():
+            self.excerpt = make_excerpt(self.content)
+
+            # Save the excerpt whenever the content is saved
+            if update_fields is not None:
+                kwargs['update_fields'] = {*update_fields, 'excerpt'}
+
+        super().save(*args, **kwargs)
 
     # Return title as a string
     def __str__(self):
         """Returns a string representation of the title of the note."""
         return self.title
+
+
+class UserPurge(models.Model):
+    """
+    Model tracking the background deletion of a user's account.
+
+    Deleting a user deactivates them at once and creates a UserPurge.
+    Their notes are then deleted in small batches by the 'purge_users'
+    management command, and the user is deleted once no notes are
+    left. The record is kept afterwards as a history of the deletion.
+
+    Attributes / Fields
+    -------------------
+    user (models.ForeignKey):
+        Field pointing to the user being deleted. It is cleared when
+        the user is finally deleted.
+    username (models.CharField):
+        Field holding the username, kept after the user is deleted.
+    requested (models.DateTimeField):
+        Field holding when the deletion was requested.
+    finished (models.DateTimeField):
+        Field holding when the user was deleted, or None while notes
+        are still being purged.
+    notes_total (models.PositiveIntegerField):
+        Field holding the number of notes the user had when the
+        deletion was requested.
+    notes_deleted (models.PositiveIntegerField):
+        Field holding the number of notes deleted so far.
+
+    Methods
+    -------
+    progress(self):
+        Returns the share of the notes deleted, as a percentage.
+    __str__(self):
+        Returns a string describing the purge.
+
+    :param models.Model: Django's base model class.
+    """
+
+    # Define fields for the UserPurge model
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL, on_delete=models.SET_NULL, null=True,
+        blank=True,
+    )
+    username = models.CharField(max_length=150)
+    requested = models.DateTimeField(auto_now_add=True)
+    finished = models.DateTimeField(null=True, blank=True)
+    notes_total = models.PositiveIntegerField(default=0)
+    notes_deleted = models.PositiveIntegerField(default=0)
+
+    def progress(self):
+        """Returns the share of the notes deleted, as a percentage."""
+
+        if self.finished or not self.notes_total:
+            return 100
+        return min(100, self.notes_deleted * 100 // self.notes_total)
+
+    # Return the username and state as a string
+    def __str__(self):
+        """Returns a string describing the purge."""
+
+        state = "finished" if self.finished else f"{self.progress()}%"
+        return f"Deletion of {self.username} ({state})"
+
+
+class Task(models.Model):
+    """
+    Model holding a piece of work queued for the background task
+    worker, see 'notes.tasks'.
+
+    Attributes / Fields
+    -------------------
+    name (models.CharField):
+        Field holding the dotted path of the task function.
+    args (models.JSONField):
+        Field holding the list of arguments the function is called
+        with.
+    key (models.CharField):
+        Field holding an optional idempotency key. Only one pending
+        task may have a given key, so queueing the same work twice
+        before it runs queues it once.
+    status (models.CharField):
+        Field holding whether the task is pending, running, done or
+        failed.
+    attempts (models.PositiveIntegerField):
+        Field holding the number of times the task has been started.
+    max_attempts (models.PositiveIntegerField):
+        Field holding the most times the task is started before it is
+        given up as failed.
+    run_after (models.DateTimeField):
+        Field holding the earliest time the task may start. Failed
+        attempts push it back.
+    created (models.DateTimeField):
+        Field holding when the task was queued.
+    started (models.DateTimeField):
+        Field holding when the latest attempt started.
+    finished (models.DateTimeField):
+        Field holding when the task finished or was given up.
+    error (models.TextField):
+        Field holding the traceback of the latest failed attempt.
+
+    Meta class
+    ----------
+    Defines an index on (status, run_after) so the worker finds the
+    next due task without scanning finished ones, and the uniqueness
+    of the key among pending tasks.
+
+    Methods
+    -------
+    __str__(self):
+        Returns a string describing the task.
+
+    :param models.Model: Django's base model class.
+    """
+
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = [
+        (PENDING, 'Pending'),
+        (RUNNING, 'Running'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+    ]
+
+    # Define fields for the Task model
+    name = models.CharField(max_length=200)
+    args = models.JSONField(default=list, blank=True)
+    key = models.CharField(max_length=200, null=True, blank=True)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES,
+                              default=PENDING)
+    attempts = models.PositiveIntegerField(default=0)
+    max_attempts = models.PositiveIntegerField(default=5)
+    run_after = models.DateTimeField()
+    created = models.DateTimeField(auto_now_add=True)
+    started = models.DateTimeField(null=True, blank=True)
+    finished = models.DateTimeField(null=True, blank=True)
+    error = models.TextField(blank=True)
+
+    class Meta:
+        """
+        Meta subclass for specifying model behaviour options for Task.
+
+        Attributes
+        ----------
+        indexes (list):
+            An index on (status, run_after) used to find due tasks.
+        constraints (list):
+            Keys unique among pending tasks.
+        """
+
+        indexes = [
+            models.Index(fields=['status', 'run_after'],
+                         name='task_status_run_after_idx'),
+        ]
+        constraints = [
+            models.UniqueConstraint(
+                fields=['key'], condition=models.Q(status='pending'),
+                name='task_pending_key_unique',
+            ),
+        ]
+
+    # Return the name and status as a string
+    def __str__(self):
+        """Returns a string describing the task."""
+        return f"{self.name} ({self.status})"
+
+
+class UserShard(models.Model):
+    """
+    Model recording which database holds a user's notes when notes are
+    sharded, see 'notes.sharding'. It is kept on the default database.
+
+    Attributes / Fields
+    -------------------
+    user (models.OneToOneField):
+        Field pointing to the user whose notes are placed.
+    shard (models.CharField):
+        Field holding the database alias of the user's notes.
+    pinned (models.BooleanField):
+        Field holding whether the user was placed by hand, so
+        rebalancing leaves them where they are.
+    moved (models.DateTimeField):
+        Field holding when the user's notes were last moved, or None
+        if they never were.
+
+    Methods
+    -------
+    __str__(self):
+        Returns a string describing the placement.
+
+    :param models.Model: Django's base model class.
+    """
+
+    # Define fields for the UserShard model
+    user = models.OneToOneField(
+        settings.AUTH_USER_MODEL, on_delete=models.CASCADE
+    )
+    shard = models.CharField(max_length=100)
+    pinned = models.BooleanField(default=False)
+    moved = models.DateTimeField(null=True, blank=True)
+
+    # Return the user and shard as a string
+    def __str__(self):
+        """Returns a string describing the placement."""
+        return f"{self.user} on {self.shard}"
+
+
+class NoteIdSequence(models.Model):
+    """
+    Model holding the next unsharded note id, in a single row on the
+    default database. Note ids are reserved from it in blocks, see
+    'notes.sharding'.
+
+    Attributes / Fields
+    -------------------
+    next_id (models.BigIntegerField):
+        Field holding the lowest id not yet handed out.
+
+    :param models.Model: Django's base model class.
+    """
+
+    # Define fields for the NoteIdSequence model
+    next_id = models.BigIntegerField()
+
+
+class ShardTombstone(models.Model):
+    """
+    Model marking a user whose notes have moved out of a database.
+
+    A trigger on the notes table rejects any insert or update of a
+    marked user's notes, so a write that was already on its way to the
+    old database when the user moved fails instead of being lost.
+
+    Attributes / Fields
+    -------------------
+    user_id (models.BigIntegerField):
+        Field holding the primary key of the user who moved out.
+    moved (models.DateTimeField):
+        Field holding when the user moved out.
+
+    :param models.Model: Django's base model class.
+    """
+
+    # Define fields for the ShardTombstone model
+    user_id = models.BigIntegerField(unique=True)
+    moved = models.DateTimeField(auto_now_add=True)
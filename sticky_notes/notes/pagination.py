@@ -0,0 +1,189 @@
+# notes/pagination.py
+
+"""
+This module provides keyset (cursor) pagination for the Sticky Notes
+application.
+
+Rather than using OFFSET, which forces the database to walk past every
+skipped row, each page is selected with a range condition on the
+primary key (``id > cursor`` or ``id < cursor``). Combined with the
+composite ``(user, id)`` index on the Note model, every page costs the
+same no matter how far through the noteboard the user has scrolled.
+"""
+
+from django.conf import settings
+from django.db.models import Exists
+
+# Default number of notes shown per noteboard page
+DEFAULT_PAGE_SIZE = 50
+
+
+def get_page_size():
+    """
+    Returns the configured noteboard page size.
+
+    :return: The value of the NOTES_PAGE_SIZE setting, or
+        DEFAULT_PAGE_SIZE if it has not been set.
+    """
+
+    return getattr(settings, 'NOTES_PAGE_SIZE', DEFAULT_PAGE_SIZE)
+
+
+def parse_cursor(value):
+    """
+    Converts a cursor taken from the query string into a primary key.
+
+    :param value: Raw cursor value from request.GET, or None.
+    :return: The cursor as a positive integer, or None if the value is
+        missing or malformed.
+    """
+
+    try:
+        cursor = int(value)
+    except (TypeError, ValueError):
+        return None
+
+    return cursor if cursor > 0 else None
+
+
+class KeysetPage:
+    """
+    A single page of results produced by keyset pagination.
+
+    Attributes
+    ----------
+    object_list (list):
+        The objects on this page, in ascending primary key order.
+    has_next (bool):
+        True if there are objects after this page.
+    has_previous (bool):
+        True if there are objects before this page.
+    next_cursor (int):
+        The cursor to request the following page, or None.
+    previous_cursor (int):
+        The cursor to request the preceding page, or None.
+    """
+
+    def __init__(self, object_list, has_next, has_previous):
+        """
+        Stores the page objects and works out the cursors for the
+        neighbouring pages.
+
+        :param object_list: The objects on this page.
+        :param has_next: Whether a following page exists.
+        :param has_previous: Whether a preceding page exists.
+        """
+
+        self.object_list = object_list
+        self.has_next = has_next and bool(object_list)
+        self.has_previous = has_previous and bool(object_list)
+        self.next_cursor = object_list[-1].pk if self.has_next else None
+        self.previous_cursor = (
+            object_list[0].pk if self.has_previous else None
+        )
+
+    def __iter__(self):
+        """Iterates over the objects on this page."""
+        return iter(self.object_list)
+
+    def __len__(self):
+        """Returns the number of objects on this page."""
+        return len(self.object_list)
+
+
+def _page_queryset(queryset, after, before, page_size):
+    """
+    Builds the sliced queryset for one page, fetching one extra row
+    beyond the page size.
+
+    Walking backwards, the cursor's own row may have been deleted, so
+    each row is annotated with whether any rows exist from the cursor
+    on. SQLite runs the uncorrelated subquery once, so this costs no
+    extra query.
+
+    :return: A (queryset, backwards) tuple, where backwards is True if
+        the rows come back in descending primary key order.
+    """
+
+    # Walk backwards from the cursor
+    if after is None and before is not None:
+        later = queryset.filter(pk__gte=before)
+        queryset = queryset.filter(pk__lt=before).annotate(
+            keyset_has_later=Exists(later)
+        ).order_by('-pk')
+        return queryset[:page_size + 1], True
+
+    # Walk forwards from the cursor (or from the start of the board)
+    queryset = queryset.order_by('pk')
+    if after is not None:
+        queryset = queryset.filter(pk__gt=after)
+    return queryset[:page_size + 1], False
+
+
+def _build_page(rows, after, page_size, backwards):
+    """
+    Turns the rows fetched by _page_queryset() into a KeysetPage.
+
+    :return: A KeysetPage instance.
+    """
+
+    has_more = len(rows) > page_size
+    rows = rows[:page_size]
+
+    # Restore ascending order after walking backwards
+    if backwards:
+        has_later = bool(rows) and rows[0].keyset_has_later
+        rows.reverse()
+        return KeysetPage(rows, has_next=has_later, has_previous=has_more)
+
+    return KeysetPage(
+        rows, has_next=has_more, has_previous=after is not None
+    )
+
+
+def keyset_paginate(queryset, after=None, before=None, page_size=None):
+    """
+    Returns one page of a queryset using keyset pagination on the
+    primary key.
+
+    One extra row is fetched beyond the page size to find out whether
+    another page exists in the direction of travel, so no COUNT query
+    is needed.
+
+    :param queryset: The queryset to paginate.
+    :param after: Return the page that follows this primary key.
+    :param before: Return the page that precedes this primary key.
+        Ignored if `after` is given.
+    :param page_size: Number of objects per page. Defaults to the
+        NOTES_PAGE_SIZE setting.
+    :return: A KeysetPage instance.
+    """
+
+    if page_size is None:
+        page_size = get_page_size()
+
+    queryset, backwards = _page_queryset(queryset, after, before, page_size)
+    return _build_page(list(queryset), after, page_size, backwards)
+
+
+async def akeyset_paginate(queryset, after=None, before=None,
+                           page_size=None):
+    """
+    Async version of keyset_paginate(), fetching the page with async
+    iteration over the queryset.
+
+    :param queryset: The queryset to paginate.
+    :param after: Return the page that follows this primary key.
+    :param before: Return the page that precedes this primary key.
+        Ignored if `after` is given.
+    :param page_size: Number of objects per page. Defaults to the
+        NOTES_PAGE_SIZE setting.
+    :return: A KeysetPage instance.
+    """
+
+    if page_size is None:
+        page_size = get_page_size()
+
+    queryset, backwards = _page_queryset(queryset, after, before, page_size)
+    rows = [row async for row in queryset]
+    return _build_page(rows, after, page_size, backwards)
@@ -0,0 +1,230 @@
+# notes/purge.py
+
+"""
+This module deletes user accounts in the background, so deleting a
+user with many notes never holds the database write lock for long.
+
+Deleting a user through Django's cascade removes every note in a single
+transaction, and SQLite lets no other request write until it commits.
+Instead, request_user_deletion() only deactivates the user, which logs
+them out everywhere and stops them from logging in, records a
+UserPurge and queues purge_user() for the task worker in 'notes.tasks'.
+The task then deletes the notes in batches of NOTES_PURGE_BATCH_SIZE,
+each in its own short transaction, pausing NOTES_PURGE_PAUSE seconds
+between batches so other writers get the lock in between. Once no notes
+are left the user row itself is deleted, which is quick, and a merge of
+the search index is queued to drop the deleted entries. Progress is
+saved after every batch and shown on the UserPurge admin page, and an
+interrupted purge carries on where it stopped when the task is retried.
+The 'purge_users' management command runs every unfinished purge
+directly, without the worker. When notes are sharded, the notes are
+deleted from the user's shard while the UserPurge and the user stay on
+the default database.
+"""
+
+import time
+from django.conf import settings
+from django.db import connections, transaction
+from django.utils import timezone
+from .models import Note, UserPurge
+from .routers import record_write
+from .sharding import notes_database
+from .tasks import background_task, enqueue
+from . import board_cache, search
+
+# Default number of notes deleted per transaction
+DEFAULT_PURGE_BATCH_SIZE = 500
+
+# Default seconds to wait between batches
+DEFAULT_PURGE_PAUSE = 0.2
+
+
+def get_purge_throttle():
+    """
+    Returns how fast purges delete notes.
+
+    :return: A (batch_size, pause) tuple from the NOTES_PURGE_BATCH_SIZE
+        and NOTES_PURGE_PAUSE settings, or the defaults if they have not
+        been set.
+    """
+
+    return (
+        getattr(settings, 'NOTES_PURGE_BATCH_SIZE', DEFAULT_PURGE_BATCH_SIZE),
+        getattr(settings, 'NOTES_PURGE_PAUSE', DEFAULT_PURGE_PAUSE),
+    )
+
+
+def request_user_deletion(user, using='default'):
+    """
+    Deactivates a user and queues their account for deletion by the
+    task worker.
+
+    :param user: The user to delete.
+    :param using: Database alias holding the user.
+    :return: The UserPurge tracking the deletion.
+    """
+
+    record_write()
+    with transaction.atomic(using=using):
+        user.is_active = False
+        user.save(update_fields=['is_active'], using=using)
+
+        purge = UserPurge.objects.using(using).filter(
+            user=user, finished__isnull=True
+        ).first()
+        if purge is None:
+            purge = UserPurge.objects.using(using).create(
+                user=user,
+                username=user.get_username(),
+                notes_total=Note.objects.using(
+                    notes_database(user.pk, using)
+                ).filter(user=user).count(),
+            )
+
+        # Queued with the purge, so the worker sees both or neither
+        enqueue(purge_user, purge.pk, using, key=f'purge-user:{purge.pk}',
+                using=using)
+
+    return purge
+
+
+def delete_note_batch(purge, batch_size, using='default'):
+    """
+    Deletes one batch of a purged user's notes in one transaction.
+
+    The batch is deleted with a single DELETE statement, as in the bulk
+    API, rather than QuerySet.delete(), which would load every note to
+    send the model signals one at a time.
+
+    :param purge: The UserPurge being worked on.
+    :param batch_size: Most notes deleted.
+    :param using: Database alias holding the purge, and the notes when
+        they are not sharded.
+    :return: The number of notes deleted.
+    """
+
+    notes_using = notes_database(purge.user_id, using)
+    with transaction.atomic(using=notes_using):
+        ids = list(
+            Note.objects.using(notes_using).filter(user_id=purge.user_id)
+            .order_by('pk').values_list('pk', flat=True)[:batch_size]
+        )
+        if not ids:
+            return 0
+
+        placeholders = ", ".join(["%s"] * len(ids))
+        with connections[notes_using].cursor() as cursor:
+            cursor.execute(
+                f"DELETE FROM {Note._meta.db_table} "
+                f"WHERE id IN ({placeholders})",
+                ids,
+            )
+        search.unindex_notes(ids, using=notes_using)
+        board_cache.bump_board_version_on_commit(purge.user_id, notes_using)
+
+    # Record the progress once the batch is committed, so it is never
+    # overstated
+    purge.notes_deleted += len(ids)
+    purge.save(update_fields=['notes_deleted'], using=using)
+
+    return len(ids)
+
+
+def finish_purge(purge, using='default'):
+    """
+    Deletes a purged user once their notes are gone.
+
+    :param purge: The UserPurge being worked on.
+    :param using: Database alias holding the user.
+    """
+
+    notes_using = notes_database(purge.user_id, using)
+    with transaction.atomic(using=using):
+        # Any notes left over are few, so the cascade removes them quickly
+        if purge.user is not None:
+            purge.user.delete(using=using)
+        purge.user = None
+        purge.finished = timezone.now()
+        purge.save(update_fields=['user', 'finished'], using=using)
+        search.schedule_optimize(notes_using)
+
+
+def run_purge(purge, batch_size=None, pause=None, using='default',
+              progress=None):
+    """
+    Deletes a user's notes batch by batch, then the user.
+
+    :param purge: The UserPurge to work on.
+    :param batch_size: Number of notes deleted per transaction.
+        Defaults to the NOTES_PURGE_BATCH_SIZE setting.
+    :param pause: Seconds to wait between batches. Defaults to the
+        NOTES_PURGE_PAUSE setting.
+    :param using: Database alias to delete from.
+    :param progress: Optional callable, given the UserPurge after each
+        batch.
+    :return: The number of notes deleted by this call.
+    """
+
+    default_batch_size, default_pause = get_purge_throttle()
+    batch_size = batch_size or default_batch_size
+    pause = default_pause if pause is None else pause
+
+    total = 0
+    while purge.user_id is not None:
+        deleted = delete_note_batch(purge, batch_size, using)
+        if not deleted:
+            break
+        total += deleted
+        if progress is not None:
+            progress(purge)
+        if pause:
+            time.sleep(pause)
+
+    finish_purge(purge, using)
+    return total
+
+
+@background_task()
+def purge_user(purge_id, using='default'):
+    """
+    Task running one queued purge to the end.
+
+    Nothing is done if the purge has already finished, for example
+    through the 'purge_users' command.
+
+    :param purge_id: Primary key of the UserPurge.
+    :param using: Database alias to delete from.
+    """
+
+    purge = UserPurge.objects.using(using).select_related('user').filter(
+        pk=purge_id, finished__isnull=True
+    ).first()
+    if purge is not None:
+        run_purge(purge, using=using)
+
+
+def purge_pending(batch_size=None, pause=None, using='default',
+                  progress=None):
+    """
+    Runs every unfinished purge, oldest first.
+
+    :param batch_size: Number of notes deleted per transaction.
+        Defaults to the NOTES_PURGE_BATCH_SIZE setting.
+    :param pause: Seconds to wait between batches. Defaults to the
+        NOTES_PURGE_PAUSE setting.
+    :param using: Database alias to delete from.
+    :param progress: Optional callable, given the UserPurge after each
+        batch.
+    :return: The number of users deleted.
+    """
+
+    purges = UserPurge.objects.using(using).filter(
+        finished__isnull=True
+    ).select_related('user').order_by('requested', 'pk')
+
+    count = 0
+    for purge in purges:
+        run_purge(purge, batch_size, pause, using, progress)
+        count += 1
+
+    return count
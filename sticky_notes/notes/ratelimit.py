@@ -0,0 +1,146 @@
+# notes/ratelimit.py
+
+"""
+This module limits how often the signup and login forms can be
+submitted, so bursts of signups or credential stuffing cannot tie up
+every worker with password hashing.
+
+Each submission takes a token from two token buckets held in Django's
+cache: one for the client's IP address and one for the username in
+the form. A bucket holds up to `capacity` tokens and refills at
+`capacity` tokens per `period` seconds, so short bursts are allowed
+while the sustained rate stays bounded. When either bucket is empty the
+request is rejected with a plain 429 response before the view runs, so
+no password is hashed and no template is rendered.
+
+The limits for each route are set in the NOTES_RATE_LIMITS setting:
+
+    NOTES_RATE_LIMITS = {
+        "login": {"ip": (20, 60), "username": (5, 60)},
+    }
+
+Here each IP address may submit the login form 20 times in a burst and
+20 times a minute after that, and each username 5 times. Routes or
+bucket kinds missing from the setting are not limited.
+
+Buckets are read and written with separate cache calls, so concurrent
+requests can occasionally take the same token. The limit is for
+shedding load, so this small overshoot is accepted rather than adding
+locks.
+"""
+
+import math
+import time
+from functools import wraps
+from django.conf import settings
+from django.core.cache import cache
+from django.http import HttpResponse
+
+# Default limits, as (capacity, period in seconds), for each route
+DEFAULT_RATE_LIMITS = {
+    "signup": {"ip": (5, 60)},
+    "login": {"ip": (20, 60), "username": (5, 60)},
+}
+
+
+def get_rate_limits(route):
+    """
+    Returns the token bucket limits of a route.
+
+    :param route: The name of the limited route, such as 'login'.
+    :return: A dictionary mapping bucket kinds ('ip', 'username') to
+        (capacity, period) tuples, from the NOTES_RATE_LIMITS setting or
+        DEFAULT_RATE_LIMITS if it has not been set.
+    """
+
+    limits = getattr(settings, 'NOTES_RATE_LIMITS', DEFAULT_RATE_LIMITS)
+    return limits.get(route, {})
+
+
+def _bucket_key(route, kind, value):
+    """Returns the cache key of a token bucket."""
+    return f'notes:ratelimit:{route}:{kind}:{value}'
+
+
+def take_token(key, capacity, period, now=None):
+    """
+    Takes a token from a bucket if one is available.
+
+    :param key: The bucket's cache key.
+    :param capacity: Most tokens the bucket holds.
+    :param period: Seconds taken to refill an empty bucket.
+    :param now: The current time, for tests. Defaults to time.time().
+    :return: 0 if a token was taken, otherwise the number of seconds
+        until the next token is available.
+    """
+
+    if now is None:
+        now = time.time()
+    rate = capacity / period
+
+    # Top the bucket up for the time since it was last used
+    tokens, updated = cache.get(key, (capacity, now))
+    tokens = min(capacity, tokens + (now - updated) * rate)
+
+    if tokens < 1:
+        cache.set(key, (tokens, now), timeout=math.ceil(period))
+        return (1 - tokens) / rate
+
+    cache.set(key, (tokens - 1, now), timeout=math.ceil(period))
+    return 0
+
+
+def check_rate_limit(request, route):
+    """
+    Takes a token from each of a request's buckets for a route.
+
+    :param request: HTTP request object.
+    :param route: The name of the limited route.
+    :return: 0 if the request may go ahead, otherwise the number of
+        seconds the client should wait.
+    """
+
+    values = {
+        "ip": request.META.get('REMOTE_ADDR', ''),
+        "username": request.POST.get('username', '').strip().lower(),
+    }
+    wait = 0
+    for kind, (capacity, period) in get_rate_limits(route).items():
+        if values.get(kind):
+            key = _bucket_key(route, kind, values[kind])
+            wait = max(wait, take_token(key, capacity, period))
+
+    return wait
+
+
+def rate_limit(route):
+    """
+    Decorator limiting how often a view's form can be submitted.
+
+    Only POST requests take tokens, so the form itself can always be
+    displayed.
+
+    :param route: The name of the route in NOTES_RATE_LIMITS.
+    :return: A decorator for sync view functions.
+    """
+
+    def decorator(view):
+        """Wraps the view with the rate limit check."""
+
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            if request.method == 'POST':
+                wait = check_rate_limit(request, route)
+                if wait:
+                    # Reject without rendering or hashing anything
+                    response = HttpResponse(
+                        "Too many attempts. Please try again later.\n",
+                        content_type='text/plain', status=429,
+                    )
+                    response['Retry-After'] = math.ceil(wait)
+                    return response
+            return view(request, *args, **kwargs)
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,299 @@
+# notes/rebalance.py
+
+"""
+This module moves users' notes between the shard databases while the
+app keeps serving them, for the 'rebalance_shards' management command.
+
+A move copies the user's notes to the target database in batches of
+NOTES_SHARD_MOVE_BATCH_SIZE rows, each in its own transaction and
+followed by a pause of NOTES_SHARD_MOVE_PAUSE seconds, so the user can
+go on reading and writing their notes meanwhile. The rows are copied
+as stored, so compressed content is never decompressed, and the search
+index entries are copied with them.
+
+The cutover is then done in one short transaction on the source
+database. It first adds a ShardTombstone row for the user there, which
+takes SQLite's write lock, and from then on a trigger on the notes
+table rejects any write of the user's notes to that database. Inside
+the transaction, the notes changed or added since they were copied are
+found by comparing their 'updated' times and copied again, notes
+deleted meanwhile are deleted from the target, and the user's
+UserShard placement on 'default' is pointed at the target.
+
+Once the transaction commits, new requests use the target database.
+Processes that cached the old placement keep using the source until
+the cache entry expires, up to NOTES_SHARD_CACHE_TIMEOUT seconds,
+unless they share the cache; their reads find no notes and their
+writes fail rather than being lost silently. The user's notes are
+finally deleted from the source in batches, and its search index is
+merged later by the task worker.
+
+A user who is moved back to a database they left has its tombstone
+removed before the copy starts.
+"""
+
+import time
+from django.conf import settings
+from django.db import connections, transaction
+from django.utils import timezone
+from . import board_cache, search, sharding
+from .models import Note, ShardTombstone, UserPurge, UserShard
+
+# Default number of notes copied or deleted per transaction
+DEFAULT_MOVE_BATCH_SIZE = 500
+
+# Default seconds to pause between batches
+DEFAULT_MOVE_PAUSE = 0.2
+
+# Most ids in one IN (...) list, well below SQLite's variable limit
+MAX_IN_IDS = 500
+
+
+def get_move_settings():
+    """
+    Returns how users are moved between databases.
+
+    :return: A (batch_size, pause) tuple from the
+        NOTES_SHARD_MOVE_BATCH_SIZE and NOTES_SHARD_MOVE_PAUSE settings,
+        or the defaults if they have not been set.
+    """
+
+    return (
+        getattr(settings, 'NOTES_SHARD_MOVE_BATCH_SIZE',
+                DEFAULT_MOVE_BATCH_SIZE),
+        getattr(settings, 'NOTES_SHARD_MOVE_PAUSE', DEFAULT_MOVE_PAUSE),
+    )
+
+
+def note_columns():
+    """Returns the columns of the notes table, primary key first."""
+    return [field.column for field in Note._meta.concrete_fields]
+
+
+def read_rows(user_id, using, after=0, limit=None, ids=None):
+    """
+    Reads a user's note rows as stored, in primary key order.
+
+    :param user_id: Primary key of the user.
+    :param using: Database alias to read from.
+    :param after: Only read notes with a higher primary key.
+    :param limit: Most rows read, or None for all of them.
+    :param ids: Only read the notes with these primary keys, at most
+        MAX_IN_IDS of them.
+    :return: A list of row tuples, in note_columns() order.
+    """
+
+    table = Note._meta.db_table
+    sql = (f"SELECT {', '.join(note_columns())} FROM {table} "
+           f"WHERE user_id = %s AND id > %s")
+    params = [user_id, after]
+    if ids is not None:
+        sql += f" AND id IN ({', '.join(['%s'] * len(ids))})"
+        params += list(ids)
+    sql += " ORDER BY id"
+    if limit is not None:
+        sql += " LIMIT %s"
+        params.append(limit)
+
+    with connections[using].cursor() as cursor:
+        cursor.execute(sql, params)
+        return cursor.fetchall()
+
+
+def write_rows(rows, source, target):
+    """
+    Writes note rows read with read_rows() to another database,
+    replacing any older copies, and copies their index entries.
+
+    :param rows: The rows to write.
+    :param source: Database alias the rows were read from.
+    :param target: Database alias to write them to.
+    """
+
+    if not rows:
+        return
+
+    columns = note_columns()
+    with connections[target].cursor() as cursor:
+        cursor.executemany(
+            f"INSERT OR REPLACE INTO {Note._meta.db_table} "
+            f"({', '.join(columns)}) "
+            f"VALUES ({', '.join(['%s'] * len(columns))})",
+            rows,
+        )
+
+    pks = [row[0] for row in rows]
+    search.unindex_notes(pks, using=target)
+    search.index_rows(search.read_index_rows(pks, using=source),
+                      using=target)
+
+
+def delete_rows(pks, using):
+    """
+    Deletes notes and their index entries without loading them.
+
+    :param pks: Primary keys of the notes, at most MAX_IN_IDS of them.
+    :param using: Database alias to delete from.
+    """
+
+    if not pks:
+        return
+
+    with connections[using].cursor() as cursor:
+        cursor.execute(
+            f"DELETE FROM {Note._meta.db_table} "
+            f"WHERE id IN ({', '.join(['%s'] * len(pks))})",
+            list(pks),
+        )
+    search.unindex_notes(pks, using=using)
+
+
+def read_versions(user_id, using):
+    """
+    Reads when each of a user's notes was last changed.
+
+    :param user_id: Primary key of the user.
+    :param using: Database alias to read from.
+    :return: A dictionary of raw 'updated' values by note primary key.
+    """
+
+    with connections[using].cursor() as cursor:
+        cursor.execute(
+            f"SELECT id, updated FROM {Note._meta.db_table} "
+            f"WHERE user_id = %s", [user_id]
+        )
+        return dict(cursor.fetchall())
+
+
+def chunked(items, size=MAX_IN_IDS):
+    """Yields successive lists of at most size items."""
+
+    items = list(items)
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def move_user(user_id, target, batch_size=None, pause=None, pin=False,
+              progress=None):
+    """
+    Moves a user's notes to another database while they stay in use.
+
+    :param user_id: Primary key of the user.
+    :param target: Database alias to move the notes to.
+    :param batch_size: Notes copied or deleted per transaction.
+        Defaults to NOTES_SHARD_MOVE_BATCH_SIZE.
+    :param pause: Seconds to pause between batches. Defaults to
+        NOTES_SHARD_MOVE_PAUSE.
+    :param pin: Whether to keep the user on the target when shards are
+        rebalanced later.
+    :param progress: Optional callable, given the running total of
+        copied notes after each batch.
+    :return: The number of notes on the target after the move.
+    :raises ValueError: If notes are not sharded, or the target is not
+        a database notes may be stored on.
+    """
+
+    if not sharding.is_enabled():
+        raise ValueError("Notes are not sharded.")
+    if target not in sharding.note_databases():
+        raise ValueError(f"'{target}' is not a notes database.")
+
+    default_batch_size, default_pause = get_move_settings()
+    batch_size = batch_size or default_batch_size
+    pause = default_pause if pause is None else pause
+
+    source = sharding.place_user(user_id)
+    if source == target:
+        UserShard.objects.using('default').filter(user_id=user_id).update(
+            pinned=pin
+        )
+        return len(read_versions(user_id, target))
+
+    # Let the user's notes be written to the target again
+    ShardTombstone.objects.using(target).filter(user_id=user_id).delete()
+
+    # Copy the notes while the user keeps working on the source
+    copied = after = 0
+    while True:
+        rows = read_rows(user_id, source, after=after, limit=batch_size)
+        with transaction.atomic(using=target):
+            write_rows(rows, source, target)
+        copied += len(rows)
+        if progress is not None and rows:
+            progress(copied)
+        if len(rows) < batch_size:
+            break
+        after = rows[-1][0]
+        time.sleep(pause)
+
+    # Inserting the tombstone first takes the source's write lock at
+    # once, then the trigger blocks the user's writes
+    with transaction.atomic(using=source):
+        ShardTombstone.objects.using(source).bulk_create(
+            [ShardTombstone(user_id=user_id)], ignore_conflicts=True,
+        )
+
+        # Catch up with the changes made during the copy
+        source_versions = read_versions(user_id, source)
+        target_versions = read_versions(user_id, target)
+        changed = [pk for pk, updated in source_versions.items()
+                   if target_versions.get(pk) != updated]
+        removed = [pk for pk in target_versions if pk not in source_versions]
+        with transaction.atomic(using=target):
+            for pks in chunked(changed):
+                write_rows(read_rows(user_id, source, ids=pks), source,
+                           target)
+            for pks in chunked(removed):
+                delete_rows(pks, target)
+
+        UserShard.objects.using('default').update_or_create(
+            user_id=user_id,
+            defaults={'shard': target, 'pinned': pin,
+                      'moved': timezone.now()},
+        )
+
+    sharding.remember_placement(user_id, target)
+    board_cache.bump_board_version(user_id)
+
+    # Remove the copies left on the source
+    for pks in chunked(source_versions, batch_size):
+        with transaction.atomic(using=source):
+            delete_rows(pks, source)
+        time.sleep(pause)
+    search.schedule_optimize(source)
+
+    return len(source_versions)
+
+
+def plan_rebalance():
+    """
+    Finds the users whose notes are not on the shard hash_shard() picks
+    for them.
+
+    Pinned users and users being purged are left where they are.
+
+    :return: A list of (user_id, source, target) tuples, by user id.
+    """
+
+    placements = UserShard.objects.using('default')
+    placed = dict(placements.values_list('user_id', 'shard'))
+    pinned = set(placements.filter(pinned=True)
+                 .values_list('user_id', flat=True))
+    purging = set(UserPurge.objects.using('default')
+                  .filter(finished__isnull=True, user__isnull=False)
+                  .values_list('user_id', flat=True))
+
+    # Users who have notes from before sharding but were never placed
+    legacy = set(Note.objects.using('default').order_by()
+                 .values_list('user_id', flat=True).distinct())
+
+    moves = []
+    for user_id in sorted(set(placed) | legacy):
+        if user_id in pinned or user_id in purging:
+            continue
+        source = placed.get(user_id, 'default')
+        target = sharding.hash_shard(user_id)
+        if source != target:
+            moves.append((user_id, source, target))
+
+    return moves
@@ -0,0 +1,289 @@
+# notes/routers.py
+
+"""
+This module contains the database routers for the notes app.
+
+ShardRouter sends each user's notes to the database holding them when
+notes are sharded across the NOTES_SHARDS databases, see
+'notes.sharding'. Queries made through a note or a user are routed by
+that note's owner or that user; other note queries made while handling
+a request are routed by the logged-in user, whom
+'notes.middleware.ReplicaRoutingMiddleware' records in the routing
+state. When notes are not sharded it leaves every query to the next
+router.
+
+Reads made while handling the views named in NOTES_REPLICA_VIEWS (the
+noteboard and note reading views) are sent by ReplicaRouter to one of
+the database aliases in NOTES_READ_REPLICAS. All writes, and every
+other read, go to the primary 'default' database. Models from other
+apps (users, sessions, admin) are left to Django's default routing.
+
+Routers are not given the request, so the per-request routing state is
+kept in a context variable that 'notes.middleware.ReplicaRoutingMiddleware'
+sets up. The middleware also gives read-your-writes stickiness: after a
+request writes to the notes app, the client's reads stay on the primary
+for NOTES_REPLICA_PIN_SECONDS so the redirect back to the noteboard
+never shows stale data from a lagging replica.
+"""
+
+import random
+from contextvars import ContextVar
+from django.conf import settings
+from . import sharding
+
+# Routing state of the request being handled, if any
+_routing_state = ContextVar('notes_routing_state', default=None)
+
+
+class RoutingState:
+    """
+    Per-request routing state shared by the middleware and the router.
+
+    Attributes
+    ----------
+    use_replica (bool):
+        True if the view being handled may read from a replica.
+    pinned (bool):
+        True if the client wrote recently and must read the primary.
+    wrote (bool):
+        True once the request has written to the notes app.
+    user_id (int):
+        Primary key of the logged-in user whose notes the request
+        works on, or None. Only set when notes are sharded.
+    shard (str):
+        The database holding that user's notes, or None.
+    """
+
+    def __init__(self, pinned=False):
+        """
+        Creates the state for a new request.
+
+        :param pinned: Whether the client is pinned to the primary.
+        """
+
+        self.use_replica = False
+        self.pinned = pinned
+        self.wrote = False
+        self.user_id = None
+        self.shard = None
+
+
+def get_routing_state():
+    """
+    Returns the routing state of the request being handled.
+
+    :return: A RoutingState instance, or None outside of a request.
+    """
+
+    return _routing_state.get()
+
+
+def set_routing_state(state):
+    """
+    Sets the routing state for the current context.
+
+    :param state: A RoutingState instance, or None.
+    :return: A token that can be passed to reset_routing_state().
+    """
+
+    return _routing_state.set(state)
+
+
+def reset_routing_state(token):
+    """
+    Restores the routing state that was set before set_routing_state().
+
+    :param token: The token returned by set_routing_state().
+    """
+
+    _routing_state.reset(token)
+
+
+def record_write():
+    """
+    Records that the request being handled wrote to the notes app, so
+    the middleware pins the client to the primary.
+
+    The routers record writes they route, but writes made on an
+    explicit database with using() or a raw cursor never reach them,
+    so the helpers making such writes call this themselves.
+    """
+
+    state = get_routing_state()
+    if state is not None:
+        state.wrote = True
+
+
+def get_read_replicas():
+    """
+    Returns the database aliases that notes may be read from.
+
+    :return: The NOTES_READ_REPLICAS setting, or an empty list.
+    """
+
+    return getattr(settings, 'NOTES_READ_REPLICAS', [])
+
+
+def reads_from_replica():
+    """
+    Checks whether notes reads in the current context may be served by
+    a replica, which can lag behind the primary.
+
+    :return: True if replicas are configured and the request being
+        handled is routed to them, False otherwise.
+    """
+
+    state = get_routing_state()
+    return (state is not None and state.use_replica and not state.pinned
+            and bool(get_read_replicas()))
+
+
+class ShardRouter:
+    """
+    Routes each user's notes to their shard when notes are sharded.
+
+    Methods
+    -------
+    db_for_read(self, model, **hints):
+        Picks the shard of the notes being read.
+    db_for_write(self, model, **hints):
+        Picks the shard of the notes being written.
+    allow_relation(self, obj1, obj2, **hints):
+        Allows notes on a shard to refer to users on 'default'.
+    allow_migrate(self, db, app_label, model_name=None, **hints):
+        Keeps only the notes tables on the shards.
+    """
+
+    app_label = 'notes'
+
+    # Models stored on the shards
+    sharded_models = {'note'}
+
+    # Models whose tables are created on the shards
+    shard_tables = {'note', 'shardtombstone'}
+
+    def is_sharded(self, model):
+        """Checks whether a model or instance is stored on a shard."""
+
+        return (model._meta.app_label == self.app_label
+                and model._meta.model_name in self.sharded_models)
+
+    def _route(self, model, hints):
+        """Returns the shard of the notes a query works on, if known."""
+
+        if not sharding.is_enabled():
+            return None
+
+        instance = hints.get('instance')
+        if not self.is_sharded(model):
+            # Users and other rows reached from a note live on 'default'
+            if instance is not None and self.is_sharded(instance):
+                return 'default'
+            return None
+
+        state = get_routing_state()
+        if instance is not None and self.is_sharded(instance):
+            user_id = instance.user_id
+        elif instance is not None:
+            # Notes reached through their user, as in user.note_set
+            user_id = instance.pk
+        else:
+            user_id = state.user_id if state is not None else None
+
+        if user_id is None:
+            return None
+        # The request's own user was placed by the middleware
+        if state is not None and state.shard and state.user_id == user_id:
+            return state.shard
+        return sharding.shard_for_user(user_id)
+
+    def db_for_read(self, model, **hints):
+        """Picks the shard of the notes being read."""
+        return self._route(model, hints)
+
+    def db_for_write(self, model, **hints):
+        """Picks the shard of the notes being written."""
+
+        # This router answers before ReplicaRouter, so record the write
+        if self.is_sharded(model) and sharding.is_enabled():
+            record_write()
+        return self._route(model, hints)
+
+    def allow_relation(self, obj1, obj2, **hints):
+        """Allows notes on a shard to refer to users on 'default'."""
+
+        if not sharding.is_enabled():
+            return None
+        if self.is_sharded(obj1) or self.is_sharded(obj2):
+            databases = {'default', *sharding.get_shards()}
+            if obj1._state.db in databases and obj2._state.db in databases:
+                return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        """Keeps only the notes tables on the shards."""
+
+        if db == 'default' or db not in sharding.get_shards():
+            return None
+        return (app_label == self.app_label
+                and model_name in {None, *self.shard_tables})
+
+
+class ReplicaRouter:
+    """
+    Routes reads of the notes app to a replica during replica-enabled
+    views, and all of its writes to the primary.
+
+    Methods
+    -------
+    db_for_read(self, model, **hints):
+        Picks a replica for notes reads when the request allows it.
+    db_for_write(self, model, **hints):
+        Sends notes writes to the primary and records the write.
+    allow_relation(self, obj1, obj2, **hints):
+        Allows relations between the primary and its replicas.
+    allow_migrate(self, db, app_label, model_name=None, **hints):
+        Prevents migrations from running on replicas.
+    """
+
+    app_label = 'notes'
+
+    def db_for_read(self, model, **hints):
+        """Picks a replica for notes reads when the request allows
+        it."""
+
+        if model._meta.app_label != self.app_label:
+            return None
+
+        state = get_routing_state()
+        replicas = get_read_replicas()
+        if state is None or not replicas:
+            return None
+        if not state.use_replica or state.pinned:
+            return 'default'
+
+        return random.choice(replicas)
+
+    def db_for_write(self, model, **hints):
+        """Sends notes writes to the primary and records the write."""
+
+        if model._meta.app_label != self.app_label:
+            return None
+
+        record_write()
+        return 'default'
+
+    def allow_relation(self, obj1, obj2, **hints):
+        """Allows relations between the primary and its replicas."""
+
+        databases = {'default', *get_read_replicas()}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        """Prevents migrations from running on replicas."""
+
+        if db in get_read_replicas():
+            return False
+        return None
@@ -0,0 +1,285 @@
+# notes/search.py
+
+"""
+This module provides full-text search over notes using an SQLite FTS5
+virtual table.
+
+The table `notes_note_fts` is a shadow index holding a copy of each
+note's title and content, keyed by the note's primary key (the FTS5
+rowid). It is kept in sync by the signal handlers in 'notes.signals'
+and can be rebuilt from scratch with the 'rebuild_search_index'
+management command. Searches are ranked with bm25 and are always
+restricted to the notes of a single user.
+
+The index stores the text it was given, uncompressed, even for notes
+whose content 'notes.fields' stores compressed. A contentless or
+external-content table would avoid the copy, but FTS5 can only delete
+an entry from one given the exact text that was indexed, which the
+signal handlers no longer have once a note has been saved, and SQLite
+only gained contentless_delete in 3.43. The copy is measured in the
+README: compression still shrinks the database file by about a
+quarter on notes with large logs.
+
+Deleting notes leaves their old entries in the index's segments until
+FTS5 merges them. After large deletions schedule_optimize() queues
+optimize_index() for the task worker in 'notes.tasks', delayed by
+NOTES_SEARCH_OPTIMIZE_DELAY seconds so a run of deletions is merged
+once.
+
+When notes are sharded (see 'notes.sharding'), every shard holds the
+index of its own notes, and searches read the searching user's shard.
+
+Only the SQLite backend supports FTS5, so every function here is a
+no-op (or returns no results) on other database vendors.
+"""
+
+from django.conf import settings
+from django.db import connections, transaction
+from .models import Note
+from .sharding import notes_database
+from .tasks import background_task, enqueue
+
+# Name of the FTS5 virtual table mirroring Note.title and Note.content
+FTS_TABLE = 'notes_note_fts'
+
+# Default number of results returned by a search
+DEFAULT_RESULT_LIMIT = 50
+
+# Default seconds a queued index merge waits for more deletions
+DEFAULT_OPTIMIZE_DELAY = 5 * 60
+
+
+def is_supported(using='default'):
+    """
+    Checks whether the given database can hold the FTS5 index.
+
+    :param using: Database alias to check.
+    :return: True if the database is SQLite.
+    """
+
+    return connections[using].vendor == 'sqlite'
+
+
+def build_match_query(text):
+    """
+    Converts free text typed by a user into a safe FTS5 MATCH query.
+
+    Each word is quoted so that FTS5 operators and punctuation in the
+    input are treated literally, and is given a trailing '*' so that
+    partial words still match. Words are combined with an implicit AND.
+
+    :param text: The raw search text.
+    :return: The MATCH expression, or an empty string if the text has
+        no words in it.
+    """
+
+    terms = []
+    for word in text.split():
+        word = word.replace('"', '""')
+        terms.append(f'"{word}"*')
+
+    return ' '.join(terms)
+
+
+def index_note(note, using='default', update_fields=None):
+    """
+    Adds or replaces the index entry for a single note.
+
+    If only some fields were saved, the content is not re-read unless
+    it was one of them, so renaming a note with large compressed
+    content does not decompress it.
+
+    :param note: The Note instance to index.
+    :param using: Database alias holding the note.
+    :param update_fields: The fields that were saved, or None if the
+        whole note was saved.
+    """
+
+    if update_fields is None or 'content' in update_fields:
+        index_rows([(note.pk, note.title, note.content)], using=using)
+    elif 'title' in update_fields and is_supported(using):
+        with connections[using].cursor() as cursor:
+            cursor.execute(
+                f"UPDATE {FTS_TABLE} SET title = %s WHERE rowid = %s",
+                [note.title, note.pk],
+            )
+
+
+def index_rows(rows, using='default'):
+    """
+    Adds or replaces the index entries for several notes at once.
+
+    :param rows: A list of (pk, title, content) tuples.
+    :param using: Database alias holding the notes.
+    """
+
+    if not rows or not is_supported(using):
+        return
+
+    unindex_notes([row[0] for row in rows], using=using)
+    with connections[using].cursor() as cursor:
+        cursor.executemany(
+            f"INSERT INTO {FTS_TABLE} (rowid, title, content) "
+            f"VALUES (%s, %s, %s)",
+            rows,
+        )
+
+
+def read_index_rows(pks, using='default'):
+    """
+    Reads the index entries of some notes, to copy them elsewhere.
+
+    :param pks: A list of Note primary keys.
+    :param using: Database alias holding the index.
+    :return: A list of (pk, title, content) tuples for the notes that
+        are indexed.
+    """
+
+    if not pks or not is_supported(using):
+        return []
+
+    placeholders = ', '.join(['%s'] * len(pks))
+    with connections[using].cursor() as cursor:
+        cursor.execute(
+            f"SELECT rowid, title, content FROM {FTS_TABLE} "
+            f"WHERE rowid IN ({placeholders})", pks
+        )
+        return cursor.fetchall()
+
+
+def unindex_notes(pks, using='default'):
+    """
+    Removes the index entries for the given notes.
+
+    :param pks: An iterable of Note primary keys.
+    :param using: Database alias holding the notes.
+    """
+
+    pks = list(pks)
+    if not pks or not is_supported(using):
+        return
+
+    placeholders = ', '.join(['%s'] * len(pks))
+    with connections[using].cursor() as cursor:
+        cursor.execute(
+            f"DELETE FROM {FTS_TABLE} WHERE rowid IN ({placeholders})", pks
+        )
+
+
+@background_task()
+def optimize_index(using='default'):
+    """
+    Task merging the index into one segment, dropping the entries of
+    deleted notes.
+
+    :param using: Database alias holding the index.
+    """
+
+    if not is_supported(using):
+        return
+
+    with connections[using].cursor() as cursor:
+        cursor.execute(
+            f"INSERT INTO {FTS_TABLE} ({FTS_TABLE}) VALUES ('optimize')"
+        )
+
+
+def schedule_optimize(using='default'):
+    """
+    Queues a merge of the index after notes were deleted.
+
+    While a merge is still waiting to run, no other is queued. The task
+    itself is always queued on 'default'.
+
+    :param using: Database alias holding the index.
+    """
+
+    if not is_supported(using):
+        return
+
+    delay = getattr(settings, 'NOTES_SEARCH_OPTIMIZE_DELAY',
+                    DEFAULT_OPTIMIZE_DELAY)
+    enqueue(optimize_index, using, key=f'search-optimize:{using}',
+            delay=delay)
+
+
+def search_notes(user, text, limit=DEFAULT_RESULT_LIMIT, using='default'):
+    """
+    Searches a user's notes, best matches first.
+
+    :param user: The user whose notes are searched.
+    :param text: The raw search text.
+    :param limit: Maximum number of notes to return.
+    :param using: Database alias holding the notes, when they are not
+        sharded.
+    :return: A list of Note instances ranked by bm25, with the content
+        deferred since results are shown by their excerpt.
+    """
+
+    using = notes_database(user.pk, using)
+    match = build_match_query(text)
+    if not match or not is_supported(using):
+        return []
+
+    # Join back to notes_note so results are scoped to the user
+    sql = (
+        f"SELECT n.id, n.title, n.excerpt, n.updated, n.user_id "
+        f"FROM {FTS_TABLE} f "
+        f"JOIN {Note._meta.db_table} n ON n.id = f.rowid "
+        f"WHERE {FTS_TABLE} MATCH %s AND n.user_id = %s "
+        f"ORDER BY bm25({FTS_TABLE}) "
+        f"LIMIT %s"
+    )
+
+    return list(Note.objects.using(using).raw(sql, [match, user.pk, limit]))
+
+
+def rebuild_index(batch_size=1000, using='default', progress=None):
+    """
+    Rebuilds the whole index from the notes table in batches.
+
+    The notes are read in primary key order using keyset pagination,
+    and each batch is written in its own transaction so the write lock
+    is only held briefly.
+
+    :param batch_size: Number of notes indexed per batch.
+    :param using: Database alias to rebuild.
+    :param progress: Optional callable, given the running total of
+        indexed notes after each batch.
+    :return: The number of notes indexed.
+    """
+
+    if not is_supported(using):
+        return 0
+
+    connection = connections[using]
+    with transaction.atomic(using=using):
+        with connection.cursor() as cursor:
+            cursor.execute(f"DELETE FROM {FTS_TABLE}")
+
+    notes = Note.objects.using(using).order_by('pk')
+    last_pk = 0
+    total = 0
+    while True:
+        rows = [
+            (pk, title, str(content)) for pk, title, content in
+            notes.filter(pk__gt=last_pk)
+            .values_list('pk', 'title', 'content')[:batch_size]
+        ]
+        if not rows:
+            break
+
+        with transaction.atomic(using=using):
+            with connection.cursor() as cursor:
+                cursor.executemany(
+                    f"INSERT INTO {FTS_TABLE} (rowid, title, content) "
+                    f"VALUES (%s, %s, %s)",
+                    rows,
+                )
+
+        last_pk = rows[-1][0]
+        total += len(rows)
+        if progress is not None:
+            progress(total)
+
+    return total
@@ -0,0 +1,381 @@
+# notes/seeding.py
+
+"""
+This module generates large synthetic data sets of users and notes,
+for the 'seed_notes' management command.
+
+The data is shaped like a real installation rather than a uniform
+grid:
+
+- Notes are shared out between users by a Zipf distribution, so a few
+  users own most of the notes and many own only a handful or none.
+- Content lengths follow a log-normal distribution around a median of
+  a few sentences, with a long tail of large notes that are stored
+  compressed (see 'notes.fields').
+- Titles and content mix plain ASCII words with accented, Cyrillic,
+  Greek, CJK and emoji words, so search and compression see unicode.
+
+Everything is derived from a single seed. Each chunk of a user's notes
+is generated from its own random generator, seeded by the run's seed,
+the user and the chunk, so the same seed always gives the same users
+and notes however many processes share the work.
+
+Generating text and compressing large notes take most of the time, so
+that work can be spread over several worker processes. SQLite allows a
+single writer per database, so the calling process does all the
+inserts, in bulk_create batches of one transaction each. Users are all
+given the same password, hashed once up front.
+"""
+
+import math
+import multiprocessing
+import os
+import random
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.db import transaction
+from .fields import (COMPRESSED_MARKER, CompressedText, compress,
+                     get_compress_threshold)
+from .models import Note, make_excerpt
+from . import board_cache, search, sharding
+
+# Password given to every seeded user
+SEED_PASSWORD = 'seed-password'
+
+# Default number of processes generating notes
+DEFAULT_PROCESSES = os.cpu_count() or 1
+
+# Notes generated per chunk; fixed so chunks do not depend on the batch
+# size or the number of processes
+GENERATE_CHUNK_SIZE = 1000
+
+# Most characters in a title, from Note.title
+TITLE_LENGTH = Note._meta.get_field('title').max_length
+
+# Words used for the plain part of the text
+ASCII_WORDS = (
+    "milk bread eggs call mum dentist meeting project deadline review "
+    "draft budget invoice travel train ticket hotel birthday gift list "
+    "ideas garden paint kitchen fix bike book read chapter notes lecture "
+    "exam recipe soup onion garlic pasta run gym yoga plan week month "
+    "monday friday morning evening remember todo done later urgent maybe "
+    "client report slides email reply renew passport insurance bank "
+    "password router printer backup photos holiday beach mountain"
+).split()
+
+# Words in other scripts, accents and emoji
+UNICODE_WORDS = (
+    "café naïve crème brûlée façade jalapeño Zürich São Paulo "
+    "straße größe über Ærø smørbrød łódź žluťoučký "
+    "привет молоко встреча книга "
+    "γεια σας καφές σημειώσεις "
+    "買い物 会議 牛乳 笔记 明天 电话 회의 우유 "
+    "مرحبا שלום नमस्ते "
+    "🙂 🎉 ✅ 📌 🚀 ☕ ❤️ 👍"
+).split()
+
+
+class SeedConfig:
+    """
+    Settings for one seeding run.
+
+    Attributes
+    ----------
+    users (int):
+        Number of users to create.
+    notes (int):
+        Total number of notes to create, shared out between the users.
+    seed (int):
+        Seed every random choice is derived from.
+    skew (float):
+        Exponent of the Zipf distribution of notes per user. Higher
+        values give more notes to the busiest users.
+    median_length (int):
+        Median number of characters of content.
+    max_length (int):
+        Most characters of content in one note.
+    unicode_ratio (float):
+        Fraction of words taken from UNICODE_WORDS.
+    prefix (str):
+        Start of every seeded username, followed by '-' and a number.
+    password (str):
+        Password of every seeded user.
+    """
+
+    def __init__(self, users=100, notes=10000, seed=0, skew=1.2,
+                 median_length=160, max_length=20000, unicode_ratio=0.1,
+                 prefix='seed', password=SEED_PASSWORD):
+        """Stores the seeding settings."""
+
+        self.users = users
+        self.notes = notes
+        self.seed = seed
+        self.skew = skew
+        self.median_length = median_length
+        self.max_length = max_length
+        self.unicode_ratio = unicode_ratio
+        self.prefix = prefix
+        self.password = password
+
+    def username(self, number):
+        """Returns the username of the user with the given number."""
+        return f'{self.prefix}-{number}'
+
+
+def notes_per_user(config):
+    """
+    Shares the notes out between the users by a Zipf distribution.
+
+    The user given each rank is picked by a shuffle, so the busiest
+    users are spread over the range of ids.
+
+    :param config: The SeedConfig for the run.
+    :return: A list with the number of notes of each user, in user
+        number order, adding up to config.notes.
+    """
+
+    if config.users < 1:
+        return []
+
+    weights = [1 / rank ** config.skew for rank in range(1, config.users + 1)]
+    total = sum(weights)
+    shares = [config.notes * weight / total for weight in weights]
+
+    # Give the notes lost to rounding down to the largest remainders
+    counts = [math.floor(share) for share in shares]
+    by_remainder = sorted(range(config.users),
+                          key=lambda rank: counts[rank] - shares[rank])
+    for rank in by_remainder[:config.notes - sum(counts)]:
+        counts[rank] += 1
+
+    users = list(range(config.users))
+    random.Random(f'{config.seed}:users').shuffle(users)
+    per_user = [0] * config.users
+    for rank, number in enumerate(users):
+        per_user[number] = counts[rank]
+    return per_user
+
+
+def plan_chunks(config, counts):
+    """
+    Splits every user's notes into chunks of GENERATE_CHUNK_SIZE.
+
+    :param config: The SeedConfig for the run.
+    :param counts: The notes of each user, from notes_per_user().
+    :return: A list of (config, user number, first note number, count)
+        tuples, one per chunk, in the order the notes are inserted.
+    """
+
+    return [
+        (config, number, first,
+         min(GENERATE_CHUNK_SIZE, count - first))
+        for number, count in enumerate(counts)
+        for first in range(0, count, GENERATE_CHUNK_SIZE)
+    ]
+
+
+def make_words(rng, config, count):
+    """
+    Picks words, some of them from other scripts.
+
+    :param rng: The chunk's random.Random instance.
+    :param config: The SeedConfig for the run.
+    :param count: Number of words.
+    :return: A list of words.
+    """
+
+    return [
+        rng.choice(UNICODE_WORDS if rng.random() < config.unicode_ratio
+                   else ASCII_WORDS)
+        for _ in range(count)
+    ]
+
+
+def make_content(rng, config):
+    """
+    Writes the content of one note.
+
+    The length is drawn from a log-normal distribution, so most notes
+    are short and a few are very long. The text is made of sentences,
+    with some line breaks between them.
+
+    :param rng: The chunk's random.Random instance.
+    :param config: The SeedConfig for the run.
+    :return: The content, between 1 and config.max_length characters.
+    """
+
+    length = int(rng.lognormvariate(math.log(config.median_length), 1.2))
+    length = max(1, min(length, config.max_length))
+
+    sentences = []
+    size = 0
+    while size < length:
+        words = make_words(rng, config, rng.randint(3, 14))
+        sentence = ' '.join(words).capitalize() + rng.choice('..!?')
+        separator = '\n' if rng.random() < 0.2 else ' '
+        sentences.append(sentence + separator)
+        size += len(sentence) + 1
+
+    return ''.join(sentences)[:length].strip() or words[0]
+
+
+def generate_chunk(chunk):
+    """
+    Generates one chunk of a user's notes.
+
+    Runs in the worker processes, so it only builds plain values. Large
+    content is compressed here, to spare the inserting process.
+
+    :param chunk: A tuple from plan_chunks().
+    :return: A (user number, rows) tuple, where each row is a (title,
+        content, stored content, excerpt) tuple.
+    """
+
+    config, number, first, count = chunk
+    rng = random.Random(f'{config.seed}:{number}:{first}')
+    threshold = get_compress_threshold()
+
+    rows = []
+    for _ in range(count):
+        title = ' '.join(make_words(rng, config, rng.randint(1, 6)))
+        title = title.capitalize()[:TITLE_LENGTH].strip() or 'Note'
+        content = make_content(rng, config)
+        rows.append((title, content, compress(content, threshold),
+                     make_excerpt(content)))
+
+    return number, rows
+
+
+def create_users(config, batch_size=1000, using='default'):
+    """
+    Creates the seeded users in bulk, all with one pre-hashed password.
+
+    :param config: The SeedConfig for the run.
+    :param batch_size: Number of users inserted per statement.
+    :param using: Database alias holding the users.
+    :return: A list of the primary keys of the users, in user number
+        order.
+    :raises ValueError: If users with the seeded usernames exist.
+    """
+
+    users = User.objects.using(using)
+    if users.filter(username__startswith=f'{config.prefix}-').exists():
+        raise ValueError(
+            f"Users named '{config.prefix}-...' already exist; choose "
+            f"another prefix."
+        )
+
+    password = make_password(config.password)
+    created = []
+    for start in range(0, config.users, batch_size):
+        with transaction.atomic(using=using):
+            created += users.bulk_create([
+                User(username=config.username(number), password=password,
+                     email=f'{config.username(number)}@example.com')
+                for number in range(start,
+                                    min(start + batch_size, config.users))
+            ])
+
+    # Backends that cannot return the new keys leave them unset
+    if created and created[0].pk is None:
+        pks = dict(users.filter(username__startswith=f'{config.prefix}-')
+                   .values_list('username', 'pk'))
+        return [pks[config.username(number)]
+                for number in range(config.users)]
+    return [user.pk for user in created]
+
+
+def insert_notes(notes, texts, using='default'):
+    """
+    Inserts a batch of notes and indexes them, one transaction per
+    database they are stored on.
+
+    :param notes: A list of unsaved Note instances.
+    :param texts: The plain content of each note, for the index.
+    :param using: Database alias to write to when notes are not
+        sharded.
+    """
+
+    batches = {}
+    for note, text in zip(notes, texts):
+        notes_using = sharding.notes_database(note.user_id, using,
+                                              place=True)
+        batches.setdefault(notes_using, []).append((note, text))
+
+    for notes_using, batch in batches.items():
+        with transaction.atomic(using=notes_using):
+            created = Note.objects.using(notes_using).bulk_create(
+                [note for note, _ in batch]
+            )
+            search.index_rows(
+                [(note.pk, note.title, text)
+                 for note, (_, text) in zip(created, batch)],
+                using=notes_using,
+            )
+            for user_id in {note.user_id for note in created}:
+                board_cache.bump_board_version_on_commit(user_id,
+                                                         notes_using)
+
+
+def seed(config, batch_size=1000, processes=1, using='default',
+         progress=None):
+    """
+    Creates the users and notes of a synthetic data set.
+
+    :param config: The SeedConfig for the run.
+    :param batch_size: Number of rows inserted per transaction.
+    :param processes: Number of processes generating notes. With 1,
+        or where processes cannot be forked, the notes are generated
+        in the calling process.
+    :param using: Database alias holding the users, and the notes
+        when they are not sharded.
+    :param progress: Optional callable, given the running total of
+        created notes after each batch.
+    :return: A (users, notes) tuple of the numbers created.
+    :raises ValueError: If users with the seeded usernames exist.
+    """
+
+    user_ids = create_users(config, batch_size, using)
+    chunks = plan_chunks(config, notes_per_user(config))
+
+    # Workers are forked, so they share the configured Django setup;
+    # imap() hands the chunks back in order, keeping the ids repeatable
+    pool = None
+    if (processes > 1 and len(chunks) > 1
+            and 'fork' in multiprocessing.get_all_start_methods()):
+        pool = multiprocessing.get_context('fork').Pool(processes)
+        generated = pool.imap(generate_chunk, chunks)
+    else:
+        generated = map(generate_chunk, chunks)
+
+    total = 0
+    notes, texts = [], []
+    try:
+        for number, rows in generated:
+            for title, content, stored, excerpt in rows:
+                if stored.startswith(COMPRESSED_MARKER):
+                    content, text = CompressedText(stored), content
+                else:
+                    text = content
+                notes.append(Note(user_id=user_ids[number], title=title,
+                                  content=content, excerpt=excerpt))
+                texts.append(text)
+
+            while len(notes) >= batch_size:
+                insert_notes(notes[:batch_size], texts[:batch_size], using)
+                del notes[:batch_size], texts[:batch_size]
+                total += batch_size
+                if progress is not None:
+                    progress(total)
+
+        if notes:
+            insert_notes(notes, texts, using)
+            total += len(notes)
+            if progress is not None:
+                progress(total)
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+    return len(user_ids), total
@@ -0,0 +1,352 @@
+# notes/sharding.py
+
+"""
+This module places each user's notes on one of several SQLite
+databases, so storage and write throughput can grow past a single
+file.
+
+The shard databases are the aliases listed in NOTES_SHARDS. When the
+list is empty, which is the default, sharding is off and every note
+stays on the 'default' database. Users, sessions and the app's other
+tables always stay on 'default'; only the notes table (with its search
+index) lives on the shards.
+
+Each user's notes are kept together on one shard. A user is placed on
+the shard picked by hash_shard(), a rendezvous hash of their id, which
+is stable across processes and moves few users when a shard is added.
+The placement is recorded in a UserShard row on 'default' when the
+user is created, and cached in Django's cache for
+NOTES_SHARD_CACHE_TIMEOUT seconds. Users who already existed when
+sharding was turned on are placed by the 'rebalance_shards' command,
+or by their first write, with users who had notes on 'default' placed
+there until the command moves them, see 'notes.rebalance'. Reads never
+record a placement, so routing a GET request does not take SQLite's
+write lock; until a user is placed, their reads go to the shard they
+would be placed on.
+
+'notes.routers.ShardRouter' reads the placement to send each note
+query to the right database, so the views work unchanged.
+
+Note ids must stay unique across the shards, so that a note keeps its
+id, and its URLs, when its owner is moved. While sharding is on, new
+notes take their ids from allocate_note_id() instead of the database.
+It reserves blocks of NOTES_SHARD_ID_BLOCK ids at a time from the
+single NoteIdSequence row on 'default', so only one write in each
+block touches the default database.
+"""
+
+import hashlib
+import threading
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db import IntegrityError, connections, transaction
+from django.db.models import F, Max
+from .models import Note, NoteIdSequence, UserShard
+
+# Default number of note ids reserved at a time
+DEFAULT_ID_BLOCK_SIZE = 100
+
+# Default seconds a user's placement is cached
+DEFAULT_PLACEMENT_CACHE_TIMEOUT = 60
+
+
+def get_shards():
+    """
+    Returns the database aliases notes are sharded across.
+
+    :return: The NOTES_SHARDS setting, or an empty list if notes are
+        not sharded.
+    """
+
+    return getattr(settings, 'NOTES_SHARDS', [])
+
+
+def is_enabled():
+    """
+    Checks whether notes are sharded.
+
+    :return: True if NOTES_SHARDS lists any databases.
+    """
+
+    return bool(get_shards())
+
+
+def note_databases():
+    """
+    Returns every database that may hold notes.
+
+    :return: 'default', which keeps the notes from before sharding was
+        turned on, followed by the shards.
+    """
+
+    return ['default', *[alias for alias in get_shards()
+                         if alias != 'default']]
+
+
+def hash_shard(user_id, shards=None):
+    """
+    Picks the shard a user belongs on by rendezvous hashing.
+
+    Each shard is scored by a hash of its alias and the user's id, and
+    the highest score wins. Adding a shard only moves the users it now
+    wins, and removing one only moves the users it held.
+
+    :param user_id: Primary key of the user.
+    :param shards: The shard aliases to choose from. Defaults to the
+        NOTES_SHARDS setting.
+    :return: The chosen alias.
+    """
+
+    return max(shards or get_shards(), key=lambda alias: hashlib.blake2b(
+        f'{alias}:{user_id}'.encode(), digest_size=8
+    ).digest())
+
+
+def placement_key(user_id):
+    """Returns the cache key of a user's placement."""
+    return f'notes:shard:{user_id}'
+
+
+def remember_placement(user_id, shard):
+    """
+    Caches a user's placement.
+
+    :param user_id: Primary key of the user.
+    :param shard: The alias holding their notes.
+    """
+
+    timeout = getattr(settings, 'NOTES_SHARD_CACHE_TIMEOUT',
+                      DEFAULT_PLACEMENT_CACHE_TIMEOUT)
+    cache.set(placement_key(user_id), shard, timeout=timeout)
+
+
+def find_placement(user_id):
+    """
+    Returns the recorded placement of a user.
+
+    :param user_id: Primary key of the user.
+    :return: The alias holding their notes, or None if the user has
+        not been placed.
+    """
+
+    return (UserShard.objects.using('default').filter(user_id=user_id)
+            .values_list('shard', flat=True).first())
+
+
+def initial_shard(user_id):
+    """
+    Returns the shard a user who has not been placed belongs on.
+
+    :param user_id: Primary key of the user.
+    :return: 'default' if the user has notes from before sharding was
+        turned on, which stay there until rebalanced, otherwise the
+        shard their id hashes to.
+    """
+
+    if Note.objects.using('default').filter(user_id=user_id).exists():
+        return 'default'
+    return hash_shard(user_id)
+
+
+def place_user(user_id):
+    """
+    Returns the recorded placement of a user, placing them first if
+    they have none.
+
+    :param user_id: Primary key of the user.
+    :return: The alias holding their notes.
+    """
+
+    shard = find_placement(user_id)
+    if shard is not None:
+        return shard
+
+    shard = initial_shard(user_id)
+    try:
+        with transaction.atomic(using='default'):
+            UserShard.objects.using('default').create(user_id=user_id,
+                                                      shard=shard)
+    except IntegrityError:
+        # Placed by another request meanwhile, or not a user at all
+        return find_placement(user_id) or shard
+
+    return shard
+
+
+def place_users():
+    """
+    Places every user who has not been placed yet, such as the users
+    who existed before sharding was turned on.
+
+    :return: The number of users placed.
+    """
+
+    users = get_user_model().objects.using('default')
+    unplaced = list(users.filter(usershard__isnull=True)
+                    .values_list('pk', flat=True))
+    legacy = set(Note.objects.using('default').filter(user_id__in=unplaced)
+                 .order_by().values_list('user_id', flat=True).distinct())
+
+    UserShard.objects.using('default').bulk_create(
+        [UserShard(user_id=user_id, shard='default' if user_id in legacy
+                   else hash_shard(user_id)) for user_id in unplaced],
+        ignore_conflicts=True,
+    )
+    return len(unplaced)
+
+
+def shard_for_user(user_id, place=False):
+    """
+    Returns the database holding a user's notes.
+
+    :param user_id: Primary key of the user.
+    :param place: Whether to record the placement of a user who has
+        not been placed. Only writes should, so reads never write.
+    :return: The user's shard, or 'default' if notes are not sharded.
+    """
+
+    if not is_enabled():
+        return 'default'
+
+    shard = cache.get(placement_key(user_id))
+    if shard is not None:
+        return shard
+
+    shard = place_user(user_id) if place else find_placement(user_id)
+    if shard is None:
+        # Only recorded placements are cached, so a later write records
+        # this one
+        return initial_shard(user_id)
+    remember_placement(user_id, shard)
+    return shard
+
+
+def notes_database(user_id, using='default', place=False):
+    """
+    Returns the database to use for a user's notes.
+
+    :param user_id: Primary key of the user.
+    :param using: Database alias to use when notes are not sharded.
+    :param place: Whether to record the placement of a user who has
+        not been placed, see shard_for_user().
+    :return: The user's shard when notes are sharded, otherwise
+        `using`.
+    """
+
+    return shard_for_user(user_id, place=place) if is_enabled() else using
+
+
+def highest_note_id():
+    """
+    Returns the highest note id in any of the note databases.
+
+    :return: The highest id, or 0 if there are no notes.
+    """
+
+    return max(
+        Note.objects.using(alias).aggregate(highest=Max('pk'))['highest'] or 0
+        for alias in note_databases()
+    )
+
+
+def reserve_note_ids(count):
+    """
+    Reserves a run of note ids from the sequence on 'default'.
+
+    :param count: Number of ids to reserve.
+    :return: The first reserved id; the run ends before first + count.
+    """
+
+    sequence = NoteIdSequence.objects.using('default').filter(pk=1)
+    while True:
+        with transaction.atomic(using='default'):
+            if sequence.update(next_id=F('next_id') + count):
+                return sequence.get().next_id - count
+
+        # Start the sequence above every note that already exists
+        first = highest_note_id() + 1
+        try:
+            with transaction.atomic(using='default'):
+                NoteIdSequence.objects.using('default').create(
+                    pk=1, next_id=first + count
+                )
+            return first
+        except IntegrityError:
+            # Another process started it first
+            continue
+
+
+class NoteIdAllocator:
+    """
+    Hands out note ids from blocks reserved with reserve_note_ids().
+
+    Attributes
+    ----------
+    block_size (int):
+        Number of ids reserved at a time.
+
+    Methods
+    -------
+    allocate(self):
+        Returns the next note id.
+    """
+
+    def __init__(self, block_size):
+        """
+        Starts with no ids reserved.
+
+        :param block_size: Number of ids reserved at a time.
+        """
+
+        self.block_size = block_size
+        self._next = self._end = 0
+        self._lock = threading.Lock()
+
+    def allocate(self):
+        """
+        Returns the next note id.
+
+        A block reserved inside a transaction on 'default' could be
+        rolled back and handed out again, so there only a single id is
+        reserved, and it is not kept for later notes.
+
+        :return: An id no other note has been given.
+        """
+
+        with self._lock:
+            if self._next < self._end:
+                self._next += 1
+                return self._next - 1
+
+            if connections['default'].in_atomic_block:
+                return reserve_note_ids(1)
+
+            first = reserve_note_ids(self.block_size)
+            self._next, self._end = first + 1, first + self.block_size
+            return first
+
+
+# The process-wide allocator, created on first use
+_allocator = None
+_allocator_lock = threading.Lock()
+
+
+def allocate_note_id():
+    """
+    Returns the primary key for a new note.
+
+    :return: An id unique across the shards when notes are sharded,
+        otherwise None so the database picks the id.
+    """
+
+    global _allocator
+    if not is_enabled():
+        return None
+
+    with _allocator_lock:
+        if _allocator is None:
+            _allocator = NoteIdAllocator(getattr(
+                settings, 'NOTES_SHARD_ID_BLOCK', DEFAULT_ID_BLOCK_SIZE
+            ))
+    return _allocator.allocate()
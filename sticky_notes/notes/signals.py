@@ -0,0 +1,146 @@
+# notes/signals.py
+
+"""
+This module contains signal handlers for the Note model.
+
+The handlers keep the full-text search index in 'notes.search' in step
+with the notes table, invalidate the owner's cached noteboard in
+'notes.board_cache', and publish the change to the owner's open
+noteboards through 'notes.events', whichever path a note is saved or
+deleted through (the note views, the admin, or the shell). They are connected
+when the app registry is ready in 'notes.apps.NotesConfig'. New users
+are placed on a shard when notes are sharded, see 'notes.sharding'.
+
+This module also applies the SQLITE_PRAGMAS setting to every new
+SQLite database connection, and adds the request query timer from
+'notes.metrics' to every new database connection.
+"""
+
+import re
+from django.conf import settings
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from .models import Note
+from . import search, board_cache, events, metrics, sharding
+
+
+@receiver(post_save, sender=Note, dispatch_uid='note_search_index_save')
+def note_saved(sender, instance, using, update_fields=None, **kwargs):
+    """
+    Updates the search index entry for a note after it is saved.
+
+    :param sender: The Note model class.
+    :param instance: The Note instance that was saved.
+    :param using: The database alias the note was saved to.
+    :param update_fields: The fields that were saved, or None.
+    """
+
+    search.index_note(instance, using=using, update_fields=update_fields)
+
+
+@receiver(post_delete, sender=Note, dispatch_uid='note_search_index_delete')
+def note_deleted(sender, instance, using, **kwargs):
+    """
+    Removes the search index entry for a note after it is deleted.
+
+    :param sender: The Note model class.
+    :param instance: The Note instance that was deleted.
+    :param using: The database alias the note was deleted from.
+    """
+
+    search.unindex_notes([instance.pk], using=using)
+
+
+@receiver(post_save, sender=Note, dispatch_uid='note_board_cache_save')
+@receiver(post_delete, sender=Note, dispatch_uid='note_board_cache_delete')
+def note_changed(sender, instance, using, **kwargs):
+    """
+    Invalidates the cached noteboard of a note's owner after the note
+    is saved or deleted.
+
+    :param sender: The Note model class.
+    :param instance: The Note instance that changed.
+    :param using: The database alias the change was written to.
+    """
+
+    board_cache.bump_board_version_on_commit(instance.user_id, using=using)
+
+
+@receiver(post_save, sender=Note, dispatch_uid='note_events_save')
+def note_published(sender, instance, using, **kwargs):
+    """
+    Sends a saved note's new card to its owner's open noteboards.
+
+    :param sender: The Note model class.
+    :param instance: The Note instance that was saved.
+    :param using: The database alias the note was saved to.
+    """
+
+    events.publish_note_saved(instance, using=using)
+
+
+@receiver(post_delete, sender=Note, dispatch_uid='note_events_delete')
+def note_unpublished(sender, instance, using, **kwargs):
+    """
+    Removes a deleted note from its owner's open noteboards.
+
+    :param sender: The Note model class.
+    :param instance: The Note instance that was deleted.
+    :param using: The database alias the note was deleted from.
+    """
+
+    events.publish_notes_deleted(instance.user_id, [instance.pk],
+                                 using=using)
+
+
+@receiver(post_save, sender=settings.AUTH_USER_MODEL,
+          dispatch_uid='user_shard_place')
+def user_created(sender, instance, created, raw=False, **kwargs):
+    """
+    Places a new user on a shard when notes are sharded, so their
+    placement is never recorded while routing a read.
+
+    :param sender: The user model class.
+    :param instance: The user that was saved.
+    :param created: Whether the user was just created.
+    :param raw: Whether the user was loaded from a fixture.
+    """
+
+    if created and not raw and sharding.is_enabled():
+        sharding.remember_placement(instance.pk,
+                                    sharding.place_user(instance.pk))
+
+
+# Pragma names and values must be plain words or integers
+PRAGMA_NAME = re.compile(r'^[a-z_]+$')
+PRAGMA_VALUE = re.compile(r'^(-?\d+|[A-Za-z]+)$')
+
+
+@receiver(connection_created, dispatch_uid='sqlite_pragmas')
+def apply_sqlite_pragmas(sender, connection, **kwargs):
+    """
+    Applies the SQLITE_PRAGMAS setting to a new SQLite connection.
+
+    :param sender: The database backend's connection wrapper class.
+    :param connection: The connection wrapper that was opened.
+    :raises ValueError: If a pragma name or value is not a plain word
+        or integer.
+    """
+
+    if connection.vendor != 'sqlite':
+        return
+
+    pragmas = getattr(settings, 'SQLITE_PRAGMAS', {})
+    with connection.cursor() as cursor:
+        for name, value in pragmas.items():
+            valid = PRAGMA_NAME.match(name) and PRAGMA_VALUE.match(str(value))
+            if not valid:
+                raise ValueError(f"Invalid SQLite pragma {name}={value!r}.")
+            cursor.execute(f"PRAGMA {name} = {value}")
+
+
+# Time every query run while a request is being handled
+connection_created.connect(
+    metrics.install_query_timer, dispatch_uid='request_query_timer'
+)
@@ -0,0 +1,48 @@
+/* notes/static/notes/js/live_board.js */
+
+/*
+Keeps an open noteboard page up to date. It listens to the note events
+stream and swaps changed note cards in place, removes deleted notes and
+adds new notes to the last page, so other tabs never need reloading.
+*/
+
+(function () {
+	"use strict";
+
+	var board = document.querySelector("[data-live-board]");
+	if (!board || !window.EventSource) {
+		return;
+	}
+
+	// Turns a card's HTML into an element
+	function parseCard(html) {
+		var template = document.createElement("template");
+		template.innerHTML = html.trim();
+		return template.content.firstElementChild;
+	}
+
+	var source = new EventSource(board.dataset.eventsUrl);
+
+	source.addEventListener("note", function (message) {
+		var change = JSON.parse(message.data);
+
+		// Too many changes were missed to patch the board
+		if (change.action === "reload") {
+			window.location.reload();
+			return;
+		}
+
+		var card = board.querySelector('[data-note-id="' + change.id + '"]');
+		if (change.action === "deleted") {
+			if (card) {
+				card.remove();
+			}
+		} else if (change.action === "saved") {
+			if (card) {
+				card.replaceWith(parseCard(change.html));
+			} else if (board.hasAttribute("data-last-page")) {
+				board.appendChild(parseCard(change.html));
+			}
+		}
+	});
+})();
@@ -0,0 +1,252 @@
+# notes/staticfiles.py
+
+"""
+This module provides the static file pipeline for the Sticky Notes
+application.
+
+CompressedManifestStaticFilesStorage extends Django's manifest storage.
+When `collectstatic` runs it writes every file under a content-hashed
+name, such as ``styles.3f1c9a0b2e4d.css``, and next to each hashed file
+that compresses well it writes a gzip variant (``.gz``) and, if the
+optional `brotli` package is installed, a brotli variant (``.br``).
+
+StaticAsset looks up a requested file under STATIC_ROOT, and
+'notes.middleware.StaticFilesMiddleware' uses it to serve the files
+from the application. Hashed files never change, so they are sent with
+far-future immutable cache headers. Each request gets the smallest
+variant the client accepts, chosen from its Accept-Encoding header.
+
+Until `collectstatic` has written a manifest, the storage falls back to
+the plain file names, so development servers and tests work without
+collecting first.
+"""
+
+import gzip
+import mimetypes
+import os
+from django.conf import settings
+from django.core.exceptions import SuspiciousFileOperation
+from django.contrib.staticfiles.storage import (ManifestStaticFilesStorage,
+                                                staticfiles_storage)
+from django.utils._os import safe_join
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# File types that are already compressed and gain nothing from gzip
+INCOMPRESSIBLE_EXTENSIONS = {
+    '.gz', '.br', '.zip', '.png', '.jpg', '.jpeg', '.gif', '.webp',
+    '.woff', '.woff2',
+}
+
+# Only keep a compressed variant if it is at most this share of the size
+MAX_COMPRESSED_RATIO = 0.95
+
+# Cache-Control header for content-hashed files, which never change
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+# Default Cache-Control max-age, in seconds, for files without a hash
+DEFAULT_STATIC_MAX_AGE = 60
+
+# Encodings in order of preference, with the suffix of their variant
+ENCODINGS = [('br', '.br'), ('gzip', '.gz')]
+
+
+def compress_variants(path):
+    """
+    Writes the gzip and brotli variants of a file where they are
+    worth keeping.
+
+    :param path: Absolute path of the file.
+    :return: A list of the variant paths written.
+    """
+
+    if os.path.splitext(path)[1].lower() in INCOMPRESSIBLE_EXTENSIONS:
+        return []
+
+    with open(path, 'rb') as source:
+        data = source.read()
+
+    # mtime=0 keeps the gzip output identical between runs
+    variants = [('.gz', gzip.compress(data, compresslevel=9, mtime=0))]
+    if brotli is not None:
+        variants.append(('.br', brotli.compress(data)))
+
+    written = []
+    for suffix, compressed in variants:
+        if len(compressed) <= len(data) * MAX_COMPRESSED_RATIO:
+            with open(path + suffix, 'wb') as target:
+                target.write(compressed)
+            written.append(path + suffix)
+
+    return written
+
+
+class CompressedManifestStaticFilesStorage(ManifestStaticFilesStorage):
+    """
+    Manifest static files storage that also writes precompressed
+    variants of every hashed file.
+
+    Methods
+    -------
+    post_process(self, paths, dry_run=False, **options):
+        Hashes the collected files, then compresses the hashed copies.
+    stored_name(self, name):
+        Returns the hashed name of a file, or the plain name if no
+        manifest has been written yet.
+    """
+
+    def post_process(self, paths, dry_run=False, **options):
+        """Hashes the collected files, then compresses the hashed
+        copies."""
+
+        yield from super().post_process(paths, dry_run, **options)
+        if dry_run:
+            return
+
+        for name in sorted(set(self.hashed_files.values())):
+            for variant in compress_variants(self.path(name)):
+                yield name, variant, True
+
+    def stored_name(self, name):
+        """
+        Returns the hashed name of a file, or the plain name if no
+        manifest has been written yet.
+        """
+
+        if not self.hashed_files:
+            return name
+        return super().stored_name(name)
+
+
+# The storage's manifest and the set of hashed names built from it
+_hashed_names = (None, 0, frozenset())
+
+
+def is_hashed(name):
+    """
+    Checks whether a file name is a content-hashed name from the
+    manifest.
+
+    The set of hashed names is rebuilt only when the storage's manifest
+    changes.
+
+    :param name: A file name relative to STATIC_ROOT.
+    :return: True if the file's content can never change.
+    """
+
+    global _hashed_names
+    hashed_files = getattr(staticfiles_storage, 'hashed_files', None) or {}
+    manifest, size, names = _hashed_names
+    if manifest is not hashed_files or size != len(hashed_files):
+        names = frozenset(hashed_files.values())
+        _hashed_names = (hashed_files, len(hashed_files), names)
+
+    return name in names
+
+
+def parse_accept_encoding(header):
+    """
+    Parses an Accept-Encoding header.
+
+    :param header: The raw header value.
+    :return: A set of the encodings the client accepts (q > 0).
+    """
+
+    accepted = set()
+    for item in header.split(','):
+        coding, _, params = item.strip().partition(';')
+        quality = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        if coding and quality > 0:
+            accepted.add(coding.strip().lower())
+
+    return accepted
+
+
+class StaticAsset:
+    """
+    A collected static file and the variant chosen for one request.
+
+    Attributes
+    ----------
+    name (str):
+        The requested name relative to STATIC_ROOT.
+    path (str):
+        Absolute path of the file to send.
+    encoding (str):
+        The Content-Encoding of the chosen variant, or None.
+    content_type (str):
+        The media type of the original file.
+    has_variants (bool):
+        True if compressed variants exist, so the response depends on
+        Accept-Encoding.
+    cache_control (str):
+        The Cache-Control header value for the file.
+
+    Methods
+    -------
+    find(cls, name, accept_encoding):
+        Looks up a collected file, choosing a variant to send.
+    """
+
+    def __init__(self, name, path, encoding, has_variants):
+        """
+        Describes the file to send.
+
+        :param name: The requested name relative to STATIC_ROOT.
+        :param path: Absolute path of the file to send.
+        :param encoding: Content-Encoding of the file to send, or None.
+        :param has_variants: Whether compressed variants exist.
+        """
+
+        self.name = name
+        self.path = path
+        self.encoding = encoding
+        self.has_variants = has_variants
+        self.content_type = (
+            mimetypes.guess_type(name)[0] or 'application/octet-stream'
+        )
+        if is_hashed(name):
+            self.cache_control = IMMUTABLE_CACHE_CONTROL
+        else:
+            max_age = getattr(settings, 'NOTES_STATIC_MAX_AGE',
+                              DEFAULT_STATIC_MAX_AGE)
+            self.cache_control = f'public, max-age={max_age}'
+
+    @classmethod
+    def find(cls, name, accept_encoding):
+        """
+        Looks up a collected file, choosing a variant to send.
+
+        :param name: The requested name relative to STATIC_ROOT.
+        :param accept_encoding: The request's Accept-Encoding header.
+        :return: A StaticAsset, or None if there is no such file.
+        """
+
+        if not settings.STATIC_ROOT:
+            return None
+        try:
+            path = safe_join(settings.STATIC_ROOT, name)
+        except SuspiciousFileOperation:
+            # The name tried to leave STATIC_ROOT
+            return None
+        if not os.path.isfile(path):
+            return None
+
+        accepted = parse_accept_encoding(accept_encoding)
+        has_variants = False
+        for encoding, suffix in ENCODINGS:
+            if os.path.isfile(path + suffix):
+                has_variants = True
+                if encoding in accepted:
+                    return cls(name, path + suffix, encoding, True)
+
+        return cls(name, path, None, has_variants)
@@ -0,0 +1,481 @@
+# notes/tasks.py
+
+"""
+This module runs deferred work outside the request, from a queue kept
+in the database.
+
+Work that does not need to finish before a response is sent is queued
+as a Task row with enqueue() and run later by the 'run_tasks'
+management command, which claims due tasks from several worker
+threads. Because the queue is an ordinary table, it needs no broker
+such as Redis, and a task queued inside a transaction is only seen by
+the worker once that transaction commits, together with the data it
+works on.
+
+Only functions decorated with background_task() can be queued, and a
+task row names its function by dotted path, so the worker can run
+nothing else:
+
+    @background_task()
+    def purge_user(purge_id):
+        ...
+
+    enqueue(purge_user, purge.pk, key=f"purge-user:{purge.pk}")
+
+The arguments are stored as JSON, so they should be primary keys and
+other plain values rather than model instances.
+
+Queueing with a key makes the call idempotent: while a task with that
+key is still pending, queueing it again returns the pending task
+instead of adding another, so a burst of identical requests runs the
+work once. A task that raises is retried after NOTES_TASK_RETRY_DELAY
+seconds, doubling each time, until it has been tried max_attempts
+times, and is then marked failed with its traceback. A task still
+running NOTES_TASK_TIMEOUT seconds after it started is assumed to have
+lost its worker and is retried the same way. Tasks may therefore run
+more than once, and must be safe to run again.
+"""
+
+import threading
+import time
+import traceback
+from datetime import timedelta
+from django.conf import settings
+from django.db import (IntegrityError, OperationalError,
+                       close_old_connections, connections, transaction)
+from django.db.models import F
+from django.utils import timezone
+from django.utils.module_loading import import_string
+from .models import Task
+
+# Default number of worker threads
+DEFAULT_TASK_THREADS = 2
+
+# Default seconds an idle worker waits before looking for tasks again
+DEFAULT_POLL_INTERVAL = 1.0
+
+# Default most times a task is started before it is marked failed
+DEFAULT_MAX_ATTEMPTS = 5
+
+# Default seconds before a failed task is first retried
+DEFAULT_RETRY_DELAY = 10
+
+# Default seconds after which a running task is assumed lost
+DEFAULT_TASK_TIMEOUT = 30 * 60
+
+# Default seconds finished tasks are kept before being deleted
+DEFAULT_TASK_RETENTION = 7 * 24 * 60 * 60
+
+# Seconds between checks for lost and old tasks while the worker runs
+MAINTENANCE_INTERVAL = 60
+
+# Times the queue's bookkeeping is tried while the database is busy
+BOOKKEEPING_ATTEMPTS = 5
+
+# Seconds waited after the first busy try, growing with each try
+BOOKKEEPING_PAUSE = 0.1
+
+
+def get_worker_settings():
+    """
+    Returns how the task worker runs.
+
+    :return: A (threads, poll_interval) tuple from the
+        NOTES_TASK_THREADS and NOTES_TASK_POLL_INTERVAL settings, or
+        the defaults if they have not been set.
+    """
+
+    return (
+        getattr(settings, 'NOTES_TASK_THREADS', DEFAULT_TASK_THREADS),
+        getattr(settings, 'NOTES_TASK_POLL_INTERVAL', DEFAULT_POLL_INTERVAL),
+    )
+
+
+def background_task(max_attempts=None):
+    """
+    Decorator marking a function as a task the worker may run.
+
+    :param max_attempts: Most times the task is started before it is
+        marked failed. Defaults to the NOTES_TASK_MAX_ATTEMPTS setting.
+    :return: The decorator, which returns the function unchanged apart
+        from its 'task_name' and 'max_attempts' attributes.
+    """
+
+    def decorator(func):
+        func.task_name = f"{func.__module__}.{func.__qualname__}"
+        func.max_attempts = max_attempts
+        return func
+
+    return decorator
+
+
+def resolve_task(name):
+    """
+    Finds the function a task row names.
+
+    :param name: The dotted path stored in Task.name.
+    :return: The task function.
+    :raises ValueError: If the path does not name a function decorated
+        with background_task().
+    """
+
+    try:
+        func = import_string(name)
+    except ImportError as error:
+        raise ValueError(f"Unknown task {name!r}.") from error
+    if getattr(func, 'task_name', None) != name:
+        raise ValueError(f"{name!r} is not a background task.")
+    return func
+
+
+def enqueue(func, *args, key=None, delay=0, using='default'):
+    """
+    Queues a call to a task function.
+
+    :param func: A function decorated with background_task().
+    :param args: JSON-serialisable positional arguments for it.
+    :param key: Optional idempotency key. If a task with this key is
+        already pending it is returned and nothing new is queued.
+    :param delay: Seconds to wait before the task may start.
+    :param using: Database alias holding the queue.
+    :return: The queued Task.
+    :raises ValueError: If the function is not a background task.
+    """
+
+    if not hasattr(func, 'task_name'):
+        raise ValueError(f"{func!r} is not a background task.")
+
+    max_attempts = func.max_attempts or getattr(
+        settings, 'NOTES_TASK_MAX_ATTEMPTS', DEFAULT_MAX_ATTEMPTS
+    )
+    fields = {
+        'name': func.task_name,
+        'args': list(args),
+        'key': key,
+        'max_attempts': max_attempts,
+        'run_after': timezone.now() + timedelta(seconds=delay),
+    }
+    tasks = Task.objects.using(using)
+    if key is None:
+        return tasks.create(**fields)
+
+    while True:
+        pending = tasks.filter(key=key, status=Task.PENDING).first()
+        if pending is not None:
+            return pending
+
+        # The pending key constraint settles races between two callers
+        try:
+            with transaction.atomic(using=using):
+                return tasks.create(**fields)
+        except IntegrityError:
+            continue
+
+
+def claim_task(using='default'):
+    """
+    Claims the next due task for the calling worker.
+
+    A task is claimed by moving it from pending to running with a
+    conditional UPDATE, so two workers never claim the same task, even
+    in separate processes.
+
+    :param using: Database alias holding the queue.
+    :return: The claimed Task, or None if no task is due.
+    """
+
+    tasks = Task.objects.using(using)
+    now = timezone.now()
+    while True:
+        pk = tasks.filter(
+            status=Task.PENDING, run_after__lte=now
+        ).order_by('run_after', 'pk').values_list('pk', flat=True).first()
+        if pk is None:
+            return None
+
+        claimed = tasks.filter(pk=pk, status=Task.PENDING).update(
+            status=Task.RUNNING, started=now, attempts=F('attempts') + 1,
+        )
+        if claimed:
+            return tasks.get(pk=pk)
+
+
+def retry_when_busy(func, *args):
+    """
+    Calls a function updating the queue, trying again while the
+    database is busy.
+
+    A task's outcome must be recorded even when another process holds
+    SQLite's write lock for longer than the busy timeout, or the task
+    stays running until it is assumed lost and is run again.
+
+    :param func: The function to call.
+    :param args: Positional arguments for the function.
+    :return: What the function returns.
+    :raises OperationalError: If the database is still busy after
+        BOOKKEEPING_ATTEMPTS tries.
+    """
+
+    for attempt in range(1, BOOKKEEPING_ATTEMPTS + 1):
+        try:
+            return func(*args)
+        except OperationalError:
+            if attempt == BOOKKEEPING_ATTEMPTS:
+                raise
+            close_old_connections()
+            time.sleep(BOOKKEEPING_PAUSE * attempt)
+
+
+def finish_task(task, using='default'):
+    """
+    Records a successful run of a task.
+
+    :param task: The running Task that succeeded.
+    :param using: Database alias holding the queue.
+    """
+
+    Task.objects.using(using).filter(pk=task.pk).update(
+        status=Task.DONE, error='', finished=timezone.now(),
+    )
+
+
+def fail_task(task, error, using='default'):
+    """
+    Records a failed attempt, queueing a retry if attempts are left.
+
+    :param task: The running Task that failed.
+    :param error: Description of the failure, usually a traceback.
+    :param using: Database alias holding the queue.
+    """
+
+    tasks = Task.objects.using(using).filter(pk=task.pk)
+    now = timezone.now()
+    if task.attempts < task.max_attempts:
+        retry_delay = getattr(settings, 'NOTES_TASK_RETRY_DELAY',
+                              DEFAULT_RETRY_DELAY)
+        backoff = retry_delay * 2 ** max(task.attempts - 1, 0)
+        try:
+            with transaction.atomic(using=using):
+                tasks.update(status=Task.PENDING, error=error,
+                             run_after=now + timedelta(seconds=backoff))
+            return
+        except IntegrityError:
+            # The same work was queued again meanwhile and will run then
+            pass
+
+    tasks.update(status=Task.FAILED, error=error, finished=now)
+
+
+def run_task(task, using='default'):
+    """
+    Runs a claimed task and records the outcome.
+
+    The task function runs in autocommit mode, so it can commit its
+    work in as many transactions as it needs. The outcome is recorded
+    with retry_when_busy().
+
+    :param task: The Task returned by claim_task().
+    :param using: Database alias holding the queue.
+    :return: True if the task succeeded.
+    :raises OperationalError: If the database stayed busy while the
+        outcome was recorded.
+    """
+
+    try:
+        resolve_task(task.name)(*task.args)
+    except Exception:
+        retry_when_busy(fail_task, task, traceback.format_exc(), using)
+        return False
+
+    retry_when_busy(finish_task, task, using)
+    return True
+
+
+def requeue_lost_tasks(using='default'):
+    """
+    Retries tasks running for longer than NOTES_TASK_TIMEOUT seconds,
+    whose worker is assumed to have stopped.
+
+    :param using: Database alias holding the queue.
+    :return: The number of tasks retried or marked failed.
+    """
+
+    timeout = getattr(settings, 'NOTES_TASK_TIMEOUT', DEFAULT_TASK_TIMEOUT)
+    lost = Task.objects.using(using).filter(
+        status=Task.RUNNING,
+        started__lt=timezone.now() - timedelta(seconds=timeout),
+    )
+
+    count = 0
+    for task in lost:
+        fail_task(task, f"Still running after {timeout} seconds.", using)
+        count += 1
+
+    return count
+
+
+def prune_tasks(using='default'):
+    """
+    Deletes tasks that finished more than NOTES_TASK_RETENTION seconds
+    ago. Failed tasks are kept, so their errors can be inspected.
+
+    :param using: Database alias holding the queue.
+    :return: The number of tasks deleted.
+    """
+
+    retention = getattr(settings, 'NOTES_TASK_RETENTION',
+                        DEFAULT_TASK_RETENTION)
+    deleted, _ = Task.objects.using(using).filter(
+        status=Task.DONE,
+        finished__lt=timezone.now() - timedelta(seconds=retention),
+    ).delete()
+    return deleted
+
+
+def run_pending(using='default', report=None):
+    """
+    Runs due tasks one at a time on the calling thread until none are
+    left.
+
+    :param using: Database alias holding the queue.
+    :param report: Optional callable, given each Task and whether it
+        succeeded.
+    :return: The number of tasks run.
+    """
+
+    count = 0
+    while True:
+        task = claim_task(using)
+        if task is None:
+            return count
+        succeeded = run_task(task, using)
+        count += 1
+        if report is not None:
+            report(task, succeeded)
+
+
+class TaskRunner:
+    """
+    Runs queued tasks on a pool of worker threads.
+
+    Each thread claims and runs one task at a time, and waits
+    poll_interval seconds whenever no task is due. The calling thread
+    meanwhile retries lost tasks and deletes old ones every
+    MAINTENANCE_INTERVAL seconds.
+
+    Attributes
+    ----------
+    threads (int):
+        Number of worker threads.
+    poll_interval (float):
+        Seconds an idle worker waits before looking again.
+    using (str):
+        Database alias holding the queue.
+
+    Methods
+    -------
+    maintain(self):
+        Retries lost tasks and deletes old ones.
+    run(self, once=False):
+        Runs tasks until stopped, or until none are due if once is set.
+    stop(self):
+        Asks the workers to stop after their current task.
+    """
+
+    def __init__(self, threads, poll_interval, using='default', report=None):
+        """
+        Prepares a runner.
+
+        :param threads: Number of worker threads.
+        :param poll_interval: Seconds an idle worker waits before
+            looking again.
+        :param using: Database alias holding the queue.
+        :param report: Optional callable, given each Task and whether it
+            succeeded. It is called from the worker threads.
+        """
+
+        self.threads = threads
+        self.poll_interval = poll_interval
+        self.using = using
+        self.report = report
+        self._stopping = threading.Event()
+
+    def _work(self, once):
+        """Claims and runs tasks on one worker thread."""
+
+        try:
+            while not self._stopping.is_set():
+                try:
+                    task = claim_task(self.using)
+                    if task is not None:
+                        succeeded = run_task(task, self.using)
+                except OperationalError:
+                    # The database is busy; look again after a pause. A
+                    # task whose outcome was not recorded is retried
+                    # once it is assumed lost
+                    close_old_connections()
+                    self._stopping.wait(self.poll_interval)
+                    continue
+
+                if task is not None:
+                    if self.report is not None:
+                        self.report(task, succeeded)
+                elif once:
+                    break
+                else:
+                    self._stopping.wait(self.poll_interval)
+                close_old_connections()
+        finally:
+            connections.close_all()
+
+    def maintain(self):
+        """
+        Retries lost tasks and deletes old ones. If the database stays
+        busy, the work is left for the next maintenance.
+        """
+
+        try:
+            retry_when_busy(requeue_lost_tasks, self.using)
+            retry_when_busy(prune_tasks, self.using)
+        except OperationalError:
+            pass
+        finally:
+            close_old_connections()
+
+    def run(self, once=False):
+        """
+        Runs tasks until stopped, or until none are due if once is set.
+
+        Returns once every worker has finished its current task.
+
+        :param once: Whether to return when no task is due, rather
+            than waiting for more.
+        """
+
+        self._stopping.clear()
+        self.maintain()
+        workers = [
+            threading.Thread(target=self._work, args=(once,),
+                             name=f'task-worker-{number}', daemon=True)
+            for number in range(self.threads)
+        ]
+        for worker in workers:
+            worker.start()
+
+        next_maintenance = time.monotonic() + MAINTENANCE_INTERVAL
+        try:
+            while any(worker.is_alive() for worker in workers):
+                if self._stopping.wait(self.poll_interval):
+                    break
+                if time.monotonic() >= next_maintenance:
+                    self.maintain()
+                    next_maintenance = time.monotonic() + MAINTENANCE_INTERVAL
+        finally:
+            # Let the workers finish the tasks they are running
+            self._stopping.set()
+            for worker in workers:
+                worker.join()
+
+    def stop(self):
+        """Asks the workers to stop after their current task."""
+        self._stopping.set()
@@ -4,16 +4,298 @@
 This script evaluates the functionality of the Sticky Notes application.
 It utilises the Django module 'django.test.TestCase' which is a subclass
 of 'unittest.TestCase' from the Python unittest framework.
+
+View tests use QueryBudgetMixin, whose test clients fail any request
+that runs more queries than its view's entry in VIEW_QUERY_BUDGETS, or
+whose query plan scans the whole notes table.
 """
 
-from django.test import TestCase
-from django.urls import reverse
+import gzip
+import importlib
+import json
+import os
+import re
+import tempfile
+import time
+import threading
+import zipfile
+from contextlib import contextmanager
+from datetime import timedelta
+from io import BytesIO, StringIO
+from types import SimpleNamespace
+from unittest import mock
+from asgiref.sync import async_to_sync, iscoroutinefunction, sync_to_async
+from django.contrib.staticfiles.storage import staticfiles_storage
+from django.core.cache import cache
+from django.core.cache.backends.filebased import FileBasedCache
+from django.core.management import CommandError, call_command
+from django.db import (IntegrityError, OperationalError, connection,
+                       connections)
+from django.db.models import QuerySet
+from django.http import HttpResponse
+from django.test import (AsyncClient, Client, RequestFactory, TestCase,
+                         TransactionTestCase, override_settings)
+from django.test.signals import template_rendered
+from django.test.utils import CaptureQueriesContext
+from django.urls import Resolver404, resolve, reverse
+from django.utils import timezone
 from django.contrib.auth.models import User
+from django.apps import apps
 from django.contrib import auth
-from .models import Note
+from .models import EXCERPT_LENGTH, Note, Task, UserShard, make_excerpt
+from .urls import urlpatterns
+from .middleware import ReplicaRoutingMiddleware
+from .routers import (ReplicaRouter, RoutingState, get_routing_state,
+                      set_routing_state, reset_routing_state)
+from . import (benchmark, board_cache, events, fields, hashing, metrics,
+               purge, ratelimit, rebalance, search, seeding, sharding,
+               staticfiles, tasks, transfer, writer)
+
+
+# Most queries each view may run for one request, including the session
+# and user lookups done by the middleware
+VIEW_QUERY_BUDGETS = {
+    # Signup and login also save the user and rotate the session
+    'signup': 12,
+    'login': 9,
+    'logout': 4,
+    # The noteboard and reads look up one page or one note
+    'note_noteboard': 3,
+    'note_search': 3,
+    'note_create': 5,
+    'note_read': 4,
+    'note_update': 6,
+    'note_delete': 5,
+    # The download's note queries run while the response streams
+    'note_download': 2,
+    # The event stream only authenticates; events come from the broker
+    'note_events': 2,
+    # Bulk endpoints use a fixed number of queries for any batch size,
+    # deletions adding a queued search index merge
+    'api_notes': 11,
+    'api_note': 6,
+    'note_metrics': 2,
+}
+
+# Tables whose queries must never scan every row
+PLAN_CHECKED_TABLES = ('notes_note',)
+
+# Words that can follow a table name but are not an alias for it
+SQL_KEYWORDS = {
+    'WHERE', 'ON', 'USING', 'JOIN', 'INNER', 'LEFT', 'CROSS', 'NATURAL',
+    'ORDER', 'GROUP', 'LIMIT', 'SET', 'VALUES', 'AND', 'OR',
+}
+
+# Statements whose plans are checked
+PLANNED_STATEMENT = re.compile(r'^\s*(SELECT|UPDATE|DELETE|WITH)\b', re.I)
+
+
+def table_names(sql, table):
+    """
+    Returns the names a query uses for a table: the table itself and
+    any aliases given to it.
+
+    :param sql: The SQL of the query.
+    :param table: The table name.
+    :return: A set of names, empty if the query does not read the table.
+    """
+
+    pattern = (r'\b(?:FROM|JOIN|UPDATE)\s+"?' + table +
+               r'"?(?:\s+(?:AS\s+)?"?(\w+)"?)?(?=[\s,)]|$)')
+    names = set()
+    for match in re.finditer(pattern, sql, re.I):
+        names.add(table)
+        alias = match.group(1)
+        if alias and alias.upper() not in SQL_KEYWORDS:
+            names.add(alias)
+
+    return names
+
+
+def full_table_scans(queries, using='default'):
+    """
+    Runs EXPLAIN QUERY PLAN on captured queries and finds the ones that
+    scan every row of a table in PLAN_CHECKED_TABLES.
+
+    :param queries: Queries captured by CaptureQueriesContext.
+    :param using: Database alias the queries ran on.
+    :return: A list of (sql, plan step) tuples, one per full scan.
+    """
+
+    scans = []
+    for query in queries:
+        sql = query['sql']
+        if not PLANNED_STATEMENT.match(sql):
+            continue
+
+        names = set()
+        for table in PLAN_CHECKED_TABLES:
+            names |= table_names(sql, table)
+        if not names:
+            continue
+
+        # Use the raw DB-API cursor so the EXPLAIN is not captured
+        cursor = connections[using].connection.cursor()
+        try:
+            cursor.execute('EXPLAIN QUERY PLAN ' + sql)
+            steps = [row[-1] for row in cursor.fetchall()]
+        finally:
+            cursor.close()
+        for step in steps:
+            scanned = re.match(r'SCAN (?:TABLE )?"?(\w+)', step)
+            if scanned and scanned.group(1) in names:
+                scans.append((sql, step))
+
+    return scans
+
+
+def check_queries(response, queries):
+    """
+    Checks the queries run for a test client response against the
+    view's budget in VIEW_QUERY_BUDGETS and for full table scans.
+
+    Admin views are only checked for full table scans.
+
+    :param response: The response from the test client.
+    :param queries: The queries captured while handling the request.
+    :raises AssertionError: If the view has no budget, runs more queries
+        than its budget, or a query scans a whole checked table.
+    """
+
+    try:
+        view_name = response.resolver_match.view_name
+    except Resolver404:
+        return
+
+    budget = VIEW_QUERY_BUDGETS.get(view_name)
+    if budget is None and not view_name.startswith('admin:'):
+        raise AssertionError(
+            f"View {view_name!r} has no entry in VIEW_QUERY_BUDGETS."
+        )
+    if budget is not None and len(queries) > budget:
+        listing = '\n'.join(query['sql'] for query in queries)
+        raise AssertionError(
+            f"View {view_name!r} ran {len(queries)} queries, over its "
+            f"budget of {budget}:\n{listing}"
+        )
+
+    for sql, step in full_table_scans(queries):
+        raise AssertionError(
+            f"View {view_name!r} ran a full table scan ({step}):\n{sql}"
+        )
+
+
+class BudgetedClient(Client):
+    """
+    A test client that checks every response with check_queries().
+
+    Methods
+    -------
+    request(self, **request):
+        Makes a request, capturing and checking its queries.
+    """
+
+    def request(self, **request):
+        """Makes a request, capturing and checking its queries."""
+
+        with CaptureQueriesContext(connection) as queries:
+            response = super().request(**request)
+        check_queries(response, queries.captured_queries)
+        return response
+
+
+class BudgetedAsyncClient(AsyncClient):
+    """
+    An async test client that checks every response with
+    check_queries().
+
+    Methods
+    -------
+    request(self, **request):
+        Makes a request, capturing and checking its queries.
+    """
+
+    async def request(self, **request):
+        """Makes a request, capturing and checking its queries."""
+
+        # The connection may only be touched from a sync context
+        queries = CaptureQueriesContext(connection)
+        await sync_to_async(queries.__enter__)()
+        try:
+            response = await super().request(**request)
+        finally:
+            await sync_to_async(queries.__exit__)(None, None, None)
+        await sync_to_async(check_queries)(response, queries.captured_queries)
+        return response
+
+
+@contextmanager
+def shared_cache():
+    """
+    Replaces the default cache with a file-based cache in a temporary
+    directory, which every process can share like Redis or Memcached.
+
+    :return: The directory holding the cache files.
+    """
+
+    with tempfile.TemporaryDirectory() as location:
+        with override_settings(CACHES={"default": {
+            "BACKEND": "django.core.cache.backends.filebased.FileBasedCache",
+            "LOCATION": location,
+        }}):
+            yield location
+
+
+class QueryBudgetMixin:
+    """
+    Test case mixin that checks every request made through the test
+    clients against the view query budgets and for full table scans,
+    and adds assertions for checking other code the same way.
+
+    Methods
+    -------
+    assertQueryBudget(self, max_queries, using='default'):
+        Context manager failing if the block runs more than
+        `max_queries` queries or scans a whole checked table.
+    assertNoFullTableScans(self, queries, using='default'):
+        Fails if any captured query scans a whole checked table.
+    """
+
+    client_class = BudgetedClient
+    async_client_class = BudgetedAsyncClient
+
+    @contextmanager
+    def assertQueryBudget(self, max_queries, using='default'):
+        """
+        Context manager failing if the block runs more than
+        `max_queries` queries or scans a whole checked table.
+
+        :param max_queries: Most queries the block may run.
+        :param using: Database alias to watch.
+        """
+
+        with CaptureQueriesContext(connections[using]) as queries:
+            yield queries
+
+        self.assertLessEqual(
+            len(queries), max_queries,
+            '\n'.join(query['sql'] for query in queries.captured_queries)
+        )
+        self.assertNoFullTableScans(queries.captured_queries, using)
+
+    def assertNoFullTableScans(self, queries, using='default'):
+        """
+        Fails if any captured query scans a whole checked table.
 
+        :param queries: Queries captured by CaptureQueriesContext.
+        :param using: Database alias the queries ran on.
+        """
 
-class AuthTestCase(TestCase):
+        scans = full_table_scans(queries, using)
+        self.assertEqual(scans, [], "Queries scanned a whole table.")
+
+
+class AuthTestCase(QueryBudgetMixin, TestCase):
     """
     Test case class for authentication processes including signup,
     login, and logout in a Django application.
@@ -36,6 +318,9 @@ class AuthTestCase(TestCase):
     def setUp(self):
         """Set up function to create a test user before each test."""
 
+        # Clear cached noteboards left by earlier tests
+        cache.clear()
+
         # Create a User object
         self.user = User.objects.create_user(
             username='testuser', password='testpassword'
@@ -153,7 +438,7 @@ class NoteModelTest(TestCase):
         self.assertEqual(note.content, "This is test content.")
 
 
-class NoteViewTest(TestCase):
+class NoteViewTest(QueryBudgetMixin, TestCase):
     """
     A suite of tests for validating the behaviour and functionality of
     the note views in Django.
@@ -183,6 +468,9 @@ class NoteViewTest(TestCase):
     def setUp(self):
         """Creates objects with example user, title, and content."""
 
+        # Clear cached noteboards left by earlier tests
+        cache.clear()
+
         # Create a User object
         test_user = User.objects.create_user(
             username='tester', password='testpassword'
@@ -283,3 +571,3585 @@ class NoteViewTest(TestCase):
         # Check the database for note absence
         with self.assertRaises(Note.DoesNotExist):
             Note.objects.get(id=note.id)
+
+
+@override_settings(NOTES_PAGE_SIZE=2)
+class NotePaginationTest(QueryBudgetMixin, TestCase):
+    """
+    Tests the keyset pagination of the noteboard.
+
+    Methods
+    -------
+    setUp(self):
+        Creates a user with five notes and another user with one note.
+    test_first_page(self):
+        Tests the first page holds the oldest notes and a next cursor.
+    test_next_and_previous_pages(self):
+        Tests following the next and previous cursors across the board.
+    test_previous_page_of_deleted_last_note(self):
+        Tests a previous page has no next page once the notes after
+        it are deleted.
+    test_pages_scoped_to_user(self):
+        Tests that other users' notes never appear on a page.
+    test_invalid_cursor(self):
+        Tests that a malformed cursor falls back to the first page.
+    """
+
+    def setUp(self):
+        """Creates a user with five notes and another user with one
+        note."""
+
+        # Clear cached noteboards left by earlier tests
+        cache.clear()
+
+        # Create User objects and log in the first one
+        test_user = User.objects.create_user(
+            username='tester', password='testpassword'
+        )
+        other_user = User.objects.create_user(
+            username='other', password='testpassword'
+        )
+        self.client.login(username='tester', password='testpassword')
+
+        # Create Note objects for both users
+        self.notes = [
+            Note.objects.create(user=test_user, title=f"Note {i}",
+                                content=f"Content {i}")
+            for i in range(5)
+        ]
+        Note.objects.create(user=other_user, title="Other Note",
+                            content="Other content")
+
+    def test_first_page(self):
+        """Tests the first page holds the oldest notes and a next
+        cursor."""
+
+        response = self.client.get(reverse("note_noteboard"))
+        page = response.context["page"]
+        self.assertEqual(list(page), self.notes[:2])
+        self.assertFalse(page.has_previous)
+        self.assertTrue(page.has_next)
+        self.assertEqual(page.next_cursor, self.notes[1].pk)
+
+    def test_next_and_previous_pages(self):
+        """Tests following the next and previous cursors across the
+        board."""
+
+        # Follow the next cursor to the last page
+        response = self.client.get(
+            reverse("note_noteboard"), {"after": self.notes[3].pk}
+        )
+        page = response.context["page"]
+        self.assertEqual(list(page), self.notes[4:])
+        self.assertFalse(page.has_next)
+        self.assertTrue(page.has_previous)
+
+        # Follow the previous cursor back towards the start
+        response = self.client.get(
+            reverse("note_noteboard"), {"before": page.previous_cursor}
+        )
+        page = response.context["page"]
+        self.assertEqual(list(page), self.notes[2:4])
+        self.assertTrue(page.has_next)
+        self.assertTrue(page.has_previous)
+        self.assertContains(response, f"?after={self.notes[3].pk}")
+        self.assertContains(response, f"?before={self.notes[2].pk}")
+
+    def test_previous_page_of_deleted_last_note(self):
+        """Tests a previous page has no next page once the notes after
+        it are deleted."""
+
+        cursor = self.notes[4].pk
+        self.notes[4].delete()
+        response = self.client.get(reverse("note_noteboard"),
+                                   {"before": cursor})
+        page = response.context["page"]
+        self.assertEqual(list(page), self.notes[2:4])
+        self.assertFalse(page.has_next)
+        self.assertIsNone(page.next_cursor)
+        self.assertTrue(page.has_previous)
+
+    def test_pages_scoped_to_user(self):
+        """Tests that other users' notes never appear on a page."""
+
+        response = self.client.get(
+            reverse("note_noteboard"), {"after": self.notes[-1].pk}
+        )
+        self.assertEqual(list(response.context["page"]), [])
+        self.assertNotContains(response, "Other Note")
+
+    def test_invalid_cursor(self):
+        """Tests that a malformed cursor falls back to the first
+        page."""
+
+        response = self.client.get(
+            reverse("note_noteboard"), {"after": "not-a-number"}
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(list(response.context["page"]), self.notes[:2])
+
+
+class NoteSearchTest(QueryBudgetMixin, TestCase):
+    """
+    Tests the full-text search view and the FTS5 index behind it.
+
+    Methods
+    -------
+    setUp(self):
+        Creates two users with notes and logs in the first one.
+    search(self, text):
+        Returns the titles of the notes found by the search view.
+    test_search_ranked_and_scoped(self):
+        Tests results are ranked by relevance and scoped to the user.
+    test_index_follows_update_and_delete(self):
+        Tests the index tracks notes updated and deleted via views.
+    test_search_input_is_literal(self):
+        Tests FTS5 operators typed by the user do not cause errors.
+    test_rebuild_command(self):
+        Tests the management command rebuilds a cleared index.
+    """
+
+    def setUp(self):
+        """Creates two users with notes and logs in the first one."""
+
+        # Create User objects and log in the first one
+        self.user = User.objects.create_user(
+            username='tester', password='testpassword'
+        )
+        other_user = User.objects.create_user(
+            username='other', password='testpassword'
+        )
+        self.client.login(username='tester', password='testpassword')
+
+        # Create Note objects for both users
+        self.shopping = Note.objects.create(
+            user=self.user, title="Shopping",
+            content="Buy milk, bread and more milk."
+        )
+        self.work = Note.objects.create(
+            user=self.user, title="Work milk run",
+            content="Ask the team about the coffee order."
+        )
+        Note.objects.create(user=other_user, title="Other milk",
+                            content="Milk for the other user.")
+
+    def search(self, text):
+        """Returns the titles of the notes found by the search view."""
+
+        response = self.client.get(reverse("note_search"), {"q": text})
+        self.assertEqual(response.status_code, 200)
+        return [note.title for note in response.context["notes"]]
+
+    def test_search_ranked_and_scoped(self):
+        """Tests results are ranked by relevance and scoped to the
+        user."""
+
+        self.assertEqual(self.search("milk"), ["Shopping", "Work milk run"])
+        self.assertEqual(self.search("coff"), ["Work milk run"])
+        self.assertEqual(self.search("nothing here"), [])
+
+    def test_index_follows_update_and_delete(self):
+        """Tests the index tracks notes updated and deleted via
+        views."""
+
+        # Update a note and check the old words are no longer indexed
+        self.client.post(
+            reverse("note_update", args=[self.work.pk]),
+            {"title": "Work", "content": "Quarterly report."},
+        )
+        self.assertEqual(self.search("quarterly"), ["Work"])
+        self.assertEqual(self.search("coffee"), [])
+
+        # Delete a note and check it no longer appears
+        self.client.post(reverse("note_delete", args=[self.shopping.pk]))
+        self.assertEqual(self.search("milk"), [])
+
+    def test_search_input_is_literal(self):
+        """Tests FTS5 operators typed by the user do not cause
+        errors."""
+
+        self.assertEqual(self.search('"milk" AND bread'), ["Shopping"])
+        self.assertEqual(self.search("NEAR(milk"), [])
+        self.assertEqual(self.search("   "), [])
+
+    def test_rebuild_command(self):
+        """Tests the management command rebuilds a cleared index."""
+
+        # Clear the index behind the signals' back
+        search.unindex_notes(Note.objects.values_list("pk", flat=True))
+        self.assertEqual(self.search("milk"), [])
+
+        # Rebuild it in small batches
+        out = StringIO()
+        call_command("rebuild_search_index", batch_size=2, stdout=out)
+        self.assertIn("rebuilt with 3 notes", out.getvalue())
+        self.assertEqual(self.search("milk"), ["Shopping", "Work milk run"])
+
+
+class NoteBoardCacheTest(QueryBudgetMixin, TestCase):
+    """
+    Tests the per-user versioned cache of the rendered noteboard. The
+    board is only cached in a cache shared between processes, so these
+    tests use a file-based cache.
+
+    Methods
+    -------
+    setUpClass(cls):
+        Switches the default cache to a shared file-based cache.
+    setUp(self):
+        Creates two users with a note each and logs in the first one.
+    test_board_served_from_cache(self):
+        Tests an unchanged board is served without re-rendering.
+    test_bump_from_another_process(self):
+        Tests a version bump made through another process's cache
+        invalidates the board.
+    test_process_local_cache_not_used(self):
+        Tests boards are not cached in a per-process cache.
+    test_views_invalidate_board(self):
+        Tests creating, updating and deleting notes refresh the board.
+    test_admin_reassignment_invalidates_both_boards(self):
+        Tests moving a note to another user in the admin refreshes the
+        boards of both users.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        """Switches the default cache to a shared file-based cache."""
+
+        cls.cache_location = cls.enterClassContext(shared_cache())
+        super().setUpClass()
+
+    def setUp(self):
+        """Creates two users with a note each and logs in the first
+        one."""
+
+        # Clear cached noteboards left by earlier tests
+        cache.clear()
+
+        # Create User objects and log in the first one
+        self.user = User.objects.create_user(
+            username='tester', password='testpassword'
+        )
+        self.other_user = User.objects.create_user(
+            username='other', password='testpassword'
+        )
+        self.client.login(username='tester', password='testpassword')
+
+        # Create a Note object for each user
+        self.note = Note.objects.create(user=self.user, title="Cached",
+                                        content="Cached content.")
+        Note.objects.create(user=self.other_user, title="Other's note",
+                            content="Other content.")
+
+    def test_board_served_from_cache(self):
+        """Tests an unchanged board is served without re-rendering."""
+
+        self.assertContains(self.client.get(reverse("note_noteboard")),
+                            "Cached")
+
+        # Change the note without sending signals; the board is stale
+        Note.objects.filter(pk=self.note.pk).update(title="Changed")
+        response = self.client.get(reverse("note_noteboard"))
+        self.assertIsNone(response.context["page"])
+        self.assertContains(response, "Cached")
+
+        # A CSRF token is still rendered for the delete buttons
+        self.assertContains(response, "csrfmiddlewaretoken")
+
+    def test_bump_from_another_process(self):
+        """Tests a version bump made through another process's cache
+        invalidates the board."""
+
+        self.client.get(reverse("note_noteboard"))
+        Note.objects.filter(pk=self.note.pk).update(
+            title="Changed", updated=timezone.now()
+        )
+
+        # Another process, such as the task worker, has its own cache
+        # instance on the same store
+        other_cache = FileBasedCache(self.cache_location, {})
+        with mock.patch.object(board_cache, "cache", other_cache):
+            board_cache.bump_board_version(self.user.pk)
+
+        response = self.client.get(reverse("note_noteboard"))
+        self.assertIsNotNone(response.context["page"])
+        self.assertContains(response, "Changed")
+
+    def test_process_local_cache_not_used(self):
+        """Tests boards are not cached in a per-process cache."""
+
+        with override_settings(CACHES={"default": {
+            "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        }}):
+            self.assertEqual(
+                [error.id for error in board_cache.check_shared_cache(None)],
+                ["notes.W001"],
+            )
+            self.client.get(reverse("note_noteboard"))
+            Note.objects.filter(pk=self.note.pk).update(
+                title="Changed", updated=timezone.now()
+            )
+            response = self.client.get(reverse("note_noteboard"))
+
+        self.assertIsNotNone(response.context["page"])
+        self.assertContains(response, "Changed")
+        self.assertEqual(board_cache.check_shared_cache(None), [])
+
+    def test_views_invalidate_board(self):
+        """Tests creating, updating and deleting notes refresh the
+        board."""
+
+        self.client.get(reverse("note_noteboard"))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse("note_create"),
+                             {"title": "Created", "content": "New."})
+        self.assertContains(self.client.get(reverse("note_noteboard")),
+                            "Created")
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse("note_update", args=[self.note.pk]),
+                             {"title": "Updated", "content": "Changed."})
+        response = self.client.get(reverse("note_noteboard"))
+        self.assertContains(response, "Updated")
+        self.assertNotContains(response, "Cached")
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse("note_delete", args=[self.note.pk]))
+        self.assertNotContains(self.client.get(reverse("note_noteboard")),
+                               "<h2>Updated</h2>", html=True)
+
+    def test_admin_reassignment_invalidates_both_boards(self):
+        """Tests moving a note to another user in the admin refreshes
+        the boards of both users."""
+
+        # Cache both users' boards
+        self.client.get(reverse("note_noteboard"))
+        other_client = self.client_class()
+        other_client.login(username='other', password='testpassword')
+        other_client.get(reverse("note_noteboard"))
+
+        # Move the note to the other user through the admin
+        User.objects.create_superuser(username='admin', password='adminpass')
+        admin_client = self.client_class()
+        admin_client.login(username='admin', password='adminpass')
+        with self.captureOnCommitCallbacks(execute=True):
+            response = admin_client.post(
+                reverse("admin:notes_note_change", args=[self.note.pk]),
+                {"user": self.other_user.pk, "title": "Moved",
+                 "content": "Cached content."},
+            )
+        self.assertEqual(response.status_code, 302)
+
+        # Both boards reflect the move
+        self.assertNotContains(self.client.get(reverse("note_noteboard")),
+                               "Cached")
+        self.assertContains(other_client.get(reverse("note_noteboard")),
+                            "Moved")
+
+
+class NoteOwnershipTest(QueryBudgetMixin, TestCase):
+    """
+    Tests the owner-scoped note lookup used by the read, update and
+    delete views, including the exact number of queries they run.
+
+    Every request below runs two queries in the auth middleware to load
+    the session and the logged in user, then one query to fetch the
+    note filtered on both its primary key and user_id.
+
+    Methods
+    -------
+    setUp(self):
+        Creates two users with a note each and logs in the first one.
+    test_read_query_count(self):
+        Tests the read view runs exactly three queries.
+    test_update_query_count(self):
+        Tests the update view's GET and POST query counts.
+    test_delete_query_count(self):
+        Tests the delete view runs exactly five queries.
+    test_other_users_note(self):
+        Tests another user's note gives the permission message.
+    test_missing_note(self):
+        Tests a note that does not exist gives a 404.
+    """
+
+    def setUp(self):
+        """Creates two users with a note each and logs in the first
+        one."""
+
+        # Create User objects and log in the first one
+        test_user = User.objects.create_user(
+            username='tester', password='testpassword'
+        )
+        other_user = User.objects.create_user(
+            username='other', password='testpassword'
+        )
+        self.client.login(username='tester', password='testpassword')
+
+        # Create a Note object for each user
+        self.note = Note.objects.create(user=test_user, title="Mine",
+                                        content="My content.")
+        self.other_note = Note.objects.create(user=other_user,
+                                              title="Theirs",
+                                              content="Their content.")
+
+    def test_read_query_count(self):
+        """Tests the read view runs exactly three queries."""
+
+        with self.assertNumQueries(3):
+            response = self.client.get(
+                reverse("note_read", args=[self.note.pk])
+            )
+        self.assertContains(response, "My content.")
+
+    def test_update_query_count(self):
+        """Tests the update view's GET and POST query counts."""
+
+        with self.assertNumQueries(3):
+            response = self.client.get(
+                reverse("note_update", args=[self.note.pk])
+            )
+        self.assertContains(response, "My content.")
+
+        # Saving adds the UPDATE and two search index statements
+        with self.assertNumQueries(6):
+            response = self.client.post(
+                reverse("note_update", args=[self.note.pk]),
+                {"title": "Updated", "content": "Updated content."},
+            )
+        self.assertEqual(response.status_code, 302)
+
+    def test_delete_query_count(self):
+        """Tests the delete view runs exactly five queries."""
+
+        # Deleting adds the DELETE and one search index statement
+        with self.assertNumQueries(5):
+            response = self.client.post(
+                reverse("note_delete", args=[self.note.pk])
+            )
+        self.assertEqual(response.status_code, 302)
+        self.assertFalse(Note.objects.filter(pk=self.note.pk).exists())
+
+    def test_other_users_note(self):
+        """Tests another user's note gives the permission message."""
+
+        for name, verb in [("note_read", "access"),
+                           ("note_update", "edit"),
+                           ("note_delete", "delete")]:
+            response = self.client.post(
+                reverse(name, args=[self.other_note.pk]), follow=True
+            )
+            self.assertRedirects(response, reverse("note_noteboard"))
+            self.assertContains(
+                response,
+                f"You do not have permission to {verb} this note."
+            )
+
+        # The other user's note is untouched
+        self.other_note.refresh_from_db()
+        self.assertEqual(self.other_note.title, "Theirs")
+
+    def test_missing_note(self):
+        """Tests a note that does not exist gives a 404."""
+
+        missing_pk = self.other_note.pk + 100
+        for name in ["note_read", "note_update", "note_delete"]:
+            response = self.client.get(reverse(name, args=[missing_pk]))
+            self.assertEqual(response.status_code, 404)
+
+
+class NoteAPITest(QueryBudgetMixin, TestCase):
+    """
+    Tests the JSON API for notes, including the bulk endpoints.
+
+    Methods
+    -------
+    setUp(self):
+        Creates two users with a note each and logs in the first one.
+    send(self, method, url, body):
+        Sends a JSON request and returns the status and decoded body.
+    count_statements(self, queries, prefix):
+        Counts captured SQL statements starting with a prefix.
+    test_requires_authentication(self):
+        Tests anonymous requests get a 401 response.
+    test_single_note_crud(self):
+        Tests creating, reading, updating and deleting one note.
+    test_other_users_note_not_found(self):
+        Tests another user's note is reported as missing.
+    test_list_paginates(self):
+        Tests the list endpoint returns pages with a next cursor.
+    test_bulk_create(self):
+        Tests a batch is inserted with a single statement and indexed.
+    test_bulk_create_reports_item_errors(self):
+        Tests invalid items are reported and nothing is created.
+    test_bulk_update(self):
+        Tests a batch is updated with a single statement.
+    test_bulk_update_rejects_foreign_ids(self):
+        Tests updating another user's note fails the whole batch.
+    test_bulk_delete(self):
+        Tests a batch is deleted with a single statement.
+    """
+
+    def setUp(self):
+        """Creates two users with a note each and logs in the first
+        one."""
+
+        # Create User objects and log in the first one
+        self.user = User.objects.create_user(
+            username='tester', password='testpassword'
+        )
+        other_user = User.objects.create_user(
+            username='other', password='testpassword'
+        )
+        self.client.login(username='tester', password='testpassword')
+
+        # Create a Note object for each user
+        self.note = Note.objects.create(user=self.user, title="Mine",
+                                        content="My content.")
+        self.other_note = Note.objects.create(user=other_user,
+                                              title="Theirs",
+                                              content="Their content.")
+
+    def send(self, method, url, body=None):
+        """Sends a JSON request and returns the status and decoded
+        body."""
+
+        if method == "get":
+            response = self.client.get(url)
+        else:
+            response = getattr(self.client, method)(
+                url, data=json.dumps(body), content_type="application/json"
+            )
+        return response.status_code, response.json()
+
+    def count_statements(self, queries, prefix):
+        """Counts captured SQL statements starting with a prefix."""
+
+        return sum(
+            1 for query in queries if query["sql"].startswith(prefix)
+        )
+
+    def test_requires_authentication(self):
+        """Tests anonymous requests get a 401 response."""
+
+        self.client.logout()
+        response = self.client.get(reverse("api_notes"))
+        self.assertEqual(response.status_code, 401)
+
+    def test_single_note_crud(self):
+        """Tests creating, reading, updating and deleting one note."""
+
+        status, body = self.send("post", reverse("api_notes"),
+                                 {"title": "API", "content": "Via API."})
+        self.assertEqual(status, 201)
+        url = reverse("api_note", args=[body["id"]])
+
+        status, body = self.send("get", url)
+        self.assertEqual(body["content"], "Via API.")
+
+        status, body = self.send("patch", url, {"title": "Patched"})
+        self.assertEqual((status, body["title"], body["content"]),
+                         (200, "Patched", "Via API."))
+
+        status, body = self.send("put", url, {"title": "No content"})
+        self.assertEqual(status, 400)
+        self.assertIn("content", body["errors"])
+
+        status, body = self.send("delete", url)
+        self.assertEqual(status, 200)
+        self.assertFalse(Note.objects.filter(title="Patched").exists())
+
+    def test_other_users_note_not_found(self):
+        """Tests another user's note is reported as missing."""
+
+        url = reverse("api_note", args=[self.other_note.pk])
+        for method in ["get", "patch", "delete"]:
+            status, body = self.send(method, url, {"title": "Hacked"})
+            self.assertEqual(status, 404)
+        self.other_note.refresh_from_db()
+        self.assertEqual(self.other_note.title, "Theirs")
+
+    @override_settings(NOTES_PAGE_SIZE=1)
+    def test_list_paginates(self):
+        """Tests the list endpoint returns pages with a next cursor."""
+
+        second = Note.objects.create(user=self.user, title="Second",
+                                     content="More.")
+        status, body = self.send("get", reverse("api_notes"))
+        self.assertEqual([note["title"] for note in body["results"]],
+                         ["Mine"])
+
+        response = self.client.get(reverse("api_notes"),
+                                   {"after": body["next"]})
+        body = response.json()
+        self.assertEqual([note["id"] for note in body["results"]],
+                         [second.pk])
+        self.assertIsNone(body["next"])
+
+    def test_bulk_create(self):
+        """Tests a batch is inserted with a single statement and
+        indexed."""
+
+        batch = [{"title": f"Bulk {i}", "content": f"Bulk content {i}"}
+                 for i in range(20)]
+        with CaptureQueriesContext(connection) as queries:
+            status, body = self.send("post", reverse("api_notes"), batch)
+        self.assertEqual(status, 201)
+        self.assertEqual(len(body["results"]), 20)
+        self.assertEqual(
+            self.count_statements(queries, 'INSERT INTO "notes_note"'), 1
+        )
+
+        # The new notes are searchable straight away
+        found = search.search_notes(self.user, "bulk")
+        self.assertEqual(len(found), 20)
+
+    def test_bulk_create_reports_item_errors(self):
+        """Tests invalid items are reported and nothing is created."""
+
+        batch = [{"title": "Fine", "content": "Fine."},
+                 {"title": "x" * 51, "content": "Too long a title."},
+                 "not an object"]
+        status, body = self.send("post", reverse("api_notes"), batch)
+        self.assertEqual(status, 400)
+        self.assertEqual([item["index"] for item in body["items"]], [1, 2])
+        self.assertIn("title", body["items"][0]["errors"])
+        self.assertFalse(Note.objects.filter(title="Fine").exists())
+
+    def test_bulk_update(self):
+        """Tests a batch is updated with a single statement."""
+
+        second = Note.objects.create(user=self.user, title="Second",
+                                     content="More.")
+        batch = [{"id": self.note.pk, "title": "New title"},
+                 {"id": second.pk, "content": "New content."}]
+        with CaptureQueriesContext(connection) as queries:
+            status, body = self.send("patch", reverse("api_notes"), batch)
+        self.assertEqual(status, 200)
+        self.assertEqual(
+            self.count_statements(queries, 'UPDATE "notes_note"'), 1
+        )
+
+        self.note.refresh_from_db()
+        second.refresh_from_db()
+        self.assertEqual((self.note.title, self.note.content),
+                         ("New title", "My content."))
+        self.assertEqual((second.title, second.content),
+                         ("Second", "New content."))
+        self.assertEqual(len(search.search_notes(self.user, "new")), 2)
+
+    def test_bulk_update_rejects_foreign_ids(self):
+        """Tests updating another user's note fails the whole batch."""
+
+        batch = [{"id": self.note.pk, "title": "Changed"},
+                 {"id": self.other_note.pk, "title": "Hacked"}]
+        status, body = self.send("patch", reverse("api_notes"), batch)
+        self.assertEqual(status, 400)
+        self.assertEqual(body["items"][0]["index"], 1)
+
+        self.note.refresh_from_db()
+        self.assertEqual(self.note.title, "Mine")
+
+    def test_bulk_delete(self):
+        """Tests a batch is deleted with a single statement."""
+
+        second = Note.objects.create(user=self.user, title="Second",
+                                     content="More.")
+        ids = [self.note.pk, second.pk]
+        with CaptureQueriesContext(connection) as queries:
+            status, body = self.send("delete", reverse("api_notes"),
+                                     {"ids": ids})
+        self.assertEqual((status, body["deleted"]), (200, ids))
+        self.assertEqual(
+            self.count_statements(queries, 'DELETE FROM notes_note '), 1
+        )
+        self.assertFalse(Note.objects.filter(user=self.user).exists())
+        self.assertTrue(Note.objects.filter(pk=self.other_note.pk).exists())
+
+
+class NoteAsyncViewTest(QueryBudgetMixin, TestCase):
+    """
+    Tests the async note views through Django's ASGI request handler,
+    using the async test client.
+
+    Methods
+    -------
+    setUp(self):
+        Creates a user with a note.
+    test_anonymous_redirected(self):
+        Tests an anonymous request is redirected to the login page.
+    test_noteboard_and_read(self):
+        Tests the noteboard and read views render over ASGI.
+    test_create_update_delete(self):
+        Tests the note CRUD views write through the async ORM.
+    """
+
+    def setUp(self):
+        """Creates a user with a note."""
+
+        # Clear cached noteboards left by earlier tests
+        cache.clear()
+
+        # Create User and Note objects
+        self.user = User.objects.create_user(
+            username='tester', password='testpassword'
+        )
+        self.note = Note.objects.create(user=self.user, title="Async",
+                                        content="Async content.")
+
+    async def test_anonymous_redirected(self):
+        """Tests an anonymous request is redirected to the login
+        page."""
+
+        response = await self.async_client.get(reverse("note_noteboard"))
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue(response.url.startswith("/accounts/login/"))
+
+    async def test_noteboard_and_read(self):
+        """Tests the noteboard and read views render over ASGI."""
+
+        await self.async_client.aforce_login(self.user)
+
+        response = await self.async_client.get(reverse("note_noteboard"))
+        self.assertContains(response, "Async content.")
+        self.assertContains(response, "Log Out")
+
+        response = await self.async_client.get(
+            reverse("note_read", args=[self.note.pk])
+        )
+        self.assertContains(response, "Async content.")
+
+    async def test_create_update_delete(self):
+        """Tests the note CRUD views write through the async ORM."""
+
+        await self.async_client.aforce_login(self.user)
+
+        response = await self.async_client.post(
+            reverse("note_create"), {"title": "New", "content": "Created."}
+        )
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue(await Note.objects.filter(title="New").aexists())
+
+        response = await self.async_client.post(
+            reverse("note_update", args=[self.note.pk]),
+            {"title": "Changed", "content": "Updated."},
+        )
+        self.assertEqual(response.status_code, 302)
+        await self.note.arefresh_from_db()
+        self.assertEqual(self.note.title, "Changed")
+
+        response = await self.async_client.post(
+            reverse("note_delete", args=[self.note.pk])
+        )
+        self.assertEqual(response.status_code, 302)
+        self.assertFalse(
+            await Note.objects.filter(pk=self.note.pk).aexists()
+        )
+
+
+class SQLitePragmaTest(TestCase):
+    """
+    Tests the SQLITE_PRAGMAS setting is applied to new connections.
+
+    Methods
+    -------
+    read_pragmas(self, *names):
+        Opens a new connection and reads back the given pragmas.
+    test_pragmas_applied(self):
+        Tests the production pragmas are set on a new connection.
+    test_invalid_pragma_rejected(self):
+        Tests a pragma value that is not a word or integer is refused.
+    """
+
+    def read_pragmas(self, *names):
+        """Opens a new connection and reads back the given pragmas."""
+
+        new_connection = connections.create_connection('default')
+        try:
+            with new_connection.cursor() as cursor:
+                values = []
+                for name in names:
+                    cursor.execute(f"PRAGMA {name}")
+                    values.append(cursor.fetchone()[0])
+        finally:
+            new_connection.close()
+
+        return values
+
+    @override_settings(SQLITE_PRAGMAS={"synchronous": "NORMAL",
+                                       "busy_timeout": 5000,
+                                       "cache_size": -65536})
+    def test_pragmas_applied(self):
+        """Tests the production pragmas are set on a new connection."""
+
+        # synchronous=NORMAL is reported as 1
+        self.assertEqual(
+            self.read_pragmas("synchronous", "busy_timeout", "cache_size"),
+            [1, 5000, -65536],
+        )
+
+    @override_settings(SQLITE_PRAGMAS={"synchronous": "OFF; DROP TABLE x"})
+    def test_invalid_pragma_rejected(self):
+        """Tests a pragma value that is not a word or integer is
+        refused."""
+
+        with self.assertRaises(ValueError):
+            self.read_pragmas("synchronous")
+
+
+@override_settings(NOTES_WRITE_COALESCING=True, NOTES_WRITE_BATCH_DELAY=0.05)
+class NoteWriterTest(QueryBudgetMixin, TransactionTestCase):
+    """
+    Tests the write-coalescing path for note mutations. The writer
+    commits on its own thread, so these tests use real transactions.
+
+    Methods
+    -------
+    setUp(self):
+        Creates a user and a fresh writer.
+    tearDown(self):
+        Stops the writer so later tests start without one.
+    test_concurrent_writes_share_transactions(self):
+        Tests concurrent writes are grouped into fewer transactions.
+    test_failure_is_isolated(self):
+        Tests a failing write reports its error without affecting the
+        rest of its group.
+    test_writes_run_in_callers_context(self):
+        Tests writes see the caller's context variables.
+    test_timed_out_writes_are_cancelled(self):
+        Tests a write whose caller timed out before it started never
+        runs.
+    test_views_use_writer(self):
+        Tests the note views still redirect with messages.
+    """
+
+    def setUp(self):
+        """Creates a user and a fresh writer."""
+
+        # Clear cached noteboards left by earlier tests
+        cache.clear()
+
+        # Create a User object and log in
+        self.user = User.objects.create_user(
+            username='tester', password='testpassword'
+        )
+        self.client.login(username='tester', password='testpassword')
+        writer.stop_writer()
+
+    def tearDown(self):
+        """Stops the writer so later tests start without one."""
+        writer.stop_writer()
+
+    def test_concurrent_writes_share_transactions(self):
+        """Tests concurrent writes are grouped into fewer
+        transactions."""
+
+        results = []
+
+        def create(i):
+            note = writer.run_write(
+                Note.objects.create, user=self.user, title=f"Note {i}",
+                content="Written by the writer."
+            )
+            results.append(note.pk)
+
+        threads = [threading.Thread(target=create, args=[i])
+                   for i in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(results), 10)
+        self.assertEqual(Note.objects.filter(user=self.user).count(), 10)
+        self.assertLess(writer.get_writer().batches_committed, 10)
+
+    def test_failure_is_isolated(self):
+        """Tests a failing write reports its error without affecting
+        the rest of its group."""
+
+        def fail():
+            Note.objects.create(user=self.user, title="Rolled back",
+                                content="Never committed.")
+            raise ValueError("Write failed.")
+
+        active = writer.get_writer()
+        failing = active.submit(fail)
+        passing = active.submit(Note.objects.create, user=self.user,
+                                title="Kept", content="Committed.")
+
+        with self.assertRaisesMessage(ValueError, "Write failed."):
+            failing.result(timeout=5)
+        self.assertEqual(passing.result(timeout=5).title, "Kept")
+        self.assertEqual(
+            list(Note.objects.values_list("title", flat=True)), ["Kept"]
+        )
+
+    def test_writes_run_in_callers_context(self):
+        """Tests writes see the caller's context variables."""
+
+        state = RoutingState()
+        token = set_routing_state(state)
+        try:
+            seen = writer.run_write(get_routing_state)
+            writer.run_write(Note.objects.create, user=self.user,
+                             title="Pinned", content="Recorded.")
+        finally:
+            reset_routing_state(token)
+
+        self.assertIs(seen, state)
+        self.assertTrue(state.wrote)
+
+    def test_timed_out_writes_are_cancelled(self):
+        """Tests a write whose caller timed out before it started never
+        runs."""
+
+        # Hold the writer in a group of its own
+        release = threading.Event()
+        active = writer.get_writer()
+        blocker = active.submit(release.wait, 5)
+        time.sleep(0.2)
+
+        with override_settings(NOTES_WRITE_TIMEOUT=0.1):
+            with self.assertRaises(TimeoutError):
+                writer.run_write(Note.objects.create, user=self.user,
+                                 title="Abandoned", content="Never run.")
+        release.set()
+        blocker.result(timeout=5)
+
+        writer.run_write(Note.objects.create, user=self.user,
+                         title="Kept", content="Committed.")
+        self.assertEqual(
+            list(Note.objects.values_list("title", flat=True)), ["Kept"]
+        )
+
+    def test_views_use_writer(self):
+        """Tests the note views still redirect with messages."""
+
+        response = self.client.post(
+            reverse("note_create"),
+            {"title": "Queued", "content": "Via the writer."},
+            follow=True,
+        )
+        self.assertRedirects(response, reverse("note_noteboard"))
+        self.assertContains(response, "Queued&quot; has been created!")
+        self.assertGreaterEqual(writer.get_writer().batches_committed, 1)
+
+
+@override_settings(NOTES_READ_REPLICAS=["replica_1", "replica_2"])
+class ReplicaRouterTest(TestCase):
+    """
+    Tests the read-replica router and its read-your-writes stickiness.
+
+    Methods
+    -------
+    route_read(self, model, **state):
+        Routes a read with the given request state.
+    test_reads_outside_requests_use_default(self):
+        Tests reads outside a request are left to Django.
+    test_replica_views_read_replicas(self):
+        Tests notes reads in replica-enabled views use a replica.
+    test_pinned_clients_read_primary(self):
+        Tests recently written clients read the primary.
+    test_writes_go_to_primary(self):
+        Tests writes go to the primary and are recorded.
+    test_write_sets_pin_cookie(self):
+        Tests a note write pins the client to the primary.
+    test_bulk_api_write_sets_pin_cookie(self):
+        Tests bulk API writes, made on an explicit database, pin the
+        client to the primary.
+    test_async_requests_stay_async(self):
+        Tests the middleware handles async requests without threads.
+    test_replica_boards_not_cached(self):
+        Tests boards read from a replica are not cached.
+    """
+
+    def route_read(self, model, **state):
+        """Routes a read with the given request state."""
+
+        routing_state = RoutingState(pinned=state.get("pinned", False))
+        routing_state.use_replica = state.get("use_replica", False)
+        token = set_routing_state(routing_state)
+        try:
+            return ReplicaRouter().db_for_read(model)
+        finally:
+            reset_routing_state(token)
+
+    def test_reads_outside_requests_use_default(self):
+        """Tests reads outside a request are left to Django."""
+
+        self.assertIsNone(ReplicaRouter().db_for_read(Note))
+
+    def test_replica_views_read_replicas(self):
+        """Tests notes reads in replica-enabled views use a replica."""
+
+        self.assertIn(self.route_read(Note, use_replica=True),
+                      ["replica_1", "replica_2"])
+        self.assertEqual(self.route_read(Note, use_replica=False),
+                         "default")
+
+        # Auth models always stay with Django's default routing
+        self.assertIsNone(self.route_read(User, use_replica=True))
+
+    def test_pinned_clients_read_primary(self):
+        """Tests recently written clients read the primary."""
+
+        self.assertEqual(
+            self.route_read(Note, use_replica=True, pinned=True), "default"
+        )
+
+    def test_writes_go_to_primary(self):
+        """Tests writes go to the primary and are recorded."""
+
+        state = RoutingState()
+        token = set_routing_state(state)
+        try:
+            self.assertEqual(ReplicaRouter().db_for_write(Note), "default")
+        finally:
+            reset_routing_state(token)
+        self.assertTrue(state.wrote)
+
+    def test_write_sets_pin_cookie(self):
+        """Tests a note write pins the client to the primary."""
+
+        User.objects.create_user(username='tester', password='testpassword')
+        self.client.login(username='tester', password='testpassword')
+
+        response = self.client.get(reverse("note_create"))
+        self.assertNotIn("notes_primary_pin", response.cookies)
+
+        response = self.client.post(reverse("note_create"),
+                                    {"title": "New", "content": "Pinned."})
+        self.assertIn("notes_primary_pin", response.cookies)
+
+    def test_bulk_api_write_sets_pin_cookie(self):
+        """Tests bulk API writes, made on an explicit database, pin the
+        client to the primary."""
+
+        user = User.objects.create_user(username='tester',
+                                        password='testpassword')
+        notes = [Note.objects.create(title=f"Bulk {i}", content="Pinned.",
+                                     user=user) for i in range(2)]
+        self.client.login(username='tester', password='testpassword')
+
+        response = self.client.post(
+            reverse("api_notes"),
+            data=json.dumps([{"title": "New", "content": "Pinned."}]),
+            content_type="application/json")
+        self.assertEqual(response.status_code, 201)
+        self.assertIn("notes_primary_pin", response.cookies)
+
+        # Updates and deletes never pass through the routers
+        self.client.cookies.pop("notes_primary_pin")
+        response = self.client.patch(
+            reverse("api_notes"),
+            data=json.dumps([{"id": notes[0].pk, "title": "Changed"}]),
+            content_type="application/json")
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("notes_primary_pin", response.cookies)
+
+        self.client.cookies.pop("notes_primary_pin")
+        response = self.client.delete(
+            reverse("api_notes"),
+            data=json.dumps({"ids": [notes[1].pk]}),
+            content_type="application/json")
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("notes_primary_pin", response.cookies)
+
+    async def test_async_requests_stay_async(self):
+        """Tests the middleware handles async requests without
+        threads."""
+
+        async def view(request):
+            await middleware.process_view(request, view, (), {})
+            state = get_routing_state()
+            state.wrote = True
+            return HttpResponse(str(state.use_replica))
+
+        middleware = ReplicaRoutingMiddleware(view)
+        self.assertTrue(iscoroutinefunction(middleware))
+        self.assertTrue(iscoroutinefunction(middleware.process_view))
+
+        request = RequestFactory().get(reverse("note_noteboard"))
+        request.resolver_match = resolve(reverse("note_noteboard"))
+        response = await middleware(request)
+        self.assertEqual(response.content, b"True")
+        self.assertIn("notes_primary_pin", response.cookies)
+
+    def test_replica_boards_not_cached(self):
+        """Tests boards read from a replica are not cached."""
+
+        self.enterContext(shared_cache())
+        cache.clear()
+        user = User.objects.create_user(username='tester',
+                                        password='testpassword')
+        Note.objects.create(title="Board", content="Cached?", user=user)
+        self.client.login(username='tester', password='testpassword')
+        key = board_cache.board_fragment_key(user.pk, None, None)
+
+        # The test database stands in for a lagging replica
+        with override_settings(NOTES_READ_REPLICAS=["default"]):
+            response = self.client.get(reverse("note_noteboard"))
+        self.assertContains(response, "Board")
+        self.assertIsNone(board_cache.get_board_fragment(key))
+
+        # Boards read from the primary are cached as before
+        with override_settings(NOTES_READ_REPLICAS=[]):
+            self.client.get(reverse("note_noteboard"))
+        self.assertIsNotNone(board_cache.get_board_fragment(key))
+
+
+class BenchmarkTest(TransactionTestCase):
+    """
+    Tests the load-testing benchmark on a tiny data set. The benchmark
+    sends requests from worker threads, so it needs committed data.
+
+    Methods
+    -------
+    test_percentile(self):
+        Tests the nearest-rank percentile calculation.
+    test_run_benchmark(self):
+        Tests a run reports every metric for each route.
+    test_auth_routes_not_rate_limited(self):
+        Tests signups and logins beyond the rate limits all succeed.
+    test_compare_reports(self):
+        Tests the percentage changes between two reports.
+    """
+
+    def test_percentile(self):
+        """Tests the nearest-rank percentile calculation."""
+
+        values = list(range(1, 101))
+        self.assertEqual(benchmark.percentile(values, 0.50), 50)
+        self.assertEqual(benchmark.percentile(values, 0.99), 99)
+        self.assertEqual(benchmark.percentile([7], 0.95), 7)
+
+    def test_run_benchmark(self):
+        """Tests a run reports every metric for each route."""
+
+        cache.clear()
+        config = benchmark.BenchmarkConfig(
+            users=2, notes_per_user=3, requests=4, concurrency=1,
+            routes=["note_noteboard", "note_read", "note_delete"],
+        )
+        report = benchmark.run_benchmark(config)
+
+        self.assertEqual(list(report["routes"]),
+                         ["note_noteboard", "note_read", "note_delete"])
+        for result in report["routes"].values():
+            self.assertEqual((result["requests"], result["errors"]), (4, 0))
+            self.assertGreater(result["throughput_rps"], 0)
+            self.assertEqual(set(result["latency_ms"]),
+                             {"p50", "p95", "p99", "mean", "max"})
+
+        # Session, user and note lookups for every read
+        self.assertEqual(
+            report["routes"]["note_read"]["queries_per_request"], 3
+        )
+
+    def test_auth_routes_not_rate_limited(self):
+        """Tests signups and logins beyond the rate limits all
+        succeed."""
+
+        cache.clear()
+        config = benchmark.BenchmarkConfig(
+            users=2, notes_per_user=10, requests=20, concurrency=2,
+            routes=["signup", "login"],
+        )
+        report = benchmark.run_benchmark(config)
+
+        for result in report["routes"].values():
+            self.assertEqual((result["requests"], result["errors"]),
+                             (20, 0))
+
+        before = {"routes": {"note_read": {
+            "throughput_rps": 100, "latency_ms": {"p95": 10},
+            "queries_per_request": 4}}}
+        after = {"routes": {"note_read": {
+            "throughput_rps": 150, "latency_ms": {"p95": 5},
+            "queries_per_request": 3}}}
+
+        self.assertEqual(benchmark.compare_reports(before, after), [
+            ("note_read", "throughput_rps", 100, 150, 50.0),
+            ("note_read", "p95_ms", 10, 5, -50.0),
+            ("note_read", "queries", 4, 3, -25.0),
+        ])
+
+
+class RequestMetricsTest(QueryBudgetMixin, TestCase):
+    """
+    Tests the request instrumentation middleware and metrics endpoint.
+
+    Methods
+    -------
+    setUp(self):
+        Creates a user with a note and logs them in.
+    test_server_timing_header(self):
+        Tests responses report database, template and view timings.
+    test_async_server_timing_header(self):
+        Tests async views are timed through the ASGI handler.
+    test_histogram_render(self):
+        Tests histograms render cumulative Prometheus buckets.
+    test_metrics_endpoint(self):
+        Tests the endpoint exposes the histograms per view.
+    test_metrics_endpoint_restricted(self):
+        Tests only staff and listed clients may read the metrics.
+    """
+
+    def setUp(self):
+        """Creates a user with a note and logs them in."""
+
+        # Clear cached noteboards left by earlier tests
+        cache.clear()
+
+        self.user = User.objects.create_user(
+            username='tester', password='testpassword'
+        )
+        self.note = Note.objects.create(user=self.user, title="Timed",
+                                        content="Timed content.")
+        self.client.login(username='tester', password='testpassword')
+
+    def test_server_timing_header(self):
+        """Tests responses report database, template and view
+        timings."""
+
+        response = self.client.get(
+            reverse("note_read", kwargs={"pk": self.note.pk})
+        )
+
+        timing = response["Server-Timing"]
+        # Session, user and note lookups
+        self.assertIn('desc="3 queries"', timing)
+        for metric in ("db;dur=", "tpl;dur=", "view;dur=", "total;dur="):
+            self.assertIn(metric, timing)
+        self.assertNotIn("tpl;dur=0.00", timing)
+
+    async def test_async_server_timing_header(self):
+        """Tests async views are timed through the ASGI handler."""
+
+        await self.async_client.aforce_login(self.user)
+        response = await self.async_client.get(reverse("note_noteboard"))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertRegex(response["Server-Timing"],
+                         r'db;dur=[\d.]+;desc="[1-9]\d* queries"')
+
+    def test_histogram_render(self):
+        """Tests histograms render cumulative Prometheus buckets."""
+
+        histogram = metrics.Histogram("test_seconds", "Test.", (1, 2))
+        for value in (0.5, 2, 5):
+            histogram.observe("home", value)
+
+        self.assertEqual(histogram.render(), [
+            "# HELP test_seconds Test.",
+            "# TYPE test_seconds histogram",
+            'test_seconds_bucket{view="home",le="1"} 1',
+            'test_seconds_bucket{view="home",le="2"} 2',
+            'test_seconds_bucket{view="home",le="+Inf"} 3',
+            'test_seconds_sum{view="home"} 7.5',
+            'test_seconds_count{view="home"} 3',
+        ])
+
+    def test_metrics_endpoint(self):
+        """Tests the endpoint exposes the histograms per view."""
+
+        self.client.get(reverse("note_read", kwargs={"pk": self.note.pk}))
+        with override_settings(NOTES_METRICS_IPS=["127.0.0.1"]):
+            response = self.client.get(reverse("note_metrics"))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response["Content-Type"].startswith("text/plain"))
+        body = response.content.decode()
+        for name in ("notes_request_duration_seconds",
+                     "notes_view_duration_seconds",
+                     "notes_db_duration_seconds",
+                     "notes_template_duration_seconds"):
+            self.assertIn(f'{name}_count{{view="note_read"}}', body)
+        self.assertIn('notes_db_queries_bucket{view="note_read",le="3"}',
+                      body)
+
+    def test_metrics_endpoint_restricted(self):
+        """Tests only staff and listed clients may read the
+        metrics."""
+
+        # Local clients, such as a reverse proxy, are not trusted
+        url = reverse("note_metrics")
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 403)
+
+        with override_settings(NOTES_METRICS_IPS=["203.0.113.5"]):
+            response = self.client.get(url, REMOTE_ADDR="203.0.113.5")
+        self.assertEqual(response.status_code, 200)
+
+        self.user.is_staff = True
+        self.user.save()
+        response = self.client.get(url, REMOTE_ADDR="203.0.113.5")
+        self.assertEqual(response.status_code, 200)
+
+
+class QueryBudgetTest(QueryBudgetMixin, TestCase):
+    """
+    Tests the query budget and query plan helpers used by the view
+    tests.
+
+    Methods
+    -------
+    setUp(self):
+        Creates a user with a note.
+    test_full_table_scan_detected(self):
+        Tests an unindexed filter on the notes table is reported.
+    test_aliased_scan_detected(self):
+        Tests a scan is reported when the table is aliased.
+    test_indexed_queries_pass(self):
+        Tests lookups by owner or primary key are not reported.
+    test_budget_exceeded(self):
+        Tests the budget assertion fails when too many queries run.
+    test_every_view_has_budget(self):
+        Tests every notes URL has a query budget.
+    """
+
+    def setUp(self):
+        """Creates a user with a note."""
+
+        self.user = User.objects.create_user(
+            username='tester', password='testpassword'
+        )
+        self.note = Note.objects.create(user=self.user, title="Plan",
+                                        content="Plan content.")
+
+    def test_full_table_scan_detected(self):
+        """Tests an unindexed filter on the notes table is reported."""
+
+        with CaptureQueriesContext(connection) as queries:
+            list(Note.objects.filter(title="Plan"))
+
+        scans = full_table_scans(queries.captured_queries)
+        self.assertEqual(len(scans), 1)
+        self.assertTrue(scans[0][1].startswith("SCAN notes_note"))
+
+    def test_aliased_scan_detected(self):
+        """Tests a scan is reported when the table is aliased."""
+
+        with CaptureQueriesContext(connection) as queries:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    "SELECT n.id FROM notes_note n WHERE n.title = 'Plan'"
+                )
+
+        self.assertEqual(len(full_table_scans(queries.captured_queries)), 1)
+
+    def test_indexed_queries_pass(self):
+        """Tests lookups by owner or primary key are not reported."""
+
+        with self.assertQueryBudget(2):
+            list(Note.objects.filter(user=self.user).order_by("pk"))
+            Note.objects.get(pk=self.note.pk)
+
+    def test_budget_exceeded(self):
+        """Tests the budget assertion fails when too many queries
+        run."""
+
+        with self.assertRaises(AssertionError):
+            with self.assertQueryBudget(1):
+                Note.objects.get(pk=self.note.pk)
+                Note.objects.get(pk=self.note.pk)
+
+    def test_every_view_has_budget(self):
+        """Tests every notes URL has a query budget."""
+
+        names = {pattern.name for pattern in urlpatterns}
+        self.assertEqual(names, set(VIEW_QUERY_BUDGETS))
+
+
+class NoteExcerptTest(QueryBudgetMixin, TestCase):
+    """
+    Tests the stored note excerpt and the noteboard's deferred content.
+
+    Methods
+    -------
+    setUp(self):
+        Creates a user with a long note and logs them in.
+    test_excerpt_on_save(self):
+        Tests saving a note refreshes its bounded excerpt.
+    test_excerpt_with_update_fields(self):
+        Tests saving only the content also saves the excerpt.
+    test_noteboard_loads_excerpt_only(self):
+        Tests the noteboard shows the excerpt without loading content.
+    test_read_loads_content(self):
+        Tests the read view still shows the full content.
+    test_api_bulk_writes_set_excerpt(self):
+        Tests bulk API creates and updates maintain the excerpt.
+    test_backfill_migration(self):
+        Tests the data migration fills in missing excerpts.
+    """
+
+    def setUp(self):
+        """Creates a user with a long note and logs them in."""
+
+        # Clear cached noteboards left by earlier tests
+        cache.clear()
+
+        self.user = User.objects.create_user(
+            username='tester', password='testpassword'
+        )
+        self.content = "First line.\n\n" + "word " * 100 + "TAILWORD"
+        self.note = Note.objects.create(user=self.user, title="Long",
+                                        content=self.content)
+        self.client.login(username='tester', password='testpassword')
+
+    def test_excerpt_on_save(self):
+        """Tests saving a note refreshes its bounded excerpt."""
+
+        self.assertEqual(len(self.note.excerpt), EXCERPT_LENGTH)
+        self.assertTrue(self.note.excerpt.startswith("First line. word"))
+        self.assertTrue(self.note.excerpt.endswith("…"))
+
+        self.note.content = "Short now."
+        self.note.save()
+        self.note.refresh_from_db()
+        self.assertEqual(self.note.excerpt, "Short now.")
+
+    def test_excerpt_with_update_fields(self):
+        """Tests saving only the content also saves the excerpt."""
+
+        self.note.content = "Changed."
+        self.note.save(update_fields=["content"])
+        self.note.refresh_from_db()
+        self.assertEqual(self.note.excerpt, "Changed.")
+
+        # Saving a deferred note leaves the excerpt alone
+        note = Note.objects.defer("content").get(pk=self.note.pk)
+        note.title = "Retitled"
+        note.save()
+        self.note.refresh_from_db()
+        self.assertEqual(self.note.excerpt, "Changed.")
+
+    def test_noteboard_loads_excerpt_only(self):
+        """Tests the noteboard shows the excerpt without loading
+        content."""
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse("note_noteboard"))
+
+        self.assertContains(response, "First line. word")
+        self.assertNotContains(response, "TAILWORD")
+        note_queries = [query["sql"] for query in queries.captured_queries
+                        if 'FROM "notes_note"' in query["sql"]]
+        self.assertEqual(len(note_queries), 1)
+        self.assertNotIn('"notes_note"."content"', note_queries[0])
+
+    def test_read_loads_content(self):
+        """Tests the read view still shows the full content."""
+
+        response = self.client.get(
+            reverse("note_read", args=[self.note.pk])
+        )
+        self.assertContains(response, "TAILWORD")
+
+    def test_api_bulk_writes_set_excerpt(self):
+        """Tests bulk API creates and updates maintain the excerpt."""
+
+        response = self.client.post(
+            reverse("api_notes"),
+            json.dumps([{"title": "Bulk", "content": "Bulk  content."}]),
+            content_type="application/json",
+        )
+        pk = response.json()["results"][0]["id"]
+        self.assertEqual(Note.objects.get(pk=pk).excerpt, "Bulk content.")
+
+        self.client.patch(
+            reverse("api_notes"),
+            json.dumps([{"id": pk, "content": "Patched."},
+                        {"id": self.note.pk, "title": "Title only"}]),
+            content_type="application/json",
+        )
+        self.assertEqual(Note.objects.get(pk=pk).excerpt, "Patched.")
+        self.assertEqual(Note.objects.get(pk=self.note.pk).excerpt,
+                         self.note.excerpt)
+
+    def test_backfill_migration(self):
+        """Tests the data migration fills in missing excerpts."""
+
+        Note.objects.update(excerpt="")
+        migration = importlib.import_module(
+            "notes.migrations.0004_note_excerpt"
+        )
+        # The backfill only needs the schema editor's connection
+        schema_editor = SimpleNamespace(connection=connection)
+        migration.backfill_excerpts(apps, schema_editor)
+
+        self.note.refresh_from_db()
+        self.assertTrue(self.note.excerpt.startswith("First line. word"))
+
+
+@override_settings(NOTES_COMPRESS_THRESHOLD=1024)
+class CompressedContentTest(QueryBudgetMixin, TestCase):
+    """
+    Tests note content is stored compressed above the size threshold
+    and stays transparent to the rest of the application.
+
+    Methods
+    -------
+    setUp(self):
+        Creates a user with a small and a large note.
+    stored_content(self, note):
+        Returns the content of a note as stored in the database.
+    test_small_content_stored_plain(self):
+        Tests content under the threshold is stored unchanged.
+    test_large_content_stored_compressed(self):
+        Tests large content is stored compressed and read back intact.
+    test_decompressed_lazily(self):
+        Tests content is only decompressed when first read.
+    test_marker_text_round_trips(self):
+        Tests text starting with the marker is not misread.
+    test_values_list(self):
+        Tests values_list() returns decompressible values.
+    test_views_and_search(self):
+        Tests the views, form and search see plain text.
+    test_migration_round_trip(self):
+        Tests the migration compresses and restores existing rows.
+    """
+
+    def setUp(self):
+        """Creates a user with a small and a large note."""
+
+        # Clear cached noteboards left by earlier tests
+        cache.clear()
+
+        self.user = User.objects.create_user(
+            username='tester', password='testpassword'
+        )
+        self.log = "".join(
+            f"2026-10-18 12:00:{n % 60:02d} INFO request {n} served\n"
+            for n in range(200)
+        ) + "needle"
+        self.small = Note.objects.create(user=self.user, title="Small",
+                                         content="A short note.")
+        self.large = Note.objects.create(user=self.user, title="Log",
+                                         content=self.log)
+
+    def stored_content(self, note):
+        """Returns the content of a note as stored in the database."""
+
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT content FROM notes_note WHERE id = %s",
+                           [note.pk])
+            return cursor.fetchone()[0]
+
+    def test_small_content_stored_plain(self):
+        """Tests content under the threshold is stored unchanged."""
+
+        self.assertEqual(self.stored_content(self.small), "A short note.")
+
+    def test_large_content_stored_compressed(self):
+        """Tests large content is stored compressed and read back
+        intact."""
+
+        stored = self.stored_content(self.large)
+        self.assertTrue(stored.startswith(fields.COMPRESSED_MARKER))
+        self.assertLess(len(stored), len(self.log) / 4)
+        self.assertEqual(Note.objects.get(pk=self.large.pk).content,
+                         self.log)
+
+    def test_decompressed_lazily(self):
+        """Tests content is only decompressed when first read."""
+
+        note = Note.objects.get(pk=self.large.pk)
+        self.assertIsInstance(note.__dict__["content"], fields.CompressedText)
+
+        # Saving other fields keeps the stored form without decompressing
+        stored = self.stored_content(self.large)
+        note.title = "Renamed"
+        note.save(update_fields=["title"])
+        self.assertIsInstance(note.__dict__["content"], fields.CompressedText)
+        self.assertEqual(self.stored_content(self.large), stored)
+        self.assertEqual(
+            [n.title for n in search.search_notes(self.user, "renamed")],
+            ["Renamed"],
+        )
+
+        self.assertEqual(note.content, self.log)
+        self.assertEqual(note.__dict__["content"], self.log)
+
+    def test_marker_text_round_trips(self):
+        """Tests text starting with the marker is not misread."""
+
+        text = fields.COMPRESSED_MARKER + "not really compressed"
+        note = Note.objects.create(user=self.user, title="Marker",
+                                   content=text)
+        self.assertEqual(Note.objects.get(pk=note.pk).content, text)
+
+    def test_values_list(self):
+        """Tests values_list() returns decompressible values."""
+
+        content = Note.objects.values_list("content", flat=True).get(
+            pk=self.large.pk
+        )
+        self.assertEqual(content.decompress(), self.log)
+        self.assertEqual(str(content), self.log)
+
+    def test_views_and_search(self):
+        """Tests the views, form and search see plain text."""
+
+        self.client.login(username='tester', password='testpassword')
+
+        response = self.client.get(reverse("note_read",
+                                           args=[self.large.pk]))
+        self.assertContains(response, "needle")
+
+        response = self.client.get(reverse("note_update",
+                                           args=[self.large.pk]))
+        self.assertEqual(response.context["form"].initial["content"],
+                         self.log)
+
+        search.rebuild_index()
+        found = search.search_notes(self.user, "needle")
+        self.assertEqual([note.title for note in found], ["Log"])
+
+    def test_migration_round_trip(self):
+        """Tests the migration compresses and restores existing rows."""
+
+        migration = importlib.import_module(
+            "notes.migrations.0005_note_compressed_content"
+        )
+        schema_editor = SimpleNamespace(connection=connection)
+
+        migration.decompress_content(apps, schema_editor)
+        self.assertEqual(self.stored_content(self.large), self.log)
+
+        migration.compress_content(apps, schema_editor)
+        self.assertTrue(self.stored_content(self.large).startswith(
+            fields.COMPRESSED_MARKER
+        ))
+        self.assertEqual(self.stored_content(self.small), "A short note.")
+
+
+class NoteTransferTest(TestCase):
+    """
+    Tests the JSON Lines export_notes and import_notes commands.
+
+    Methods
+    -------
+    setUp(self):
+        Creates two users with notes and a temporary directory.
+    write_lines(self, name, records):
+        Writes records to a JSON Lines file in the temporary directory.
+    test_export_all(self):
+        Tests every note is exported in primary key order.
+    test_export_user(self):
+        Tests the export can be limited to one user.
+    test_round_trip(self):
+        Tests exported notes are imported intact and searchable.
+    test_resume_after_failure(self):
+        Tests a failed import resumes after its last committed batch.
+    test_unknown_user_and_owner(self):
+        Tests unknown users are rejected unless an owner is given.
+    """
+
+    def setUp(self):
+        """Creates two users with notes and a temporary directory."""
+
+        self.alice = User.objects.create_user(username='alice',
+                                              password='testpassword')
+        self.bob = User.objects.create_user(username='bob',
+                                            password='testpassword')
+        for number in range(3):
+            Note.objects.create(user=self.alice, title=f"Alice {number}",
+                                content=f"Alice content {number}.")
+        Note.objects.create(user=self.bob, title="Bob", content="Bob's.")
+
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+
+    def write_lines(self, name, records):
+        """Writes records to a JSON Lines file in the temporary
+        directory."""
+
+        path = os.path.join(self.directory, name)
+        with open(path, "w") as stream:
+            for record in records:
+                stream.write(json.dumps(record) + "\n")
+        return path
+
+    def test_export_all(self):
+        """Tests every note is exported in primary key order."""
+
+        out = StringIO()
+        call_command("export_notes", "--chunk-size", "2", stdout=out,
+                     stderr=StringIO())
+
+        records = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertEqual([record["title"] for record in records],
+                         ["Alice 0", "Alice 1", "Alice 2", "Bob"])
+        self.assertEqual(records[3]["user"], "bob")
+        self.assertEqual(records[3]["content"], "Bob's.")
+
+    def test_export_user(self):
+        """Tests the export can be limited to one user."""
+
+        path = os.path.join(self.directory, "bob.jsonl")
+        err = StringIO()
+        call_command("export_notes", "--user", "bob", "--output", path,
+                     stderr=err)
+
+        with open(path) as stream:
+            records = [json.loads(line) for line in stream]
+        self.assertEqual([record["title"] for record in records], ["Bob"])
+        self.assertIn("Exported 1 notes.", err.getvalue())
+
+    def test_round_trip(self):
+        """Tests exported notes are imported intact and searchable."""
+
+        path = os.path.join(self.directory, "alice.jsonl")
+        call_command("export_notes", "--user", "alice", "--output", path,
+                     stderr=StringIO())
+        Note.objects.filter(user=self.alice).delete()
+
+        out = StringIO()
+        call_command("import_notes", path, "--batch-size", "2", stdout=out)
+
+        notes = Note.objects.filter(user=self.alice).order_by("pk")
+        self.assertEqual(
+            [(note.title, note.content, note.excerpt) for note in notes],
+            [(f"Alice {n}", f"Alice content {n}.", f"Alice content {n}.")
+             for n in range(3)],
+        )
+        self.assertEqual(len(search.search_notes(self.alice, "content")), 3)
+        self.assertIn("Imported 3 notes.", out.getvalue())
+        self.assertFalse(os.path.exists(path + ".progress"))
+
+    def test_resume_after_failure(self):
+        """Tests a failed import resumes after its last committed
+        batch."""
+
+        records = [{"user": "bob", "title": f"Import {n}", "content": "x"}
+                   for n in range(5)]
+        records[3]["title"] = "T" * 51
+        path = self.write_lines("import.jsonl", records)
+
+        with self.assertRaisesMessage(CommandError, "Line 4: title"):
+            call_command("import_notes", path, "--batch-size", "2",
+                         stdout=StringIO())
+        imported = Note.objects.filter(title__startswith="Import")
+        self.assertEqual(imported.count(), 2)
+
+        # A fresh run must not silently import the same lines again
+        with self.assertRaisesMessage(CommandError, "--resume"):
+            call_command("import_notes", path, stdout=StringIO())
+
+        records[3]["title"] = "Import 3"
+        self.write_lines("import.jsonl", records)
+        out = StringIO()
+        call_command("import_notes", path, "--resume", "--batch-size", "2",
+                     stdout=out)
+
+        self.assertIn("Resuming after line 2.", out.getvalue())
+        self.assertEqual(
+            sorted(imported.values_list("title", flat=True)),
+            [f"Import {n}" for n in range(5)],
+        )
+        self.assertFalse(os.path.exists(path + ".progress"))
+
+    def test_unknown_user_and_owner(self):
+        """Tests unknown users are rejected unless an owner is given."""
+
+        path = self.write_lines("carol.jsonl", [
+            {"user": "carol", "title": "Carol", "content": "Hers."},
+        ])
+        with self.assertRaisesMessage(CommandError, "Unknown user 'carol'"):
+            call_command("import_notes", path, stdout=StringIO())
+        # Nothing was committed, so there is nothing to resume
+        self.assertFalse(os.path.exists(path + ".progress"))
+
+        call_command("import_notes", path, "--owner", "alice",
+                     stdout=StringIO())
+        self.assertTrue(
+            Note.objects.filter(user=self.alice, title="Carol").exists()
+        )
+
+
+class NoteDownloadTest(QueryBudgetMixin, TestCase):
+    """
+    Tests the streaming note download view under WSGI and ASGI.
+
+    Methods
+    -------
+    setUp(self):
+        Creates two users with notes and logs the first one in.
+    test_login_required(self):
+        Tests anonymous users are redirected to the login page.
+    test_jsonl_download(self):
+        Tests the user's notes stream as JSON Lines.
+    test_zip_download(self):
+        Tests the notes stream as a zip archive.
+    test_download_streams_in_chunks(self):
+        Tests a large download is sent in several pieces.
+    test_unknown_format(self):
+        Tests an unsupported format is not found.
+    test_async_download(self):
+        Tests the download streams from an async iterator under ASGI.
+    """
+
+    def setUp(self):
+        """Creates two users with notes and logs the first one in."""
+
+        self.user = User.objects.create_user(username='tester',
+                                             password='testpassword')
+        other = User.objects.create_user(username='other',
+                                         password='testpassword')
+        for number in range(3):
+            Note.objects.create(user=self.user, title=f"Mine {number}",
+                                content=f"Content {number}.")
+        Note.objects.create(user=other, title="Theirs", content="Private.")
+        self.client.login(username='tester', password='testpassword')
+
+    def read_lines(self, data):
+        """Decodes JSON Lines into a list of titles."""
+        return [json.loads(line)["title"]
+                for line in data.decode().splitlines()]
+
+    def test_login_required(self):
+        """Tests anonymous users are redirected to the login page."""
+
+        self.client.logout()
+        response = self.client.get(reverse("note_download"))
+        self.assertEqual(response.status_code, 302)
+
+    def test_jsonl_download(self):
+        """Tests the user's notes stream as JSON Lines."""
+
+        response = self.client.get(reverse("note_download"))
+
+        self.assertTrue(response.streaming)
+        self.assertEqual(response["Content-Disposition"],
+                         'attachment; filename="notes-tester.jsonl"')
+        data = b"".join(response.streaming_content)
+        self.assertEqual(self.read_lines(data),
+                         ["Mine 0", "Mine 1", "Mine 2"])
+
+    def test_zip_download(self):
+        """Tests the notes stream as a zip archive."""
+
+        response = self.client.get(reverse("note_download"),
+                                   {"format": "zip"})
+
+        self.assertEqual(response["Content-Type"], "application/zip")
+        data = b"".join(response.streaming_content)
+        with zipfile.ZipFile(BytesIO(data)) as archive:
+            self.assertEqual(archive.namelist(), ["notes-tester.jsonl"])
+            member = archive.read("notes-tester.jsonl")
+        self.assertEqual(self.read_lines(member),
+                         ["Mine 0", "Mine 1", "Mine 2"])
+
+    @override_settings(NOTES_COMPRESS_THRESHOLD=10 ** 9)
+    def test_download_streams_in_chunks(self):
+        """Tests a large download is sent in several pieces."""
+
+        Note.objects.bulk_create([
+            Note(user=self.user, title=f"Bulk {number}", content="x" * 1000)
+            for number in range(300)
+        ])
+        response = self.client.get(reverse("note_download"))
+
+        pieces = list(response.streaming_content)
+        self.assertGreater(len(pieces), 2)
+        self.assertTrue(all(len(piece) < 2 * transfer.STREAM_CHUNK_SIZE
+                            for piece in pieces))
+        self.assertEqual(len(b"".join(pieces).splitlines()), 303)
+
+    def test_unknown_format(self):
+        """Tests an unsupported format is not found."""
+
+        response = self.client.get(reverse("note_download"),
+                                   {"format": "csv"})
+        self.assertEqual(response.status_code, 404)
+
+    async def test_async_download(self):
+        """Tests the download streams from an async iterator under
+        ASGI."""
+
+        await self.async_client.aforce_login(self.user)
+        for file_format in ("jsonl", "zip"):
+            response = await self.async_client.get(
+                reverse("note_download"), {"format": file_format}
+            )
+            self.assertTrue(response.is_async)
+            data = b"".join([piece async for piece in
+                             response.streaming_content])
+            if file_format == "zip":
+                with zipfile.ZipFile(BytesIO(data)) as archive:
+                    data = archive.read("notes-tester.jsonl")
+            self.assertEqual(self.read_lines(data),
+                             ["Mine 0", "Mine 1", "Mine 2"])
+
+
+class StaticPipelineTest(QueryBudgetMixin, TestCase):
+    """
+    Tests the hashed, precompressed static files and how they are
+    served.
+
+    Methods
+    -------
+    setUp(self):
+        Collects the static files into a temporary STATIC_ROOT.
+    test_collect_writes_hashed_variants(self):
+        Tests collectstatic writes hashed files with gzip variants.
+    test_templates_use_hashed_names(self):
+        Tests pages link to the hashed file names.
+    test_serves_gzip_variant(self):
+        Tests a client accepting gzip gets the gzip variant.
+    test_serves_identity_without_header(self):
+        Tests clients that accept no encoding get the original file.
+    test_unhashed_name_short_cache(self):
+        Tests files without a hash are only cached briefly.
+    test_not_modified(self):
+        Tests a matching If-None-Match gets an empty 304 response.
+    test_head_request(self):
+        Tests HEAD requests get the headers without the body.
+    test_path_traversal_rejected(self):
+        Tests names leaving STATIC_ROOT are not served.
+    test_parse_accept_encoding(self):
+        Tests Accept-Encoding parsing honours q=0.
+    test_pages_render_without_manifest(self):
+        Tests pages use plain names before collectstatic has run.
+    """
+
+    def setUp(self):
+        """Collects the static files into a temporary STATIC_ROOT."""
+
+        cache.clear()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.root = directory.name
+        settings_override = override_settings(STATIC_ROOT=self.root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        call_command('collectstatic', interactive=False, verbosity=0)
+
+        self.styles = staticfiles_storage.stored_name('notes/css/styles.css')
+        self.url = f"/static/{self.styles}"
+
+    def test_collect_writes_hashed_variants(self):
+        """Tests collectstatic writes hashed files with gzip
+        variants."""
+
+        self.assertRegex(self.styles, r'^notes/css/styles\.[0-9a-f]{12}\.css$')
+        path = os.path.join(self.root, self.styles)
+        self.assertTrue(os.path.isfile(path + '.gz'))
+
+        # Fonts are already compressed, so they get no variant
+        font = staticfiles_storage.stored_name(
+            'notes/css/fonts/caveat/caveat-v18-latin-regular.woff2'
+        )
+        self.assertFalse(os.path.exists(
+            os.path.join(self.root, font) + '.gz'
+        ))
+
+    def test_templates_use_hashed_names(self):
+        """Tests pages link to the hashed file names."""
+
+        response = self.client.get(reverse("login"))
+        self.assertContains(response, self.url)
+
+    def test_serves_gzip_variant(self):
+        """Tests a client accepting gzip gets the gzip variant."""
+
+        response = self.client.get(self.url,
+                                   HTTP_ACCEPT_ENCODING='gzip, deflate')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Encoding"], "gzip")
+        self.assertEqual(response["Content-Type"], "text/css")
+        self.assertEqual(response["Vary"], "Accept-Encoding")
+        self.assertEqual(response["Cache-Control"],
+                         staticfiles.IMMUTABLE_CACHE_CONTROL)
+        with open(os.path.join(self.root, self.styles), 'rb') as original:
+            self.assertEqual(
+                gzip.decompress(b"".join(response.streaming_content)),
+                original.read(),
+            )
+
+    def test_serves_identity_without_header(self):
+        """Tests clients that accept no encoding get the original
+        file."""
+
+        response = self.client.get(self.url)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(response.has_header("Content-Encoding"))
+        self.assertEqual(response["Vary"], "Accept-Encoding")
+        size = os.path.getsize(os.path.join(self.root, self.styles))
+        self.assertEqual(int(response["Content-Length"]), size)
+
+    @override_settings(NOTES_STATIC_MAX_AGE=30)
+    def test_unhashed_name_short_cache(self):
+        """Tests files without a hash are only cached briefly."""
+
+        response = self.client.get("/static/notes/css/styles.css")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Cache-Control"], "public, max-age=30")
+
+    def test_not_modified(self):
+        """Tests a matching If-None-Match gets an empty 304 response."""
+
+        etag = self.client.get(self.url)["ETag"]
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b"")
+
+    def test_head_request(self):
+        """Tests HEAD requests get the headers without the body."""
+
+        response = self.client.head(self.url)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, b"")
+        size = os.path.getsize(os.path.join(self.root, self.styles))
+        self.assertEqual(int(response["Content-Length"]), size)
+
+    def test_path_traversal_rejected(self):
+        """Tests names leaving STATIC_ROOT are not served."""
+
+        self.assertIsNone(staticfiles.StaticAsset.find('../settings.py', ''))
+        response = self.client.get("/static/../manage.py")
+        self.assertEqual(response.status_code, 404)
+
+    def test_parse_accept_encoding(self):
+        """Tests Accept-Encoding parsing honours q=0."""
+
+        self.assertEqual(
+            staticfiles.parse_accept_encoding('br;q=0, gzip;q=0.8, *'),
+            {'gzip', '*'},
+        )
+        asset = staticfiles.StaticAsset.find(self.styles, 'br;q=0, gzip')
+        self.assertEqual(asset.encoding, 'gzip')
+
+    def test_pages_render_without_manifest(self):
+        """Tests pages use plain names before collectstatic has run."""
+
+        with tempfile.TemporaryDirectory() as empty:
+            with override_settings(STATIC_ROOT=empty):
+                response = self.client.get(reverse("login"))
+
+        self.assertContains(response, "/static/notes/css/styles.css")
+
+
+class NoteCardCacheTest(QueryBudgetMixin, TestCase):
+    """
+    Tests each note's card is cached under its updated time, so only
+    the cards of changed notes are rendered again.
+
+    Methods
+    -------
+    setUp(self):
+        Creates a user with three notes and logs them in.
+    card_renders(self, response):
+        Counts the note cards rendered for a response.
+    count_card_renders(self):
+        Counts the note cards rendered while the block runs.
+    test_only_changed_cards_rendered(self):
+        Tests a changed board only renders the changed note's card.
+    test_partial_save_moves_updated(self):
+        Tests saving only some fields still changes the card key.
+    test_bulk_update_moves_updated(self):
+        Tests bulk API updates change the card keys.
+    test_cards_hold_no_csrf_token(self):
+        Tests cached cards are shared while each page gets its own
+        CSRF token.
+    test_search_uses_cached_cards(self):
+        Tests search results reuse the cached cards.
+    """
+
+    def setUp(self):
+        """Creates a user with three notes and logs them in."""
+
+        cache.clear()
+        self.user = User.objects.create_user(username='tester',
+                                             password='testpassword')
+        self.notes = [
+            Note.objects.create(user=self.user, title=f"Card {number}",
+                                content=f"Card content {number}.")
+            for number in range(3)
+        ]
+        self.client.login(username='tester', password='testpassword')
+
+    def card_renders(self, response):
+        """Counts the note cards rendered for a response."""
+        return sum(1 for template in response.templates
+                   if template.name == "notes/note_card.html")
+
+    @contextmanager
+    def count_card_renders(self):
+        """Counts the note cards rendered while the block runs."""
+
+        rendered = []
+
+        def record(sender, template, **kwargs):
+            if template.name == "notes/note_card.html":
+                rendered.append(template)
+
+        template_rendered.connect(record)
+        try:
+            yield rendered
+        finally:
+            template_rendered.disconnect(record)
+
+    def test_only_changed_cards_rendered(self):
+        """Tests a changed board only renders the changed note's
+        card."""
+
+        response = self.client.get(reverse("note_noteboard"))
+        self.assertEqual(self.card_renders(response), 3)
+
+        # The changed card is rendered once, when its change is published
+        note = self.notes[1]
+        note.title = "Changed card"
+        with self.count_card_renders() as rendered:
+            with self.captureOnCommitCallbacks(execute=True):
+                note.save()
+            response = self.client.get(reverse("note_noteboard"))
+
+        self.assertEqual(len(rendered), 1)
+        self.assertContains(response, "Changed card")
+        self.assertContains(response, "Card 0")
+
+    def test_partial_save_moves_updated(self):
+        """Tests saving only some fields still changes the card key."""
+
+        note = self.notes[0]
+        key = board_cache.note_card_key(note)
+        note.title = "Renamed"
+        note.save(update_fields=["title"])
+
+        note.refresh_from_db()
+        self.assertEqual(note.title, "Renamed")
+        self.assertNotEqual(board_cache.note_card_key(note), key)
+
+    def test_bulk_update_moves_updated(self):
+        """Tests bulk API updates change the card keys."""
+
+        self.client.get(reverse("note_noteboard"))
+        batch = [{"id": self.notes[0].pk, "title": "Bulk renamed"}]
+        with self.count_card_renders() as rendered:
+            with self.captureOnCommitCallbacks(execute=True):
+                response = self.client.patch(
+                    reverse("api_notes"), data=json.dumps(batch),
+                    content_type="application/json",
+                )
+            self.assertEqual(response.status_code, 200)
+            response = self.client.get(reverse("note_noteboard"))
+
+        self.assertEqual(len(rendered), 1)
+        self.assertContains(response, "Bulk renamed")
+
+    def test_cards_hold_no_csrf_token(self):
+        """Tests cached cards are shared while each page gets its own
+        CSRF token."""
+
+        first = self.client.get(reverse("note_noteboard"))
+        other = self.client_class()
+        other.login(username='tester', password='testpassword')
+        second = other.get(reverse("note_noteboard"))
+
+        self.assertEqual(self.card_renders(second), 0)
+        self.assertNotEqual(first.context["csrf_token"],
+                            second.context["csrf_token"])
+        cards = board_cache.get_note_cards(self.notes)
+        self.assertEqual(len(cards), 3)
+        for card in cards.values():
+            self.assertNotIn("csrfmiddlewaretoken", card)
+
+    def test_search_uses_cached_cards(self):
+        """Tests search results reuse the cached cards."""
+
+        self.client.get(reverse("note_noteboard"))
+        response = self.client.get(reverse("note_search"), {"q": "card"})
+
+        self.assertEqual(self.card_renders(response), 0)
+        self.assertContains(response, "Card 2")
+
+
+@override_settings(NOTES_RATE_LIMITS={
+    "signup": {"ip": (2, 60)},
+    "login": {"ip": (3, 60), "username": (2, 60)},
+})
+class RateLimitTest(QueryBudgetMixin, TestCase):
+    """
+    Tests the token bucket rate limits on signup and login.
+
+    Methods
+    -------
+    setUp(self):
+        Clears the buckets and creates a user.
+    login(self, username, address='10.0.0.1'):
+        Submits the login form from an IP address.
+    test_login_throttled_before_hashing(self):
+        Tests an empty bucket gets a 429 without touching the database.
+    test_username_bucket(self):
+        Tests one username is limited across IP addresses.
+    test_form_display_not_limited(self):
+        Tests GET requests take no tokens.
+    test_signup_throttled(self):
+        Tests signup submissions are limited per IP address.
+    test_tokens_refill(self):
+        Tests a bucket refills at its rate up to its capacity.
+    """
+
+    def setUp(self):
+        """Clears the buckets and creates a user."""
+
+        cache.clear()
+        User.objects.create_user(username='tester', password='testpassword')
+
+    def login(self, username, address='10.0.0.1'):
+        """Submits the login form from an IP address."""
+        return self.client.post(
+            reverse('login'), {'username': username, 'password': 'wrong'},
+            REMOTE_ADDR=address,
+        )
+
+    def test_login_throttled_before_hashing(self):
+        """Tests an empty bucket gets a 429 without touching the
+        database."""
+
+        # Stop the buckets' clock, so the time spent hashing the first
+        # passwords does not refill them
+        clock = SimpleNamespace(time=lambda: 1000.0)
+        self.enterContext(mock.patch.object(ratelimit, "time", clock))
+
+        for number in range(3):
+            response = self.login(f'user{number}')
+            self.assertEqual(response.status_code, 200)
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.login('user3')
+
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response['Retry-After'], '20')
+        self.assertEqual(len(queries), 0)
+
+    def test_username_bucket(self):
+        """Tests one username is limited across IP addresses."""
+
+        self.assertEqual(self.login('Tester', '10.0.0.1').status_code, 200)
+        self.assertEqual(self.login('tester', '10.0.0.2').status_code, 200)
+        self.assertEqual(self.login('tester', '10.0.0.3').status_code, 429)
+
+        # Other usernames from the same address are unaffected
+        self.assertEqual(self.login('other', '10.0.0.3').status_code, 200)
+
+    def test_form_display_not_limited(self):
+        """Tests GET requests take no tokens."""
+
+        for _ in range(5):
+            self.assertEqual(self.client.get(reverse('login')).status_code,
+                             200)
+            self.assertEqual(self.client.get(reverse('signup')).status_code,
+                             200)
+
+    def test_signup_throttled(self):
+        """Tests signup submissions are limited per IP address."""
+
+        data = {'username': 'newuser', 'password1': 'short',
+                'password2': 'different'}
+        for _ in range(2):
+            response = self.client.post(reverse('signup'), data)
+            self.assertEqual(response.status_code, 200)
+
+        response = self.client.post(reverse('signup'), data)
+        self.assertEqual(response.status_code, 429)
+        self.assertFalse(User.objects.filter(username='newuser').exists())
+
+    def test_tokens_refill(self):
+        """Tests a bucket refills at its rate up to its capacity."""
+
+        key = 'notes:ratelimit:test:ip:10.0.0.9'
+        self.assertEqual(ratelimit.take_token(key, 2, 10, now=100), 0)
+        self.assertEqual(ratelimit.take_token(key, 2, 10, now=100), 0)
+        self.assertEqual(ratelimit.take_token(key, 2, 10, now=100), 5)
+
+        # One token comes back every five seconds
+        self.assertEqual(ratelimit.take_token(key, 2, 10, now=105), 0)
+        self.assertEqual(ratelimit.take_token(key, 2, 10, now=105), 5)
+
+        # A long wait refills the bucket only up to its capacity
+        self.assertEqual(ratelimit.take_token(key, 2, 10, now=1000), 0)
+        self.assertEqual(ratelimit.take_token(key, 2, 10, now=1000), 0)
+        self.assertGreater(ratelimit.take_token(key, 2, 10, now=1000), 0)
+
+
+@override_settings(NOTES_PBKDF2_ITERATIONS=1000)
+class PasswordHashingTest(QueryBudgetMixin, TestCase):
+    """
+    Tests signup and login hash passwords once each, in the bounded
+    hashing pool.
+
+    Methods
+    -------
+    setUp(self):
+        Clears the rate limit buckets and creates a user.
+    record_hashes(self):
+        Records the thread of every password hash computed.
+    test_signup_hashes_once(self):
+        Tests signup hashes the password once, in the pool, and
+        reports it to the password validators.
+    test_login_hashes_in_pool(self):
+        Tests login checks the password in the pool.
+    test_full_pool_sheds_load(self):
+        Tests a full pool gets a 503 response instead of queueing.
+    test_rehash_on_new_iterations(self):
+        Tests a login upgrades a hash made with an old count.
+    test_tune_password_hasher(self):
+        Tests the command recommends an iteration count.
+    """
+
+    def setUp(self):
+        """Clears the rate limit buckets and creates a user."""
+
+        cache.clear()
+        self.user = User.objects.create_user(username='tester',
+                                             password='testpassword')
+
+    @contextmanager
+    def record_hashes(self):
+        """Records the thread of every password hash computed."""
+
+        threads = []
+        original = hashing.TunablePBKDF2PasswordHasher.encode
+
+        def encode(hasher, *args, **kwargs):
+            threads.append(threading.current_thread().name)
+            return original(hasher, *args, **kwargs)
+
+        with mock.patch.object(hashing.TunablePBKDF2PasswordHasher,
+                               'encode', encode):
+            yield threads
+
+    def test_signup_hashes_once(self):
+        """Tests signup hashes the password once, in the pool, and
+        reports it to the password validators."""
+
+        data = {'username': 'newuser', 'email': 'new@example.com',
+                'password1': 'a-long-password', 'password2': 'a-long-password'}
+        with self.record_hashes() as threads, mock.patch(
+            'django.contrib.auth.base_user.password_validation'
+            '.password_changed'
+        ) as password_changed:
+            response = self.client.post(reverse('signup'), data)
+
+        self.assertRedirects(response, reverse('note_noteboard'))
+        self.assertEqual(len(threads), 1)
+        self.assertTrue(threads[0].startswith('password-hashing'))
+        self.assertEqual(auth.get_user(self.client).username, 'newuser')
+
+        # Password validators are told about the new password once
+        password_changed.assert_called_once()
+        self.assertEqual(password_changed.call_args.args[0],
+                         'a-long-password')
+        self.assertTrue(
+            User.objects.get(username='newuser')
+            .check_password('a-long-password')
+        )
+
+    def test_login_hashes_in_pool(self):
+        """Tests login checks the password in the pool."""
+
+        with self.record_hashes() as threads:
+            response = self.client.post(reverse('login'), {
+                'username': 'tester', 'password': 'testpassword',
+            })
+
+        self.assertRedirects(response, reverse('note_noteboard'),
+                             fetch_redirect_response=False)
+        self.assertEqual(len(threads), 1)
+        self.assertTrue(threads[0].startswith('password-hashing'))
+
+    @override_settings(NOTES_HASHING_WORKERS=1, NOTES_HASHING_QUEUE=1)
+    def test_full_pool_sheds_load(self):
+        """Tests a full pool gets a 503 response instead of queueing."""
+
+        release = threading.Event()
+        blocker = hashing.get_pool().submit(release.wait)
+        try:
+            with self.record_hashes() as threads:
+                response = self.client.post(reverse('login'), {
+                    'username': 'tester', 'password': 'testpassword',
+                })
+        finally:
+            release.set()
+            blocker.result()
+
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], '1')
+        self.assertEqual(threads, [])
+
+    def test_rehash_on_new_iterations(self):
+        """Tests a login upgrades a hash made with an old count."""
+
+        self.assertIn('$1000$', self.user.password)
+        with override_settings(NOTES_PBKDF2_ITERATIONS=2000):
+            user = auth.authenticate(username='tester',
+                                     password='testpassword')
+
+        self.assertEqual(user, self.user)
+        self.user.refresh_from_db()
+        self.assertIn('$2000$', self.user.password)
+        self.assertTrue(self.user.check_password('testpassword'))
+
+    def test_tune_password_hasher(self):
+        """Tests the command recommends an iteration count."""
+
+        out = StringIO()
+        call_command('tune_password_hasher', samples=1, workers=1,
+                     stdout=out)
+
+        match = re.search(r'NOTES_PBKDF2_ITERATIONS = (\d+)', out.getvalue())
+        self.assertIsNotNone(match)
+        self.assertGreaterEqual(int(match.group(1)), 600000)
+
+
+class UserPurgeTest(QueryBudgetMixin, TestCase):
+    """
+    Tests users are deactivated at once and deleted in the background
+    in batches.
+
+    Methods
+    -------
+    setUp(self):
+        Creates a user with seven notes and another with one.
+    indexed(self, ids):
+        Counts the search index entries of some notes.
+    test_request_deactivates_user(self):
+        Tests requesting a deletion deactivates the user and keeps
+        their notes for now.
+    test_deactivated_user_logged_out(self):
+        Tests a queued user's sessions stop working.
+    test_purge_in_batches(self):
+        Tests notes are deleted in batches, then the user.
+    test_admin_delete_queues_purge(self):
+        Tests deleting a user in the admin only queues the deletion.
+    test_purge_users_command(self):
+        Tests the command finishes every queued deletion.
+    """
+
+    def setUp(self):
+        """Creates a user with seven notes and another with one."""
+
+        cache.clear()
+        self.user = User.objects.create_user(username='leaving',
+                                             password='testpassword')
+        self.other = User.objects.create_user(username='staying',
+                                              password='testpassword')
+        self.notes = [
+            Note.objects.create(user=self.user, title=f"Note {number}",
+                                content=f"Leaving content {number}.")
+            for number in range(7)
+        ]
+        self.kept = Note.objects.create(user=self.other, title="Kept",
+                                        content="Staying content.")
+
+    def indexed(self, ids):
+        """Counts the search index entries of some notes."""
+
+        placeholders = ", ".join(["%s"] * len(ids))
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"SELECT COUNT(*) FROM {search.FTS_TABLE} "
+                f"WHERE rowid IN ({placeholders})", ids,
+            )
+            return cursor.fetchone()[0]
+
+    def test_request_deactivates_user(self):
+        """Tests requesting a deletion deactivates the user and keeps
+        their notes for now."""
+
+        user_purge = purge.request_user_deletion(self.user)
+
+        self.user.refresh_from_db()
+        self.assertFalse(self.user.is_active)
+        self.assertEqual(user_purge.notes_total, 7)
+        self.assertEqual(Note.objects.filter(user=self.user).count(), 7)
+
+        # Asking again reuses the queued purge
+        self.assertEqual(purge.request_user_deletion(self.user), user_purge)
+
+    def test_deactivated_user_logged_out(self):
+        """Tests a queued user's sessions stop working."""
+
+        self.client.login(username='leaving', password='testpassword')
+        purge.request_user_deletion(self.user)
+
+        response = self.client.get(reverse("note_noteboard"))
+        self.assertEqual(response.status_code, 302)
+        self.assertFalse(self.client.login(username='leaving',
+                                           password='testpassword'))
+
+    def test_purge_in_batches(self):
+        """Tests notes are deleted in batches, then the user."""
+
+        user_purge = purge.request_user_deletion(self.user)
+        reports = []
+        with self.captureOnCommitCallbacks(execute=True):
+            deleted = purge.run_purge(
+                user_purge, batch_size=3, pause=0,
+                progress=lambda item: reports.append(item.notes_deleted),
+            )
+
+        self.assertEqual(deleted, 7)
+        self.assertEqual(reports, [3, 6, 7])
+        self.assertFalse(User.objects.filter(username='leaving').exists())
+        self.assertEqual(self.indexed([note.pk for note in self.notes]), 0)
+
+        user_purge.refresh_from_db()
+        self.assertIsNotNone(user_purge.finished)
+        self.assertIsNone(user_purge.user)
+        self.assertEqual(user_purge.progress(), 100)
+        self.assertEqual(str(user_purge), "Deletion of leaving (finished)")
+
+        # Other users' notes are untouched
+        self.assertTrue(Note.objects.filter(pk=self.kept.pk).exists())
+        self.assertEqual(self.indexed([self.kept.pk]), 1)
+
+    def test_admin_delete_queues_purge(self):
+        """Tests deleting a user in the admin only queues the
+        deletion."""
+
+        User.objects.create_superuser(username='admin',
+                                      password='adminpassword')
+        self.client.login(username='admin', password='adminpassword')
+        url = reverse('admin:auth_user_delete', args=[self.user.pk])
+
+        confirmation = self.client.get(url)
+        self.assertContains(confirmation, "deleted in the background")
+        self.assertNotContains(confirmation, "Note 0")
+
+        response = self.client.post(url, {'post': 'yes'})
+        self.assertRedirects(response,
+                             reverse('admin:notes_userpurge_changelist'))
+
+        self.user.refresh_from_db()
+        self.assertFalse(self.user.is_active)
+        self.assertEqual(Note.objects.filter(user=self.user).count(), 7)
+
+        changelist = self.client.get(
+            reverse('admin:notes_userpurge_changelist')
+        )
+        self.assertContains(changelist, "leaving")
+        self.assertContains(changelist, "0%")
+
+    def test_purge_users_command(self):
+        """Tests the command finishes every queued deletion."""
+
+        purge.request_user_deletion(self.user)
+        out = StringIO()
+        call_command('purge_users', batch_size=5, pause=0, stdout=out)
+
+        self.assertIn("leaving: deleted 5 of 7 notes", out.getvalue())
+        self.assertIn("Deleted 1 users.", out.getvalue())
+        self.assertFalse(Note.objects.filter(pk__in=[
+            note.pk for note in self.notes
+        ]).exists())
+
+
+class RecordingBroker:
+    """
+    Event broker for tests that records what is published.
+
+    Methods
+    -------
+    has_subscribers(self, user_id):
+        Reports every user as subscribed.
+    publish(self, user_id, event):
+        Records an event.
+    """
+
+    published = []
+
+    def has_subscribers(self, user_id):
+        """Reports every user as subscribed."""
+        return True
+
+    def publish(self, user_id, event):
+        """Records an event."""
+        self.published.append((user_id, event))
+
+
+class LiveEventsTest(QueryBudgetMixin, TestCase):
+    """
+    Tests note changes are published and streamed as Server-Sent
+    Events.
+
+    Methods
+    -------
+    setUp(self):
+        Creates a user and logs them in.
+    test_wsgi_refused(self):
+        Tests WSGI requests are told not to reconnect.
+    test_login_required(self):
+        Tests anonymous users are redirected to the login page.
+    test_changes_published(self):
+        Tests saving and deleting notes publish events after commit.
+    test_bulk_api_publishes(self):
+        Tests bulk API writes publish events too.
+    test_unwatched_changes_not_rendered(self):
+        Tests no cards are rendered or events stored for users without
+        an open noteboard.
+    test_stream_delivers_events(self):
+        Tests the stream sends published events and keep-alives.
+    test_local_broker_unsubscribe(self):
+        Tests closed subscriptions stop receiving events.
+    test_cache_broker(self):
+        Tests the cache broker delivers events in order, waits for
+        events not stored yet and asks for a reload after a gap.
+    test_board_marked_live(self):
+        Tests the noteboard loads the live board script.
+    """
+
+    def setUp(self):
+        """Creates a user and logs them in."""
+
+        cache.clear()
+        RecordingBroker.published = []
+        self.user = User.objects.create_user(username='tester',
+                                             password='testpassword')
+        self.client.login(username='tester', password='testpassword')
+
+    def test_wsgi_refused(self):
+        """Tests WSGI requests are told not to reconnect."""
+
+        response = self.client.get(reverse("note_events"))
+        self.assertEqual(response.status_code, 204)
+
+    def test_login_required(self):
+        """Tests anonymous users are redirected to the login page."""
+
+        self.client.logout()
+        response = self.client.get(reverse("note_events"))
+        self.assertEqual(response.status_code, 302)
+
+    @override_settings(NOTES_EVENTS_BACKEND='notes.tests.RecordingBroker')
+    def test_changes_published(self):
+        """Tests saving and deleting notes publish events after
+        commit."""
+
+        with self.captureOnCommitCallbacks(execute=True):
+            note = Note.objects.create(user=self.user, title="Live",
+                                       content="Live content.")
+            self.assertEqual(RecordingBroker.published, [])
+
+        user_id, event = RecordingBroker.published[0]
+        self.assertEqual(user_id, self.user.pk)
+        self.assertEqual(event["action"], "saved")
+        self.assertEqual(event["id"], note.pk)
+        self.assertIn(f'data-note-id="{note.pk}"', event["html"])
+        self.assertIn("Live", event["html"])
+
+        # The published card is cached for the next board render
+        self.assertEqual(len(board_cache.get_note_cards([note])), 1)
+
+        pk = note.pk
+        with self.captureOnCommitCallbacks(execute=True):
+            note.delete()
+        self.assertEqual(RecordingBroker.published[-1],
+                         (self.user.pk, {"action": "deleted", "id": pk}))
+
+    @override_settings(NOTES_EVENTS_BACKEND='notes.tests.RecordingBroker')
+    def test_bulk_api_publishes(self):
+        """Tests bulk API writes publish events too."""
+
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(
+                reverse("api_notes"),
+                data=json.dumps([{"title": "One", "content": "First."},
+                                 {"title": "Two", "content": "Second."}]),
+                content_type="application/json",
+            )
+        ids = [note["id"] for note in response.json()["results"]]
+        self.assertEqual(
+            [event["id"] for _, event in RecordingBroker.published], ids
+        )
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.delete(reverse("api_notes"),
+                               data=json.dumps({"ids": ids}),
+                               content_type="application/json")
+        self.assertEqual(
+            [event for _, event in RecordingBroker.published[2:]],
+            [{"action": "deleted", "id": pk} for pk in ids],
+        )
+
+    @override_settings(NOTES_EVENTS_BACKEND='notes.events.CacheBroker')
+    def test_unwatched_changes_not_rendered(self):
+        """Tests no cards are rendered or events stored for users
+        without an open noteboard."""
+
+        broker = events.get_broker()
+        with mock.patch.object(events, "render_card",
+                               wraps=events.render_card) as render:
+            with self.captureOnCommitCallbacks(execute=True):
+                note = Note.objects.create(user=self.user, title="Quiet",
+                                           content="Nobody is watching.")
+            render.assert_not_called()
+            self.assertIsNone(cache.get(broker.sequence_key(self.user.pk)))
+
+            broker.subscribe(self.user.pk)
+            with self.captureOnCommitCallbacks(execute=True):
+                note.save()
+            render.assert_called_once()
+            self.assertEqual(cache.get(broker.sequence_key(self.user.pk)), 1)
+
+    @override_settings(NOTES_EVENTS_HEARTBEAT=0.05)
+    async def test_stream_delivers_events(self):
+        """Tests the stream sends published events and keep-alives."""
+
+        await self.async_client.aforce_login(self.user)
+        response = await self.async_client.get(reverse("note_events"))
+        self.assertEqual(response["Content-Type"], "text/event-stream")
+        self.assertEqual(response["Cache-Control"], "no-cache")
+        chunks = aiter(response.streaming_content)
+        self.assertEqual(await anext(chunks), b"retry: 5000\n\n")
+
+        # Events may be published from any thread
+        await sync_to_async(events.get_broker().publish,
+                            thread_sensitive=False)(
+            self.user.pk, {"action": "deleted", "id": 7}
+        )
+        self.assertEqual(
+            await anext(chunks),
+            b'id: 1\nevent: note\ndata: {"action":"deleted","id":7}\n\n',
+        )
+        self.assertEqual(await anext(chunks), b": keep-alive\n\n")
+
+    async def test_local_broker_unsubscribe(self):
+        """Tests closed subscriptions stop receiving events."""
+
+        broker = events.LocalBroker()
+        first = broker.subscribe(1)
+        second = broker.subscribe(1)
+        broker.publish(1, {"action": "deleted", "id": 1})
+        first.close()
+        broker.publish(1, {"action": "deleted", "id": 2})
+
+        self.assertEqual((await first.get(0.1))["id"], 1)
+        self.assertIsNone(await first.get(0.01))
+        self.assertEqual((await second.get(0.1))["id"], 1)
+        self.assertEqual((await second.get(0.1))["id"], 2)
+        second.close()
+        self.assertEqual(broker._subscribers, {})
+
+    @override_settings(NOTES_EVENTS_POLL_INTERVAL=0.01)
+    async def test_cache_broker(self):
+        """Tests the cache broker delivers events in order, waits for
+        events not stored yet and asks for a reload after a gap."""
+
+        broker = events.CacheBroker()
+        subscription = broker.subscribe(5)
+        self.assertIsNone(await subscription.get(0.02))
+
+        broker.publish(5, {"action": "deleted", "id": 1})
+        broker.publish(5, {"action": "deleted", "id": 2})
+        self.assertEqual((await subscription.get(1))["id"], 1)
+        self.assertEqual((await subscription.get(1))["id"], 2)
+
+        # An event numbered but not yet stored is waited for
+        cache.incr(broker.sequence_key(5))
+        self.assertIsNone(await subscription.get(0.05))
+        cache.set(broker.event_key(5, 3), {"action": "deleted", "id": 3})
+        self.assertEqual((await subscription.get(1))["id"], 3)
+
+        # An evicted event cannot be replayed, so the page must reload
+        broker.publish(5, {"action": "deleted", "id": 4})
+        broker.publish(5, {"action": "deleted", "id": 5})
+        cache.delete(broker.event_key(5, 4))
+        self.assertEqual(await subscription.get(1), events.RELOAD_EVENT)
+        self.assertIsNone(await subscription.get(0.05))
+
+    def test_board_marked_live(self):
+        """Tests the noteboard loads the live board script."""
+
+        response = self.client.get(reverse("note_noteboard"))
+        self.assertContains(response, "data-live-board")
+        self.assertContains(response, reverse("note_events"))
+        self.assertContains(response, "notes/js/live_board.js")
+
+        # Search results are not patched live
+        response = self.client.get(reverse("note_search"), {"q": "live"})
+        self.assertNotContains(response, "data-live-board")
+
+
+# Calls made to the test tasks below
+task_calls = []
+
+
+@tasks.background_task()
+def record_task(*args):
+    """Test task recording its arguments."""
+    task_calls.append(list(args))
+
+
+@tasks.background_task(max_attempts=2)
+def failing_task():
+    """Test task that always fails."""
+    raise RuntimeError("Task failed on purpose.")
+
+
+def plain_function():
+    """Function not marked as a background task."""
+
+
+class BackgroundTaskTest(QueryBudgetMixin, TestCase):
+    """
+    Tests deferred work is queued in the database and run by the task
+    worker.
+
+    Methods
+    -------
+    setUp(self):
+        Clears the recorded task calls.
+    test_enqueue_and_run(self):
+        Tests a queued task runs once with its arguments.
+    test_idempotency_key(self):
+        Tests a key queues the same work only once while it is pending.
+    test_delay(self):
+        Tests a delayed task is not run early.
+    test_retry_then_fail(self):
+        Tests a failing task is retried later, then marked failed.
+    test_only_background_tasks_run(self):
+        Tests only decorated functions can be queued or run.
+    test_lost_task_requeued(self):
+        Tests a task running for too long is retried.
+    test_prune_tasks(self):
+        Tests old finished tasks are deleted and failed ones kept.
+    test_user_purge_runs_as_task(self):
+        Tests deleting a user queues a purge task and a search index
+        merge.
+    test_bulk_delete_queues_optimize(self):
+        Tests bulk API deletions queue one search index merge.
+    """
+
+    def setUp(self):
+        """Clears the recorded task calls."""
+
+        cache.clear()
+        task_calls.clear()
+
+    def test_enqueue_and_run(self):
+        """Tests a queued task runs once with its arguments."""
+
+        task = tasks.enqueue(record_task, 1, "two")
+        self.assertEqual(task.name, "notes.tests.record_task")
+        self.assertEqual(task.status, Task.PENDING)
+
+        self.assertEqual(tasks.run_pending(), 1)
+        self.assertEqual(task_calls, [[1, "two"]])
+        task.refresh_from_db()
+        self.assertEqual(task.status, Task.DONE)
+        self.assertEqual(task.attempts, 1)
+        self.assertIsNotNone(task.finished)
+
+        # Nothing is left to run
+        self.assertEqual(tasks.run_pending(), 0)
+
+    def test_idempotency_key(self):
+        """Tests a key queues the same work only once while it is
+        pending."""
+
+        first = tasks.enqueue(record_task, "a", key="work")
+        self.assertEqual(tasks.enqueue(record_task, "a", key="work"), first)
+        self.assertEqual(Task.objects.count(), 1)
+
+        # Once the task has started, the same work can be queued again
+        claimed = tasks.claim_task()
+        second = tasks.enqueue(record_task, "a", key="work")
+        self.assertNotEqual(second, claimed)
+        self.assertEqual(Task.objects.filter(key="work").count(), 2)
+
+    def test_delay(self):
+        """Tests a delayed task is not run early."""
+
+        task = tasks.enqueue(record_task, key="later", delay=60)
+        self.assertEqual(tasks.run_pending(), 0)
+
+        Task.objects.filter(pk=task.pk).update(run_after=timezone.now())
+        self.assertEqual(tasks.run_pending(), 1)
+
+    @override_settings(NOTES_TASK_RETRY_DELAY=30)
+    def test_retry_then_fail(self):
+        """Tests a failing task is retried later, then marked failed."""
+
+        task = tasks.enqueue(failing_task)
+        started = timezone.now()
+        self.assertEqual(tasks.run_pending(), 1)
+
+        task.refresh_from_db()
+        self.assertEqual(task.status, Task.PENDING)
+        self.assertEqual(task.attempts, 1)
+        self.assertIn("Task failed on purpose.", task.error)
+        self.assertGreaterEqual(task.run_after,
+                                started + timedelta(seconds=30))
+
+        # The second attempt is the last one allowed
+        Task.objects.filter(pk=task.pk).update(run_after=timezone.now())
+        self.assertEqual(tasks.run_pending(), 1)
+        task.refresh_from_db()
+        self.assertEqual(task.status, Task.FAILED)
+        self.assertEqual(task.attempts, 2)
+        self.assertIsNotNone(task.finished)
+
+    def test_only_background_tasks_run(self):
+        """Tests only decorated functions can be queued or run."""
+
+        with self.assertRaises(ValueError):
+            tasks.enqueue(plain_function)
+
+        task = Task.objects.create(name="notes.tests.plain_function",
+                                   run_after=timezone.now(), max_attempts=1)
+        tasks.run_pending()
+        task.refresh_from_db()
+        self.assertEqual(task.status, Task.FAILED)
+        self.assertIn("is not a background task", task.error)
+
+    @override_settings(NOTES_TASK_TIMEOUT=60)
+    def test_lost_task_requeued(self):
+        """Tests a task running for too long is retried."""
+
+        task = tasks.enqueue(record_task)
+        tasks.claim_task()
+        self.assertEqual(tasks.requeue_lost_tasks(), 0)
+
+        Task.objects.filter(pk=task.pk).update(
+            started=timezone.now() - timedelta(seconds=120)
+        )
+        self.assertEqual(tasks.requeue_lost_tasks(), 1)
+        task.refresh_from_db()
+        self.assertEqual(task.status, Task.PENDING)
+        self.assertIn("Still running", task.error)
+
+    @override_settings(NOTES_TASK_RETENTION=60)
+    def test_prune_tasks(self):
+        """Tests old finished tasks are deleted and failed ones kept."""
+
+        old = timezone.now() - timedelta(seconds=120)
+        done = Task.objects.create(name="done", run_after=old,
+                                   status=Task.DONE, finished=old)
+        failed = Task.objects.create(name="failed", run_after=old,
+                                     status=Task.FAILED, finished=old)
+        recent = Task.objects.create(name="recent", run_after=old,
+                                     status=Task.DONE,
+                                     finished=timezone.now())
+
+        self.assertEqual(tasks.prune_tasks(), 1)
+        self.assertFalse(Task.objects.filter(pk=done.pk).exists())
+        self.assertEqual(
+            Task.objects.filter(pk__in=[failed.pk, recent.pk]).count(), 2
+        )
+
+    @override_settings(NOTES_PURGE_PAUSE=0)
+    def test_user_purge_runs_as_task(self):
+        """Tests deleting a user queues a purge task and a search index
+        merge."""
+
+        user = User.objects.create_user(username='leaving',
+                                        password='testpassword')
+        for number in range(3):
+            Note.objects.create(user=user, title=f"Note {number}",
+                                content="Leaving content.")
+
+        user_purge = purge.request_user_deletion(user)
+        purge.request_user_deletion(user)
+        task = Task.objects.get()
+        self.assertEqual(task.name, "notes.purge.purge_user")
+        self.assertEqual(task.key, f"purge-user:{user_purge.pk}")
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(tasks.run_pending(), 1)
+
+        self.assertFalse(User.objects.filter(username='leaving').exists())
+        user_purge.refresh_from_db()
+        self.assertIsNotNone(user_purge.finished)
+
+        # The merge waits for any further deletions
+        merge = Task.objects.get(name="notes.search.optimize_index")
+        self.assertGreater(merge.run_after, timezone.now())
+        Task.objects.filter(pk=merge.pk).update(run_after=timezone.now())
+        self.assertEqual(tasks.run_pending(), 1)
+        merge.refresh_from_db()
+        self.assertEqual(merge.status, Task.DONE)
+
+    def test_bulk_delete_queues_optimize(self):
+        """Tests bulk API deletions queue one search index merge."""
+
+        user = User.objects.create_user(username='testuser',
+                                        password='testpassword')
+        self.client.login(username='testuser', password='testpassword')
+        ids = [Note.objects.create(user=user, title=f"Note {number}",
+                                   content="Content.").pk
+               for number in range(4)]
+
+        for pair in (ids[:2], ids[2:]):
+            response = self.client.delete(
+                reverse("api_notes"), data=json.dumps({"ids": pair}),
+                content_type="application/json",
+            )
+            self.assertEqual(response.status_code, 200)
+
+        self.assertEqual(
+            Task.objects.filter(name="notes.search.optimize_index").count(),
+            1,
+        )
+
+
+class TaskRunnerTest(TransactionTestCase):
+    """
+    Tests the worker command runs tasks on its threads. The threads use
+    their own database connections, so this test uses real
+    transactions.
+
+    Methods
+    -------
+    test_run_tasks_command(self):
+        Tests the command runs every due task and reports failures.
+    test_busy_database_outcomes_retried(self):
+        Tests outcomes are still recorded when the database is busy.
+    """
+
+    def test_run_tasks_command(self):
+        """Tests the command runs every due task and reports
+        failures."""
+
+        task_calls.clear()
+        for number in range(3):
+            tasks.enqueue(record_task, number)
+        tasks.enqueue(failing_task)
+
+        out, err = StringIO(), StringIO()
+        call_command('run_tasks', once=True, threads=1, poll_interval=0.01,
+                     stdout=out, stderr=err)
+
+        self.assertEqual(sorted(task_calls), [[0], [1], [2]])
+        self.assertEqual(out.getvalue().count("Finished notes.tests."), 3)
+        self.assertIn("Failed notes.tests.failing_task", err.getvalue())
+        self.assertEqual(Task.objects.filter(status=Task.DONE).count(), 3)
+
+        with self.assertRaises(CommandError):
+            call_command('run_tasks', threads=0)
+
+    def test_busy_database_outcomes_retried(self):
+        """Tests outcomes are still recorded when the database is
+        busy."""
+
+        task_calls.clear()
+        tasks.enqueue(record_task, 1)
+        tasks.enqueue(failing_task)
+
+        # Each kind of outcome is refused once, as a held lock would
+        update = QuerySet.update
+        refused = set()
+
+        def busy_update(queryset, **kwargs):
+            status = kwargs.get("status")
+            if queryset.model is Task and status in (Task.DONE, Task.PENDING):
+                if status not in refused:
+                    refused.add(status)
+                    raise OperationalError("database is locked")
+            return update(queryset, **kwargs)
+
+        with mock.patch.object(QuerySet, "update", busy_update):
+            tasks.TaskRunner(threads=1, poll_interval=0.01).run(once=True)
+
+        self.assertEqual(refused, {Task.DONE, Task.PENDING})
+        self.assertEqual(task_calls, [[1]])
+        self.assertEqual(Task.objects.get(status=Task.DONE).name,
+                         "notes.tests.record_task")
+        failed = Task.objects.get(name="notes.tests.failing_task")
+        self.assertEqual(failed.status, Task.PENDING)
+        self.assertIn("Traceback", failed.error)
+
+
+class ShardingTest(QueryBudgetMixin, TransactionTestCase):
+    """
+    Tests notes are kept on their owners' shards and moved between
+    them. Two shard aliases are added for the tests, backed by
+    temporary files, so this test uses real transactions.
+
+    Methods
+    -------
+    setUpClass(cls):
+        Adds the shard databases and creates their tables.
+    tearDownClass(cls):
+        Removes the shard databases.
+    setUp(self):
+        Creates a user on each shard.
+    make_user(self, shard):
+        Creates a user whose id hashes to the given shard.
+    shard_ids(self, alias, user=None):
+        Returns the ids of the notes on a database.
+    test_router_places_notes_by_user(self):
+        Tests notes are written and read on their owner's shard.
+    test_users_placed_on_creation(self):
+        Tests users are placed when created or when they first write,
+        never while their reads are routed.
+    test_admin_lists_chosen_database(self):
+        Tests the admin lists the notes of the chosen database, not
+        those on the staff member's own shard.
+    test_views_use_shards(self):
+        Tests the note views and API work on the user's shard.
+    test_ids_unique_across_shards(self):
+        Tests new notes get ids no other shard uses.
+    test_legacy_notes_rebalanced(self):
+        Tests notes from before sharding are moved to the hashed shard.
+    test_move_catches_up_changes(self):
+        Tests changes made while a user is copied reach the target.
+    test_moved_user_writes_rejected(self):
+        Tests the source rejects writes once a user has moved.
+    test_note_users_checked(self):
+        Tests the main database rejects notes of unknown users.
+    test_rebalance_command(self):
+        Tests the command's dry run, pinning and option checks.
+    """
+
+    databases = '__all__'
+    shard_aliases = ['shard_1', 'shard_2']
+
+    @classmethod
+    def setUpClass(cls):
+        """Adds the shard databases and creates their tables."""
+
+        cls.shard_dir = tempfile.TemporaryDirectory()
+        for alias in cls.shard_aliases:
+            connections.settings[alias] = {
+                **connections.settings['default'],
+                'NAME': os.path.join(cls.shard_dir.name, f'{alias}.sqlite3'),
+                'TEST': {**connections.settings['default']['TEST'],
+                         'NAME': None},
+            }
+        cls.enterClassContext(override_settings(
+            NOTES_SHARDS=cls.shard_aliases, NOTES_SHARD_ID_BLOCK=10,
+            NOTES_SHARD_MOVE_PAUSE=0,
+        ))
+        for alias in cls.shard_aliases:
+            call_command('migrate', database=alias, verbosity=0)
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        """Removes the shard databases."""
+
+        super().tearDownClass()
+        for alias in cls.shard_aliases:
+            connections[alias].close()
+            del connections[alias]
+            del connections.settings[alias]
+        cls.shard_dir.cleanup()
+        sharding._allocator = None
+
+    def setUp(self):
+        """Creates a user on each shard."""
+
+        # Clear cached placements and noteboards left by earlier tests
+        cache.clear()
+        sharding._allocator = None
+
+        self.first = self.make_user('shard_1')
+        self.second = self.make_user('shard_2')
+
+    def make_user(self, shard):
+        """Creates a user whose id hashes to the given shard."""
+
+        while True:
+            user = User.objects.create_user(
+                username=f'user{User.objects.count()}',
+                password='testpassword',
+            )
+            if sharding.hash_shard(user.pk) == shard:
+                return user
+            user.delete()
+
+    def shard_ids(self, alias, user=None):
+        """Returns the ids of the notes on a database."""
+
+        notes = Note.objects.using(alias).order_by('pk')
+        if user is not None:
+            notes = notes.filter(user_id=user.pk)
+        return list(notes.values_list('pk', flat=True))
+
+    def test_router_places_notes_by_user(self):
+        """Tests notes are written and read on their owner's shard."""
+
+        first_note = Note.objects.create(user=self.first, title="One",
+                                         content="On the first shard.")
+        second_note = Note.objects.create(user=self.second, title="Two",
+                                          content="On the second shard.")
+
+        self.assertEqual(first_note._state.db, 'shard_1')
+        self.assertEqual(second_note._state.db, 'shard_2')
+        self.assertEqual(self.shard_ids('shard_1'), [first_note.pk])
+        self.assertEqual(self.shard_ids('shard_2'), [second_note.pk])
+        self.assertEqual(self.shard_ids('default'), [])
+
+        # Notes reached through their owner, and owners through their
+        # notes, use the right databases
+        self.assertEqual(list(self.second.note_set.all()), [second_note])
+        reloaded = Note.objects.using('shard_2').get(pk=second_note.pk)
+        self.assertEqual(reloaded.user, self.second)
+
+        # Placements are recorded, and users stay on 'default'
+        self.assertEqual(sharding.place_user(self.first.pk), 'shard_1')
+        self.assertEqual(UserShard.objects.count(), 2)
+        self.assertEqual(
+            search.search_notes(self.second, "second")[0].pk, second_note.pk
+        )
+
+    def test_users_placed_on_creation(self):
+        """Tests users are placed when created or when they first write,
+        never while their reads are routed."""
+
+        self.assertEqual(
+            dict(UserShard.objects.values_list('user_id', 'shard')),
+            {self.first.pk: 'shard_1', self.second.pk: 'shard_2'},
+        )
+
+        # A user from before sharding is only placed by a write; until
+        # then each request looks them up, over the views' budgets
+        UserShard.objects.filter(user=self.second).delete()
+        cache.clear()
+        client = Client()
+        client.login(username=self.second.username, password='testpassword')
+        response = client.get(reverse("note_noteboard"))
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(UserShard.objects.filter(user=self.second).exists())
+
+        client.post(reverse("note_create"),
+                    {"title": "Placed", "content": "On a write."})
+        self.assertEqual(UserShard.objects.get(user=self.second).shard,
+                         'shard_2')
+
+        # The command places every remaining user
+        UserShard.objects.all().delete()
+        call_command('rebalance_shards', stdout=StringIO())
+        self.assertEqual(UserShard.objects.count(), 2)
+
+    def test_admin_lists_chosen_database(self):
+        """Tests the admin lists the notes of the chosen database, not
+        those on the staff member's own shard."""
+
+        Note.objects.create(user=self.first, title="First shard",
+                            content="One.")
+        Note.objects.create(user=self.second, title="Second shard",
+                            content="Two.")
+        staff = self.make_user('shard_1')
+        staff.is_staff = staff.is_superuser = True
+        staff.save()
+
+        # The changelist counts every note on the chosen database
+        client = Client()
+        client.force_login(staff)
+        url = reverse("admin:notes_note_changelist")
+        response = client.get(url)
+        self.assertNotContains(response, "First shard")
+        self.assertNotContains(response, "Second shard")
+
+        response = client.get(url, {"database": "shard_2"})
+        self.assertContains(response, "Second shard")
+        self.assertNotContains(response, "First shard")
+
+    def test_views_use_shards(self):
+        """Tests the note views and API work on the user's shard."""
+
+        # Place the user and reserve a block of ids up front, as earlier
+        # requests would have done, so the views run within their budgets
+        sharding.shard_for_user(self.second.pk)
+        sharding.allocate_note_id()
+
+        self.client.login(username=self.second.username,
+                          password='testpassword')
+        response = self.client.post(reverse("note_create"),
+                                    {"title": "Sharded", "content": "Web."})
+        self.assertEqual(response.status_code, 302)
+        note = Note.objects.using('shard_2').get(title="Sharded")
+
+        response = self.client.get(reverse("note_noteboard"))
+        self.assertContains(response, "Sharded")
+        response = self.client.get(reverse("note_read", args=[note.pk]))
+        self.assertContains(response, "Web.")
+
+        # Async requests look the shard up off the event loop
+        async_client = AsyncClient()
+        async_client.cookies = self.client.cookies
+        response = async_to_sync(async_client.get)(reverse("note_noteboard"))
+        self.assertContains(response, "Sharded")
+
+        batch = [{"title": f"Bulk {i}", "content": "Via the API."}
+                 for i in range(3)]
+        response = self.client.post(reverse("api_notes"),
+                                    data=json.dumps(batch),
+                                    content_type="application/json")
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(len(self.shard_ids('shard_2', self.second)), 4)
+        self.assertEqual(self.shard_ids('shard_1'), [])
+
+        response = self.client.get(reverse("note_search"), {"q": "api"})
+        self.assertContains(response, "Bulk 2")
+
+        # Notes on other shards are refused rather than missing
+        other = Note.objects.create(user=self.first, title="Elsewhere",
+                                    content="On the first shard.")
+        response = self.client.get(reverse("note_read", args=[other.pk]),
+                                   follow=True)
+        self.assertContains(response, "You do not have permission")
+        response = self.client.get(reverse("note_read",
+                                           args=[other.pk + 1000]))
+        self.assertEqual(response.status_code, 404)
+
+    def test_ids_unique_across_shards(self):
+        """Tests new notes get ids no other shard uses."""
+
+        notes = []
+        for number in range(12):
+            user = self.first if number % 2 else self.second
+            notes.append(Note.objects.create(user=user, title=f"{number}",
+                                             content="Numbered."))
+
+        ids = [note.pk for note in notes]
+        self.assertEqual(len(set(ids)), 12)
+        self.assertEqual(ids, sorted(ids))
+
+        # Bulk inserts take their ids from the same sequence
+        created = Note.objects.using('shard_1').bulk_create([
+            Note(user=self.first, title="Bulk", content="Bulk.")
+            for _ in range(3)
+        ])
+        self.assertTrue(all(note.pk > max(ids) for note in created))
+
+    def test_legacy_notes_rebalanced(self):
+        """Tests notes from before sharding are moved to the hashed
+        shard."""
+
+        with override_settings(NOTES_SHARDS=[]):
+            legacy = [
+                Note.objects.create(user=self.first, title=f"Old {number}",
+                                    content=f"Legacy note {number}.")
+                for number in range(5)
+            ]
+        # The user existed before sharding was turned on
+        UserShard.objects.filter(user=self.first).delete()
+        cache.clear()
+        self.assertEqual(sharding.shard_for_user(self.first.pk), 'default')
+
+        out = StringIO()
+        call_command('rebalance_shards', batch_size=2, stdout=out)
+        self.assertIn(f"User {self.first.pk}: default -> shard_1",
+                      out.getvalue())
+        self.assertIn("Moved 1 users.", out.getvalue())
+
+        self.assertEqual(self.shard_ids('default'), [])
+        self.assertEqual(self.shard_ids('shard_1'),
+                         [note.pk for note in legacy])
+        self.assertEqual(sharding.shard_for_user(self.first.pk), 'shard_1')
+        self.assertEqual(len(search.search_notes(self.first, "legacy")), 5)
+
+        # Nothing is left to move
+        self.assertEqual(rebalance.plan_rebalance(), [])
+
+    def test_move_catches_up_changes(self):
+        """Tests changes made while a user is copied reach the target."""
+
+        notes = [Note.objects.create(user=self.first, title=f"Note {number}",
+                                     content=f"Content {number}.")
+                 for number in range(5)]
+
+        def progress(copied):
+            """Changes the notes on the source during the copy."""
+            if copied == 2:
+                Note.objects.using('shard_1').filter(pk=notes[0].pk).update(
+                    title="Edited", updated=timezone.now(),
+                )
+                Note.objects.using('shard_1').filter(pk=notes[1].pk).delete()
+                Note.objects.create(user=self.first, title="Late",
+                                    content="Added during the copy.")
+
+        moved = rebalance.move_user(self.first.pk, 'shard_2', batch_size=2,
+                                    progress=progress)
+        self.assertEqual(moved, 5)
+        self.assertEqual(self.shard_ids('shard_1'), [])
+
+        titles = list(Note.objects.using('shard_2').filter(user=self.first)
+                      .order_by('pk').values_list('title', flat=True))
+        self.assertEqual(titles,
+                         ["Edited", "Note 2", "Note 3", "Note 4", "Late"])
+        self.assertEqual(search.search_notes(self.first, "late")[0].title,
+                         "Late")
+
+    def test_moved_user_writes_rejected(self):
+        """Tests the source rejects writes once a user has moved."""
+
+        note = Note.objects.create(user=self.first, title="Moving",
+                                   content="Soon elsewhere.")
+        rebalance.move_user(self.first.pk, 'shard_2')
+        self.assertEqual(UserShard.objects.get(user=self.first).shard,
+                         'shard_2')
+
+        # A process still caching the old placement cannot write there
+        with self.assertRaises(IntegrityError):
+            Note.objects.using('shard_1').create(
+                user=self.first, title="Stale", content="Rejected.",
+            )
+
+        # Moving back lifts the tombstone again
+        rebalance.move_user(self.first.pk, 'shard_1')
+        self.assertEqual(self.shard_ids('shard_1'), [note.pk])
+        Note.objects.create(user=self.first, title="Back", content="Home.")
+        self.assertEqual(len(self.shard_ids('shard_1')), 2)
+
+    def test_note_users_checked(self):
+        """Tests the main database rejects notes of unknown users."""
+
+        unknown = User.objects.order_by('-pk')[0].pk + 1
+        with self.assertRaises(IntegrityError):
+            Note.objects.using('default').create(
+                user_id=unknown, title="Orphan", content="Rejected.",
+            )
+
+        note = Note.objects.using('default').create(
+            user=self.first, title="Owned", content="Accepted.",
+        )
+        with self.assertRaises(IntegrityError):
+            Note.objects.using('default').filter(pk=note.pk).update(
+                user_id=unknown
+            )
+
+        # Shards have no users table to check against
+        Note.objects.using('shard_1').create(
+            user_id=unknown, title="Unchecked", content="Accepted.",
+        )
+
+    def test_rebalance_command(self):
+        """Tests the command's dry run, pinning and option checks."""
+
+        Note.objects.create(user=self.first, title="Pinned",
+                            content="Stays put.")
+
+        out = StringIO()
+        call_command('rebalance_shards', user=self.first.username,
+                     to='shard_2', dry_run=True, stdout=out)
+        self.assertIn("Would move 1 users.", out.getvalue())
+        self.assertEqual(sharding.place_user(self.first.pk), 'shard_1')
+
+        call_command('rebalance_shards', user=self.first.username,
+                     to='shard_2', stdout=StringIO())
+        self.assertEqual(len(self.shard_ids('shard_2', self.first)), 1)
+        self.assertTrue(UserShard.objects.get(user=self.first).pinned)
+
+        # Pinned users are left alone by a full rebalance
+        self.assertEqual(rebalance.plan_rebalance(), [])
+
+        with self.assertRaises(CommandError):
+            call_command('rebalance_shards', to='shard_2')
+        with self.assertRaises(CommandError):
+            call_command('rebalance_shards', user=self.first.username,
+                         to='replica_9')
+        with override_settings(NOTES_SHARDS=[]):
+            with self.assertRaises(CommandError):
+                call_command('rebalance_shards')
+
+
+class SeedNotesTest(TestCase):
+    """
+    Tests the synthetic data generator and the seed_notes command.
+
+    Methods
+    -------
+    seeded_notes(self, prefix):
+        Returns the seeded notes by user number, title and content.
+    test_notes_per_user(self):
+        Tests the notes are shared out by a skewed, repeatable split.
+    test_seed_command(self):
+        Tests the command creates searchable users and notes in bulk.
+    test_repeatable_across_processes(self):
+        Tests the same seed gives the same notes with more processes.
+    """
+
+    def setUp(self):
+        """Clears cached noteboards left by earlier tests."""
+        cache.clear()
+
+    def seeded_notes(self, prefix):
+        """Returns the seeded notes by user number, title and
+        content."""
+
+        notes = Note.objects.filter(user__username__startswith=f'{prefix}-')
+        return sorted(
+            (int(note.user.username.rsplit('-', 1)[1]), note.title,
+             note.content)
+            for note in notes.select_related('user')
+        )
+
+    def test_notes_per_user(self):
+        """Tests the notes are shared out by a skewed, repeatable
+        split."""
+
+        config = seeding.SeedConfig(users=50, notes=1000, seed=3)
+        counts = seeding.notes_per_user(config)
+
+        self.assertEqual(len(counts), 50)
+        self.assertEqual(sum(counts), 1000)
+        self.assertGreater(max(counts), 10 * sorted(counts)[25])
+        self.assertEqual(counts, seeding.notes_per_user(config))
+        self.assertNotEqual(
+            counts,
+            seeding.notes_per_user(seeding.SeedConfig(users=50, notes=1000,
+                                                      seed=4)),
+        )
+
+    def test_seed_command(self):
+        """Tests the command creates searchable users and notes in
+        bulk."""
+
+        out = StringIO()
+        with CaptureQueriesContext(connection) as queries:
+            call_command('seed_notes', users=20, notes=300, batch_size=100,
+                         processes=1, median_length=2000,
+                         unicode_ratio=0.3, stdout=out)
+        self.assertIn("Created 20 users and 300 notes.", out.getvalue())
+
+        # Users and notes are inserted in batches, not one by one
+        inserts = [query for query in queries
+                   if query['sql'].startswith('INSERT INTO "notes_note"')]
+        self.assertEqual(len(inserts), 3)
+
+        users = User.objects.filter(username__startswith='seed-')
+        self.assertEqual(users.count(), 20)
+        self.assertTrue(users.first().check_password(seeding.SEED_PASSWORD))
+
+        notes = Note.objects.all()
+        self.assertEqual(notes.count(), 300)
+        self.assertTrue(notes.filter(content__startswith='zlib$').exists())
+        self.assertTrue(any(
+            not note.content.isascii() for note in notes.only('content')
+        ))
+        note = notes.exclude(content__startswith='zlib$').first()
+        self.assertEqual(note.excerpt, make_excerpt(note.content))
+
+        # The notes are indexed as they are inserted
+        word = note.content.split()[0].strip('.!?')
+        self.assertIn(note, search.search_notes(note.user, word))
+
+        with self.assertRaises(CommandError):
+            call_command('seed_notes', users=1, notes=1, stdout=StringIO())
+
+    def test_repeatable_across_processes(self):
+        """Tests the same seed gives the same notes with more
+        processes."""
+
+        config = seeding.SeedConfig(users=5, notes=2500, seed=7,
+                                    prefix='single')
+        seeding.seed(config, batch_size=500, processes=1)
+        config.prefix = 'forked'
+        seeding.seed(config, batch_size=700, processes=2)
+
+        self.assertEqual(self.seeded_notes('single'),
+                         self.seeded_notes('forked'))
@@ -0,0 +1,505 @@
+# notes/transfer.py
+
+"""
+This module moves notes in and out of the database as JSON Lines, one
+note per line, for the 'export_notes' and 'import_notes' management
+commands and the note download view.
+
+Each line holds a note's title and content and its owner's username,
+so files can be imported into another environment where the users have
+different primary keys:
+
+    {"id": 12, "user": "alice", "title": "Milk", "content": "Buy milk"}
+
+Exports stream the notes with QuerySet.iterator() in primary key order,
+so memory use stays constant however many notes there are. Imports read
+the stream line by line and insert the notes with bulk_create in
+batches, each batch in its own transaction. After every committed batch
+a checkpoint records how many lines have been imported, so an import
+that fails part way can be resumed without inserting notes twice.
+
+Downloads can also be packed into a zip archive on the fly. The archive
+is written to an in-memory buffer that is emptied after every chunk, so
+only one chunk is held at a time.
+"""
+
+import json
+import os
+import zipfile
+from itertools import islice
+from asgiref.sync import sync_to_async
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.db.models import Value
+from .forms import NoteForm
+from .models import Note, make_excerpt
+from .routers import record_write
+from . import board_cache, search, sharding
+
+# Default number of notes fetched per database round trip on export
+DEFAULT_CHUNK_SIZE = 2000
+
+# Default number of notes inserted per transaction on import
+DEFAULT_BATCH_SIZE = 500
+
+# Bytes gathered before a piece of a download is sent
+STREAM_CHUNK_SIZE = 64 * 1024
+
+
+class TransferError(Exception):
+    """
+    Raised when an import line cannot be turned into a note.
+
+    Attributes
+    ----------
+    line_number (int):
+        The 1-based number of the offending line.
+    """
+
+    def __init__(self, line_number, message):
+        """
+        Stores the line number with the message.
+
+        :param line_number: The 1-based number of the offending line.
+        :param message: What is wrong with the line.
+        """
+
+        super().__init__(f"Line {line_number}: {message}")
+        self.line_number = line_number
+
+
+def note_to_line(pk, username, title, content):
+    """
+    Serialises one note as a JSON line.
+
+    :param pk: The note's primary key.
+    :param username: The owner's username.
+    :param title: The note's title.
+    :param content: The note's content.
+    :return: The JSON object followed by a newline.
+    """
+
+    record = {"id": pk, "user": username, "title": title,
+              "content": str(content)}
+    return json.dumps(record, ensure_ascii=False) + "\n"
+
+
+def _export_rows(usernames, user, using):
+    """
+    Returns the queryset of (pk, username, title, content) rows to
+    export, in primary key order.
+
+    A single user's notes are read from the database holding them, with
+    the known username filled in. Shards hold no users, so the notes of
+    a shard are returned with their user_id in place of the username,
+    for _name_rows() to fill in.
+    """
+
+    if user is not None:
+        notes = Note.objects.using(sharding.notes_database(user.pk, using))
+        notes = notes.filter(user_id=user.pk).order_by('pk')
+        if usernames is not None and user.username not in usernames:
+            notes = notes.none()
+        return notes.values_list('pk', Value(user.username), 'title',
+                                 'content')
+
+    notes = Note.objects.using(using).order_by('pk')
+    if using not in sharding.get_shards():
+        if usernames is not None:
+            notes = notes.filter(user__username__in=usernames)
+        return notes.values_list('pk', 'user__username', 'title', 'content')
+
+    if usernames is not None:
+        notes = notes.filter(user_id__in=list(
+            get_user_model().objects.using('default')
+            .filter(username__in=usernames).values_list('pk', flat=True)
+        ))
+    return notes.values_list('pk', 'user_id', 'title', 'content')
+
+
+def _name_rows(rows, user, using):
+    """
+    Fills in the usernames of a chunk of rows read from a shard.
+
+    :param rows: A list of rows from _export_rows().
+    :param user: The user passed to _export_rows().
+    :param using: The database alias passed to _export_rows().
+    :return: The rows, each with its owner's username.
+    """
+
+    if user is not None or using not in sharding.get_shards():
+        return rows
+
+    usernames = dict(
+        get_user_model().objects.using('default')
+        .filter(pk__in={row[1] for row in rows})
+        .values_list('pk', 'username')
+    )
+    return [(pk, usernames.get(user_id, ''), title, content)
+            for pk, user_id, title, content in rows]
+
+
+def export_lines(usernames=None, chunk_size=DEFAULT_CHUNK_SIZE,
+                 using='default', user=None):
+    """
+    Yields every note as a JSON line, in primary key order.
+
+    :param usernames: Only export the notes of these users, or every
+        note if None.
+    :param chunk_size: Number of notes fetched per round trip.
+    :param using: Database alias to read from.
+    :param user: Only export the notes of this user, or every note if
+        None.
+    :return: A generator of JSON lines.
+    """
+
+    rows = _export_rows(usernames, user, using).iterator(chunk_size=chunk_size)
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        for row in _name_rows(chunk, user, using):
+            yield note_to_line(*row)
+        if len(chunk) < chunk_size:
+            break
+
+
+async def aexport_lines(usernames=None, chunk_size=DEFAULT_CHUNK_SIZE,
+                        using='default', user=None):
+    """
+    Async version of export_lines(), fetching each chunk of notes
+    without blocking the event loop.
+
+    :param usernames: Only export the notes of these users, or every
+        note if None.
+    :param chunk_size: Number of notes fetched per round trip.
+    :param using: Database alias to read from.
+    :param user: Only export the notes of this user, or every note if
+        None.
+    :return: An async generator of JSON lines.
+    """
+
+    # QuerySet.aiterator() runs values_list() queries on the event loop,
+    # so advance the sync iterator one chunk at a time in a thread
+    rows = _export_rows(usernames, user, using).iterator(chunk_size=chunk_size)
+    while True:
+        chunk = await sync_to_async(list)(islice(rows, chunk_size))
+        if user is None:
+            chunk = await sync_to_async(_name_rows)(chunk, user, using)
+        for row in chunk:
+            yield note_to_line(*row)
+        if len(chunk) < chunk_size:
+            break
+
+
+def export_notes(stream, usernames=None, chunk_size=DEFAULT_CHUNK_SIZE,
+                 using='default', progress=None):
+    """
+    Writes notes to a text stream as JSON lines.
+
+    :param stream: A writable text stream.
+    :param usernames: Only export the notes of these users, or every
+        note if None.
+    :param chunk_size: Number of notes fetched per round trip.
+    :param using: Database alias to read from.
+    :param progress: Optional callable, given the running total of
+        exported notes after each chunk.
+    :return: The number of notes exported.
+    """
+
+    total = 0
+    for line in export_lines(usernames, chunk_size, using):
+        stream.write(line)
+        total += 1
+        if progress is not None and total % chunk_size == 0:
+            progress(total)
+
+    return total
+
+
+class ChunkBuffer:
+    """
+    A write-only, unseekable byte stream that hands back what has been
+    written so far, used to stream a download as it is built.
+
+    Methods
+    -------
+    write(self, data):
+        Appends bytes to the buffer.
+    flush(self):
+        Does nothing; present for the file interface.
+    take(self):
+        Returns and clears the buffered bytes.
+    """
+
+    def __init__(self):
+        """Starts with an empty buffer."""
+        self._chunks = []
+        self.size = 0
+
+    def write(self, data):
+        """Appends bytes to the buffer."""
+
+        self._chunks.append(bytes(data))
+        self.size += len(data)
+        return len(data)
+
+    def flush(self):
+        """Does nothing; present for the file interface."""
+
+    def take(self):
+        """Returns and clears the buffered bytes."""
+
+        data = b''.join(self._chunks)
+        self._chunks = []
+        self.size = 0
+        return data
+
+
+def encode_lines(lines):
+    """
+    Encodes lines of text as UTF-8, gathered into pieces of about
+    STREAM_CHUNK_SIZE bytes so a download is not sent line by line.
+
+    :param lines: An iterable of text lines.
+    :return: A generator of bytes.
+    """
+
+    buffer = ChunkBuffer()
+    for line in lines:
+        buffer.write(line.encode('utf-8'))
+        if buffer.size >= STREAM_CHUNK_SIZE:
+            yield buffer.take()
+
+    yield buffer.take()
+
+
+async def aencode_lines(lines):
+    """
+    Async version of encode_lines(), for an async iterable of lines.
+
+    :param lines: An async iterable of text lines.
+    :return: An async generator of bytes.
+    """
+
+    buffer = ChunkBuffer()
+    async for line in lines:
+        buffer.write(line.encode('utf-8'))
+        if buffer.size >= STREAM_CHUNK_SIZE:
+            yield buffer.take()
+
+    yield buffer.take()
+
+
+def _open_zip_member(buffer, member_name):
+    """
+    Starts a zip archive in `buffer` with one deflated member.
+
+    :return: An (archive, member) tuple of open file objects.
+    """
+
+    archive = zipfile.ZipFile(buffer, 'w', compression=zipfile.ZIP_DEFLATED)
+    # The size is unknown up front, so allow the member to grow past 4GB
+    member = archive.open(member_name, 'w', force_zip64=True)
+    return archive, member
+
+
+def zip_lines(lines, member_name):
+    """
+    Packs lines of text into a zip archive, yielding the archive in
+    pieces as it is built.
+
+    :param lines: An iterable of text lines.
+    :param member_name: The file name of the lines inside the archive.
+    :return: A generator of bytes.
+    """
+
+    buffer = ChunkBuffer()
+    archive, member = _open_zip_member(buffer, member_name)
+    for line in lines:
+        member.write(line.encode('utf-8'))
+        if buffer.size >= STREAM_CHUNK_SIZE:
+            yield buffer.take()
+
+    member.close()
+    archive.close()
+    yield buffer.take()
+
+
+async def azip_lines(lines, member_name):
+    """
+    Async version of zip_lines(), for an async iterable of lines.
+
+    :param lines: An async iterable of text lines.
+    :param member_name: The file name of the lines inside the archive.
+    :return: An async generator of bytes.
+    """
+
+    buffer = ChunkBuffer()
+    archive, member = _open_zip_member(buffer, member_name)
+    async for line in lines:
+        member.write(line.encode('utf-8'))
+        if buffer.size >= STREAM_CHUNK_SIZE:
+            yield buffer.take()
+
+    member.close()
+    archive.close()
+    yield buffer.take()
+
+
+def parse_line(line_number, line):
+    """
+    Parses and validates one import line.
+
+    :param line_number: The 1-based line number, for error messages.
+    :param line: The raw line.
+    :return: A (username, cleaned fields) tuple.
+    :raises TransferError: If the line is not a valid note.
+    """
+
+    try:
+        record = json.loads(line)
+    except ValueError as error:
+        raise TransferError(line_number, f"Invalid JSON: {error}.")
+    if not isinstance(record, dict):
+        raise TransferError(line_number, "Expected a JSON object.")
+
+    username = record.get("user")
+    if not isinstance(username, str):
+        raise TransferError(line_number, "A username is required.")
+
+    form = NoteForm(data={"title": record.get("title"),
+                          "content": record.get("content")})
+    if not form.is_valid():
+        errors = "; ".join(
+            f"{field}: {' '.join(messages)}"
+            for field, messages in form.errors.items()
+        )
+        raise TransferError(line_number, errors)
+
+    return username, form.cleaned_data
+
+
+def insert_batch(notes, using='default'):
+    """
+    Inserts a batch of notes in one transaction, keeping the search
+    index and the owners' cached noteboards up to date.
+
+    When notes are sharded, the notes are inserted on their owners'
+    shards, in one transaction per shard.
+
+    :param notes: A list of unsaved Note instances.
+    :param using: Database alias to write to.
+    """
+
+    record_write()
+    batches = {}
+    for note in notes:
+        notes_using = sharding.notes_database(note.user_id, using,
+                                              place=True)
+        batches.setdefault(notes_using, []).append(note)
+
+    for notes_using, batch in batches.items():
+        with transaction.atomic(using=notes_using):
+            batch = Note.objects.using(notes_using).bulk_create(batch)
+            search.index_rows(
+                [(note.pk, note.title, note.content) for note in batch],
+                using=notes_using,
+            )
+            for user_id in {note.user_id for note in batch}:
+                board_cache.bump_board_version_on_commit(user_id,
+                                                         notes_using)
+
+
+def read_checkpoint(path):
+    """
+    Returns the number of lines a previous import committed.
+
+    :param path: The checkpoint file.
+    :return: The line count, or 0 if there is no checkpoint.
+    """
+
+    try:
+        with open(path) as checkpoint:
+            return int(checkpoint.read().strip() or 0)
+    except FileNotFoundError:
+        return 0
+
+
+def write_checkpoint(path, lines_done):
+    """
+    Records how many lines have been committed, replacing the file
+    atomically so a crash never leaves it half written.
+
+    :param path: The checkpoint file.
+    :param lines_done: Number of input lines committed so far.
+    """
+
+    temporary = f"{path}.tmp"
+    with open(temporary, "w") as checkpoint:
+        checkpoint.write(str(lines_done))
+    os.replace(temporary, path)
+
+
+def import_notes(stream, batch_size=DEFAULT_BATCH_SIZE, owner=None,
+                 checkpoint=None, using='default', progress=None):
+    """
+    Reads JSON lines from a text stream and inserts them as notes.
+
+    :param stream: A readable text stream of JSON lines.
+    :param batch_size: Number of notes inserted per transaction.
+    :param owner: A user to own every imported note, ignoring the
+        usernames in the file, or None to match users by username.
+    :param checkpoint: Optional path of a checkpoint file. Lines already
+        recorded there are skipped, and it is updated after every
+        committed batch.
+    :param using: Database alias to write to.
+    :param progress: Optional callable, given the running total of
+        imported notes after each batch.
+    :return: The number of notes imported by this call.
+    :raises TransferError: If a line is invalid or names an unknown
+        user. Batches before the line stay committed.
+    """
+
+    users = get_user_model().objects.using(using)
+    owners = {}
+    skip = read_checkpoint(checkpoint) if checkpoint else 0
+    line_number = 0
+    batch = []
+    total = 0
+
+    def flush():
+        """Commits the pending batch and records the checkpoint."""
+
+        nonlocal batch, total
+        if batch:
+            insert_batch(batch, using)
+            total += len(batch)
+            batch = []
+        if checkpoint:
+            write_checkpoint(checkpoint, line_number)
+        if progress is not None:
+            progress(total)
+
+    for line_number, line in enumerate(stream, start=1):
+        # Skip lines committed by an earlier run, and blank lines
+        if line_number <= skip or not line.strip():
+            continue
+
+        username, fields = parse_line(line_number, line)
+        user = owner
+        if user is None:
+            if username not in owners:
+                owners[username] = users.filter(username=username).first()
+            user = owners[username]
+            if user is None:
+                raise TransferError(line_number,
+                                    f"Unknown user '{username}'.")
+
+        batch.append(Note(user=user,
+                          excerpt=make_excerpt(fields["content"]),
+                          **fields))
+        if len(batch) >= batch_size:
+            flush()
+
+    if line_number > skip:
+        flush()
+    return total
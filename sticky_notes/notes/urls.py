@@ -6,22 +6,31 @@ This module defines URL patterns for the Sticky Notes application.
 It creates a list named urlpatterns that contains several URL patterns
 used for routing in the Sticky Notes application. Each URL pattern
 corresponds to a specific view relating to individual CRUD actions as
-well as signing up, logging in, and logging out.
+well as signing up, logging in, and logging out. The JSON API routes
+are served by the views in 'notes.api', and the request metrics by
+the metrics view. Signup and login submissions are rate limited by
+'notes.ratelimit'.
 """
 
 from django.urls import path
 from django.contrib.auth.views import LoginView
-from .views import (note_signup, note_logout, note_noteboard, note_create,
-                    note_read, note_update, note_delete)
+from .views import (note_signup, note_logout, note_noteboard, note_search,
+                    note_create, note_read, note_update, note_delete,
+                    note_download, note_events, note_metrics)
+from .api import api_notes, api_note
+from .hashing import shed_load
+from .ratelimit import rate_limit
 
 urlpatterns = [
     # URL pattern for user signup
     path('signup/', note_signup, name='signup'),
 
-    # URL pattern for user login
+    # URL pattern for user login, rate limited before passwords are checked
     path('accounts/login/',
-         LoginView.as_view(template_name='notes/note_login.html'), name='login'
-         ),
+         rate_limit('login')(shed_load(
+             LoginView.as_view(template_name='notes/note_login.html')
+         )),
+         name='login'),
 
     # URL pattern for user logout
     path('logout/', note_logout, name='logout'),
@@ -29,6 +38,9 @@ urlpatterns = [
     # URL pattern for displaying a list of all notes
     path("", note_noteboard, name="note_noteboard"),
 
+    # URL pattern for searching notes
+    path("note/search/", note_search, name="note_search"),
+
     # URL pattern for creating a new note
     path("note/create/", note_create, name="note_create"),
 
@@ -40,4 +52,19 @@ urlpatterns = [
 
     # URL pattern for deleting an existing note
     path("note/<int:pk>/delete/", note_delete, name="note_delete"),
+
+    # URL pattern for downloading all of the user's notes as a file
+    path("note/download/", note_download, name="note_download"),
+
+    # URL pattern for the Server-Sent Events stream of note changes
+    path("note/events/", note_events, name="note_events"),
+
+    # JSON API URL pattern for listing, creating and bulk changing notes
+    path("api/notes/", api_notes, name="api_notes"),
+
+    # JSON API URL pattern for reading, updating and deleting a note
+    path("api/notes/<int:pk>/", api_note, name="api_note"),
+
+    # URL pattern for the Prometheus request metrics
+    path("metrics/", note_metrics, name="note_metrics"),
 ]
@@ -6,25 +6,56 @@ Notes application as well as signup and logout processes.
 
 Each view function is connected to specific URLs configured to interact
 with the database through Django's ORM to execute CRUD operations. It
-includes views for signing_up, listing all notes, creating a new note,
-reading details of a specific note, updating an existing note, deleting
-a note, and logging out. User feedback is provided through messages as
-required by each process.
+includes views for signing_up, listing all notes, searching notes,
+creating a new note, reading details of a specific note, updating an
+existing note, deleting a note, and logging out. User feedback is
+provided through messages as required by each process. The download
+view streams all of a user's notes as a file, the events view streams
+live note changes to open noteboards, and the metrics view exposes the
+request timings collected by 'notes.metrics'.
+
+The noteboard and note CRUD views are async views using Django's async
+ORM, so under ASGI they run on the event loop without a thread per
+request. Django adapts them automatically when served through WSGI.
+Note writes go through 'notes.writer' so they can be coalesced into
+grouped transactions.
 """
 
-from django.shortcuts import render, get_object_or_404, redirect
+from functools import wraps
+from django.conf import settings
+from django.core.exceptions import PermissionDenied
+from django.core.handlers.asgi import ASGIRequest
+from django.http import Http404, HttpResponse, StreamingHttpResponse
+from django.shortcuts import render, redirect
+from django.template.loader import render_to_string
+from django.utils.safestring import mark_safe
 from django.contrib import messages
-from django.contrib.auth import login, authenticate, logout
+from django.contrib.auth import login, logout
 from django.contrib.auth.decorators import login_required
+from django.contrib.auth.views import redirect_to_login
 from .models import Note
 from .forms import NoteForm
 from .forms import SignUpForm
+from .pagination import akeyset_paginate, parse_cursor
+from .ratelimit import rate_limit
+from .hashing import shed_load
+from .search import search_notes
+from .writer import arun_write
+from .routers import reads_from_replica
+from . import board_cache, events, metrics, sharding, transfer
 
 
+@rate_limit('signup')
+@shed_load
 def note_signup(request):
     """
     View for the signup process.
 
+    Submissions are rate limited per IP address by 'notes.ratelimit',
+    since creating the user hashes the password. The password is hashed
+    once, in the bounded pool in 'notes.hashing', and the new user is
+    logged in directly rather than authenticated again.
+
     :param request: HTTP request object.
     :return: Rendered template with a signup form.
     """
@@ -33,10 +64,9 @@ def note_signup(request):
     if request.method == 'POST':
         form = SignUpForm(request.POST)
         if form.is_valid():
-            form.save()
-            username = form.cleaned_data.get('username')
-            raw_password = form.cleaned_data.get('password1')
-            user = authenticate(username=username, password=raw_password)
+            user = form.save()
+            # The form has just checked the password, so log in without
+            # authenticate(), which would hash it a second time
             login(request, user)
             messages.success(request, ("Welcome to Sticky Notes!"))
             messages.success(
@@ -49,20 +79,174 @@ def note_signup(request):
     return render(request, 'notes/note_signup.html', {'form': form})
 
 
-@login_required
-def note_noteboard(request):
+def async_login_required(view):
+    """
+    Decorator for async views that redirects anonymous users to the
+    login page, like login_required does for sync views.
+
+    The user is loaded with request.auser() and stored back on
+    request.user, so that templates using 'user' do not trigger a
+    synchronous database query from the event loop.
+
+    :param view: The async view function to decorate.
+    :return: The decorated view function.
+    """
+
+    @wraps(view)
+    async def wrapper(request, *args, **kwargs):
+        user = await request.auser()
+        request.user = user
+        if not user.is_authenticated:
+            return redirect_to_login(request.get_full_path())
+        return await view(request, *args, **kwargs)
+
+    return wrapper
+
+
+async def aget_owned_note(request, pk):
+    """
+    Returns a note belonging to the requesting user.
+
+    The note is fetched with a single query filtered on both the
+    primary key and user_id, so the owner's User row is never loaded.
+    Only when that query finds nothing is a second query run to tell a
+    missing note apart from someone else's note; when notes are
+    sharded, every database that may hold notes is checked, as the
+    owner may be on another shard.
+
+    :param request: HTTP request object.
+    :param pk: Primary key of the note.
+    :return: The Note instance, or None if it belongs to another user.
+    :raises Http404: If no note with that primary key exists.
+    """
+
+    try:
+        return await Note.objects.aget(pk=pk, user_id=request.user.pk)
+    except Note.DoesNotExist:
+        for using in sharding.note_databases():
+            if await Note.objects.using(using).filter(pk=pk).aexists():
+                return None
+        raise Http404("No Note matches the given query.")
+
+
+def render_cards(notes, cached):
+    """
+    Returns the HTML card of each note, rendering only the cards that
+    are not cached.
+
+    :param notes: The notes to display, with their 'updated' field
+        loaded.
+    :param cached: Cached cards, as returned by get_note_cards().
+    :return: A (cards, rendered) tuple of the list of every card's HTML
+        and a dictionary of the newly rendered cards to cache.
+    """
+
+    cards = []
+    rendered = {}
+    for note in notes:
+        key = board_cache.note_card_key(note)
+        card = cached.get(key)
+        if card is None:
+            card = rendered[key] = render_to_string(
+                "notes/note_card.html", {"note": note}
+            )
+        cards.append(mark_safe(card))
+
+    return cards, rendered
+
+
+def render_board(request, notes, page=None):
+    """
+    Renders the sticky notes of a noteboard as an HTML fragment.
+
+    The fragment holds no per-request data (such as CSRF tokens), so it
+    can be cached and shared between all of a user's sessions. Each
+    note's card is cached too, so only the cards of notes that changed
+    are rendered again.
+
+    :param request: HTTP request object.
+    :param notes: The notes to display.
+    :param page: Optional KeysetPage used for the page navigation.
+    :return: The rendered HTML, marked as safe.
+    """
+
+    cards, rendered = render_cards(notes, board_cache.get_note_cards(notes))
+    board_cache.set_note_cards(rendered)
+
+    return mark_safe(render_to_string(
+        "notes/note_board.html", {"cards": cards, "page": page},
+        request=request,
+    ))
+
+
+async def arender_board(request, notes, page=None):
+    """
+    Async version of render_board(), reading and writing the cached
+    cards without blocking the event loop.
+
+    :param request: HTTP request object.
+    :param notes: The notes to display.
+    :param page: Optional KeysetPage used for the page navigation.
+    :return: The rendered HTML, marked as safe.
+    """
+
+    cached = await board_cache.aget_note_cards(notes)
+    cards, rendered = render_cards(notes, cached)
+    await board_cache.aset_note_cards(rendered)
+
+    return mark_safe(render_to_string(
+        "notes/note_board.html", {"cards": cards, "page": page},
+        request=request,
+    ))
+
+
+@async_login_required
+async def note_noteboard(request):
     """
-    View to display a list of all notes on the user's noteboard
+    View to display a page of notes on the user's noteboard.
+
+    The board is paginated by keyset: the optional 'after' and 'before'
+    query parameters hold the primary key of the note at the edge of
+    the current page. The rendered page of notes is cached per user
+    under their board version, so unchanged boards are served without
+    querying the notes table; pages read from a replica are not cached,
+    as the replica may still be behind that version. When the board has
+    changed, only the cards of changed notes are rendered again. Only
+    the title, excerpt and updated time of each note are loaded; the
+    full content is left in the database until the note is read or
+    updated.
 
     :param request: HTTP request object.
-    :return: Rendered template with a list of notes.
+    :return: Rendered template with a page of notes.
     """
 
-    notes = Note.objects.filter(user=request.user)
+    after = parse_cursor(request.GET.get("after"))
+    before = parse_cursor(request.GET.get("before"))
+
+    # Serve the board from the cache if this version has been rendered
+    cache_key = await board_cache.aboard_fragment_key(
+        request.user.pk, after, before
+    )
+    board = await board_cache.aget_board_fragment(cache_key)
+    page = None
+    if board is None:
+        page = await akeyset_paginate(
+            Note.objects.filter(user=request.user).only(
+                "id", "title", "excerpt", "updated"
+            ),
+            after=after, before=before,
+        )
+        board = await arender_board(request, page.object_list, page)
+
+        # A lagging replica may not show the change that moved the
+        # board to this version, so only primary reads are cached
+        if not reads_from_replica():
+            await board_cache.aset_board_fragment(cache_key, str(board))
 
     # Creating a context dictionary to pass data
     context = {
-        "notes": notes,
+        "board": mark_safe(board),
+        "page": page,
         "note_title": "List of Notes",
     }
 
@@ -70,7 +254,30 @@ def note_noteboard(request):
 
 
 @login_required
-def note_create(request):
+def note_search(request):
+    """
+    View to display the user's notes matching a full-text search.
+
+    :param request: HTTP request object.
+    :return: Rendered template with the matching notes, best first.
+    """
+
+    query = request.GET.get("q", "").strip()
+    notes = search_notes(request.user, query) if query else []
+
+    # Creating a context dictionary to pass data
+    context = {
+        "board": render_board(request, notes),
+        "notes": notes,
+        "query": query,
+        "note_title": "Search Results",
+    }
+
+    return render(request, "notes/note_list.html", context)
+
+
+@async_login_required
+async def note_create(request):
     """
     View to create a new note.
 
@@ -84,7 +291,7 @@ def note_create(request):
         if form.is_valid():
             note = form.save(commit=False)
             note.user = request.user  # set the user
-            note.save()
+            await arun_write(note.save)
             messages.success(request, (f'"{note.title}" has been created!'))
             return redirect("note_noteboard")
     else:
@@ -93,8 +300,8 @@ def note_create(request):
     return render(request, "notes/note_form.html", {"form": form})
 
 
-@login_required
-def note_read(request, pk):
+@async_login_required
+async def note_read(request, pk):
     """
     View to display details of a specific note.
 
@@ -103,10 +310,10 @@ def note_read(request, pk):
     :return: Rendered template with details of the specified note.
     """
 
-    note = get_object_or_404(Note, pk=pk)
+    note = await aget_owned_note(request, pk)
 
     # Check permissions - give error message if wrong
-    if note.user != request.user:
+    if note is None:
         messages.error(
             request, "You do not have permission to access this note."
         )
@@ -115,8 +322,8 @@ def note_read(request, pk):
     return render(request, "notes/note_read.html", {"note": note})
 
 
-@login_required
-def note_update(request, pk):
+@async_login_required
+async def note_update(request, pk):
     """
     View to update an existing note.
 
@@ -125,10 +332,10 @@ def note_update(request, pk):
     :return: Rendered template for updating the specified note.
     """
 
-    note = get_object_or_404(Note, pk=pk)
+    note = await aget_owned_note(request, pk)
 
     # Check permissions - give error message if wrong
-    if note.user != request.user:
+    if note is None:
         messages.error(
             request, "You do not have permission to edit this note."
         )
@@ -140,7 +347,7 @@ def note_update(request, pk):
         if form.is_valid():
             note = form.save(commit=False)
             note.user = request.user  # set the user
-            note.save()
+            await arun_write(note.save)
             messages.success(request, (f'"{note.title}" has been updated!'))
             return redirect("note_noteboard")
     else:
@@ -149,8 +356,8 @@ def note_update(request, pk):
     return render(request, "notes/note_form.html", {"form": form})
 
 
-@login_required
-def note_delete(request, pk):
+@async_login_required
+async def note_delete(request, pk):
     """
     View to delete an existing note.
 
@@ -159,17 +366,17 @@ def note_delete(request, pk):
     :return: Redirect to the noteboard after deletion.
     """
 
-    note = get_object_or_404(Note, pk=pk)
+    note = await aget_owned_note(request, pk)
 
     # Check permissions - give error message if wrong
-    if note.user != request.user:
+    if note is None:
         messages.error(
             request, "You do not have permission to delete this note."
         )
         return redirect('note_noteboard')
 
     # Process for deleting a note
-    note.delete()
+    await arun_write(note.delete)
     messages.success(request, (f'"{note.title}" has been deleted!'))
     return redirect('note_noteboard')
 
@@ -187,3 +394,136 @@ def note_logout(request):
     logout(request)
     messages.success(request, "You have been successfully logged out.")
     return redirect('login')
+
+
+# Content types of the download formats
+DOWNLOAD_CONTENT_TYPES = {
+    "jsonl": "application/x-ndjson; charset=utf-8",
+    "zip": "application/zip",
+}
+
+
+@login_required
+def note_download(request):
+    """
+    View to download all of the user's notes as a file.
+
+    The 'format' query parameter chooses JSON Lines ('jsonl', the
+    default) or a zip archive holding the JSON Lines file ('zip'). The
+    file is built while it is sent, reading the notes in chunks, so
+    memory use stays flat however many notes the user has. Under ASGI
+    the notes are read with an async iterator, since Django would
+    otherwise read a sync iterator to the end before sending anything.
+    The file can be loaded again with the 'import_notes' command.
+
+    :param request: HTTP request object.
+    :return: Streaming response with the notes as an attachment.
+    :raises Http404: If the format is not supported.
+    """
+
+    file_format = request.GET.get("format", "jsonl")
+    if file_format not in DOWNLOAD_CONTENT_TYPES:
+        raise Http404("Unsupported download format.")
+
+    filename = f"notes-{request.user.username}.jsonl"
+    if isinstance(request, ASGIRequest):
+        lines = transfer.aexport_lines(user=request.user)
+        if file_format == "zip":
+            content = transfer.azip_lines(lines, filename)
+        else:
+            content = transfer.aencode_lines(lines)
+    else:
+        lines = transfer.export_lines(user=request.user)
+        if file_format == "zip":
+            content = transfer.zip_lines(lines, filename)
+        else:
+            content = transfer.encode_lines(lines)
+
+    if file_format == "zip":
+        filename = f"notes-{request.user.username}.zip"
+    response = StreamingHttpResponse(
+        content, content_type=DOWNLOAD_CONTENT_TYPES[file_format]
+    )
+    response["Content-Disposition"] = f'attachment; filename="{filename}"'
+    return response
+
+
+# Default seconds between keep-alive comments on an idle event stream
+DEFAULT_EVENTS_HEARTBEAT = 15
+
+# Milliseconds browsers wait before reconnecting a dropped event stream
+EVENTS_RETRY = 5000
+
+
+@async_login_required
+async def note_events(request):
+    """
+    View streaming changes to the user's notes as Server-Sent Events.
+
+    The noteboard's script listens to this stream and patches the board
+    in place, so open tabs stay current without reloading. Events come
+    from the broker in 'notes.events'. An idle stream gets a comment
+    every NOTES_EVENTS_HEARTBEAT seconds so proxies keep it open.
+
+    Streams need ASGI, where an open stream is only a waiting
+    coroutine. Under WSGI each stream would hold a worker thread, so
+    the view answers with 204 No Content, which tells browsers not to
+    reconnect.
+
+    :param request: HTTP request object.
+    :return: Streaming text/event-stream response.
+    """
+
+    if not isinstance(request, ASGIRequest):
+        return HttpResponse(status=204)
+
+    heartbeat = getattr(settings, 'NOTES_EVENTS_HEARTBEAT',
+                        DEFAULT_EVENTS_HEARTBEAT)
+    subscription = events.get_broker().subscribe(request.user.pk)
+
+    async def stream():
+        """Yields the events, closing the subscription on disconnect."""
+
+        try:
+            yield f"retry: {EVENTS_RETRY}\n\n".encode()
+            number = 0
+            while True:
+                event = await subscription.get(heartbeat)
+                if event is None:
+                    yield b": keep-alive\n\n"
+                    continue
+                number += 1
+                yield events.format_event(number, event)
+        finally:
+            subscription.close()
+
+    response = StreamingHttpResponse(stream(),
+                                     content_type="text/event-stream")
+    response["Cache-Control"] = "no-cache"
+    # Stop proxies such as nginx from buffering the stream
+    response["X-Accel-Buffering"] = "no"
+    return response
+
+
+def note_metrics(request):
+    """
+    View exposing the request timing histograms in the Prometheus text
+    format.
+
+    Only staff users and clients from the NOTES_METRICS_IPS setting,
+    which is empty by default, may read the metrics.
+
+    :param request: HTTP request object.
+    :return: Plain text response with the metrics.
+    :raises PermissionDenied: If the client may not read the metrics.
+    """
+
+    allowed = getattr(settings, "NOTES_METRICS_IPS", [])
+    if not (request.META.get("REMOTE_ADDR") in allowed
+            or request.user.is_staff):
+        raise PermissionDenied
+
+    return HttpResponse(
+        metrics.render_metrics(),
+        content_type="text/plain; version=0.0.4; charset=utf-8",
+    )
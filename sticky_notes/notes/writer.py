@@ -0,0 +1,292 @@
+# notes/writer.py
+
+"""
+This module provides an optional write-coalescing path for note
+mutations.
+
+SQLite allows only one writer at a time, so bursts of note writes from
+many requests queue up on the database lock. When the
+NOTES_WRITE_COALESCING setting is enabled, note mutations are instead
+handed to a single background writer thread. The writer takes the
+waiting operations in small groups and commits each group in one
+transaction, so many requests share a single lock acquisition and
+fsync.
+
+Every operation runs inside its own savepoint within the group, so one
+failing operation does not affect the others. Callers block until their
+group has committed and then receive the operation's return value, or
+its exception, exactly as if they had run it themselves. Each operation
+runs in a copy of the caller's context, so context variables such as
+the request's routing state and timings are seen by the operation just
+as on the calling thread. This keeps the existing redirects and
+messages in the views working unchanged.
+
+A caller that gives up waiting after NOTES_WRITE_TIMEOUT seconds
+cancels its operation if the writer has not started it yet. Once its
+group has started the operation may still commit, even though the
+caller has received a timeout error.
+
+When the setting is disabled, operations simply run on the calling
+thread. The writer is per process: deployments running several worker
+processes have one writer in each.
+"""
+
+import asyncio
+import contextvars
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from .routers import record_write
+
+# Default largest number of operations committed in one transaction
+DEFAULT_BATCH_SIZE = 50
+
+# Default number of seconds the writer waits to fill a batch
+DEFAULT_BATCH_DELAY = 0.002
+
+# Default number of seconds a caller waits for its operation
+DEFAULT_TIMEOUT = 30
+
+
+def is_enabled():
+    """
+    Checks whether note mutations should go through the writer.
+
+    :return: The value of the NOTES_WRITE_COALESCING setting.
+    """
+
+    return getattr(settings, 'NOTES_WRITE_COALESCING', False)
+
+
+class NoteWriter:
+    """
+    A single background thread that commits queued write operations in
+    grouped transactions.
+
+    Attributes
+    ----------
+    batch_size (int):
+        Largest number of operations committed in one transaction.
+    batch_delay (float):
+        Seconds to wait for more operations once the first arrives.
+    batches_committed (int):
+        Number of transactions the writer has committed.
+
+    Methods
+    -------
+    submit(self, func, *args, **kwargs):
+        Queues an operation and returns a Future for its result.
+    stop(self):
+        Stops the writer thread once the queue has drained.
+    """
+
+    def __init__(self, batch_size=DEFAULT_BATCH_SIZE,
+                 batch_delay=DEFAULT_BATCH_DELAY):
+        """
+        Starts the writer thread.
+
+        :param batch_size: Largest number of operations per transaction.
+        :param batch_delay: Seconds to wait to fill a batch.
+        """
+
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self.batches_committed = 0
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(
+            target=self._run, name='note-writer', daemon=True
+        )
+        self._thread.start()
+
+    def submit(self, func, *args, **kwargs):
+        """
+        Queues an operation for the writer thread, to run in a copy of
+        the caller's context.
+
+        :param func: A callable performing the database writes.
+        :param args: Positional arguments for `func`.
+        :param kwargs: Keyword arguments for `func`.
+        :return: A Future resolved once the operation's group commits.
+        """
+
+        future = Future()
+        context = contextvars.copy_context()
+        self._queue.put((future, context, func, args, kwargs))
+        return future
+
+    def stop(self):
+        """Stops the writer thread once the queue has drained."""
+
+        self._queue.put(None)
+        self._thread.join()
+
+    def _next_batch(self):
+        """
+        Waits for the next operation, then gathers any others that
+        arrive within the batch delay.
+
+        :return: A list of queued operations, or None to stop.
+        """
+
+        first = self._queue.get()
+        if first is None:
+            return None
+
+        batch = [first]
+        deadline = time.monotonic() + self.batch_delay
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                item = self._queue.get(timeout=max(remaining, 0))
+            except queue.Empty:
+                break
+            if item is None:
+                # Finish this batch, then stop
+                self._queue.put(None)
+                break
+            batch.append(item)
+
+        return batch
+
+    def _run(self):
+        """Commits batches of operations until stopped."""
+
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                close_old_connections()
+                return
+
+            # Skip operations whose callers timed out and cancelled
+            # them; the rest can no longer be cancelled
+            batch = [item for item in batch
+                     if item[0].set_running_or_notify_cancel()]
+            if not batch:
+                continue
+
+            close_old_connections()
+            outcomes = []
+            try:
+                with transaction.atomic():
+                    for future, context, func, args, kwargs in batch:
+                        # A savepoint per operation isolates failures
+                        try:
+                            with transaction.atomic():
+                                outcomes.append((
+                                    future,
+                                    context.run(func, *args, **kwargs),
+                                    None,
+                                ))
+                        except Exception as error:
+                            outcomes.append((future, None, error))
+            except Exception as error:
+                # The commit itself failed, so every operation failed
+                for future, *_ in batch:
+                    future.set_exception(error)
+                continue
+
+            self.batches_committed += 1
+            for future, result, error in outcomes:
+                if error is None:
+                    future.set_result(result)
+                else:
+                    future.set_exception(error)
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def get_writer():
+    """
+    Returns the process-wide writer, starting it on first use.
+
+    :return: The NoteWriter instance.
+    """
+
+    global _writer
+    with _writer_lock:
+        if _writer is None:
+            _writer = NoteWriter(
+                batch_size=getattr(
+                    settings, 'NOTES_WRITE_BATCH_SIZE', DEFAULT_BATCH_SIZE
+                ),
+                batch_delay=getattr(
+                    settings, 'NOTES_WRITE_BATCH_DELAY', DEFAULT_BATCH_DELAY
+                ),
+            )
+        return _writer
+
+
+def stop_writer():
+    """Stops the process-wide writer if it is running."""
+
+    global _writer
+    with _writer_lock:
+        if _writer is not None:
+            _writer.stop()
+            _writer = None
+
+
+def run_write(func, *args, **kwargs):
+    """
+    Runs a write operation, through the writer if coalescing is enabled.
+    The request is recorded as a write, so its client reads from the
+    primary afterwards.
+
+    :param func: A callable performing the database writes.
+    :param args: Positional arguments for `func`.
+    :param kwargs: Keyword arguments for `func`.
+    :return: The return value of `func`.
+    :raises TimeoutError: If the writer did not finish the operation in
+        NOTES_WRITE_TIMEOUT seconds. The operation is cancelled if it
+        has not started, but otherwise may still commit.
+    :raises Exception: Whatever `func` raised.
+    """
+
+    # Writes on an explicit database bypass the routers, so pin the
+    # client to the primary here
+    record_write()
+    if not is_enabled():
+        return func(*args, **kwargs)
+
+    future = get_writer().submit(func, *args, **kwargs)
+    try:
+        return future.result(
+            timeout=getattr(settings, 'NOTES_WRITE_TIMEOUT', DEFAULT_TIMEOUT)
+        )
+    except TimeoutError:
+        future.cancel()
+        raise
+
+
+async def arun_write(func, *args, **kwargs):
+    """
+    Async version of run_write(), waiting for the writer without
+    blocking the event loop.
+
+    :param func: A callable performing the database writes.
+    :param args: Positional arguments for `func`.
+    :param kwargs: Keyword arguments for `func`.
+    :return: The return value of `func`.
+    :raises TimeoutError: If the writer did not finish the operation in
+        NOTES_WRITE_TIMEOUT seconds. The operation is cancelled if it
+        has not started, but otherwise may still commit.
+    :raises Exception: Whatever `func` raised.
+    """
+
+    record_write()
+    if not is_enabled():
+        return await sync_to_async(func)(*args, **kwargs)
+
+    # Timing out cancels the wrapping asyncio future, which cancels the
+    # queued operation too unless it has started
+    future = get_writer().submit(func, *args, **kwargs)
+    return await asyncio.wait_for(
+        asyncio.wrap_future(future),
+        timeout=getattr(settings, 'NOTES_WRITE_TIMEOUT', DEFAULT_TIMEOUT),
+    )
@@ -6,6 +6,13 @@ ASGI config for sticky_notes project.
 It exposes the ASGI callable as a module-level variable named
 ``application``.
 
+Serve the project through this module, for example with
+``uvicorn sticky_notes.asgi:application``, to get live noteboard
+updates: the 'note_events' Server-Sent Events stream only runs under
+ASGI, where each open stream waits on the event loop instead of holding
+a worker thread. Under WSGI the stream is refused and noteboards simply
+show changes on the next page load.
+
 For more information on this file, see
 https://docs.djangoproject.com/en/5.0/howto/deployment/asgi/
 """
@@ -12,7 +12,9 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.0/ref/settings/
 """
 
+import os
 from pathlib import Path
+from django.core.exceptions import ImproperlyConfigured
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -46,11 +48,14 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     "django.middleware.security.SecurityMiddleware",
+    "notes.middleware.StaticFilesMiddleware",
+    "notes.middleware.RequestMetricsMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
     "django.middleware.csrf.CsrfViewMiddleware",
     "django.contrib.auth.middleware.AuthenticationMiddleware",
     "django.contrib.messages.middleware.MessageMiddleware",
+    "notes.middleware.ReplicaRoutingMiddleware",
     "django.middleware.clickjacking.XFrameOptionsMiddleware",
 ]
 
@@ -58,7 +63,7 @@ ROOT_URLCONF = "sticky_notes.urls"
 
 TEMPLATES = [
     {
-        "BACKEND": "django.template.backends.django.DjangoTemplates",
+        "BACKEND": "notes.metrics.TimedDjangoTemplates",
         "DIRS": [],
         "APP_DIRS": True,
         "OPTIONS": {
@@ -85,6 +90,129 @@ DATABASES = {
     }
 }
 
+# Database profile
+# Set STICKY_NOTES_DB_PROFILE=production to run SQLite in WAL mode with
+# tuned pragmas and persistent, health-checked connections. The pragmas
+# are applied to every new connection by 'notes.signals'.
+DATABASE_PROFILE = os.environ.get("STICKY_NOTES_DB_PROFILE", "development")
+
+if DATABASE_PROFILE == "production":
+    DATABASES["default"].update({
+        "CONN_MAX_AGE": int(os.environ.get("STICKY_NOTES_CONN_MAX_AGE", 600)),
+        "CONN_HEALTH_CHECKS": True,
+    })
+    SQLITE_PRAGMAS = {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "busy_timeout": 5000,
+        "mmap_size": 256 * 1024 * 1024,
+        "cache_size": -64 * 1024,
+        "temp_store": "MEMORY",
+    }
+elif DATABASE_PROFILE == "development":
+    SQLITE_PRAGMAS = {}
+else:
+    raise ImproperlyConfigured(
+        f"Unknown STICKY_NOTES_DB_PROFILE '{DATABASE_PROFILE}'."
+    )
+
+# Read replicas
+# Set STICKY_NOTES_READ_REPLICAS to a comma-separated list of SQLite files
+# holding read-only copies of the primary database. Each one is added as
+# a 'replica_N' alias that the noteboard and note reading views may read
+# from, through 'notes.routers.ReplicaRouter'.
+NOTES_READ_REPLICAS = []
+
+for number, path in enumerate(
+    filter(None, os.environ.get("STICKY_NOTES_READ_REPLICAS", "").split(",")),
+    start=1,
+):
+    alias = f"replica_{number}"
+    DATABASES[alias] = {
+        **DATABASES["default"],
+        "NAME": path.strip(),
+        "TEST": {"MIRROR": "default"},
+    }
+    NOTES_READ_REPLICAS.append(alias)
+
+# Shards
+# Set STICKY_NOTES_SHARDS to a comma-separated list of SQLite files to
+# spread users' notes across. Each one is added as a 'shard_N' alias,
+# and every user's notes are kept on one of them, picked by a hash of
+# their id, through 'notes.routers.ShardRouter'. Users, sessions and
+# everything else stay on 'default'. Run 'migrate --database shard_N'
+# for each new shard and 'rebalance_shards' after changing the list.
+NOTES_SHARDS = []
+
+for number, path in enumerate(
+    filter(None, os.environ.get("STICKY_NOTES_SHARDS", "").split(",")),
+    start=1,
+):
+    alias = f"shard_{number}"
+    DATABASES[alias] = {**DATABASES["default"], "NAME": path.strip()}
+    NOTES_SHARDS.append(alias)
+
+DATABASE_ROUTERS = ["notes.routers.ShardRouter", "notes.routers.ReplicaRouter"]
+
+# Note ids reserved from the shared sequence at a time while sharded
+NOTES_SHARD_ID_BLOCK = 100
+
+# Seconds each user's shard is cached; a move is seen by processes not
+# sharing the cache once this has passed
+NOTES_SHARD_CACHE_TIMEOUT = 60
+
+# Notes copied per transaction, and seconds to pause between batches,
+# while rebalance_shards moves a user
+NOTES_SHARD_MOVE_BATCH_SIZE = 500
+NOTES_SHARD_MOVE_PAUSE = 0.2
+
+# Names of the views whose reads may be served by a replica
+NOTES_REPLICA_VIEWS = ["note_noteboard", "note_read"]
+
+# Seconds a client keeps reading from the primary after writing a note
+NOTES_REPLICA_PIN_SECONDS = 5
+
+
+# Cache
+# https://docs.djangoproject.com/en/5.0/topics/cache/
+# LocMemCache is private to each process, so rendered noteboard pages are
+# only cached once this is a shared backend such as Redis or Memcached
+# (see 'notes.board_cache'); note cards are cached either way
+
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        "LOCATION": "sticky-notes",
+        # Room for every note card on large boards, about 1KB each;
+        # the default of 300 entries would evict them before reuse
+        "OPTIONS": {"MAX_ENTRIES": 10000},
+    }
+}
+
+
+# Password hashing
+# Passwords are checked by PooledModelBackend and hashed by
+# TunablePBKDF2PasswordHasher, both in 'notes.hashing', in a bounded pool
+# of worker threads instead of on the request thread
+AUTHENTICATION_BACKENDS = ["notes.hashing.PooledModelBackend"]
+
+PASSWORD_HASHERS = [
+    "notes.hashing.TunablePBKDF2PasswordHasher",
+    "django.contrib.auth.hashers.PBKDF2SHA1PasswordHasher",
+    "django.contrib.auth.hashers.Argon2PasswordHasher",
+    "django.contrib.auth.hashers.BCryptSHA256PasswordHasher",
+    "django.contrib.auth.hashers.ScryptPasswordHasher",
+]
+
+# PBKDF2 iterations for new hashes. None keeps Django's default; run
+# 'python manage.py tune_password_hasher' for a value suited to the server
+NOTES_PBKDF2_ITERATIONS = None
+
+# Threads hashing passwords, and the most hashes running or waiting before
+# signups and logins get a 503 response. None sizes the pool by CPU count.
+NOTES_HASHING_WORKERS = None
+NOTES_HASHING_QUEUE = None
+
 
 # Password validation
 # docs.djangoproject.com/en/5.0/ref/settings/#auth-password-validators
@@ -140,6 +268,23 @@ STATICFILES_DIRS = [
 
 STATIC_ROOT = BASE_DIR / "static"
 
+# collectstatic writes content-hashed copies of every file with gzip (and,
+# if the brotli package is installed, brotli) variants next to them
+STORAGES = {
+    "default": {
+        "BACKEND": "django.core.files.storage.FileSystemStorage",
+    },
+    "staticfiles": {
+        "BACKEND": "notes.staticfiles.CompressedManifestStaticFilesStorage",
+    },
+}
+
+# Serve the collected files from the app with immutable cache headers
+NOTES_SERVE_STATIC = True
+
+# Seconds browsers may cache static files that have no content hash
+NOTES_STATIC_MAX_AGE = 60
+
 
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.0/ref/settings/#default-auto-field
@@ -150,3 +295,101 @@ DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 # Login
 # After successful login, redirect to the homepage
 LOGIN_REDIRECT_URL = '/'
+
+# Token buckets limiting signup and login submissions, checked before any
+# password is hashed. Each entry is (burst capacity, seconds to refill it)
+# per client IP address and per submitted username.
+NOTES_RATE_LIMITS = {
+    "signup": {"ip": (5, 60)},
+    "login": {"ip": (20, 60), "username": (5, 60)},
+}
+
+
+# Noteboard
+# Number of notes shown on each keyset-paginated noteboard page
+NOTES_PAGE_SIZE = 50
+
+# Number of seconds a rendered noteboard page is kept in the cache
+NOTES_BOARD_CACHE_TIMEOUT = 60 * 60
+
+# Size in bytes from which note content is stored compressed
+NOTES_COMPRESS_THRESHOLD = 4096
+
+
+# Account deletion
+# Users deleted in the admin are deactivated at once; the task worker (or
+# 'python manage.py purge_users') then deletes their notes in batches of
+# this size, pausing between batches so other requests can write
+NOTES_PURGE_BATCH_SIZE = 500
+NOTES_PURGE_PAUSE = 0.2
+
+
+# Background tasks
+# Deferred work is queued in the database and run by 'python manage.py
+# run_tasks' on this many threads, polling for due tasks at this interval
+NOTES_TASK_THREADS = 2
+NOTES_TASK_POLL_INTERVAL = 1.0
+
+# Failed tasks are retried after this many seconds, doubling each time,
+# until they have been tried this many times
+NOTES_TASK_RETRY_DELAY = 10
+NOTES_TASK_MAX_ATTEMPTS = 5
+
+# Seconds after which a running task is assumed lost and retried, and
+# seconds finished tasks are kept
+NOTES_TASK_TIMEOUT = 30 * 60
+NOTES_TASK_RETENTION = 7 * 24 * 60 * 60
+
+# Seconds a queued merge of the search index waits after notes are deleted
+NOTES_SEARCH_OPTIMIZE_DELAY = 5 * 60
+
+
+# Live noteboard updates
+# Broker passing note changes to the Server-Sent Events streams. The local
+# broker only reaches streams in the same process; with several ASGI
+# workers and a shared cache (Redis or Memcached) use
+# "notes.events.CacheBroker", which polls the cache every
+# NOTES_EVENTS_POLL_INTERVAL seconds.
+NOTES_EVENTS_BACKEND = "notes.events.LocalBroker"
+NOTES_EVENTS_POLL_INTERVAL = 0.5
+
+# Seconds between keep-alive comments on idle event streams
+NOTES_EVENTS_HEARTBEAT = 15
+
+
+# Notes API
+# Largest number of notes accepted in one bulk API request
+NOTES_API_MAX_BATCH = 500
+
+
+# Write coalescing
+# Set STICKY_NOTES_WRITE_COALESCING=1 to funnel note writes through a
+# single writer thread that commits them in small grouped transactions
+NOTES_WRITE_COALESCING = (
+    os.environ.get("STICKY_NOTES_WRITE_COALESCING", "0") == "1"
+)
+
+# Largest number of note writes committed in one transaction
+NOTES_WRITE_BATCH_SIZE = 50
+
+# Seconds the writer waits for more writes to join a transaction
+NOTES_WRITE_BATCH_DELAY = 0.002
+
+# Seconds a request waits for its write before giving up
+NOTES_WRITE_TIMEOUT = 30
+
+
+# Instrumentation
+# Add a Server-Timing header with database, template and view times to
+# every response
+NOTES_SERVER_TIMING = True
+
+# Addresses allowed to scrape the metrics endpoint without logging in.
+# Empty by default, so only staff users can read the metrics; behind a
+# reverse proxy every request comes from the proxy's address. Set
+# STICKY_NOTES_METRICS_IPS to a comma-separated list to allow scrapers.
+NOTES_METRICS_IPS = [
+    address.strip() for address in
+    os.environ.get("STICKY_NOTES_METRICS_IPS", "").split(",")
+    if address.strip()
+]